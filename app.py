@@ -4,35 +4,48 @@ DESI Data Inspector - app.py
 
 import io
 import os
-import glob
 import tempfile
 from urllib.parse import urlencode
 import hashlib
-import uuid
 
 import numpy as np
-from astropy.table import Table
-import fitsio
 
-from desispec import inventory
-from desispec.io import read_spectra_parallel, write_spectra, specprod_root
-from desispec.io import findfile
-from desispec.io.meta import get_lastnight
-
-from prospect.viewer import plotspectra
-
-from flask import Flask, request, jsonify, render_template, make_response, Response
-import werkzeug.datastructures.structures
-
-from inspector.auth import conditional_auth
+#- astropy, fitsio, desispec, and prospect are imported only when needed by a
+#- data request, or up front by preload(); see inspector.startup
+from inspector import startup
+
+from flask import (Flask, request, jsonify, render_template, make_response, Response, send_file, send_from_directory,
+                   stream_with_context)
+
+from inspector.auth import conditional_auth, requires_auth
+from inspector.caching import http_cache
+from inspector.compression import compress_response
+from inspector import assets
+from inspector import specbin
+from inspector import stack
+from inspector import attrindex
+from inspector import compare
+from inspector import shards
+from inspector import admission
 from inspector.io import (standardize_specprod, parse_fibers, validate_radec,
-                          load_targets, load_spectra,
+                          load_targets, iter_spectra,
                           filter_table, add_zcat_columns,
-                          MAX_SPECTRA, MAX_SPECTRA_ERROR_MESSAGE)
+                          MAX_SPECTRA, MAX_SPECTRA_ERROR_MESSAGE, TooManySpectraError, DEDUP_COLUMNS)
+from inspector import jobs
+from inspector import memstats
+from inspector import warmup
+from inspector.schema import validate_columns
+from inspector.crossmatch import read_positions, crossmatch
 
 
 app = Flask(__name__)
 app.url_map.strict_slashes = False
+app.after_request(compress_response)
+app.before_request(memstats.before_request)
+app.after_request(memstats.after_request)
+
+if startup.PRELOAD:
+    startup.preload()
 
 ### @app.route("/testargs")
 ### def test_filter():
@@ -80,6 +93,25 @@ Allow: /license
 Allow: /about
 """, mimetype="text/plain")
 
+@app.route("/internal/stats")
+@requires_auth
+def internal_stats():
+    """Per-route memory and timing stats and warm-up reports for all workers; see inspector.memstats"""
+    stats = memstats.collect_stats()
+    stats['warmup'] = warmup.collect_reports()
+    return jsonify(stats)
+
+@app.route("/assets/<string:name>")
+def static_asset(name):
+    """Serve Bokeh/prospect javascript and css extracted by inspector.assets"""
+    if not assets.valid_asset_name(name):
+        return render_template("error.html", code=404, summary='Not Found', message=f'Asset {name} not found'), 404
+
+    response = send_from_directory(assets.ASSETS_DIR, name, max_age=assets.ASSET_MAX_AGE)
+    response.cache_control.public = True
+    response.cache_control.immutable = True
+    return response
+
 def _current_url_as_format(fmt):
     """
     Return current URL with alternate ?format=blah option
@@ -91,7 +123,7 @@ def _current_url_as_format(fmt):
     newurl = f'{base_url}?{options}'
     return newurl
 
-def render_table_html(table, header, description=''):
+def render_table_html(table, header, description='', extra_footer=''):
     """
     TODO: document
     """
@@ -124,9 +156,15 @@ def render_table_html(table, header, description=''):
         url = _current_url_as_format(fmt)
         footer += f' <a href={url}>{fmt}</a>'
 
-    specview_url = _current_url_as_format('html').replace('/targets/', '/spectra/')
-    specfits_url = _current_url_as_format('fits').replace('/targets/', '/spectra/')
-    footer += f'; Spectra <a href="{specview_url}">view</a> <a href="{specfits_url}">fits</a>'
+    if '/targets/' in request.path:
+        specview_url = _current_url_as_format('html').replace('/targets/', '/spectra/')
+        footer += f'; Spectra <a href="{specview_url}">view</a>'
+        #- comparisons only have the overlay viewer
+        if not request.path.startswith('/compare/'):
+            specfits_url = _current_url_as_format('fits').replace('/targets/', '/spectra/')
+            footer += f' <a href="{specfits_url}">fits</a>'
+
+    footer += extra_footer
 
     if 'RA' in table.meta and 'DEC' in table.meta and 'RADIUS' in table.meta:
         ra = table.meta['RA']
@@ -207,7 +245,17 @@ def get_table_format():
 
 def get_spectra_format():
     """Return format option from URL, while checking that it is valid for spectra"""
-    return validate_format(format_type=None, valid_formats=('html', 'fits'))
+    return validate_format(format_type=None, valid_formats=('html', 'fits', 'bin', 'viewer', 'progressive'))
+
+def get_spectra_read_options(format_type):
+    """Return rdspec_kwargs for reading spectra to render in format_type"""
+    rdspec_kwargs = dict(return_redshifts=True)
+    if format_type in ('bin', 'progressive'):
+        rdspec_kwargs['skip_hdus'] = specbin.SKIP_HDUS
+        if request.args.get('model', '').lower() in ('1', 'true', 'yes'):
+            rdspec_kwargs['return_models'] = True
+
+    return rdspec_kwargs
 
 def _format_radec(ra,dec):
     rastr = f'{ra:.4f}'.rstrip('0').rstrip('.')
@@ -228,6 +276,9 @@ def render_table(table, format_type):
         else:
             description = f'{len(table)} targets'
 
+        description += _dedup_description(table)
+        if 'PARTIAL' in table.meta:
+            description += f' (partial result: {table.meta["PARTIAL"]})'
         return render_table_html(table, header, description)
 
     elif format_type == 'json':
@@ -257,6 +308,25 @@ def get_filters():
 
     return filters
 
+def get_dedup():
+    """
+    Return URL dedup option for inspector.io.load_targets, or None; raises ValueError if invalid
+    """
+    dedup = request.args.get('dedup')
+    if dedup is not None:
+        dedup = dedup.lower()
+        if dedup not in DEDUP_COLUMNS:
+            raise ValueError(f"Unsupported dedup='{dedup}'; supported options are {list(DEDUP_COLUMNS)}")
+
+    return dedup
+
+def _dedup_description(table):
+    """Return description suffix reporting rows skipped by dedup, if any"""
+    ndedup = table.meta.get('NDEDUP')
+    if ndedup is None:
+        return ''
+    return f' (best spectrum per target; skipped {ndedup} duplicate rows)'
+
 def get_extra_columns():
     """
     Parse URL request.args to derive extra columns to read from redrock files; return list
@@ -272,6 +342,11 @@ def get_extra_columns():
 
     return xcol
 
+@app.errorhandler(shards.PartialResultError)
+def partial_result_error(err):
+    """Shard failures in coordinator mode; see inspector.shards"""
+    return render_template("error.html", code=502, summary='Bad Gateway', message=str(err)), 502
+
 #-------------------------------------------------------------------------
 #- Inventory of targets
 
@@ -283,46 +358,96 @@ def render_targets(specprod, specgroup, radec=None, targetids=None):
         format_type = get_table_format()
         filters = get_filters()
         xcol = get_extra_columns()
-        t = load_targets(specprod, specgroup, radec=radec, targetids=targetids, filters=filters, xcol=xcol)
+        t = load_targets(specprod, specgroup, radec=radec, targetids=targetids, filters=filters, xcol=xcol,
+                         dedup=get_dedup())
+    except shards.PartialResultError as err:
+        #- in coordinator mode, partial=1 returns the targets from the shards that answered
+        if request.args.get('partial', '').lower() not in ('1', 'true', 'yes'):
+            raise
+        t = err.table
+        t.meta['PARTIAL'] = f'{len(err.failed)} of {err.nshards} shards failed'
     except ValueError as err:
         return render_template("error.html", code=400, summary='Bad Request', message=str(err)), 400
     except KeyError as err:
         msg = f'Column {err} not found'
         return render_template("error.html", code=400, summary='Bad Request', message=msg), 400
 
-    return render_table(t, format_type)
+    response = make_response(render_table(t, format_type))
+    if 'PARTIAL' in t.meta:
+        response.headers[shards.PARTIAL_HEADER] = t.meta['PARTIAL']
+    return response
 
 @app.route("/<string:specprod>/targets/radec/<string:radec>")
 @app.route("/<string:specprod>/targets/healpix/radec/<string:radec>")
 @conditional_auth
+@http_cache
 def target_healpix_radec(specprod, radec):
     return render_targets(specprod, specgroup='healpix', radec=radec)
 
 @app.route("/<string:specprod>/targets/<string:targetids>")
 @app.route("/<string:specprod>/targets/healpix/<string:targetids>")
 @conditional_auth
+@http_cache
 def targets_healpix_targetids(specprod, targetids):
     return render_targets(specprod, specgroup='healpix', targetids=targetids)
 
 @app.route("/<string:specprod>/targets/tiles/radec/<string:radec>")
 @conditional_auth
+@http_cache
 def targets_tiles_radec(specprod, radec):
     return render_targets(specprod, specgroup='tiles', radec=radec)
 
 @app.route("/<string:specprod>/targets/tiles/<string:targetids>")
 @conditional_auth
+@http_cache
 def targets_tiles_targetids(specprod, targetids):
     return render_targets(specprod, specgroup='tiles', targetids=targetids)
 
+def render_crossmatch(specprod, specgroup):
+    """
+    Crossmatch uploaded positions against targets; see inspector.crossmatch
+
+    Positions are the "positions" file of a multipart form upload, or the request body
+    """
+    try:
+        format_type = get_table_format()
+        if 'positions' in request.files:
+            data = request.files['positions'].read()
+        else:
+            data = request.get_data()
+        default_radius = float(request.values.get('radius', 1.0))
+        positions = read_positions(data, default_radius=default_radius)
+        t = crossmatch(positions, specprod, specgroup, xcol=get_extra_columns(), filters=get_filters())
+    except ValueError as err:
+        return render_template("error.html", code=400, summary='Bad Request', message=str(err)), 400
+    except KeyError as err:
+        msg = f'Column {err} not found'
+        return render_template("error.html", code=400, summary='Bad Request', message=msg), 400
+
+    return render_table(t, format_type)
+
+@app.route("/<string:specprod>/crossmatch", methods=['POST'])
+@app.route("/<string:specprod>/crossmatch/healpix", methods=['POST'])
+@conditional_auth
+def crossmatch_healpix(specprod):
+    return render_crossmatch(specprod, specgroup='healpix')
+
+@app.route("/<string:specprod>/crossmatch/tiles", methods=['POST'])
+@conditional_auth
+def crossmatch_tiles(specprod):
+    return render_crossmatch(specprod, specgroup='tiles')
+
 @app.route("/<string:specprod>/targets/<int:tileid>/<string:fibers>")
 @app.route("/<string:specprod>/targets/tiles/<int:tileid>/<string:fibers>")
 @conditional_auth
+@http_cache
 def targets_tiles_fibers(specprod, tileid, fibers):
     specprod = standardize_specprod(specprod)
     try:
         format_type = get_table_format()
         fibers = parse_fibers(fibers)
         xcol = get_extra_columns()
+        validate_columns(specprod, 'tiles', xcol)
     except ValueError as err:
         return render_template("error.html", code=400, summary='Bad Request', message=str(err)), 400
 
@@ -330,6 +455,10 @@ def targets_tiles_fibers(specprod, tileid, fibers):
         msg = 'Fibers must be in 0 <= FIBER < 5000'
         return render_template("error.html", code=400, summary='Bad Request', message=msg), 400
 
+    from astropy.table import Table
+    from desispec.io.meta import get_lastnight
+    from inspector.fitscache import findfile, open_fits
+
     #- Find LASTNIGHT for this tile
     try:
         lastnight = get_lastnight(tileid, specprod=specprod)
@@ -341,7 +470,8 @@ def targets_tiles_fibers(specprod, tileid, fibers):
     fiber2targetid = dict()
     for petal in np.unique(np.asarray(fibers)//500):
         coaddfile = findfile('coadd', tile=tileid, night=lastnight, groupname='cumulative', spectrograph=petal, specprod=specprod)
-        fm = fitsio.read(coaddfile, 'FIBERMAP', columns=('TARGETID', 'FIBER'))
+        with open_fits(coaddfile) as fx:
+            fm = fx['FIBERMAP'].read(columns=('TARGETID', 'FIBER'))
         keep = np.isin(fm['FIBER'], fibers)
         for tid, fiber in zip(fm['TARGETID'][keep], fm['FIBER'][keep]):
             fiber2targetid[fiber] = tid
@@ -369,6 +499,8 @@ def targets_tiles_fibers(specprod, tileid, fibers):
 #- Spectra
 
 def render_spectra_plot(spectra):
+    from prospect.viewer import plotspectra
+
     with tempfile.TemporaryDirectory() as tmpdir:
 
         if 'description' in spectra.meta:
@@ -403,6 +535,11 @@ def render_spectra_plot(spectra):
         with open(prospectfile, 'r') as fp:
             html_content = fp.read()
 
+    #- serve the Bokeh/prospect libraries as cacheable static assets
+    if assets.EXTERNAL_ASSETS:
+        root_url = request.root_url.rstrip('/')
+        html_content = assets.externalize_assets(html_content, f'{root_url}/assets')
+
     download_url = _current_url_as_format('fits')
     table_url = _current_url_as_format('html').replace('/spectra/', '/targets/')
 
@@ -421,6 +558,8 @@ DESI Data Inspector:
     return html_content, 200, {'Content-Type': 'text/html'}
 
 def render_spectra_fits(spectra):
+    from desispec.io import write_spectra
+
     with tempfile.TemporaryDirectory() as tmpdir:
         filename = f'{tmpdir}/spectra.fits'
         write_spectra(filename, spectra)
@@ -438,79 +577,263 @@ def render_spectra_fits(spectra):
 
     return response
 
-def render_spectra(specprod, specgroup, radec=None, targetids=None):
+def render_spectra_bin(spectra):
+    """Return spectra in the compact binary format of inspector.specbin"""
+    data = specbin.encode_spectra(spectra, title=spectra.meta.get('description'))
+    response = make_response(data)
+    response.headers['Content-Type'] = 'application/octet-stream'
+    return response
+
+def render_spectra_viewer():
+    """
+    Return page that fetches this URL with format=bin and plots it in the browser
+    """
+    root_url = request.root_url.rstrip('/')
+    data_url = _current_url_as_format('bin')
+    fits_url = _current_url_as_format('fits')
+    table_url = _current_url_as_format('html').replace('/spectra/', '/targets/')
+    return render_template('specviewer.html', root_url=root_url,
+                           data_url=data_url, fits_url=fits_url, table_url=table_url)
+
+#- marker in specviewer.html where progressive spectra batches are streamed
+PROGRESSIVE_MARKER = '<!-- spectra batches -->'
+
+def render_spectra_progressive(targetcat, specprod, description=''):
+    """
+    Stream a page with the target table followed by spectra as each file is read
+
+    The page shell and targetcat table are sent immediately; each batch of
+    spectra from iter_spectra then follows as a <script> block passing
+    base64 inspector.specbin data to the viewer javascript.
+    """
+    import base64
+
+    table = targetcat.copy()
+    for col in table.colnames:
+        if table[col].dtype.kind == 'f':
+            table[col].format = '{:.4f}'
+
+    with io.StringIO() as buffer:
+        table.write(buffer, format='ascii.html')
+        table_html = buffer.getvalue()
+
+    root_url = request.root_url.rstrip('/')
+    fits_url = _current_url_as_format('fits')
+    table_url = _current_url_as_format('html').replace('/spectra/', '/targets/')
+    page = render_template('specviewer.html', root_url=root_url, progressive=True,
+                           title=description or f'{len(targetcat)} targets', table_html=table_html,
+                           data_url=_current_url_as_format('bin'), fits_url=fits_url, table_url=table_url)
+    head, tail = page.split(PROGRESSIVE_MARKER)
+
+    rdspec_kwargs = get_spectra_read_options('progressive')
+
+    def generate():
+        yield head
+        try:
+            for spectra in iter_spectra(targetcat, specprod, rdspec_kwargs=rdspec_kwargs):
+                data = base64.b64encode(specbin.encode_spectra(spectra)).decode()
+                del spectra
+                yield f'<script>addBatchBase64("{data}");</script>\n'
+        except Exception as err:
+            #- headers are already sent, so report the error to the page instead
+            print(f'ERROR reading spectra: {err}')
+            yield '<script>loadError("Error reading spectra");</script>\n'
+        yield '<script>loadDone();</script>\n'
+        yield tail
+
+    response = Response(stream_with_context(generate()), mimetype='text/html')
+    #- ask nginx not to buffer, so each batch reaches the browser as it is read
+    response.headers['X-Accel-Buffering'] = 'no'
+    #- a read error after the 200 is sent is only reported in the page, so don't cache it
+    response.cache_control.no_store = True
+    return response
+
+def submit_spectra_job(targetcat, specprod):
+    """
+    Submit background job to read spectra for targetcat, returning 202 Accepted
+    response with the job ID and URLs for checking status and downloading
+    """
+    specprod = standardize_specprod(specprod)
     try:
-        format_type = get_spectra_format()
-        filters = get_filters()
-        spectra = load_spectra(specprod, specgroup=specgroup, radec=radec, targetids=targetids, filters=filters)
+        jobid = jobs.submit_spectra_job(targetcat, specprod)
     except ValueError as err:
         return render_template("error.html", code=400, summary='Bad Request', message=str(err)), 400
-    except KeyError as err:
-        msg = f'Column {err} not found'
-        return render_template("error.html", code=400, summary='Bad Request', message=msg), 400
 
-    #- Handle case of no spectra found
-    if spectra is None:
-        if radec is not None:
-            ra,dec,radius = validate_radec(radec)
-            msg = f'No targets found within {radius} arcsec of RA,dec=({ra},{dec})'
+    root_url = request.root_url.rstrip('/')
+    status_url = f'{root_url}/{specprod}/jobs/{jobid}'
+    result = dict(jobid=jobid, status='queued', num_spectra=len(targetcat),
+                  status_url=status_url, download_url=f'{status_url}/download')
+
+    return result, 202, {'Location': status_url}
+
+def render_admission_error(err):
+    """Return 400 response for AdmissionError err if it can never fit, otherwise 503 with Retry-After"""
+    if err.retry_after is None:
+        return render_template("error.html", code=400, summary='Bad Request', message=str(err)), 400
+    else:
+        return (render_template("error.html", code=503, summary='Service Unavailable', message=str(err)),
+                503, {'Retry-After': str(err.retry_after)})
+
+def render_targets_spectra(targetcat, specprod, format_type, description=''):
+    """
+    Read spectra for targetcat within the memory budget and render them as format_type
+
+    Requests too large for the memory budget are run as background jobs
+    (fits) or downgraded to a preview of the first spectra; requests that
+    don't fit alongside other requests in progress wait for them to finish.
+    See inspector.admission.
+    """
+    from inspector.sharedread import read_spectra_shared
+
+    rdspec_kwargs = get_spectra_read_options(format_type)
+    cost = admission.estimate_cost(targetcat, rdspec_kwargs, format_type)
+    if not admission.fits_budget(cost):
+        if format_type == 'fits':
+            return submit_spectra_job(targetcat, specprod)
+
+        npreview = admission.preview_size(targetcat, rdspec_kwargs, format_type)
+        if npreview > 0:
+            print(f'Downgrading to preview of {npreview}/{len(targetcat)} spectra; estimated {cost}')
+            preview = f'preview of first {npreview} of {len(targetcat)} targets'
+            description = f'{description}; {preview}' if description else preview.capitalize()
+            targetcat = targetcat[0:npreview]
+            cost = admission.estimate_cost(targetcat, rdspec_kwargs, format_type)
+
+    try:
+        reservation = admission.admit(cost)
+    except admission.AdmissionError as err:
+        return render_admission_error(err)
+
+    if format_type == 'progressive':
+        #- spectra are read while streaming, so hold the memory until the response is done
+        try:
+            response = render_spectra_progressive(targetcat, specprod, description)
+        except BaseException:
+            reservation.release()
+            raise
+        response.call_on_close(reservation.release)
+        return response
+
+    with reservation:
+        print(f'Reading {len(targetcat)} spectra; estimated {cost}')
+        try:
+            spectra = read_spectra_shared(targetcat, specprod, rdspec_kwargs=rdspec_kwargs)
+        except OSError:
+            if rdspec_kwargs.get('return_models', False):
+                msg = 'Redrock models are not available for these spectra'
+                return render_template("error.html", code=404, summary='Not Found', message=msg), 404
+            raise
+
+        if format_type == 'html':
+            if description:
+                spectra.meta['description'] = description
+            return render_spectra_plot(spectra)
+        elif format_type == 'fits':
+            return render_spectra_fits(spectra)
+        elif format_type == 'bin':
+            if description:
+                spectra.meta['description'] = description
+            return render_spectra_bin(spectra)
         else:
-            msg = f'No targets found with TARGETIDs={targetids}'
+            #- Upstream code should have validated format_type, but catch here just in case
+            msg = f"Unsupportedformat='{format_type}'"
+            return render_template("error.html", code=400, summary='Bad Request', message=msg), 400
 
-        return render_template("error.html", code=400, summary='Not Found', message=str(msg)), 404
+def render_spectra(specprod, specgroup, radec=None, targetids=None):
+    specprod = standardize_specprod(specprod)
+    try:
+        format_type = get_spectra_format()
+        #- the viewer page loads the spectra itself with format=bin
+        if format_type == 'viewer':
+            return render_spectra_viewer()
 
-    if format_type == 'html':
+        filters = get_filters()
+        targetcat = load_targets(specprod, specgroup=specgroup, radec=radec, targetids=targetids, filters=filters,
+                                 dedup=get_dedup())
+        if len(targetcat) > MAX_SPECTRA:
+            raise TooManySpectraError(len(targetcat), MAX_SPECTRA, targetcat=targetcat)
+
+        #- Handle case of no spectra found
+        if len(targetcat) == 0:
+            if radec is not None:
+                ra,dec,radius = validate_radec(radec)
+                msg = f'No targets found within {radius} arcsec of RA,dec=({ra},{dec})'
+            else:
+                msg = f'No targets found with TARGETIDs={targetids}'
+
+            return render_template("error.html", code=400, summary='Not Found', message=str(msg)), 404
+
+        description = ''
         if radec is not None:
             ra,dec,radius = validate_radec(radec)
-            spectra.meta['description'] = f'{len(spectra)} targets within {radius:.1f} arcsec of RA,dec=({ra:.4f},{dec:.4f})'
+            description = f'{len(targetcat)} targets within {radius:.1f} arcsec of RA,dec=({ra:.4f},{dec:.4f})'
 
-        return render_spectra_plot(spectra)
-    elif format_type == 'fits':
-        return render_spectra_fits(spectra)
-    else:
-        #- Upstream code should have validated format_type, but catch here just in case
-        msg = f"Unsupportedformat='{format_type}'"
+        description += _dedup_description(targetcat)
+        return render_targets_spectra(targetcat, specprod, format_type, description)
+
+    except TooManySpectraError as err:
+        #- too many to view, but a FITS download can be run as a background job
+        if format_type == 'fits':
+            return submit_spectra_job(err.targetcat, specprod)
+        else:
+            return render_template("error.html", code=400, summary='Bad Request', message=str(err)), 400
+    except ValueError as err:
+        return render_template("error.html", code=400, summary='Bad Request', message=str(err)), 400
+    except KeyError as err:
+        msg = f'Column {err} not found'
         return render_template("error.html", code=400, summary='Bad Request', message=msg), 400
 
 
 @app.route("/<string:specprod>/spectra/radec/<string:radec>")
 @app.route("/<string:specprod>/spectra/healpix/radec/<string:radec>")
 @conditional_auth
+@http_cache
 def spectra_healpix_radec(specprod, radec):
     return render_spectra(specprod, specgroup='healpix', radec=radec)
 
 @app.route("/<string:specprod>/spectra/<string:targetids>")
 @app.route("/<string:specprod>/spectra/healpix/<string:targetids>")
 @conditional_auth
+@http_cache
 def spectra_healpix_targetids(specprod, targetids):
     return render_spectra(specprod, specgroup='healpix', targetids=targetids)
 
 @app.route("/<string:specprod>/spectra/tiles/radec/<string:radec>")
 @conditional_auth
+@http_cache
 def spectra_tiles_radec(specprod, radec):
     return render_spectra(specprod, specgroup='tiles', radec=radec)
 
 @app.route("/<string:specprod>/spectra/tiles/<string:targetids>")
 @conditional_auth
+@http_cache
 def spectra_tiles_targetids(specprod, targetids):
     return render_spectra(specprod, specgroup='tiles', targetids=targetids)
 
 @app.route("/<string:specprod>/spectra/<int:tileid>/<string:fibers>")
 @app.route("/<string:specprod>/spectra/tiles/<int:tileid>/<string:fibers>")
 @conditional_auth
+@http_cache
 def spectra_tiles_fibers(specprod, tileid, fibers):
     specprod = standardize_specprod(specprod)
     try:
         format_type = get_spectra_format()
         xcol = get_extra_columns()
+        validate_columns(specprod, 'tiles', xcol)
     except ValueError as err:
         return render_template("error.html", code=400, summary='Bad Request', message=str(err)), 400
 
+    if format_type == 'viewer':
+        return render_spectra_viewer()
+
     fibers = parse_fibers(fibers)
-    if len(fibers) > MAX_SPECTRA:
+    if len(fibers) > MAX_SPECTRA and format_type != 'fits':
         msg = MAX_SPECTRA_ERROR_MESSAGE.format(len(fibers), MAX_SPECTRA)
         return render_template("error.html", code=400, summary='Bad Request', message=msg), 400
 
+    from astropy.table import Table
+    from desispec.io.meta import get_lastnight
+
     #- Find LASTNIGHT for this tile
     try:
         lastnight = get_lastnight(tileid, specprod=specprod)
@@ -529,19 +852,410 @@ def spectra_tiles_fibers(specprod, tileid, fibers):
     except ValueError as err:
         return render_template("error.html", code=400, summary='Bad Request', message=str(err)), 400
 
-    print(f'Reading {len(targetcat)} spectra')
-    print(targetcat)
-    spectra = read_spectra_parallel(targetcat, specprod=specprod, rdspec_kwargs=dict(return_redshifts=True))
+    if len(targetcat) > MAX_SPECTRA:
+        return submit_spectra_job(targetcat, specprod)
+
+    return render_targets_spectra(targetcat, specprod, format_type)
+
+#-------------------------------------------------------------------------
+#- Rest-frame stacks of spectra
+
+def _float_arg(name):
+    """Return float URL option name, or None if not given; raises ValueError if invalid"""
+    value = request.args.get(name)
+    if value is None:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        raise ValueError(f'Invalid {name}={value}; should be a number')
+
+def render_stack(specprod, specgroup, radec=None, targetids=None):
+    """
+    Stack spectra of targets selected like render_spectra; see inspector.stack
+
+    Options: method=mean|median, wmin, wmax, dw rest-frame grid [Angstrom],
+    norm=WMIN,WMAX rest-frame normalization window, plus the usual filters
+    """
+    specprod = standardize_specprod(specprod)
+    try:
+        format_type = get_table_format()
+        method = request.args.get('method', 'mean').lower()
+        if method not in stack.METHODS:
+            raise ValueError(f"Unsupported method='{method}'; supported methods are {stack.METHODS}")
+
+        dw = _float_arg('dw')
+        norm = None
+        if 'norm' in request.args:
+            try:
+                norm = tuple(map(float, request.args['norm'].split(',')))
+            except ValueError:
+                norm = ()
+            if len(norm) != 2 or not norm[0] < norm[1]:
+                raise ValueError(f"Invalid norm={request.args['norm']}; should be WMIN,WMAX")
+
+        filters = get_filters()
+        targetcat = load_targets(specprod, specgroup=specgroup, radec=radec, targetids=targetids, filters=filters,
+                                 dedup=get_dedup())
+        if len(targetcat) > stack.MAX_STACK_SPECTRA:
+            raise ValueError(f'{len(targetcat)} spectra is more than the maximum {stack.MAX_STACK_SPECTRA} '
+                             'for a stack; please add filters or split your query')
+
+        grid = stack.rest_grid(targetcat['Z'], wmin=_float_arg('wmin'), wmax=_float_arg('wmax'),
+                               dw=dw if dw is not None else stack.DEFAULT_DW)
+    except ValueError as err:
+        return render_template("error.html", code=400, summary='Bad Request', message=str(err)), 400
+    except KeyError as err:
+        msg = f'Column {err} not found'
+        return render_template("error.html", code=400, summary='Bad Request', message=msg), 400
+
+    if len(targetcat) == 0:
+        msg = 'No targets found'
+        return render_template("error.html", code=404, summary='Not Found', message=msg), 404
+
+    rdspec_kwargs = dict(return_redshifts=True, skip_hdus=specbin.SKIP_HDUS)
+    cost = admission.estimate_cost(targetcat, rdspec_kwargs, 'stack')
+    try:
+        reservation = admission.admit(cost)
+    except admission.AdmissionError as err:
+        return render_admission_error(err)
+
+    with reservation:
+        print(f'Stacking {len(targetcat)} spectra; estimated {cost}')
+        t = stack.stack_spectra(targetcat, specprod, grid, method=method, norm=norm)
 
     if format_type == 'html':
-        return render_spectra_plot(spectra)
-    elif format_type == 'fits':
-        return render_spectra_fits(spectra)
+        header = f'DESI {specprod} production'
+        description = (f'{method.capitalize()} rest-frame stack of {t.meta["NSTACK"]} spectra, '
+                       f'{t.meta["ZMIN"]:.3f} <= z <= {t.meta["ZMAX"]:.3f}')
+        description += _dedup_description(targetcat)
+        return render_table_html(t, header, description)
     else:
-        #- Upstream code should have validated format_type, but catch here just in case
-        msg = f'Unrecognized format {format_type}'
+        return render_table(t, format_type)
+
+@app.route("/<string:specprod>/stack/radec/<string:radec>")
+@app.route("/<string:specprod>/stack/healpix/radec/<string:radec>")
+@conditional_auth
+@http_cache
+def stack_healpix_radec(specprod, radec):
+    return render_stack(specprod, specgroup='healpix', radec=radec)
+
+@app.route("/<string:specprod>/stack/<string:targetids>")
+@app.route("/<string:specprod>/stack/healpix/<string:targetids>")
+@conditional_auth
+@http_cache
+def stack_healpix_targetids(specprod, targetids):
+    return render_stack(specprod, specgroup='healpix', targetids=targetids)
+
+@app.route("/<string:specprod>/stack/tiles/radec/<string:radec>")
+@conditional_auth
+@http_cache
+def stack_tiles_radec(specprod, radec):
+    return render_stack(specprod, specgroup='tiles', radec=radec)
+
+@app.route("/<string:specprod>/stack/tiles/<string:targetids>")
+@conditional_auth
+@http_cache
+def stack_tiles_targetids(specprod, targetids):
+    return render_stack(specprod, specgroup='tiles', targetids=targetids)
+
+#-------------------------------------------------------------------------
+#- Production-wide queries resolved through secondary indexes
+
+def _int_arg(name, default):
+    """Return int URL option name, or default if not given; raises ValueError if invalid"""
+    value = request.args.get(name)
+    if value is None:
+        return default
+    try:
+        return int(value)
+    except ValueError:
+        raise ValueError(f'Invalid {name}={value}; should be an integer')
+
+def _current_url_with_offset(offset):
+    """Return current URL with alternate ?offset=N option"""
+    args = request.args.copy()
+    args['offset'] = offset
+    return f'{request.base_url}?{urlencode(args)}'
+
+def render_query(specprod, specgroup):
+    """
+    Page of targets matching UPPERCASE filters anywhere in the production; see inspector.attrindex
+
+    Options: offset, limit for pagination, xcol for additional columns
+    """
+    try:
+        format_type = get_table_format()
+        offset = _int_arg('offset', 0)
+        limit = _int_arg('limit', attrindex.QUERY_LIMIT)
+        xcol = request.args['xcol'].split(',') if 'xcol' in request.args else []
+        t = attrindex.query(specprod, specgroup, filters=get_filters(), xcol=xcol, offset=offset, limit=limit)
+    except ValueError as err:
+        return render_template("error.html", code=400, summary='Bad Request', message=str(err)), 400
+    except KeyError as err:
+        msg = f'Column {err} not found'
+        return render_template("error.html", code=400, summary='Bad Request', message=msg), 400
+    except attrindex.IndexNotBuiltError as err:
+        return render_template("error.html", code=503, summary='Service Unavailable', message=str(err)), 503
+
+    if format_type == 'html':
+        header = f'DESI {t.meta["SPECPROD"]} production'
+        nmatch = t.meta['NMATCH']
+        if len(t) > 0:
+            description = f'Targets {offset+1}-{offset+len(t)} of {nmatch} matching the filters'
+        elif nmatch > 0:
+            description = f'offset={offset} is past the {nmatch} targets matching the filters'
+        else:
+            description = 'No targets match the filters'
+
+        links = ''
+        if offset > 0:
+            links += f'; <a href="{_current_url_with_offset(max(0, offset-limit))}">previous</a>'
+        if 'NEXT_OFFSET' in t.meta:
+            links += f'; <a href="{_current_url_with_offset(t.meta["NEXT_OFFSET"])}">next</a>'
+
+        return render_table_html(t, header, description, extra_footer=links)
+    else:
+        return render_table(t, format_type)
+
+@app.route("/<string:specprod>/query")
+@app.route("/<string:specprod>/query/healpix")
+@conditional_auth
+@http_cache
+def query_healpix(specprod):
+    return render_query(specprod, specgroup='healpix')
+
+@app.route("/<string:specprod>/query/tiles")
+@conditional_auth
+@http_cache
+def query_tiles(specprod):
+    return render_query(specprod, specgroup='tiles')
+
+#-------------------------------------------------------------------------
+#- Comparisons of the same targets across productions
+
+def _compare_description(comparison):
+    """Return description of compare_targets table with the number of targets per production"""
+    specprods = comparison.meta['SPECPRODS'].split(',')
+    counts = ', '.join(f'{comparison.meta["NTARGETS" + compare.suffix(p)]} in {p}' for p in specprods)
+    if 'RADIUS' in comparison.meta:
+        radius = comparison.meta['RADIUS']
+        radius_str = f'{radius:.1f}'.rstrip('0').rstrip('.')
+        radec = _format_radec(comparison.meta['RA'], comparison.meta['DEC'])
+        description = f'{len(comparison)} targets within {radius_str} arcsec of RA,dec={radec}'
+    else:
+        description = f'{len(comparison)} targets'
+
+    description += f' ({counts})'
+    if get_dedup() is not None:
+        description += ' (best spectrum per target in each production)'
+
+    return description
+
+def render_compare_targets(specprods, specgroup, radec=None, targetids=None):
+    """
+    Table joining targets of specprods, with per-production columns suffixed by production name
+    """
+    try:
+        format_type = get_table_format()
+        xcol = get_extra_columns()
+        t = compare.compare_targets(specprods, specgroup, radec=radec, targetids=targetids,
+                                    filters=get_filters(), xcol=xcol, dedup=get_dedup())
+    except ValueError as err:
+        return render_template("error.html", code=400, summary='Bad Request', message=str(err)), 400
+    except KeyError as err:
+        msg = f'Column {err} not found'
+        return render_template("error.html", code=400, summary='Bad Request', message=msg), 400
+
+    if format_type == 'html':
+        header = f'DESI {t.meta["SPECPROD"]} productions'
+        return render_table_html(t, header, _compare_description(t))
+    else:
+        return render_table(t, format_type)
+
+def render_compare_spectra(specprods, specgroup, radec=None, targetids=None):
+    """
+    Stream viewer page overlaying the spectra of each target from each of specprods
+
+    Like format=progressive for a single production, with the spectra of
+    all productions read concurrently.
+    """
+    import base64
+
+    try:
+        validate_format(format_type=None, valid_formats=('html', 'viewer', 'progressive'))
+        dedup = get_dedup()
+        comparison = compare.compare_targets(specprods, specgroup, radec=radec, targetids=targetids,
+                                             filters=get_filters(), dedup=dedup)
+        specprods = comparison.meta['SPECPRODS'].split(',')
+        targetcats = compare.split_targets(comparison, specgroup, specprods)
+        nspec = sum(len(t) for t in targetcats.values())
+        if nspec > MAX_SPECTRA:
+            raise TooManySpectraError(nspec, MAX_SPECTRA)
+    except ValueError as err:
+        return render_template("error.html", code=400, summary='Bad Request', message=str(err)), 400
+    except KeyError as err:
+        msg = f'Column {err} not found'
         return render_template("error.html", code=400, summary='Bad Request', message=msg), 400
 
+    if nspec == 0:
+        msg = f'No targets found in {comparison.meta["SPECPROD"]}'
+        return render_template("error.html", code=404, summary='Not Found', message=msg), 404
+
+    #- each production is read with its own iter_spectra, so their memory adds up
+    rdspec_kwargs = get_spectra_read_options('progressive')
+    costs = [admission.estimate_cost(t, rdspec_kwargs, 'progressive') for t in targetcats.values()]
+    cost = admission.SpectraCost(sum(c.nspec for c in costs), sum(c.nfiles for c in costs),
+                                 sum(c.bytes_read for c in costs), sum(c.peak_bytes for c in costs))
+    with io.StringIO() as buffer:
+        table = comparison.copy()
+        for col in table.colnames:
+            if table[col].dtype.kind == 'f':
+                table[col].format = '{:.4f}'
+        table.write(buffer, format='ascii.html')
+        table_html = buffer.getvalue()
+
+    #- spectra of a target are overlaid if they match on these metadata columns;
+    #- specbin sends TARGETID as a string, so it is exact in javascript
+    if dedup is not None:
+        overlay_keys = ['TARGETID']
+    elif specgroup == 'tiles':
+        overlay_keys = ['TARGETID', 'TILEID', 'FIBER']
+    else:
+        overlay_keys = ['TARGETID', 'SURVEY', 'PROGRAM']
+
+    root_url = request.root_url.rstrip('/')
+    table_url = _current_url_as_format('html').replace('/spectra/', '/targets/')
+    page = render_template('specviewer.html', root_url=root_url, progressive=True,
+                           title=_compare_description(comparison), table_html=table_html,
+                           overlay_keys=overlay_keys, labels=specprods,
+                           data_url=None, fits_url=None, table_url=table_url)
+    head, tail = page.split(PROGRESSIVE_MARKER)
+
+    def generate():
+        yield head
+        spectra_iter = compare.iter_compare_spectra(targetcats, rdspec_kwargs=rdspec_kwargs)
+        try:
+            for specprod, spectra in spectra_iter:
+                data = base64.b64encode(specbin.encode_spectra(spectra, label=specprod)).decode()
+                yield f'<script>addBatchBase64("{data}");</script>\n'
+        except Exception as err:
+            #- headers are already sent, so report the error to the page instead
+            print(f'ERROR reading spectra: {err}')
+            yield '<script>loadError("Error reading spectra");</script>\n'
+        finally:
+            spectra_iter.close()
+        yield '<script>loadDone();</script>\n'
+        yield tail
+
+    #- reserve memory only once nothing else can fail before the response is
+    #- returned, since the reservation is released when the response closes
+    try:
+        reservation = admission.admit(cost)
+    except admission.AdmissionError as err:
+        return render_admission_error(err)
+
+    response = Response(stream_with_context(generate()), mimetype='text/html')
+    response.headers['X-Accel-Buffering'] = 'no'
+    #- like render_spectra_progressive, read errors are only reported in the page
+    response.cache_control.no_store = True
+    response.call_on_close(reservation.release)
+    return response
+
+@app.route("/compare/<string:specprods>/targets/radec/<string:radec>")
+@app.route("/compare/<string:specprods>/targets/healpix/radec/<string:radec>")
+@conditional_auth
+@http_cache
+def compare_targets_healpix_radec(specprods, radec):
+    return render_compare_targets(specprods, specgroup='healpix', radec=radec)
+
+@app.route("/compare/<string:specprods>/targets/<string:targetids>")
+@app.route("/compare/<string:specprods>/targets/healpix/<string:targetids>")
+@conditional_auth
+@http_cache
+def compare_targets_healpix_targetids(specprods, targetids):
+    return render_compare_targets(specprods, specgroup='healpix', targetids=targetids)
+
+@app.route("/compare/<string:specprods>/targets/tiles/radec/<string:radec>")
+@conditional_auth
+@http_cache
+def compare_targets_tiles_radec(specprods, radec):
+    return render_compare_targets(specprods, specgroup='tiles', radec=radec)
+
+@app.route("/compare/<string:specprods>/targets/tiles/<string:targetids>")
+@conditional_auth
+@http_cache
+def compare_targets_tiles_targetids(specprods, targetids):
+    return render_compare_targets(specprods, specgroup='tiles', targetids=targetids)
+
+@app.route("/compare/<string:specprods>/spectra/radec/<string:radec>")
+@app.route("/compare/<string:specprods>/spectra/healpix/radec/<string:radec>")
+@conditional_auth
+@http_cache
+def compare_spectra_healpix_radec(specprods, radec):
+    return render_compare_spectra(specprods, specgroup='healpix', radec=radec)
+
+@app.route("/compare/<string:specprods>/spectra/<string:targetids>")
+@app.route("/compare/<string:specprods>/spectra/healpix/<string:targetids>")
+@conditional_auth
+@http_cache
+def compare_spectra_healpix_targetids(specprods, targetids):
+    return render_compare_spectra(specprods, specgroup='healpix', targetids=targetids)
+
+@app.route("/compare/<string:specprods>/spectra/tiles/radec/<string:radec>")
+@conditional_auth
+@http_cache
+def compare_spectra_tiles_radec(specprods, radec):
+    return render_compare_spectra(specprods, specgroup='tiles', radec=radec)
+
+@app.route("/compare/<string:specprods>/spectra/tiles/<string:targetids>")
+@conditional_auth
+@http_cache
+def compare_spectra_tiles_targetids(specprods, targetids):
+    return render_compare_spectra(specprods, specgroup='tiles', targetids=targetids)
+
+#-------------------------------------------------------------------------
+#- Background jobs for requests too large to handle interactively
+
+@app.route("/<string:specprod>/jobs/<string:jobid>")
+@conditional_auth
+def job_status(specprod, jobid):
+    try:
+        status = jobs.read_status(jobid)
+    except ValueError as err:
+        return render_template("error.html", code=400, summary='Bad Request', message=str(err)), 400
+
+    specprod = standardize_specprod(specprod)
+    if status is None or status['specprod'] != specprod:
+        msg = f'Job {jobid} not found; it may have expired'
+        return render_template("error.html", code=404, summary='Not Found', message=msg), 404
+
+    if status['status'] == 'done':
+        status['download_url'] = request.base_url.rstrip('/') + '/download'
+
+    return jsonify(status)
+
+@app.route("/<string:specprod>/jobs/<string:jobid>/download")
+@conditional_auth
+def job_download(specprod, jobid):
+    try:
+        status = jobs.read_status(jobid)
+    except ValueError as err:
+        return render_template("error.html", code=400, summary='Bad Request', message=str(err)), 400
+
+    specprod = standardize_specprod(specprod)
+    if status is None or status['specprod'] != specprod:
+        msg = f'Job {jobid} not found; it may have expired'
+        return render_template("error.html", code=404, summary='Not Found', message=msg), 404
+
+    if status['status'] != 'done':
+        msg = f"Job {jobid} is {status['status']}; results are not available for download"
+        return render_template("error.html", code=409, summary='Conflict', message=msg), 409
+
+    filename = jobs.results_filename(jobid)
+    return send_file(filename, mimetype='application/x-tar',
+                     as_attachment=True, download_name=os.path.basename(filename))
+
 if __name__ == "__main__":
     app.run(debug=True, port=5500)
 
@@ -0,0 +1,10 @@
+"""
+gunicorn settings, read from the working directory when gunicorn starts;
+command line options take precedence
+"""
+
+def post_worker_init(worker):
+    """Warm this worker's caches in the background once it has loaded the app; see inspector.warmup"""
+    from inspector import warmup
+    if warmup.WARMUP:
+        warmup.start(worker.wsgi)
@@ -0,0 +1,335 @@
+"""
+inspector.admission
+===================
+
+Memory-aware admission control for spectra requests.
+
+estimate_cost runs after load_targets and predicts the bytes read from disk
+and the peak memory needed to read and render the spectra, based on the
+number of spectra, the number of source files, which HDUs are read, and the
+output format.  admit() then reserves that memory against a per-worker
+budget and an optional budget shared by all workers on the node, waiting
+for other requests to finish if needed.  Requests that could never fit can
+be downgraded to a preview of the first spectra with preview_size.
+
+The global budget is tracked in a small json ledger file locked with
+fcntl, with entries for dead processes pruned automatically.
+
+The cost constants are rough upper bounds for real DESI coadds; tune them
+with inspector.benchmark and inspector.loadtest.
+"""
+
+import os
+import json
+import time
+import fcntl
+import tempfile
+import threading
+import itertools
+import collections
+
+import numpy as np
+
+#- memory budgets [MB]; 0 disables the corresponding limit
+WORKER_MEMORY_MB = int(os.getenv('DESI_INSPECTOR_WORKER_MEMORY_MB', 8192))
+GLOBAL_MEMORY_MB = int(os.getenv('DESI_INSPECTOR_GLOBAL_MEMORY_MB', 0))
+
+#- seconds to wait for memory from other requests before giving up
+ADMISSION_WAIT = float(os.getenv('DESI_INSPECTOR_ADMISSION_WAIT', 20))
+
+LEDGER_FILE = os.getenv('DESI_INSPECTOR_ADMISSION_LEDGER',
+                        os.path.join(tempfile.gettempdir(), 'desi-inspector-admission.json'))
+
+#- wavelength bins per spectrum summed over b,r,z cameras in DESI coadds
+NWAVE = 2751 + 2326 + 2881
+
+#- bytes per wavelength bin for each HDU read by desispec.io.read_spectra
+PIXEL_BYTES = dict(FLUX=4, IVAR=4, MASK=4, RESOLUTION=11*4, MODEL=4)
+
+#- fibermap, redshift, and scores rows per spectrum [bytes]
+ROW_BYTES = 4000
+
+#- headers and full FIBERMAP/EXP_FIBERMAP read per file [bytes]
+FILE_BYTES = 4*1024**2
+
+#- peak memory relative to the spectra data for each output format: reading
+#- in a process pool and stacking copies the data; prospect/bokeh html
+#- serializes every float as text; stacks resample a chunk at a time
+PEAK_FACTOR = dict(html=6.0, fits=3.0, bin=3.5, progressive=4.0, stack=4.0)
+
+#- formats that only hold the few files being read in memory; see
+#- inspector.io.iter_spectra
+STREAMING_FORMATS = ('progressive', 'stack')
+
+class SpectraCost(object):
+    """
+    Estimated cost of reading and rendering spectra
+
+    Attributes: nspec, nfiles, bytes_read, peak_bytes
+    """
+    def __init__(self, nspec, nfiles, bytes_read, peak_bytes):
+        self.nspec = nspec
+        self.nfiles = nfiles
+        self.bytes_read = int(bytes_read)
+        self.peak_bytes = int(peak_bytes)
+
+    def __str__(self):
+        return (f'{self.nspec} spectra from {self.nfiles} files: '
+                f'~{self.bytes_read/1024**2:.0f} MB read, '
+                f'~{self.peak_bytes/1024**2:.0f} MB peak memory')
+
+class AdmissionError(RuntimeError):
+    """
+    Request can't be admitted within the memory budget
+
+    retry_after is None if the request can never fit, otherwise a
+    suggested number of seconds to wait before retrying.
+    """
+    def __init__(self, message, cost, retry_after=None):
+        super().__init__(message)
+        self.cost = cost
+        self.retry_after = retry_after
+
+def _file_columns(targetcat):
+    """Return column values that identify which file each target is read from"""
+    colnames = targetcat.colnames
+    if 'HEALPIX' in colnames:
+        keys = ['HEALPIX', 'SURVEY', 'PROGRAM']
+    else:
+        keys = ['TILEID', 'LASTNIGHT', 'PETAL_LOC']
+
+    columns = list()
+    for key in keys:
+        if key in colnames:
+            columns.append(np.asarray(targetcat[key]))
+        elif key == 'PETAL_LOC' and 'FIBER' in colnames:
+            columns.append(np.asarray(targetcat['FIBER']) // 500)
+
+    return columns
+
+def _file_counts(targetcat):
+    """Return array with the number of targets read from each source file"""
+    if len(targetcat) == 0:
+        return np.zeros(0, dtype=int)
+
+    columns = _file_columns(targetcat)
+    if len(columns) == 0:
+        return np.ones(len(targetcat), dtype=int)
+
+    counts = collections.Counter(zip(*[c.tolist() for c in columns]))
+    return np.array(list(counts.values()), dtype=int)
+
+def count_files(targetcat):
+    """Return number of source files needed to read spectra for targetcat"""
+    return len(_file_counts(targetcat))
+
+def estimate_cost(targetcat, rdspec_kwargs=None, format_type='html', nproc=None):
+    """
+    Estimate the cost of reading and rendering spectra for targetcat
+
+    Args:
+        targetcat: targets table from load_targets
+        rdspec_kwargs (dict): options passed to desispec.io.read_spectra
+        format_type (str): html, fits, bin, progressive, or stack
+        nproc (int): files read in parallel for progressive and stack formats
+
+    Returns SpectraCost
+    """
+    if rdspec_kwargs is None:
+        rdspec_kwargs = dict()
+
+    skip_hdus = set(rdspec_kwargs.get('skip_hdus', ()))
+    pixel_bytes = 0
+    for hdu, nbytes in PIXEL_BYTES.items():
+        if hdu == 'MODEL':
+            if rdspec_kwargs.get('return_models', False):
+                pixel_bytes += nbytes
+        elif hdu not in skip_hdus:
+            pixel_bytes += nbytes
+
+    spectrum_bytes = NWAVE*pixel_bytes + ROW_BYTES
+    nspec = len(targetcat)
+    file_counts = _file_counts(targetcat)
+    nfiles = len(file_counts)
+    bytes_read = nspec * spectrum_bytes + nfiles * FILE_BYTES
+
+    factor = PEAK_FACTOR.get(format_type, max(PEAK_FACTOR.values()))
+    if format_type in STREAMING_FORMATS and nfiles > 0:
+        #- inspector.io.iter_spectra holds at most nproc files at a time;
+        #- charge for the largest ones since files can be very uneven
+        if nproc is None:
+            from inspector.io import PROGRESSIVE_NPROC
+            nproc = PROGRESSIVE_NPROC
+        largest = np.sort(file_counts)[::-1][0:max(1, nproc)]
+        peak_bytes = factor * (np.sum(largest) * spectrum_bytes + len(largest) * FILE_BYTES)
+    else:
+        peak_bytes = factor * bytes_read
+
+    return SpectraCost(nspec, nfiles, bytes_read, peak_bytes)
+
+def preview_size(targetcat, rdspec_kwargs=None, format_type='html', budget_mb=None):
+    """
+    Return the largest n such that targetcat[0:n] fits within budget_mb
+
+    budget_mb defaults to the smaller of the per-worker and global budgets;
+    returns len(targetcat) if there are no budgets.
+    """
+    if budget_mb is None:
+        budgets = [b for b in (WORKER_MEMORY_MB, GLOBAL_MEMORY_MB) if b > 0]
+        if len(budgets) == 0:
+            return len(targetcat)
+        budget_mb = min(budgets)
+
+    budget = budget_mb * 1024**2
+    lo, hi = 0, len(targetcat)
+    while lo < hi:
+        mid = (lo + hi + 1) // 2
+        if estimate_cost(targetcat[0:mid], rdspec_kwargs, format_type).peak_bytes <= budget:
+            lo = mid
+        else:
+            hi = mid - 1
+
+    return lo
+
+def fits_budget(cost):
+    """Return True if cost could ever be admitted, i.e. fits within the budgets when idle"""
+    for budget_mb in (WORKER_MEMORY_MB, GLOBAL_MEMORY_MB):
+        if budget_mb > 0 and cost.peak_bytes > budget_mb * 1024**2:
+            return False
+    return True
+
+def _pid_alive(pid):
+    """Return True if process pid exists on this host"""
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+class _Ledger(object):
+    """Reservations shared by all processes on this node, stored in LEDGER_FILE"""
+    def __init__(self, filename):
+        self.filename = filename
+
+    def _update(self, func):
+        """Call func(reservations) with the ledger locked; saves changes and returns the result"""
+        with open(self.filename, 'a+') as fp:
+            fcntl.flock(fp, fcntl.LOCK_EX)
+            try:
+                fp.seek(0)
+                content = fp.read()
+                reservations = json.loads(content) if content else dict()
+                reservations = {key: nbytes for key, nbytes in reservations.items()
+                                if _pid_alive(int(key.split(':')[0]))}
+                result = func(reservations)
+                fp.seek(0)
+                fp.truncate()
+                json.dump(reservations, fp)
+                return result
+            finally:
+                fcntl.flock(fp, fcntl.LOCK_UN)
+
+    def reserve(self, key, nbytes, budget):
+        def func(reservations):
+            if sum(reservations.values()) + nbytes > budget:
+                return False
+            reservations[key] = nbytes
+            return True
+        return self._update(func)
+
+    def release(self, key):
+        self._update(lambda reservations: reservations.pop(key, None))
+
+    def total(self):
+        return self._update(lambda reservations: sum(reservations.values()))
+
+class Reservation(object):
+    """
+    Memory reserved for one request; release when done, or use as a context manager
+    """
+    def __init__(self, budget, key, nbytes):
+        self.budget = budget
+        self.key = key
+        self.nbytes = nbytes
+
+    def release(self):
+        if self.budget is not None:
+            self.budget._release(self)
+            self.budget = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.release()
+
+class MemoryBudget(object):
+    """
+    Per-worker and node-wide memory budgets for concurrent requests
+
+    Thread-safe within a worker; the node-wide budget uses a ledger file
+    shared by all workers.
+    """
+    def __init__(self, worker_mb=WORKER_MEMORY_MB, global_mb=GLOBAL_MEMORY_MB, ledger_file=LEDGER_FILE):
+        self.worker_bytes = worker_mb * 1024**2
+        self.global_bytes = global_mb * 1024**2
+        self.ledger = _Ledger(ledger_file) if global_mb > 0 else None
+        self.reserved = 0
+        self._lock = threading.Lock()
+        self._counter = itertools.count()
+
+    def try_reserve(self, cost):
+        """Return Reservation for cost if memory is available now, otherwise None"""
+        nbytes = cost.peak_bytes
+        with self._lock:
+            if self.worker_bytes > 0 and self.reserved > 0 and self.reserved + nbytes > self.worker_bytes:
+                return None
+
+            key = f'{os.getpid()}:{next(self._counter)}'
+            if self.ledger is not None and not self.ledger.reserve(key, nbytes, self.global_bytes):
+                return None
+
+            self.reserved += nbytes
+            return Reservation(self, key, nbytes)
+
+    def reserve(self, cost, timeout=ADMISSION_WAIT):
+        """
+        Reserve memory for cost, waiting up to timeout seconds for it to be available
+
+        Returns Reservation; raises AdmissionError if cost can never fit or
+        if memory doesn't become available in time.
+
+        A worker with nothing reserved always admits a request that fits the
+        per-worker budget, so that a single request can't wait on itself.
+        """
+        for budget, name in ((self.worker_bytes, 'per worker'), (self.global_bytes, 'in total')):
+            if budget > 0 and cost.peak_bytes > budget:
+                raise AdmissionError(f'Request too large: estimated {cost}, but the memory budget is '
+                                     f'{budget/1024**2:.0f} MB {name}; please request fewer spectra', cost)
+
+        t0 = time.time()
+        while True:
+            reservation = self.try_reserve(cost)
+            if reservation is not None:
+                return reservation
+            if time.time() - t0 > timeout:
+                raise AdmissionError(f'Server busy: estimated {cost} is not available; '
+                                     'please try again later', cost, retry_after=int(timeout))
+            time.sleep(0.1)
+
+    def _release(self, reservation):
+        with self._lock:
+            self.reserved -= reservation.nbytes
+            if self.ledger is not None:
+                self.ledger.release(reservation.key)
+
+_budget = None
+
+def admit(cost, timeout=ADMISSION_WAIT):
+    """Reserve memory for cost from this worker's MemoryBudget; see MemoryBudget.reserve"""
+    global _budget
+    if _budget is None:
+        _budget = MemoryBudget()
+    return _budget.reserve(cost, timeout=timeout)
@@ -0,0 +1,133 @@
+"""
+inspector.assets
+================
+
+Serve the Bokeh/prospect JavaScript and CSS from the app instead of inlining
+them into every spectra page.
+
+prospect.viewer.plotspectra writes self-contained html with the same large
+library <script> and <style> blocks on every page.  externalize_assets
+replaces each large inline block with a reference to a content-addressed
+/assets/HASH.js or .css URL, which is served with long-lived immutable cache
+headers, so browsers download the libraries once and each spectra page
+carries only its own data and plot spec.  No external CDN is needed.
+
+Assets are written to $DESI_INSPECTOR_ASSETS_DIR so that any worker can
+serve an asset first seen by another worker.  Each worker touches the
+assets it uses, at most every ASSET_TOUCH_INTERVAL, and whenever a new
+asset is written (e.g. after a Bokeh or prospect upgrade), assets that no
+worker has used for ASSET_KEEP_DAYS are removed, so old versions don't
+accumulate while those still used by workers that haven't been upgraded
+yet are kept.
+"""
+
+import os
+import re
+import time
+import hashlib
+import tempfile
+
+EXTERNAL_ASSETS = os.getenv('DESI_INSPECTOR_EXTERNAL_ASSETS', '0').lower() in ('1', 'true', 'yes')
+ASSETS_DIR = os.getenv('DESI_INSPECTOR_ASSETS_DIR', os.path.join(tempfile.gettempdir(), 'desi-inspector-assets'))
+
+#- inline blocks smaller than this [bytes] are left in the page
+ASSET_MIN_SIZE = 10000
+
+#- one year; assets are content-addressed so never change
+ASSET_MAX_AGE = 365*24*3600
+
+#- assets not used by any worker for this many days are removed when a new one is stored
+ASSET_KEEP_DAYS = float(os.getenv('DESI_INSPECTOR_ASSET_KEEP_DAYS', 30))
+
+#- seconds between touches of an asset that is still in use
+ASSET_TOUCH_INTERVAL = 24*3600
+
+_inline_block = re.compile(r'<(script|style)([^>]*)>(.*?)</\1>', re.DOTALL | re.IGNORECASE)
+_asset_name = re.compile(r'^[0-9a-f]{32}\.(js|css)$')
+
+#- asset name -> time this process last stored or touched it
+_stored = dict()
+
+def valid_asset_name(name):
+    """Return True if name looks like an asset filename from store_asset"""
+    return _asset_name.match(name) is not None
+
+def store_asset(content, ext):
+    """
+    Store content in ASSETS_DIR if needed; returns content-addressed filename
+    """
+    name = hashlib.sha256(content.encode()).hexdigest()[0:32] + '.' + ext
+    now = time.time()
+    if now - _stored.get(name, 0) > ASSET_TOUCH_INTERVAL:
+        filename = os.path.join(ASSETS_DIR, name)
+        try:
+            #- mark as in use so that remove_stale_assets keeps it
+            os.utime(filename)
+        except FileNotFoundError:
+            os.makedirs(ASSETS_DIR, exist_ok=True)
+            tmpfile = f'{filename}.{os.getpid()}.tmp'
+            with open(tmpfile, 'w') as fp:
+                fp.write(content)
+            os.replace(tmpfile, filename)
+            remove_stale_assets()
+        except OSError:
+            pass
+        _stored[name] = now
+
+    return name
+
+def remove_stale_assets(keep_days=ASSET_KEEP_DAYS):
+    """
+    Remove assets, and leftover temporary files, not used for keep_days
+
+    Returns list of removed filenames
+    """
+    cutoff = time.time() - keep_days*24*3600
+    try:
+        entries = list(os.scandir(ASSETS_DIR))
+    except OSError:
+        return list()
+
+    removed = list()
+    for entry in entries:
+        if not (valid_asset_name(entry.name) or entry.name.endswith('.tmp')):
+            continue
+        try:
+            if entry.stat().st_mtime < cutoff:
+                os.remove(entry.path)
+                removed.append(entry.name)
+        except OSError:
+            pass
+
+    return removed
+
+def externalize_assets(html, url_prefix):
+    """
+    Replace large inline script/style blocks in html with links to stored assets
+
+    Args:
+        html (str): html page content
+        url_prefix (str): URL under which assets are served, e.g. root_url+'/assets'
+
+    Returns modified html.  Non-javascript scripts such as the
+    type="application/json" blocks holding the per-page Bokeh document are
+    never externalized.
+    """
+    def replace(match):
+        tag, attrs, body = match.groups()
+        if len(body) < ASSET_MIN_SIZE:
+            return match.group(0)
+
+        attrs_lower = attrs.lower()
+        if tag.lower() == 'script':
+            if 'src=' in attrs_lower:
+                return match.group(0)
+            if 'type=' in attrs_lower and 'javascript' not in attrs_lower:
+                return match.group(0)
+            name = store_asset(body, 'js')
+            return f'<script type="text/javascript" src="{url_prefix}/{name}"></script>'
+        else:
+            name = store_asset(body, 'css')
+            return f'<link rel="stylesheet" href="{url_prefix}/{name}">'
+
+    return _inline_block.sub(replace, html)
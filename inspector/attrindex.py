@@ -0,0 +1,874 @@
+"""
+inspector.attrindex
+===================
+
+Production-wide secondary indexes over the key redshift catalog columns.
+
+Targets and spectra queries start from a cone search or a list of
+TARGETIDs, so selections like "all QSOs with 2.1<Z<2.2 and ZWARN=0" would
+otherwise require reading every redrock file.  build_index reads TARGETID,
+Z, SPECTYPE, ZWARN, TILEID/HEALPIX, the targeting bit columns, etc. from
+all redrock files of a production once, and writes each column as a .npy
+file under $DESI_INSPECTOR_INDEX_DIR/SPECPROD-SPECGROUP/ together with
+
+  * a sorted index (argsort order and sorted values) for columns with many
+    distinct values (Z, TARGETID, TARGET_RA, ...), answering eq/lt/le/gt/ge
+    with a binary search;
+  * a bitmap index (one packed bitmap per distinct value) for columns with
+    at most MAX_BITMAP_VALUES distinct values (SPECTYPE, ZWARN, SURVEY, ...);
+  * one bitmap per bit for the targeting bit columns, for bitand filters.
+
+AttributeIndex.select combines the bitmaps, starts from the most selective
+sorted range, and checks any remaining filters on just those rows, using
+the same UPPERCASE filter syntax as inspector.io.filter_table.  Index files
+are memory mapped, so they are shared by all workers via the page cache.
+
+Indexes of small productions are built on first use; larger ones should be
+built ahead of time with
+
+    python -m inspector.attrindex iron --specgroup healpix
+
+index.json includes a manifest of the size and mtime of every redrock file,
+so that indexes of productions that grow nightly (e.g. daily) can be kept
+up to date by re-reading only new and changed files, e.g. every 10 minutes:
+
+    python -m inspector.attrindex daily --update --watch 600
+
+Each build is written to its own hidden version directory, and
+SPECPROD-SPECGROUP is a symlink to the current one that is replaced
+atomically.  An AttributeIndex resolves the symlink when it is created, so
+queries keep reading one consistent version while a new one is swapped in;
+replaced versions are removed once unused for INDEX_KEEP_OLD seconds.
+
+Example usage:
+
+    t = query('iron', 'healpix', filters=dict(SPECTYPE='QSO', Z=['gt:2.1', 'lt:2.2'], ZWARN='0'),
+              offset=0, limit=1000)
+"""
+
+import os
+import sys
+import json
+import time
+import fcntl
+import shutil
+import argparse
+import tempfile
+import threading
+from contextlib import contextmanager
+
+import numpy as np
+
+INDEX_DIR = os.getenv('DESI_INSPECTOR_INDEX_DIR', os.path.join(tempfile.gettempdir(), 'desi-inspector-index'))
+
+#- bump when the index file format changes
+INDEX_VERSION = 1
+
+#- indexes of productions with at most this many redrock files are built on first query
+AUTOBUILD_MAX_FILES = int(os.getenv('DESI_INSPECTOR_INDEX_AUTOBUILD_MAX_FILES', 1000))
+
+#- seconds that a replaced index version is kept for queries still reading it
+INDEX_KEEP_OLD = float(os.getenv('DESI_INSPECTOR_INDEX_KEEP_OLD', 3600))
+
+#- columns with at most this many distinct values get a bitmap index instead of a sorted index
+MAX_BITMAP_VALUES = 256
+
+#- default and maximum rows per page of query results
+QUERY_LIMIT = 1000
+MAX_QUERY_LIMIT = 10000
+
+#- redrock files read at a time per process while building
+BUILD_BATCH = 16
+
+#- columns indexed from each redrock HDU, if present
+INDEX_COLUMNS = dict(
+    REDSHIFTS=('TARGETID', 'Z', 'ZERR', 'ZWARN', 'SPECTYPE', 'DELTACHI2'),
+    FIBERMAP=('TARGET_RA', 'TARGET_DEC', 'PETAL_LOC', 'FIBER', 'COADD_FIBERSTATUS'),
+    )
+
+#- targeting bit columns, indexed with one bitmap per bit
+TARGET_BIT_COLUMNS = ('CMX_TARGET',) + tuple(
+    f'{prefix}{name}' for prefix in ('', 'SV1_', 'SV2_', 'SV3_')
+    for name in ('DESI_TARGET', 'BGS_TARGET', 'MWS_TARGET', 'SCND_TARGET'))
+
+#- columns from the redrock file path/header, as in the target inventory
+FILE_KEY_COLUMNS = dict(
+    healpix=dict(SURVEY='S7', PROGRAM='S6', HEALPIX='i4'),
+    tiles=dict(SURVEY='S7', PROGRAM='S6', TILEID='i4', LASTNIGHT='i4', PETAL_LOC='i2'),
+    )
+
+#- columns returned by query in addition to the filter columns and xcol
+OUTPUT_COLUMNS = dict(
+    healpix=('TARGETID', 'TARGET_RA', 'TARGET_DEC', 'SURVEY', 'PROGRAM', 'HEALPIX',
+             'SPECTYPE', 'Z', 'ZWARN'),
+    tiles=('TARGETID', 'TARGET_RA', 'TARGET_DEC', 'SURVEY', 'PROGRAM', 'TILEID',
+           'LASTNIGHT', 'PETAL_LOC', 'FIBER', 'SPECTYPE', 'Z', 'ZWARN'),
+    )
+
+class IndexNotBuiltError(RuntimeError):
+    """Index doesn't exist and the production is too large to build it during a request"""
+    pass
+
+def _listdirs(dirname):
+    try:
+        return sorted(e.name for e in os.scandir(dirname) if e.is_dir())
+    except OSError:
+        return list()
+
+def _redrock_names(dirname):
+    try:
+        return sorted(n for n in os.listdir(dirname) if n.startswith('redrock-') and n.endswith('.fits'))
+    except OSError:
+        return list()
+
+def list_redrock_files(specprod, specgroup):
+    """
+    Return list of (filename, keys) for every redrock file of specprod/specgroup
+
+    keys is a dict of the FILE_KEY_COLUMNS derived from the file path, plus
+    PETAL_LOC for tiles; tiles use only their latest cumulative night.
+    """
+    from inspector.io import production_dir
+
+    files = list()
+    if specgroup == 'healpix':
+        topdir = os.path.join(production_dir(specprod), 'healpix')
+        for survey in _listdirs(topdir):
+            for program in _listdirs(os.path.join(topdir, survey)):
+                #- healpix/SURVEY/PROGRAM/HPIXGROUP/HEALPIX/redrock-SURVEY-PROGRAM-HEALPIX.fits
+                progdir = os.path.join(topdir, survey, program)
+                for group in _listdirs(progdir):
+                    for hpix in _listdirs(os.path.join(progdir, group)):
+                        if not hpix.isdigit():
+                            continue
+                        filename = os.path.join(progdir, group, hpix, f'redrock-{survey}-{program}-{hpix}.fits')
+                        if os.path.exists(filename):
+                            files.append((filename, dict(SURVEY=survey, PROGRAM=program, HEALPIX=int(hpix))))
+    elif specgroup == 'tiles':
+        topdir = os.path.join(production_dir(specprod), 'tiles', 'cumulative')
+        tiles = [t for t in _listdirs(topdir) if t.isdigit()]
+        for tileid in sorted(tiles, key=int):
+            #- tiles/cumulative/TILEID/LASTNIGHT/redrock-PETAL-TILEID-thruLASTNIGHT.fits
+            nights = [n for n in _listdirs(os.path.join(topdir, tileid)) if n.isdigit()]
+            if len(nights) == 0:
+                continue
+            night = max(nights, key=int)
+            nightdir = os.path.join(topdir, tileid, night)
+            for name in _redrock_names(nightdir):
+                petal = name.split('-')[1]
+                if petal.isdigit():
+                    files.append((os.path.join(nightdir, name),
+                                  dict(TILEID=int(tileid), LASTNIGHT=int(night), PETAL_LOC=int(petal))))
+    else:
+        raise ValueError(f'Unknown specgroup {specgroup}; should be healpix or tiles')
+
+    return files
+
+def _file_columns(fx):
+    """Return dict of HDU name -> list of index columns in open redrock file fx"""
+    result = dict()
+    for hdu, names in INDEX_COLUMNS.items():
+        if hdu == 'FIBERMAP':
+            names = names + TARGET_BIT_COLUMNS
+        available = fx[hdu].get_colnames()
+        result[hdu] = [n for n in names if n in available]
+    return result
+
+def _header_keys(fx):
+    """Return SURVEY, PROGRAM from redrock primary header"""
+    from inspector.fitscache import read_header
+    hdr = read_header(fx[0])
+    survey = hdr.get('SURVEY', '') or ''
+    program = hdr.get('PROGRAM', hdr.get('FAPRGRM', '')) or ''
+    return str(survey).strip(), str(program).strip()
+
+def _scan_file(filename):
+    """Return (nrows, dict of column -> dtype str, survey, program) from redrock file headers"""
+    from inspector.fitscache import open_fits
+    #- new and changed files may have just been rewritten, so check the pooled handle is current
+    with open_fits(filename, revalidate=0) as fx:
+        nrows = fx['REDSHIFTS'].get_nrows()
+        dtypes = dict()
+        for hdu, names in _file_columns(fx).items():
+            rec_dtype = fx[hdu].get_rec_dtype()[0]
+            for name in names:
+                dtypes[name] = rec_dtype[name].str
+        survey, program = _header_keys(fx)
+
+    return nrows, dtypes, survey, program
+
+def _read_file(filename):
+    """Return dict of column -> array of index columns in redrock file, in REDSHIFTS row order"""
+    from inspector.fitscache import open_fits
+    data = dict()
+    with open_fits(filename, revalidate=0) as fx:
+        columns = _file_columns(fx)
+        redshifts = fx['REDSHIFTS'].read(columns=columns['REDSHIFTS'])
+        fibermap = fx['FIBERMAP'].read(columns=['TARGETID',] + columns['FIBERMAP'])
+
+    #- FIBERMAP and REDSHIFTS rows are normally aligned, but don't rely on it
+    if not np.all(fibermap['TARGETID'] == redshifts['TARGETID']):
+        order = np.argsort(fibermap['TARGETID'])
+        fibermap = fibermap[order[np.searchsorted(fibermap['TARGETID'], redshifts['TARGETID'], sorter=order)]]
+
+    for name in columns['REDSHIFTS']:
+        data[name] = redshifts[name]
+    for name in columns['FIBERMAP']:
+        data[name] = fibermap[name]
+
+    return data
+
+def _map(func, args, nproc):
+    """Yield func(arg) for args in order, with nproc processes if nproc>1"""
+    if nproc is not None and nproc <= 1:
+        for arg in args:
+            yield func(arg)
+        return
+
+    from inspector.sharedread import _get_pool, process_pool
+    pool = _get_pool() if nproc is None else process_pool(nproc)
+    batch = BUILD_BATCH * (nproc or 4)
+    try:
+        #- submit in batches so that finished results don't pile up in memory
+        for start in range(0, len(args), batch):
+            for result in pool.map(func, args[start:start+batch]):
+                yield result
+    finally:
+        if nproc is not None:
+            pool.shutdown()
+
+def _index_path(specprod, specgroup, index_dir):
+    return os.path.join(index_dir, f'{specprod}-{specgroup}')
+
+def _version_prefix(specprod, specgroup):
+    """Return name prefix of the version directories of the specprod/specgroup index"""
+    return f'.{specprod}-{specgroup}.v'
+
+def _install_version(version, outdir, prefix):
+    """
+    Atomically point symlink outdir at index version directory version
+
+    prefix is the _version_prefix of the index, used to keep an index
+    directory from before version directories as an old version.
+    """
+    index_dir = os.path.dirname(version)
+    previous = os.path.realpath(outdir) if os.path.lexists(outdir) else None
+    if os.path.isdir(outdir) and not os.path.islink(outdir):
+        #- an index written before version directories; move it aside as a version
+        aside = tempfile.mkdtemp(prefix=prefix, dir=index_dir)
+        os.rename(outdir, aside)
+        previous = aside
+
+    link = f'{version}.link'
+    os.symlink(os.path.basename(version), link)
+    try:
+        os.replace(link, outdir)
+    except BaseException:
+        os.remove(link)
+        raise
+
+    if previous is not None:
+        #- its mtime records when it was replaced, for _remove_old_versions
+        try:
+            os.utime(previous)
+        except OSError:
+            pass
+
+def _remove_old_versions(specprod, specgroup, index_dir, keep=INDEX_KEEP_OLD):
+    """
+    Remove complete index versions of specprod/specgroup replaced more than keep seconds ago
+
+    Version directories without index.json are builds still in progress
+    (failed builds remove their own), so they are left alone.
+    """
+    prefix = _version_prefix(specprod, specgroup)
+    current = os.path.realpath(_index_path(specprod, specgroup, index_dir))
+    cutoff = time.time() - keep
+    try:
+        entries = list(os.scandir(index_dir))
+    except OSError:
+        return
+
+    for entry in entries:
+        if not entry.name.startswith(prefix) or '.' in entry.name[len(prefix):]:
+            continue
+        if entry.path == current or not os.path.exists(os.path.join(entry.path, 'index.json')):
+            continue
+        try:
+            if entry.stat(follow_symlinks=False).st_mtime < cutoff:
+                shutil.rmtree(entry.path, ignore_errors=True)
+        except OSError:
+            pass
+
+def _bitmap(rows, nrows):
+    """Return packed bitmap of nrows bits with rows set"""
+    bits = np.zeros(nrows, dtype=bool)
+    bits[rows] = True
+    return np.packbits(bits)
+
+def _write_column_index(outdir, name, values, is_bits):
+    """Write sorted, bitmap, or bits index for column values; return its index.json entry"""
+    info = dict(dtype=values.dtype.str)
+    nrows = len(values)
+    if is_bits:
+        bitnums = [b for b in range(values.dtype.itemsize*8) if np.any((values >> b) & 1)]
+        bitmaps = np.zeros((len(bitnums), (nrows+7)//8), dtype=np.uint8)
+        for i, b in enumerate(bitnums):
+            bitmaps[i] = np.packbits(((values >> b) & 1).astype(bool))
+        np.save(os.path.join(outdir, f'{name}.bitmap.npy'), bitmaps)
+        info.update(index='bits', bits=bitnums)
+        return info
+
+    order = np.argsort(values, kind='stable').astype(np.uint32 if nrows < 2**32 else np.int64)
+    sorted_values = values[order]
+    if sorted_values.dtype.kind == 'f':
+        nvalid = int(np.count_nonzero(~np.isnan(sorted_values)))
+    else:
+        nvalid = nrows
+
+    #- distinct values from the boundaries of the sorted values; NaN sort last and are never equal
+    if nrows > 0:
+        starts = np.concatenate([[0], np.where(sorted_values[1:nvalid] != sorted_values[:nvalid-1])[0] + 1])
+        starts = starts[starts < nvalid] if nvalid > 0 else np.zeros(0, dtype=int)
+    else:
+        starts = np.zeros(0, dtype=int)
+
+    if len(starts) <= MAX_BITMAP_VALUES:
+        ends = np.concatenate([starts[1:], [nvalid]]).astype(int)
+        bitmaps = np.zeros((len(starts), (nrows+7)//8), dtype=np.uint8)
+        for i, (start, end) in enumerate(zip(starts, ends)):
+            bitmaps[i] = _bitmap(order[start:end], nrows)
+        np.save(os.path.join(outdir, f'{name}.values.npy'), sorted_values[starts])
+        np.save(os.path.join(outdir, f'{name}.bitmap.npy'), bitmaps)
+        info.update(index='bitmap', nvalues=len(starts))
+    else:
+        np.save(os.path.join(outdir, f'{name}.order.npy'), order)
+        np.save(os.path.join(outdir, f'{name}.sorted.npy'), sorted_values)
+        info.update(index='sorted', nvalid=nvalid)
+
+    return info
+
+def build_index(specprod, specgroup, index_dir=INDEX_DIR, nproc=None, files=None, previous=None):
+    """
+    Build the secondary indexes for specprod/specgroup from all its redrock files
+
+    Args:
+        specprod (str): production name
+        specgroup (str): healpix or tiles
+
+    Options:
+        index_dir (str): where to write SPECPROD-SPECGROUP/ index directory
+        nproc (int): number of processes reading files; default sharedread pool; 1 for serial
+        files (list): (filename, keys) from list_redrock_files; default all files
+        previous (AttributeIndex): existing index whose rows are copied for
+            files with the same size and mtime instead of reading them again
+
+    Returns path to index directory, or None if there are no redrock files.
+    An existing index is replaced once the new one is complete, without
+    changing the files of AttributeIndex objects reading it.
+    """
+    from numpy.lib.format import open_memmap
+    from inspector.io import standardize_specprod, production_dir
+    specprod = standardize_specprod(specprod)
+
+    t0 = time.time()
+    if files is None:
+        files = list_redrock_files(specprod, specgroup)
+    if len(files) == 0:
+        return None
+
+    filenames = [f for f, keys in files]
+    reuse = _unchanged_files(previous, filenames, specprod) if previous is not None else dict()
+    new_filenames = [f for f in filenames if f not in reuse]
+    new_scans = _map(_scan_file, new_filenames, nproc)
+    scans = [previous._scan(reuse[f]) if f in reuse else next(new_scans) for f in filenames]
+    nrows = sum(s[0] for s in scans)
+
+    #- SURVEY and PROGRAM from the healpix path, or from the tiles redrock headers
+    surveys = [keys.get('SURVEY', scan[2]) for (f, keys), scan in zip(files, scans)]
+    programs = [keys.get('PROGRAM', scan[3]) for (f, keys), scan in zip(files, scans)]
+
+    #- widest dtype of each column over all files; files without a column get zeros
+    dtypes = {name: np.dtype(dt) for name, dt in FILE_KEY_COLUMNS[specgroup].items()}
+    dtypes['SURVEY'] = np.dtype(f'S{max(len(s) for s in surveys)}')
+    dtypes['PROGRAM'] = np.dtype(f'S{max(len(p) for p in programs)}')
+    for n, file_dtypes, survey, program in scans:
+        for name, dt in file_dtypes.items():
+            dt = np.dtype(dt)
+            if dt.kind == 'U':
+                #- stored as bytes; converted back to str when read
+                dt = np.dtype(f'S{dt.itemsize//4}')
+            dt = dt.newbyteorder('=')
+            dtypes[name] = np.result_type(dtypes[name], dt) if name in dtypes else dt
+
+    os.makedirs(index_dir, exist_ok=True)
+    outdir = _index_path(specprod, specgroup, index_dir)
+    tmpdir = tempfile.mkdtemp(prefix=_version_prefix(specprod, specgroup), dir=index_dir)
+    try:
+        columns = {name: open_memmap(os.path.join(tmpdir, f'{name}.npy'), mode='w+', dtype=dt, shape=(nrows,))
+                   for name, dt in dtypes.items()}
+
+        manifest = list()
+        offset = 0
+        new_results = _map(_read_file, new_filenames, nproc)
+        for (filename, keys), scan, survey, program in zip(files, scans, surveys, programs):
+            data = previous._rows(reuse[filename]) if filename in reuse else next(new_results)
+            n = scan[0]
+            rows = slice(offset, offset+n)
+            for name, values in data.items():
+                columns[name][rows] = values
+            for name, value in keys.items():
+                columns[name][rows] = value
+            columns['SURVEY'][rows] = survey
+            columns['PROGRAM'][rows] = program
+
+            st = os.stat(filename)
+            manifest.append(dict(filename=os.path.relpath(filename, production_dir(specprod)),
+                                 size=st.st_size, mtime=st.st_mtime, offset=offset, nrows=n,
+                                 columns=sorted(scan[1])))
+            offset += n
+
+        colinfo = dict()
+        for name, values in columns.items():
+            values.flush()
+            colinfo[name] = _write_column_index(tmpdir, name, np.asarray(values), name in TARGET_BIT_COLUMNS)
+        del columns
+
+        meta = dict(version=INDEX_VERSION, specprod=specprod, specgroup=specgroup, nrows=nrows,
+                    created=time.strftime('%Y-%m-%dT%H:%M:%S'), columns=colinfo, files=manifest)
+        with open(os.path.join(tmpdir, 'index.json'), 'w') as fp:
+            json.dump(meta, fp)
+
+        #- readers of the previous version keep it until it is removed after INDEX_KEEP_OLD
+        _install_version(tmpdir, outdir, _version_prefix(specprod, specgroup))
+    except BaseException:
+        shutil.rmtree(tmpdir, ignore_errors=True)
+        raise
+
+    _remove_old_versions(specprod, specgroup, index_dir)
+
+    print(f'Built {specprod} {specgroup} index of {nrows} rows from {len(files)} files '
+          f'({len(new_filenames)} read) in {time.time()-t0:.1f} sec')
+    return outdir
+
+def _manifest_key(filename, specprod):
+    """Return (relative path, size, mtime) of filename as recorded in the index manifest"""
+    from inspector.io import production_dir
+    st = os.stat(filename)
+    return os.path.relpath(filename, production_dir(specprod)), st.st_size, st.st_mtime
+
+def _unchanged_files(index, filenames, specprod):
+    """Return dict of filename -> index manifest entry for filenames whose size and mtime match"""
+    entries = {(e['filename'], e['size'], e['mtime']): e for e in index.meta['files']}
+    unchanged = dict()
+    for filename in filenames:
+        try:
+            key = _manifest_key(filename, specprod)
+        except OSError:
+            continue
+        if key in entries:
+            unchanged[filename] = entries[key]
+    return unchanged
+
+def diff_manifest(index, files, specprod):
+    """
+    Compare the manifest of index with the current redrock files of specprod
+
+    Args:
+        index (AttributeIndex): existing index
+        files (list): (filename, keys) from list_redrock_files
+        specprod (str): production name
+
+    Returns dict with lists of relative paths "added", "changed" (size or
+    mtime differ), and "removed".  A tile with a new LASTNIGHT shows up as
+    its new cumulative files added and the previous night's removed.
+    """
+    manifest = {e['filename']: (e['size'], e['mtime']) for e in index.meta['files']}
+    added, changed = list(), list()
+    current = set()
+    for filename, keys in files:
+        try:
+            relpath, size, mtime = _manifest_key(filename, specprod)
+        except OSError:
+            #- removed since it was listed
+            continue
+        current.add(relpath)
+        if relpath not in manifest:
+            added.append(relpath)
+        elif manifest[relpath] != (size, mtime):
+            changed.append(relpath)
+
+    removed = [relpath for relpath in manifest if relpath not in current]
+    return dict(added=added, changed=changed, removed=removed)
+
+def update_index(specprod, specgroup, index_dir=INDEX_DIR, nproc=None):
+    """
+    Bring the index of specprod/specgroup up to date with its redrock files
+
+    Only new and changed files are read; rows of unchanged files are copied
+    from the current index and rows of removed files are dropped, then the
+    sorted and bitmap indexes are recomputed from the columns.  New columns
+    in the new or changed files are added to the cached inspector.schema.
+    Nothing is rewritten if no files changed, and workers pick up a new
+    index on their next query (see get_index).  Builds the index from
+    scratch if there isn't a current one.
+
+    Returns dict of "added", "changed", "removed" relative paths as from
+    diff_manifest, or None if the production has no redrock files.
+    """
+    from inspector.io import standardize_specprod, production_dir
+    from inspector.schema import update_schema
+    specprod = standardize_specprod(specprod)
+
+    files = list_redrock_files(specprod, specgroup)
+    if len(files) == 0:
+        return None
+
+    path = _index_path(specprod, specgroup, index_dir)
+    try:
+        previous = AttributeIndex(path)
+    except (OSError, ValueError):
+        build_index(specprod, specgroup, index_dir=index_dir, nproc=nproc, files=files)
+        relpaths = [os.path.relpath(f, production_dir(specprod)) for f, keys in files]
+        return dict(added=relpaths, changed=list(), removed=list())
+
+    changes = diff_manifest(previous, files, specprod)
+    if any(changes.values()):
+        build_index(specprod, specgroup, index_dir=index_dir, nproc=nproc, files=files, previous=previous)
+        filenames = [os.path.join(production_dir(specprod), f) for f in changes['added'] + changes['changed']]
+        added = update_schema(specprod, specgroup, filenames)
+        if len(added) > 0:
+            print(f'Added columns {added} to {specprod} {specgroup} schema')
+
+    return changes
+
+class AttributeIndex(object):
+    """
+    Memory mapped secondary indexes of one production and specgroup, see build_index
+    """
+    def __init__(self, path):
+        #- stay on this version even if the SPECPROD-SPECGROUP symlink is replaced
+        self.path = os.path.realpath(path)
+        with open(os.path.join(self.path, 'index.json')) as fp:
+            self.meta = json.load(fp)
+        if self.meta.get('version') != INDEX_VERSION:
+            raise ValueError(f'{path} index version {self.meta.get("version")} != {INDEX_VERSION}')
+
+        self.specprod = self.meta['specprod']
+        self.specgroup = self.meta['specgroup']
+        self.nrows = self.meta['nrows']
+        self.columns = self.meta['columns']
+        self._arrays = dict()
+        self._lock = threading.Lock()
+
+    def __contains__(self, name):
+        return name in self.columns
+
+    def _array(self, name, kind=None):
+        """Return memory mapped NAME.npy or NAME.KIND.npy"""
+        key = (name, kind)
+        with self._lock:
+            if key not in self._arrays:
+                filename = f'{name}.npy' if kind is None else f'{name}.{kind}.npy'
+                self._arrays[key] = np.load(os.path.join(self.path, filename), mmap_mode='r')
+            return self._arrays[key]
+
+    def _file_columns(self, entry):
+        """Return names of the redrock columns of the file of manifest entry"""
+        if 'columns' in entry:
+            return entry['columns']
+        #- older manifests don't list them; assume all
+        keys = set(FILE_KEY_COLUMNS[self.specgroup])
+        return [name for name in self.columns if name not in keys]
+
+    def _scan(self, entry):
+        """Return _scan_file style (nrows, dtypes, survey, program) for the file of manifest entry"""
+        n = entry['nrows']
+        dtypes = {name: self.columns[name]['dtype'] for name in self._file_columns(entry)}
+        if n == 0:
+            return 0, dtypes, '', ''
+        survey = self._array('SURVEY')[entry['offset']].decode()
+        program = self._array('PROGRAM')[entry['offset']].decode()
+        return n, dtypes, survey, program
+
+    def _rows(self, entry):
+        """Return _read_file style dict of column -> values for the file of manifest entry"""
+        rows = slice(entry['offset'], entry['offset'] + entry['nrows'])
+        return {name: self._array(name)[rows] for name in self._file_columns(entry)}
+
+    def _bits(self, name, selected):
+        """Return OR of the packed bitmaps with True in selected"""
+        bitmaps = self._array(name, 'bitmap')
+        result = np.zeros(bitmaps.shape[1], dtype=np.uint8)
+        for i in np.where(selected)[0]:
+            result |= bitmaps[i]
+        return result
+
+    def _range(self, name, operator, value):
+        """Return (lo, hi) range in the sorted values of name matching operator, value"""
+        values = self._array(name, 'sorted')
+        nvalid = self.columns[name]['nvalid']
+        value = np.array(value, dtype=values.dtype)
+        if operator == 'eq':
+            lo, hi = np.searchsorted(values, value, 'left'), np.searchsorted(values, value, 'right')
+        elif operator == 'lt':
+            lo, hi = 0, np.searchsorted(values, value, 'left')
+        elif operator == 'le':
+            lo, hi = 0, np.searchsorted(values, value, 'right')
+        elif operator == 'gt':
+            lo, hi = np.searchsorted(values, value, 'right'), nvalid
+        else:   # ge
+            lo, hi = np.searchsorted(values, value, 'left'), nvalid
+
+        hi = min(int(hi), nvalid)
+        return min(int(lo), hi), hi
+
+    def parse_filters(self, filters):
+        """
+        Return list of (column, operator, value) from filter_table style filters dict
+
+        Raises ValueError for columns that aren't indexed or unknown operators
+        """
+        from inspector.io import parse_filter
+
+        clauses = list()
+        if filters is None:
+            return clauses
+
+        for column, filter_list in filters.items():
+            if not column.isupper():
+                continue
+            if column not in self.columns:
+                raise ValueError(f'Filter column "{column}" is not indexed for {self.specprod} {self.specgroup}; '
+                                 f'indexed columns are {sorted(self.columns)}')
+            for filt in np.atleast_1d(filter_list):
+                operator, value = parse_filter(filt)
+                clauses.append((column, operator, value))
+
+        return clauses
+
+    def select(self, filters):
+        """
+        Return sorted array of rows matching filter_table style filters
+        """
+        from inspector.io import apply_filter
+
+        bitmap = None
+        ranges = list()
+        remaining = list()
+        for column, operator, value in self.parse_filters(filters):
+            info = self.columns[column]
+            if info['index'] == 'bitmap':
+                selected = apply_filter(self._array(column, 'values'), operator, value)
+                bits = self._bits(column, selected)
+            elif info['index'] == 'bits' and operator == 'bitand':
+                mask = int(value)
+                bits = self._bits(column, [(mask >> b) & 1 for b in info['bits']])
+            elif info['index'] == 'sorted' and operator in ('eq', 'lt', 'le', 'gt', 'ge'):
+                lo, hi = self._range(column, operator, value)
+                ranges.append((hi-lo, lo, hi, (column, operator, value)))
+                continue
+            else:
+                remaining.append((column, operator, value))
+                continue
+
+            bitmap = bits if bitmap is None else bitmap & bits
+
+        #- start from the most selective sorted range, then check the other filters on just those rows
+        if len(ranges) > 0:
+            ranges.sort(key=lambda r: r[0])
+            n, lo, hi, (column, operator, value) = ranges[0]
+            rows = np.sort(self._array(column, 'order')[lo:hi]).astype(np.int64)
+            remaining = [r[3] for r in ranges[1:]] + remaining
+            if bitmap is not None:
+                rows = rows[((bitmap[rows >> 3] >> (7 - (rows & 7))) & 1).astype(bool)]
+        elif bitmap is not None:
+            rows = np.flatnonzero(np.unpackbits(bitmap, count=self.nrows))
+        else:
+            rows = np.arange(self.nrows)
+
+        for column, operator, value in remaining:
+            rows = rows[apply_filter(self._array(column)[rows], operator, value)]
+
+        return rows
+
+    def table(self, rows, columns):
+        """Return Table of columns for rows, with strings as str like fitsio"""
+        from astropy.table import Table
+        t = Table()
+        for name in columns:
+            values = np.asarray(self._array(name)[rows])
+            if values.dtype.kind == 'S':
+                values = np.char.decode(values, 'ascii')
+            t[name] = values
+        return t
+
+_indexes = dict()
+_indexes_lock = threading.Lock()
+
+def _current_version(path):
+    """Return the version directory index symlink path points to, or None if there is no index"""
+    version = os.path.realpath(path)
+    if not os.path.exists(os.path.join(version, 'index.json')):
+        return None
+    return version
+
+@contextmanager
+def _build_lock(specprod, specgroup, index_dir):
+    """Hold a lock file so that only one process or thread builds the specprod/specgroup index"""
+    os.makedirs(index_dir, exist_ok=True)
+    with open(os.path.join(index_dir, f'.{specprod}-{specgroup}.lock'), 'a') as fp:
+        fcntl.flock(fp, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(fp, fcntl.LOCK_UN)
+
+def get_index(specprod, specgroup, index_dir=INDEX_DIR):
+    """
+    Return AttributeIndex for specprod/specgroup, building it first for small productions
+
+    Raises IndexNotBuiltError if the index doesn't exist and the production
+    has more than AUTOBUILD_MAX_FILES redrock files, and ValueError if it has
+    none.  Only one worker builds a missing index; others needing it wait
+    for that build, while queries of other indexes continue.
+    """
+    from inspector.io import standardize_specprod
+    specprod = standardize_specprod(specprod)
+    path = _index_path(specprod, specgroup, index_dir)
+    key = (path, specgroup)
+
+    version = _current_version(path)
+    with _indexes_lock:
+        if version is not None and key in _indexes and _indexes[key][0] == version:
+            return _indexes[key][1]
+
+    if version is None:
+        files = list_redrock_files(specprod, specgroup)
+        if len(files) == 0:
+            raise ValueError(f'No redrock files found for {specprod} {specgroup}')
+        if len(files) > AUTOBUILD_MAX_FILES:
+            raise IndexNotBuiltError(
+                f'{specprod} {specgroup} index not yet available; '
+                f'build it with python -m inspector.attrindex {specprod} --specgroup {specgroup}')
+        with _build_lock(specprod, specgroup, index_dir):
+            #- another worker may have built it while this one waited for the lock
+            if _current_version(path) is None:
+                build_index(specprod, specgroup, index_dir=index_dir, files=files)
+
+    index = AttributeIndex(path)
+    with _indexes_lock:
+        _indexes[key] = (index.path, index)
+    return index
+
+def query(specprod, specgroup, filters=None, xcol=None, offset=0, limit=QUERY_LIMIT, index_dir=INDEX_DIR):
+    """
+    Return one page of the targets of specprod/specgroup matching filters
+
+    Args:
+        specprod (str): production name
+        specgroup (str): healpix or tiles
+
+    Options:
+        filters (dict): inspector.io.filter_table style filters on indexed columns
+        xcol (list): additional columns; non-indexed ones are read from the
+            redrock files of just this page, like load_targets
+        offset (int): index of first matching row to return
+        limit (int): maximum number of rows to return, up to MAX_QUERY_LIMIT
+
+    Returns Table with meta NMATCH (total number of matches), OFFSET, LIMIT,
+    and NEXT_OFFSET if there are more matches.
+    """
+    from inspector.io import standardize_specprod, add_zcat_columns
+    from inspector.schema import validate_columns
+
+    specprod = standardize_specprod(specprod)
+    offset, limit = int(offset), int(limit)
+    if offset < 0:
+        raise ValueError(f'offset={offset} should be >= 0')
+    if not 0 < limit <= MAX_QUERY_LIMIT:
+        raise ValueError(f'limit={limit} should be between 1 and {MAX_QUERY_LIMIT}')
+
+    index = get_index(specprod, specgroup, index_dir=index_dir)
+    rows = index.select(filters)
+    nmatch = len(rows)
+    rows = rows[offset:offset+limit]
+
+    columns = list(OUTPUT_COLUMNS[specgroup])
+    extra = list()
+    for name in list(filters or []) + list(xcol or []):
+        if not name.isupper() or name in columns or name in extra:
+            continue
+        if name in index:
+            columns.append(name)
+        else:
+            extra.append(name)
+
+    columns = [c for c in columns if c in index]
+    validate_columns(specprod, specgroup, extra)
+    t = index.table(rows, columns)
+    if len(extra) > 0:
+        t = add_zcat_columns(t, specprod, xcol=extra)
+
+    t.meta['SPECPROD'] = specprod
+    t.meta['SPECGROUP'] = specgroup
+    t.meta['NMATCH'] = nmatch
+    t.meta['OFFSET'] = offset
+    t.meta['LIMIT'] = limit
+    if offset + limit < nmatch:
+        t.meta['NEXT_OFFSET'] = offset + limit
+
+    return t
+
+def _update(specprod, specgroups, index_dir, nproc):
+    """Run update_index for each specgroup, printing what changed; returns False if there were no files"""
+    ok = True
+    for specgroup in specgroups:
+        changes = update_index(specprod, specgroup, index_dir=index_dir, nproc=nproc)
+        if changes is None:
+            print(f'No redrock files found for {specprod} {specgroup}', file=sys.stderr)
+            ok = False
+        elif any(changes.values()):
+            counts = ', '.join(f'{len(v)} {k}' for k, v in changes.items())
+            print(f'{time.strftime("%Y-%m-%dT%H:%M:%S")} {specprod} {specgroup}: {counts}')
+    return ok
+
+def main():
+    parser = argparse.ArgumentParser(description='Build Data Inspector secondary indexes for a production')
+    parser.add_argument('specprod', help='production name, e.g. iron')
+    parser.add_argument('--specgroup', choices=('healpix', 'tiles'), action='append',
+                        help='healpix and/or tiles (default both)')
+    parser.add_argument('--index-dir', default=INDEX_DIR, help='output directory (default %(default)s)')
+    parser.add_argument('--nproc', type=int, default=max(1, (os.cpu_count() or 2)//2),
+                        help='number of processes reading files (default %(default)s)')
+    parser.add_argument('--update', action='store_true',
+                        help='only read files that are new or changed since the existing index')
+    parser.add_argument('--watch', type=float, metavar='SECONDS',
+                        help='with --update, keep checking for changes at this interval')
+    args = parser.parse_args()
+
+    if args.watch is not None and not args.update:
+        parser.error('--watch requires --update')
+
+    specgroups = args.specgroup if args.specgroup is not None else ['healpix', 'tiles']
+    if args.update:
+        ok = _update(args.specprod, specgroups, args.index_dir, args.nproc)
+        while args.watch is not None:
+            time.sleep(args.watch)
+            try:
+                _update(args.specprod, specgroups, args.index_dir, args.nproc)
+            except Exception as err:
+                #- e.g. a file being rewritten while it was read; try again next time
+                print(f'ERROR updating {args.specprod} index: {err}', file=sys.stderr)
+        if not ok:
+            sys.exit(1)
+        return
+
+    for specgroup in specgroups:
+        path = build_index(args.specprod, specgroup, index_dir=args.index_dir, nproc=args.nproc)
+        if path is None:
+            print(f'No redrock files found for {args.specprod} {specgroup}', file=sys.stderr)
+            sys.exit(1)
+
+if __name__ == '__main__':
+    main()
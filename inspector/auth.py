@@ -7,12 +7,183 @@ Example usage:
 @conditional_auth
 def healpix_radec_targets(specprod, foo):
     return f"Access to {specprod} with {foo=}"
+
+Credentials come from $DESI_COLLAB_USERNAME/$DESI_COLLAB_PASSWORD, read once
+at startup, and/or from a file of hashed credentials named by
+$DESI_INSPECTOR_CREDENTIALS with one "username:hash" line per user.
+The file is re-read when it changes, so users can be added or rotated without
+restarting the workers.  Generate lines for that file with
+
+    python -m inspector.auth USERNAME
 """
 
 import os, sys
-from flask import Flask, request, Response
+import time
+import hmac
+import base64
+import hashlib
+import getpass
+import threading
+from flask import request, Response
 from functools import wraps
 
+#- productions that are public and thus don't require authentication
+PUBLIC_SPECPRODS = frozenset(('fuji', 'guadalupe', 'iron', 'edr', 'dr1'))
+
+#- seconds between checks of whether the credentials file has changed
+CREDENTIALS_RELOAD_INTERVAL = 10
+
+#- default PBKDF2 iterations when creating new hashed credentials
+PBKDF2_ITERATIONS = 200000
+
+#- limit on number of cached successful logins
+MAX_CACHED_LOGINS = 1024
+
+def hash_password(password, salt=None, iterations=PBKDF2_ITERATIONS):
+    """
+    Return hashed password string 'pbkdf2_sha256$iterations$salt$hash'
+    suitable for the $DESI_INSPECTOR_CREDENTIALS file
+    """
+    if salt is None:
+        salt = os.urandom(16).hex()
+    digest = hashlib.pbkdf2_hmac('sha256', password.encode(), salt.encode(), iterations)
+    return f'pbkdf2_sha256${iterations}${salt}${digest.hex()}'
+
+def verify_password(password, hashed):
+    """
+    Return True if password matches hashed from hash_password, comparing in constant time
+    """
+    try:
+        algorithm, iterations, salt, expected = hashed.split('$')
+        iterations = int(iterations)
+    except ValueError:
+        return False
+
+    if algorithm != 'pbkdf2_sha256':
+        return False
+
+    digest = hashlib.pbkdf2_hmac('sha256', password.encode(), salt.encode(), iterations)
+    return hmac.compare_digest(digest.hex(), expected)
+
+class CredentialStore:
+    """
+    Username/password checks against credentials loaded once rather than per request
+
+    Plaintext environment credentials are kept only as a SHA-256 digest.
+    Because PBKDF2 is deliberately slow, successful logins are cached under
+    a keyed digest of username:password so that only the first request
+    from each user pays that cost.
+    """
+    def __init__(self, filename=None):
+        self.filename = filename
+        self._lock = threading.Lock()
+        self._cache_key = os.urandom(32)
+        #- same cost as checking a real hash, without computing one at startup
+        self._dummy_hash = f'pbkdf2_sha256${PBKDF2_ITERATIONS}${os.urandom(16).hex()}${"0"*64}'
+        self._hashes = dict()
+        self._mtime = None
+        self._logins = dict()
+        self.reload()
+
+    def reload(self):
+        """(Re)load credentials from the environment and the credentials file"""
+        env_username = os.getenv('DESI_COLLAB_USERNAME')
+        env_password = os.getenv('DESI_COLLAB_PASSWORD')
+        if env_username is not None and env_password is not None:
+            self._env_username = env_username.encode()
+            self._env_digest = hashlib.sha256(env_password.encode()).digest()
+        else:
+            self._env_username = self._env_digest = None
+
+        hashes = dict()
+        mtime = None
+        if self.filename is not None:
+            try:
+                mtime = os.path.getmtime(self.filename)
+                with open(self.filename) as fp:
+                    for lineno, line in enumerate(fp, start=1):
+                        line = line.strip()
+                        if not line or line.startswith('#'):
+                            continue
+                        username, sep, hashed = line.partition(':')
+                        if not sep or not username:
+                            print(f'WARNING: skipping malformed line {lineno} of credentials file {self.filename}')
+                            continue
+                        hashes[username] = hashed
+            except FileNotFoundError:
+                print(f'WARNING: credentials file {self.filename} not found')
+            except (OSError, UnicodeDecodeError) as err:
+                #- keep the previous credentials rather than locking everyone out
+                print(f'WARNING: unable to read credentials file {self.filename}: {err}')
+                with self._lock:
+                    self._last_check = time.time()
+                return
+
+        with self._lock:
+            self._hashes = hashes
+            self._mtime = mtime
+            self._last_check = time.time()
+            self._logins = dict()
+
+    def _check_reload(self):
+        """Reload if the credentials file has changed, checking at most every CREDENTIALS_RELOAD_INTERVAL"""
+        if self.filename is None:
+            return
+
+        now = time.time()
+        if now - self._last_check < CREDENTIALS_RELOAD_INTERVAL:
+            return
+
+        self._last_check = now
+        try:
+            mtime = os.path.getmtime(self.filename)
+        except FileNotFoundError:
+            mtime = None
+
+        if mtime != self._mtime:
+            self.reload()
+
+    def check(self, username, password):
+        """Return True if username/password are valid credentials"""
+        if username is None or password is None:
+            return False
+
+        self._check_reload()
+
+        login = hmac.new(self._cache_key, f'{username}:{password}'.encode(), 'sha256').digest()
+        if login in self._logins:
+            return True
+
+        valid = False
+        if self._env_username is not None:
+            #- evaluate both comparisons so timing doesn't reveal which failed
+            user_ok = hmac.compare_digest(username.encode(), self._env_username)
+            password_ok = hmac.compare_digest(hashlib.sha256(password.encode()).digest(), self._env_digest)
+            valid = user_ok & password_ok
+
+        if not valid and self._hashes:
+            #- unknown users still pay the hashing cost so timing doesn't reveal who
+            #- exists; environment credentials alone are already constant time
+            hashed = self._hashes.get(username)
+            if hashed is None:
+                verify_password(password, self._dummy_hash)
+            else:
+                valid = verify_password(password, hashed)
+
+        if valid:
+            with self._lock:
+                if len(self._logins) >= MAX_CACHED_LOGINS:
+                    self._logins.clear()
+                self._logins[login] = True
+
+        return valid
+
+_credentials = CredentialStore(os.getenv('DESI_INSPECTOR_CREDENTIALS'))
+
+def reload_credentials():
+    """Reload credentials after changing $DESI_COLLAB_USERNAME/PASSWORD or the credentials file"""
+    _credentials.reload()
+
 # Define a decorator for requiring HTTP Basic Auth
 def requires_auth(f):
     @wraps(f)
@@ -25,7 +196,7 @@ def requires_auth(f):
 
 # Function to check if username and password are correct
 def check_auth(username, password):
-    return (username == os.environ['DESI_COLLAB_USERNAME']) and (password == os.environ['DESI_COLLAB_PASSWORD'])
+    return _credentials.check(username, password)
 
 # Function to send a 401 response that enables basic auth
 def authenticate():
@@ -36,11 +207,36 @@ def authenticate():
 
 # Custom route decorator to conditionally apply requires_auth
 def conditional_auth(f):
+    protected = requires_auth(f)   # wrap once per route, not per request
     @wraps(f)
     def decorated(*args, **kwargs):
-        specprod = kwargs.get('specprod')
-        if specprod not in ('fuji', 'guadalupe', 'iron', 'edr', 'dr1'):
-            return requires_auth(f)(*args, **kwargs)
+        #- comparison routes have a comma separated list of specprods
+        specprods = kwargs.get('specprods', kwargs.get('specprod') or '').split(',')
+        if not all(s.strip() in PUBLIC_SPECPRODS for s in specprods):
+            return protected(*args, **kwargs)
         return f(*args, **kwargs)
     return decorated
 
+def auth_headers(prefix):
+    """
+    Return Authorization header for requests to another inspector server, if any
+
+    Credentials come from ${prefix}_USERNAME/${prefix}_PASSWORD, falling
+    back to $DESI_COLLAB_USERNAME/$DESI_COLLAB_PASSWORD
+    """
+    username = os.getenv(f'{prefix}_USERNAME', os.getenv('DESI_COLLAB_USERNAME'))
+    password = os.getenv(f'{prefix}_PASSWORD', os.getenv('DESI_COLLAB_PASSWORD'))
+    if username is None or password is None:
+        return dict()
+    token = base64.b64encode(f'{username}:{password}'.encode()).decode()
+    return {'Authorization': f'Basic {token}'}
+
+if __name__ == '__main__':
+    #- print a line for the $DESI_INSPECTOR_CREDENTIALS file
+    if len(sys.argv) != 2:
+        print('Usage: python -m inspector.auth USERNAME', file=sys.stderr)
+        sys.exit(1)
+
+    username = sys.argv[1]
+    password = getpass.getpass(f'Password for {username}: ')
+    print(f'{username}:{hash_password(password)}')
@@ -0,0 +1,225 @@
+"""
+inspector.benchmark
+===================
+
+Time the core Data Inspector code paths against a synthetic production
+(see inspector.synthetic) so that performance regressions are caught before
+deployment.  Runs offline; no $DESI_ROOT data are needed.
+
+    python -m inspector.benchmark --output bench.json
+    python -m inspector.benchmark --output new.json --compare bench.json
+
+With --compare, exits with status 1 if any benchmark is slower than the
+baseline by more than --tolerance.
+"""
+
+import sys
+import json
+import time
+import socket
+import platform
+import argparse
+import tempfile
+import warnings
+
+import numpy as np
+
+#- numbers of targets returned by each benchmarked query
+SIZES = (1, 10, 100, 1000, 10000)
+
+#- spectra reads and rendering are limited to MAX_SPECTRA anyway and are slow,
+#- so use fewer sizes
+SPECTRA_SIZES = (1, 10, 100)
+
+RA0, DEC0 = 210.0, 5.0
+
+def timeit(func, repeat=3):
+    """
+    Call func() repeat times; returns (list of elapsed seconds, last result)
+    """
+    times = list()
+    result = None
+    for i in range(repeat):
+        t0 = time.perf_counter()
+        result = func()
+        times.append(time.perf_counter() - t0)
+
+    return times, result
+
+def radius_for_size(targets, n):
+    """
+    Return radius [arcsec] of cone around (RA0,DEC0) containing n targets
+    """
+    cosdec = np.cos(np.radians(DEC0))
+    dra = (targets['TARGET_RA'] - RA0) * cosdec
+    ddec = targets['TARGET_DEC'] - DEC0
+    sep = np.sort(np.sqrt(dra**2 + ddec**2)) * 3600
+    return sep[n-1] + 0.01
+
+def _record(results, name, specgroup, size, times, nrows):
+    entry = dict(name=name, specgroup=specgroup, size=size, nrows=int(nrows),
+                 times=times, min=min(times), median=float(np.median(times)))
+    results.append(entry)
+    print(f'{name:24s} {specgroup:8s} {size:6d} {nrows:6d} rows  '
+          f'min {entry["min"]:8.4f}  median {entry["median"]:8.4f} sec')
+    return entry
+
+def run_benchmarks(specprod, targets, sizes=SIZES, spectra_sizes=SPECTRA_SIZES, repeat=3):
+    """
+    Run benchmarks against specprod whose targets are in table targets
+
+    Returns list of dict with keys name, specgroup, size, nrows, times, min, median
+    """
+    from desispec import inventory
+    from desispec.io import read_spectra_parallel
+    from inspector.io import load_targets, load_spectra, add_zcat_columns, filter_table
+    from inspector.sharedread import read_spectra_shared
+    from app import app, render_table, render_spectra_plot, render_spectra_fits
+
+    rng = np.random.default_rng(0)
+    results = list()
+    filters = dict(Z=['gt:0.5', 'lt:2.0'], ZWARN='0')
+    for size in sizes:
+        if size > len(targets):
+            print(f'Skipping size {size} > {len(targets)} targets')
+            continue
+
+        radius = radius_for_size(targets, size)
+        radec = f'{RA0},{DEC0},{radius:.3f}'
+        targetids = list(rng.choice(targets['TARGETID'], size, replace=False))
+        for specgroup in ('healpix', 'tiles'):
+            if specgroup == 'healpix':
+                query = lambda: inventory.target_healpix(radec=(RA0, DEC0, radius), specprod=specprod)
+            else:
+                query = lambda: inventory.target_tiles(radec=(RA0, DEC0, radius), specprod=specprod)
+
+            times, t = timeit(query, repeat)
+            _record(results, 'inventory', specgroup, size, times, len(t))
+
+            times, zcat = timeit(lambda: add_zcat_columns(t, specprod), repeat)
+            _record(results, 'add_zcat_columns', specgroup, size, times, len(zcat))
+
+            times, filtered = timeit(lambda: filter_table(zcat, filters), repeat)
+            _record(results, 'filter_table', specgroup, size, times, len(filtered))
+
+            times, tx = timeit(lambda: load_targets(specprod, specgroup, radec=radec), repeat)
+            _record(results, 'load_targets_radec', specgroup, size, times, len(tx))
+
+            times, tx = timeit(lambda: load_targets(specprod, specgroup, targetids=targetids), repeat)
+            _record(results, 'load_targets_targetids', specgroup, size, times, len(tx))
+
+            url = f'/{specprod}/targets/{specgroup}/radec/{radec}'
+            for fmt in ('html', 'json', 'csv', 'fits'):
+                with app.test_request_context(f'{url}?format={fmt}'):
+                    times, _ = timeit(lambda: render_table(tx.copy(), fmt), repeat)
+                _record(results, f'render_table_{fmt}', specgroup, size, times, len(tx))
+
+            if size in spectra_sizes:
+                times, spectra = timeit(lambda: load_spectra(specprod, specgroup, radec=radec), repeat)
+                _record(results, 'load_spectra', specgroup, size, times, len(spectra.fibermap))
+
+                #- shared memory reader vs. read_spectra_parallel, for scaling with cores
+                rdspec_kwargs = dict(return_redshifts=True)
+                times, sp = timeit(lambda: read_spectra_parallel(tx, specprod=specprod,
+                                                                 rdspec_kwargs=rdspec_kwargs), repeat)
+                _record(results, 'read_spectra_parallel', specgroup, size, times, len(sp.fibermap))
+                for nproc in (1, 2, 4):
+                    times, sp = timeit(lambda: read_spectra_shared(tx, specprod, rdspec_kwargs=rdspec_kwargs,
+                                                                   nproc=nproc, min_files=1), repeat)
+                    _record(results, f'read_spectra_shared_{nproc}', specgroup, size, times, len(sp.fibermap))
+
+                url = f'/{specprod}/spectra/{specgroup}/radec/{radec}'
+                with app.test_request_context(url):
+                    times, _ = timeit(lambda: render_spectra_plot(spectra), repeat)
+                _record(results, 'render_spectra_plot', specgroup, size, times, len(spectra.fibermap))
+
+                with app.test_request_context(f'{url}?format=fits'):
+                    times, _ = timeit(lambda: render_spectra_fits(spectra), repeat)
+                _record(results, 'render_spectra_fits', specgroup, size, times, len(spectra.fibermap))
+
+    return results
+
+def compare(results, baseline, tolerance=1.25):
+    """
+    Compare benchmark results to baseline results
+
+    Args:
+        results: list of dict from run_benchmarks
+        baseline: list of dict from a previous run_benchmarks
+        tolerance (float): allowed ratio of median times before flagging a regression
+
+    Returns list of (entry, baseline_entry, ratio) for regressions
+    """
+    key = lambda r: (r['name'], r['specgroup'], r['size'])
+    baseline = {key(r): r for r in baseline}
+    regressions = list()
+    for entry in results:
+        if key(entry) in baseline:
+            base = baseline[key(entry)]
+            ratio = entry['median'] / base['median']
+            if ratio > tolerance:
+                regressions.append((entry, base, ratio))
+
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the Data Inspector on a synthetic production')
+    parser.add_argument('-o', '--output', help='output json file with results')
+    parser.add_argument('--compare', help='baseline json file to compare against')
+    parser.add_argument('--tolerance', type=float, default=1.25,
+                        help='allowed ratio new/baseline median time (default %(default)s)')
+    parser.add_argument('--desi-root', help='where to write synthetic production (default: tmpdir)')
+    parser.add_argument('--ntargets', type=int, default=max(SIZES),
+                        help='number of synthetic targets (default %(default)s)')
+    parser.add_argument('--wavestep', type=float, default=8.0,
+                        help='wavelength step [Angstrom] of synthetic spectra (default %(default)s)')
+    parser.add_argument('--sizes', type=str, help='comma separated query sizes')
+    parser.add_argument('--repeat', type=int, default=3, help='timing repeats per benchmark')
+    args = parser.parse_args()
+
+    from inspector import synthetic
+
+    if args.sizes is not None:
+        sizes = tuple(int(x) for x in args.sizes.split(','))
+    else:
+        sizes = SIZES
+
+    specprod = 'synth'
+    with tempfile.TemporaryDirectory() as tmpdir:
+        desi_root = args.desi_root if args.desi_root is not None else tmpdir
+        synthetic.set_environment(desi_root)
+
+        t0 = time.perf_counter()
+        targets, obs = synthetic.make_production(desi_root, specprod, ntargets=args.ntargets,
+                                                 wavestep=args.wavestep, ra0=RA0, dec0=DEC0)
+        print(f'Generated {len(targets)} synthetic targets in {time.perf_counter()-t0:.1f} sec')
+
+        with warnings.catch_warnings():
+            warnings.filterwarnings("ignore", message=r".*Cannot merge meta key .*")
+            results = run_benchmarks(specprod, targets, sizes=sizes, repeat=args.repeat)
+
+    meta = dict(timestamp=time.strftime('%Y-%m-%dT%H:%M:%S'), host=socket.gethostname(),
+                python=platform.python_version(), numpy=np.__version__,
+                ntargets=args.ntargets, wavestep=args.wavestep, repeat=args.repeat)
+
+    if args.output is not None:
+        with open(args.output, 'w') as fp:
+            json.dump(dict(meta=meta, results=results), fp, indent=1)
+        print(f'Wrote {args.output}')
+
+    if args.compare is not None:
+        with open(args.compare) as fp:
+            baseline = json.load(fp)['results']
+
+        regressions = compare(results, baseline, args.tolerance)
+        for entry, base, ratio in regressions:
+            print(f"REGRESSION {entry['name']} {entry['specgroup']} size={entry['size']}: "
+                  f"{entry['median']:.4f} vs {base['median']:.4f} sec ({ratio:.2f}x)")
+
+        if len(regressions) > 0:
+            sys.exit(1)
+        else:
+            print(f'No regressions relative to {args.compare}')
+
+if __name__ == '__main__':
+    main()
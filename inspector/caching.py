@@ -0,0 +1,154 @@
+"""
+inspector.caching
+=================
+
+HTTP caching for responses from released productions, which never change.
+
+Responses for immutable productions get a deterministic ETag derived from
+the request URL (with query options sorted), a Last-Modified from the
+production directory, and a Cache-Control max-age, so that browsers and
+front-end caches can revalidate with a cheap 304 Not Modified that skips
+load_targets entirely.  The Cache-Control is public only if every
+production is public; immutable productions that require authentication
+are "private" so that shared caches don't serve them to anonymous clients.
+Other productions (e.g. daily) are marked "private, no-cache".
+
+Example usage:
+
+@app.route("/<string:specprod>/targets/<string:targetids>")
+@conditional_auth
+@http_cache
+def targets(specprod, targetids):
+    ...
+"""
+
+import os
+import hashlib
+from datetime import datetime, timezone
+from functools import wraps
+
+from flask import request, make_response, Response
+
+from inspector.auth import PUBLIC_SPECPRODS
+from inspector.compression import COMPRESS
+from inspector.io import standardize_specprod
+from inspector.shards import PARTIAL_HEADER
+
+#- productions whose responses never change, by standardized name
+if 'DESI_INSPECTOR_IMMUTABLE_SPECPRODS' in os.environ:
+    IMMUTABLE_SPECPRODS = frozenset(standardize_specprod(s.strip())
+                                    for s in os.environ['DESI_INSPECTOR_IMMUTABLE_SPECPRODS'].split(',') if s.strip())
+else:
+    IMMUTABLE_SPECPRODS = frozenset(standardize_specprod(s) for s in PUBLIC_SPECPRODS)
+
+#- productions that shared caches may store, by standardized name
+_PUBLIC = frozenset(standardize_specprod(s) for s in PUBLIC_SPECPRODS)
+
+#- bump to invalidate cached responses after a deployment changes their content
+CACHE_VERSION = os.getenv('DESI_INSPECTOR_CACHE_VERSION', '1')
+
+#- seconds that caches may reuse a response without revalidating
+CACHE_MAX_AGE = int(os.getenv('DESI_INSPECTOR_CACHE_MAX_AGE', 24*3600))
+
+_production_mtimes = dict()
+
+def production_mtime(specprod):
+    """
+    Return datetime when specprod directory was last modified, or None if unknown
+
+    Cached per process since this is only used for immutable productions
+    """
+    if specprod not in _production_mtimes:
+        from desispec.io import specprod_root
+        try:
+            mtime = os.path.getmtime(specprod_root(specprod))
+            _production_mtimes[specprod] = datetime.fromtimestamp(int(mtime), tz=timezone.utc)
+        except (OSError, KeyError):
+            _production_mtimes[specprod] = None
+
+    return _production_mtimes[specprod]
+
+def normalized_query():
+    """
+    Return current request as a normalized string: host and path followed by
+    query options sorted by key and value, with the default format=html added
+    """
+    args = request.args.to_dict(flat=False)
+    args['format'] = [v.lower() for v in args.get('format', ['html',])]
+    query = '&'.join(f'{key}={value}' for key in sorted(args) for value in sorted(args[key]))
+    return f'{request.host_url}{request.path.lstrip("/")}?{query}'
+
+def query_etag(specprod):
+    """Return ETag for the current request to specprod"""
+    key = f'{CACHE_VERSION}|{specprod}|{normalized_query()}'
+    return hashlib.sha256(key.encode()).hexdigest()[0:32]
+
+def _add_cache_headers(response, etag, last_modified, public=True):
+    response.set_etag(etag)
+    if last_modified is not None:
+        response.last_modified = last_modified
+    if public:
+        response.cache_control.public = True
+    else:
+        response.cache_control.private = True
+    response.cache_control.max_age = CACHE_MAX_AGE
+    #- curl/wget get an attachment Content-Disposition for csv/ascii, and only for those
+    if request.args.get('format', '').lower() in ('csv', 'ascii'):
+        response.vary.add('User-Agent')
+    return response
+
+def http_cache(f):
+    """
+    Route decorator adding conditional GET support and Cache-Control headers
+
+    Requires the route to have a specprod argument, or a comma separated
+    specprods argument for comparisons, which are cached only if all of
+    the productions are immutable
+    """
+    @wraps(f)
+    def decorated(*args, **kwargs):
+        specprods = kwargs.get('specprods', kwargs.get('specprod', '')).split(',')
+        specprods = [standardize_specprod(s.strip()) for s in specprods]
+        specprod = ','.join(specprods)
+        if not all(s in IMMUTABLE_SPECPRODS for s in specprods):
+            response = make_response(f(*args, **kwargs))
+            if response.status_code == 200:
+                response.cache_control.private = True
+                response.cache_control.no_cache = True
+            return response
+
+        etag = query_etag(specprod)
+        public = all(s in _PUBLIC for s in specprods)
+        mtimes = [production_mtime(s) for s in specprods]
+        last_modified = None if None in mtimes else max(mtimes)
+
+        #- If-None-Match takes precedence over If-Modified-Since (RFC 9110)
+        not_modified = False
+        if request.if_none_match:
+            #- inspector.compression appends the content encoding to the ETag
+            for variant in (etag, f'{etag}-gzip', f'{etag}-zstd'):
+                if request.if_none_match.contains_weak(variant):
+                    not_modified = True
+                    etag = variant
+                    break
+        elif request.if_modified_since and last_modified is not None:
+            not_modified = last_modified <= request.if_modified_since
+
+        if not_modified:
+            response = _add_cache_headers(Response(status=304), etag, last_modified, public)
+            if COMPRESS:
+                #- match the Vary of the 200 response, added by inspector.compression
+                response.vary.add('Accept-Encoding')
+            return response
+
+        response = make_response(f(*args, **kwargs))
+        if PARTIAL_HEADER in response.headers or response.cache_control.no_store:
+            #- missing results from failed shards must not be reused, nor
+            #- streamed pages whose success is only known after the body is sent
+            response.cache_control.no_store = True
+        elif response.status_code == 200:
+            _add_cache_headers(response, etag, last_modified, public)
+
+        return response
+
+    return decorated
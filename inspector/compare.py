@@ -0,0 +1,234 @@
+"""
+inspector.compare
+=================
+
+Compare the same targets across productions, e.g. a new production vs iron.
+
+compare_targets runs load_targets for each production in its own thread, so
+that the inventory lookups and redrock reads of the productions overlap and
+the latency is close to that of the slowest single production, then outer
+joins the results on TARGETID (plus SURVEY/PROGRAM/HEALPIX for healpix or
+TILEID/PETAL_LOC/FIBER for tiles).  Per-production columns like Z, ZWARN,
+and SPECTYPE get a _SPECPROD suffix, e.g. Z_IRON and Z_LOA; targets missing
+from a production are masked in its columns.
+
+iter_compare_spectra reads the spectra of each production concurrently and
+yields them as they are read, labeled by production, for the overlay viewer.
+
+Example usage:
+
+    t = compare_targets(['iron', 'loa'], 'healpix', radec='210,5,30')
+    print(t['TARGETID', 'Z_IRON', 'Z_LOA'])
+"""
+
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+#- maximum number of productions in one comparison
+MAX_COMPARE_SPECPRODS = 4
+
+#- columns identifying the same spectrum in different productions
+JOIN_KEYS = dict(
+    healpix=('TARGETID', 'SURVEY', 'PROGRAM', 'HEALPIX'),
+    tiles=('TARGETID', 'TILEID', 'PETAL_LOC', 'FIBER'),
+    )
+
+#- columns shared by all productions rather than suffixed
+COMMON_COLUMNS = ('TARGET_RA', 'TARGET_DEC')
+
+def parse_specprods(specprods):
+    """
+    Parse comma separated string or list of productions -> list of standardized names
+
+    Raises ValueError unless there are 2 to MAX_COMPARE_SPECPRODS unique productions
+    """
+    from inspector.io import standardize_specprod
+
+    if isinstance(specprods, str):
+        specprods = specprods.split(',')
+
+    result = list()
+    for specprod in specprods:
+        specprod = standardize_specprod(specprod.strip())
+        if specprod != '' and specprod not in result:
+            result.append(specprod)
+
+    if not 2 <= len(result) <= MAX_COMPARE_SPECPRODS:
+        raise ValueError(f'Please compare between 2 and {MAX_COMPARE_SPECPRODS} different productions, '
+                         f'not {specprods}')
+
+    return result
+
+def suffix(specprod):
+    """Return column name suffix for specprod"""
+    return '_' + specprod.upper()
+
+def join_targets(tables, specgroup, keys=None):
+    """
+    Outer join per-production target tables, suffixing per-production columns
+
+    Args:
+        tables: dict of specprod -> table from load_targets
+        specgroup (str): healpix or tiles
+
+    Options:
+        keys (list): columns to join on; default JOIN_KEYS[specgroup]
+
+    Returns joined Table sorted by the keys
+    """
+    from astropy.table import Table, join, unique, vstack
+
+    if keys is None:
+        keys = list(JOIN_KEYS[specgroup])
+
+    #- positions are the same in every production, so keep one copy
+    common = [c for c in COMMON_COLUMNS if all(c in t.colnames for t in tables.values())]
+    positions = vstack([Table(t[keys + common], copy=False) for t in tables.values()],
+                       metadata_conflicts='silent')
+    positions = unique(positions, keys=keys)
+    positions.meta = dict()
+
+    result = positions
+    for specprod, t in tables.items():
+        t = Table(t, copy=False)
+        t.meta = dict()
+        renamed = [c for c in t.colnames if c not in keys and c not in common]
+        t = t[keys + renamed]
+        t.rename_columns(renamed, [c + suffix(specprod) for c in renamed])
+        result = join(result, t, keys=keys, join_type='left')
+
+    return result
+
+def compare_targets(specprods, specgroup, radec=None, targetids=None, filters=None, xcol=None, dedup=None):
+    """
+    Return table joining the targets of each production
+
+    Args:
+        specprods: list or comma separated string of production names
+        specgroup (str): healpix or tiles
+        radec, targetids, filters, xcol, dedup: passed to load_targets for each production
+
+    Filters are applied to each production separately, so a target is
+    included if it passes the filters in any production.  With dedup, rows
+    are joined on TARGETID alone since the best tile can differ between
+    productions.  The meta has SPECPRODS and NTARGETS_SPECPROD for each.
+    """
+    from inspector.io import load_targets
+
+    specprods = parse_specprods(specprods)
+
+    def _load(specprod):
+        try:
+            return load_targets(specprod, specgroup, radec=radec, targetids=targetids,
+                                filters=filters, xcol=xcol, dedup=dedup)
+        except ValueError as err:
+            raise ValueError(f'{specprod}: {err}') from err
+
+    with ThreadPoolExecutor(max_workers=len(specprods)) as pool:
+        futures = [pool.submit(_load, specprod) for specprod in specprods]
+        tables = dict(zip(specprods, [f.result() for f in futures]))
+
+    keys = ['TARGETID',] if dedup is not None else None
+    t = join_targets(tables, specgroup, keys=keys)
+
+    first = tables[specprods[0]]
+    for key in ('RA', 'DEC', 'RADIUS'):
+        if key in first.meta:
+            t.meta[key] = first.meta[key]
+    t.meta['SPECPROD'] = ' vs '.join(specprods)
+    t.meta['SPECPRODS'] = ','.join(specprods)
+    for specprod, targets in tables.items():
+        t.meta['NTARGETS' + suffix(specprod)] = len(targets)
+        if 'NDEDUP' in targets.meta:
+            t.meta['NDEDUP' + suffix(specprod)] = targets.meta['NDEDUP']
+
+    return t
+
+def split_targets(comparison, specgroup, specprods):
+    """
+    Return dict of specprod -> targets table for reading spectra, from a compare_targets table
+
+    Only targets found in each production are included in its table.
+    """
+    from astropy.table import Table
+
+    tables = dict()
+    for specprod in specprods:
+        sfx = suffix(specprod)
+        present = np.asarray(~np.ma.getmaskarray(comparison['Z' + sfx]))
+        t = Table()
+        for col in comparison.colnames:
+            if col.endswith(sfx):
+                t[col[:-len(sfx)]] = np.asarray(comparison[col][present])
+            elif not any(col.endswith(suffix(p)) for p in specprods):
+                t[col] = np.asarray(comparison[col][present])
+        tables[specprod] = t
+
+    return tables
+
+def iter_compare_spectra(tables, rdspec_kwargs=None):
+    """
+    Yield (specprod, Spectra) for the targets of each production as files are read
+
+    Args:
+        tables: dict of specprod -> targets table, e.g. from split_targets
+        rdspec_kwargs (dict): passed to inspector.io.iter_spectra
+
+    Each production is read by its own thread running iter_spectra, so the
+    productions are read concurrently.  Each thread waits for the caller
+    to take its previous file before handing over the next one, so memory
+    doesn't grow with the number of files.  Closing the generator stops
+    the remaining reads.
+    """
+    from inspector.io import iter_spectra
+
+    results = queue.Queue(maxsize=max(1, len(tables)))
+    stop = threading.Event()
+    done = object()
+
+    def _put(item):
+        #- give up if the caller has gone away, rather than block forever
+        while not stop.is_set():
+            try:
+                results.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def _read(specprod, targetcat):
+        try:
+            if len(targetcat) > 0:
+                spectra_iter = iter_spectra(targetcat, specprod, rdspec_kwargs=rdspec_kwargs)
+                try:
+                    for spectra in spectra_iter:
+                        if not _put((specprod, spectra)):
+                            break
+                        del spectra
+                finally:
+                    spectra_iter.close()
+        except Exception as err:
+            _put((specprod, err))
+        finally:
+            _put((specprod, done))
+
+    threads = [threading.Thread(target=_read, args=(specprod, t), daemon=True) for specprod, t in tables.items()]
+    for thread in threads:
+        thread.start()
+
+    try:
+        remaining = len(threads)
+        while remaining > 0:
+            specprod, item = results.get()
+            if item is done:
+                remaining -= 1
+            elif isinstance(item, Exception):
+                raise item
+            else:
+                yield specprod, item
+            del item
+    finally:
+        stop.set()
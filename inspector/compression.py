@@ -0,0 +1,138 @@
+"""
+inspector.compression
+=====================
+
+Content-negotiated gzip/zstd compression of responses.
+
+Compression runs incrementally over the response body, so streamed bodies
+are compressed chunk by chunk as they are generated rather than buffered.
+Text-like responses (html, json, csv/ascii) above a size threshold are
+compressed when the client's Accept-Encoding allows it; FITS and other
+binary downloads are left alone unless the request also includes
+?compress=1, since they compress poorly relative to the CPU cost.
+
+zstd is offered only if the optional zstandard package is installed.
+
+Example usage:
+
+app.after_request(compress_response)
+"""
+
+import os
+import zlib
+
+from flask import request
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+COMPRESS = os.getenv('DESI_INSPECTOR_COMPRESS', '1').lower() not in ('0', 'false', 'no')
+
+#- responses with known length smaller than this [bytes] are sent uncompressed
+COMPRESS_MIN_SIZE = int(os.getenv('DESI_INSPECTOR_COMPRESS_MIN_SIZE', 1024))
+
+GZIP_LEVEL = int(os.getenv('DESI_INSPECTOR_GZIP_LEVEL', 6))
+ZSTD_LEVEL = int(os.getenv('DESI_INSPECTOR_ZSTD_LEVEL', 3))
+
+#- chunk size when compressing non-streamed bodies
+CHUNK_SIZE = 256*1024
+
+COMPRESSIBLE_MIMETYPES = ('text/html', 'text/plain', 'text/csv', 'text/css',
+                          'text/javascript', 'application/json', 'application/javascript')
+
+def available_encodings():
+    """Return supported encodings in order of preference"""
+    if zstandard is not None:
+        return ('zstd', 'gzip')
+    else:
+        return ('gzip',)
+
+def _compressor(encoding):
+    """Return (compress, flush_block, finish) functions for encoding"""
+    if encoding == 'gzip':
+        obj = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        return obj.compress, lambda: obj.flush(zlib.Z_SYNC_FLUSH), obj.flush
+    elif encoding == 'zstd':
+        obj = zstandard.ZstdCompressor(level=ZSTD_LEVEL).compressobj()
+        return (obj.compress, lambda: obj.flush(zstandard.COMPRESSOBJ_FLUSH_BLOCK),
+                lambda: obj.flush(zstandard.COMPRESSOBJ_FLUSH_FINISH))
+    else:
+        raise ValueError(f'Unsupported encoding {encoding}')
+
+def compress_chunks(chunks, encoding, flush_each=False):
+    """
+    Generator yielding chunks compressed with encoding
+
+    Args:
+        chunks: iterable of bytes or str
+        encoding (str): 'gzip' or 'zstd'
+        flush_each (bool): if True, flush after every input chunk so that a
+            streaming client can decode each one as soon as it arrives
+    """
+    compress, flush_block, finish = _compressor(encoding)
+    try:
+        for chunk in chunks:
+            if isinstance(chunk, str):
+                chunk = chunk.encode()
+            data = compress(chunk)
+            if flush_each:
+                data += flush_block()
+            if data:
+                yield data
+        yield finish()
+    finally:
+        if hasattr(chunks, 'close'):
+            chunks.close()
+
+def _split(data, size=CHUNK_SIZE):
+    for i in range(0, len(data), size):
+        yield data[i:i+size]
+
+def compress_response(response):
+    """
+    Compress response body if the client accepts it and it is worth it;
+    for use with app.after_request
+    """
+    if not COMPRESS or request.method == 'HEAD':
+        return response
+
+    if response.status_code < 200 or response.status_code in (204, 206, 304):
+        return response
+
+    if 'Content-Encoding' in response.headers:
+        return response
+
+    #- vary on Accept-Encoding even if not compressing this time,
+    #- so that caches don't serve an uncompressed body to everyone
+    response.vary.add('Accept-Encoding')
+
+    explicit = request.args.get('compress', '').lower() in ('1', 'true', 'yes')
+    if response.mimetype not in COMPRESSIBLE_MIMETYPES and not explicit:
+        return response
+
+    encoding = request.accept_encodings.best_match(available_encodings())
+    if encoding is None:
+        return response
+
+    #- e.g. send_file; iterate through the file wrapper rather than passing it through
+    response.direct_passthrough = False
+
+    if response.is_streamed:
+        response.response = compress_chunks(response.response, encoding, flush_each=True)
+        response.headers.pop('Content-Length', None)
+    else:
+        data = response.get_data()
+        if len(data) < COMPRESS_MIN_SIZE and not explicit:
+            return response
+        response.set_data(b''.join(compress_chunks(_split(data), encoding)))
+
+    response.headers['Content-Encoding'] = encoding
+
+    #- compressed and uncompressed bodies need different strong ETags
+    etag, weak = response.get_etag()
+    if etag is not None:
+        response.set_etag(f'{etag}-{encoding}', weak=weak)
+
+    return response
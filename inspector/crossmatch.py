@@ -0,0 +1,257 @@
+"""
+inspector.crossmatch
+====================
+
+Crossmatch an uploaded list of positions against a production's targets.
+
+Rather than one inventory cone search per position, positions are grouped
+by the HEALPix pixels that the target inventory is partitioned by
+(INVENTORY_NSIDE), and each group is covered by a single cone search around
+its center, so each inventory file is read about once however many
+positions fall in it.  Candidates farther than the largest match radius
+from every position are dropped as each group is read, and the remaining
+targets are matched to all positions at once with a KD-tree of unit
+vectors, using each position's own radius.  The result has one row per
+(position, target) match, with the INPUT_ROW index of the position and the
+SEPARATION in arcsec; without matches it still has the requested columns.
+
+Example usage:
+
+    positions = read_positions(open('mycat.csv', 'rb').read(), default_radius=1.0)
+    matches = crossmatch(positions, 'iron', 'healpix')
+"""
+
+import io
+import os
+
+import numpy as np
+
+MAX_POSITIONS = 10000
+
+#- maximum match radius per position [arcsec]
+MAX_MATCH_RADIUS = 60.0
+
+#- HEALPix nside for grouping positions, matching the inventory files; ~3.7 deg pixels
+INVENTORY_NSIDE = int(os.getenv('DESI_INSPECTOR_INVENTORY_NSIDE', 16))
+
+RA_COLUMNS = ('RA', 'TARGET_RA', 'RA_DEG', 'ALPHA')
+DEC_COLUMNS = ('DEC', 'TARGET_DEC', 'DEC_DEG', 'DELTA')
+RADIUS_COLUMNS = ('RADIUS', 'RADIUS_ARCSEC')
+
+def _find_column(table, names, what):
+    upper = {c.upper(): c for c in table.colnames}
+    for name in names:
+        if name in upper:
+            return upper[name]
+    raise ValueError(f'No {what} column found; expected one of {names}')
+
+def read_positions(data, default_radius=1.0):
+    """
+    Parse uploaded positions from FITS or CSV/ECSV bytes
+
+    Args:
+        data (bytes): file contents, with RA and DEC columns [deg] and an
+            optional RADIUS column [arcsec]
+        default_radius (float): radius [arcsec] for positions without one
+
+    Returns Table with RA, DEC, RADIUS columns; raises ValueError for invalid input
+    """
+    from astropy.table import Table
+
+    if len(data) == 0:
+        raise ValueError('No positions uploaded')
+
+    try:
+        if data[0:6] == b'SIMPLE':
+            t = Table.read(io.BytesIO(data), format='fits')
+        else:
+            text = data.decode('utf-8')
+            fmt = 'ascii.ecsv' if text.startswith('# %ECSV') else 'ascii.csv'
+            t = Table.read(text, format=fmt)
+    except ValueError:
+        raise
+    except Exception as err:
+        raise ValueError(f'Unable to parse positions: {err}')
+
+    if len(t) > MAX_POSITIONS:
+        raise ValueError(f'{len(t)} positions is more than the maximum {MAX_POSITIONS}; please split your catalog')
+
+    positions = Table()
+    try:
+        positions['RA'] = np.asarray(t[_find_column(t, RA_COLUMNS, 'RA')], dtype=float)
+        positions['DEC'] = np.asarray(t[_find_column(t, DEC_COLUMNS, 'DEC')], dtype=float)
+        try:
+            positions['RADIUS'] = np.asarray(t[_find_column(t, RADIUS_COLUMNS, 'RADIUS')], dtype=float)
+        except ValueError:
+            positions['RADIUS'] = float(default_radius)
+    except (TypeError, ValueError) as err:
+        raise ValueError(f'Unable to parse positions: {err}')
+
+    ra, dec, radius = positions['RA'], positions['DEC'], positions['RADIUS']
+    bad = ~np.isfinite(ra) | (ra < 0) | (ra > 360) | ~np.isfinite(dec) | (dec < -90) | (dec > 90)
+    if np.any(bad):
+        raise ValueError(f'Invalid RA,dec for input rows {np.where(bad)[0][0:10].tolist()}')
+    bad = ~np.isfinite(radius) | (radius <= 0) | (radius > MAX_MATCH_RADIUS)
+    if np.any(bad):
+        raise ValueError(f'Radius must be in 0 < RADIUS <= {MAX_MATCH_RADIUS} arcsec; '
+                         f'bad input rows {np.where(bad)[0][0:10].tolist()}')
+
+    return positions
+
+def _unit_vectors(ra, dec):
+    ra, dec = np.radians(ra), np.radians(dec)
+    cosdec = np.cos(dec)
+    return np.column_stack([cosdec*np.cos(ra), cosdec*np.sin(ra), np.sin(dec)])
+
+def _chord(arcsec):
+    """Chord length on the unit sphere for an angle in arcsec"""
+    return 2*np.sin(np.radians(np.asarray(arcsec)/3600)/2)
+
+def _angle(chord):
+    """Angle in arcsec for a chord length on the unit sphere"""
+    return np.degrees(2*np.arcsin(np.clip(chord/2, 0, 1)))*3600
+
+def group_positions(ra, dec, radius, nside=INVENTORY_NSIDE):
+    """
+    Group positions by HEALPix pixel
+
+    Returns list of (indices, ra_center, dec_center, cone_radius) where the
+    cone [arcsec] around the center covers the match radius of every
+    position in the group
+    """
+    import healpy
+
+    pixels = healpy.ang2pix(nside, ra, dec, nest=True, lonlat=True)
+    order = np.argsort(pixels, kind='stable')
+    pixels = pixels[order]
+    splits = np.where(np.diff(pixels) != 0)[0] + 1
+
+    xyz = _unit_vectors(ra, dec)
+    groups = list()
+    for indices in np.split(order, splits):
+        center = xyz[indices].sum(axis=0)
+        center /= np.linalg.norm(center)
+        ra_center = np.degrees(np.arctan2(center[1], center[0])) % 360
+        dec_center = np.degrees(np.arcsin(np.clip(center[2], -1, 1)))
+        offsets = _angle(np.linalg.norm(xyz[indices] - center, axis=1))
+        cone_radius = float(np.max(offsets + radius[indices]))
+        groups.append((indices, ra_center, dec_center, cone_radius))
+
+    return groups
+
+def match_positions(ra1, dec1, radius1, ra2, dec2):
+    """
+    Return (idx1, idx2, separation) for all pairs within radius1[idx1] arcsec
+
+    Matches are sorted by idx1 then separation; separation is in arcsec.
+    """
+    from scipy.spatial import cKDTree
+
+    if len(ra1) == 0 or len(ra2) == 0:
+        empty = np.zeros(0, dtype=int)
+        return empty, empty, np.zeros(0)
+
+    xyz1 = _unit_vectors(ra1, dec1)
+    xyz2 = _unit_vectors(ra2, dec2)
+    tree = cKDTree(xyz2)
+    neighbors = tree.query_ball_point(xyz1, _chord(radius1))
+
+    counts = np.array([len(n) for n in neighbors], dtype=int)
+    idx1 = np.repeat(np.arange(len(ra1)), counts)
+    idx2 = np.concatenate([np.asarray(n, dtype=int) for n in neighbors]) if counts.sum() > 0 else np.zeros(0, dtype=int)
+    separation = _angle(np.linalg.norm(xyz1[idx1] - xyz2[idx2], axis=1))
+
+    order = np.lexsort((separation, idx1))
+    return idx1[order], idx2[order], separation[order]
+
+def _cone_search(specprod, specgroup, ra, dec, radius):
+    from desispec import inventory
+    radec = (ra, dec, radius)
+    if specgroup == 'healpix':
+        return inventory.target_healpix(radec=radec, specprod=specprod)
+    else:
+        return inventory.target_tiles(radec=radec, specprod=specprod)
+
+def crossmatch(positions, specprod, specgroup, xcol=None, filters=None, cone_search=None):
+    """
+    Crossmatch positions against targets in specprod
+
+    Args:
+        positions: Table from read_positions with RA, DEC, RADIUS
+        specprod (str): production name
+        specgroup (str): healpix or tiles
+
+    Options:
+        xcol (list): extra redrock columns to add, as for load_targets
+        filters (dict): filters applied to the matches, as for filter_table
+        cone_search: function(specprod, specgroup, ra, dec, radius) returning
+            targets within radius arcsec of ra,dec; default desispec inventory
+
+    Returns Table of matched targets with INPUT_ROW, INPUT_RA, INPUT_DEC,
+    and SEPARATION [arcsec] columns, sorted by INPUT_ROW and SEPARATION
+    """
+    from astropy.table import Table, vstack
+    from scipy.spatial import cKDTree
+    from inspector.io import standardize_specprod, add_zcat_columns, filter_table
+    from inspector.schema import validate_columns, get_schema, INVENTORY_COLUMNS
+
+    specprod = standardize_specprod(specprod)
+    if cone_search is None:
+        cone_search = _cone_search
+
+    xcol = list(xcol) if xcol is not None else []
+    if filters is not None:
+        for colname in filters:
+            if colname.isupper() and colname not in xcol:
+                xcol.append(colname)
+
+    validate_columns(specprod, specgroup, xcol)
+
+    ra = np.asarray(positions['RA'], dtype=float)
+    dec = np.asarray(positions['DEC'], dtype=float)
+    radius = np.asarray(positions['RADIUS'], dtype=float)
+
+    #- one inventory search per inventory pixel with positions, keeping only
+    #- targets within the largest radius of any position to bound memory
+    tree = cKDTree(_unit_vectors(ra, dec))
+    max_chord = _chord(np.max(radius))
+    candidates = list()
+    for indices, ra_center, dec_center, cone_radius in group_positions(ra, dec, radius):
+        t = cone_search(specprod, specgroup, ra_center, dec_center, cone_radius)
+        if len(t) == 0:
+            continue
+        xyz = _unit_vectors(np.asarray(t['TARGET_RA']), np.asarray(t['TARGET_DEC']))
+        distance, _ = tree.query(xyz, distance_upper_bound=max_chord)
+        t = t[np.isfinite(distance)]
+        if len(t) > 0:
+            candidates.append(t)
+
+    if len(candidates) > 0:
+        targets = vstack(candidates, metadata_conflicts='silent')
+        #- neighboring cones overlap
+        keycols = [c for c in ('TARGETID', 'HEALPIX', 'SURVEY', 'PROGRAM', 'TILEID', 'PETAL_LOC')
+                   if c in targets.colnames]
+        _, unique = np.unique(np.rec.fromarrays([np.asarray(targets[c]) for c in keycols]), return_index=True)
+        targets = targets[np.sort(unique)]
+    else:
+        targets = Table({name: np.zeros(0, dtype=dtype) for name, dtype in INVENTORY_COLUMNS[specgroup].items()})
+
+    idx1, idx2, separation = match_positions(ra, dec, radius,
+                                             np.asarray(targets['TARGET_RA']), np.asarray(targets['TARGET_DEC']))
+
+    result = targets[idx2]
+    result.meta.clear()
+    result.meta['SPECPROD'] = specprod
+    result.meta['NINPUT'] = len(positions)
+    result.add_column(idx1, name='INPUT_ROW', index=0)
+    result.add_column(ra[idx1], name='INPUT_RA', index=1)
+    result.add_column(dec[idx1], name='INPUT_DEC', index=2)
+    result['SEPARATION'] = separation
+
+    #- without matches this adds empty columns with dtypes from the schema,
+    #- unless there are no redrock files to take them from
+    if len(result) > 0 or get_schema(specprod, specgroup) is not None:
+        result = add_zcat_columns(result, specprod, xcol=xcol)
+        result = filter_table(result, filters)
+
+    return result
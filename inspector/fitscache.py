@@ -0,0 +1,252 @@
+"""
+inspector.fitscache
+===================
+
+Per-process pool of open fitsio.FITS handles, plus memoized findfile.
+
+Opening a FITS file with fitsio scans every HDU header, which is slow on a
+network filesystem, and the inspector repeatedly opens the same coadd and
+redrock files.  FITSPool keeps up to MAX_OPEN_FILES handles open in least
+recently used order, together with their parsed headers, so that repeat
+opens of hot files are nearly free.  Each handle is used by one thread at
+a time; other threads needing the same file wait for it, and files in use
+are never closed, so the pool only exceeds MAX_OPEN_FILES while more than
+that many are in use at once.  Files are re-checked with os.stat at most
+every REVALIDATE_INTERVAL seconds, and reopened if they have changed.
+
+Example usage:
+
+    with open_fits(filename) as fx:
+        fibermap = fx['FIBERMAP'].read(columns=['TARGETID', 'FIBER'])
+        header = read_header(fx[0])
+"""
+
+import os
+import time
+import threading
+import functools
+from collections import OrderedDict
+from contextlib import contextmanager
+
+MAX_OPEN_FILES = int(os.getenv('DESI_INSPECTOR_MAX_OPEN_FILES', 64))
+
+#- seconds between checks whether an open file has changed on disk
+REVALIDATE_INTERVAL = float(os.getenv('DESI_INSPECTOR_FITS_REVALIDATE', 10))
+
+FINDFILE_CACHE_SIZE = 16384
+
+#- environment variables that desispec.io.findfile results depend on
+FINDFILE_ENVIRON = ('DESI_ROOT', 'DESI_ROOT_READONLY', 'DESI_SPECTRO_REDUX', 'SPECPROD')
+
+def _stamp(filename):
+    st = os.stat(filename)
+    return (st.st_ino, st.st_size, st.st_mtime_ns)
+
+class _Entry(object):
+    """Open file with its cached headers; lock is held while a caller uses fits"""
+    def __init__(self, filename):
+        import fitsio
+        self.stamp = _stamp(filename)
+        self.checked = time.time()
+        self.fits = fitsio.FITS(filename)
+        if _stamp(filename) != self.stamp:
+            #- replaced while opening, so it isn't known which version is open;
+            #- the next revalidation reopens it
+            self.stamp = None
+        self.headers = dict()
+        self.lock = threading.Lock()
+
+    def close(self):
+        try:
+            self.fits.close()
+        except Exception:
+            pass
+
+class FITSPool(object):
+    """
+    Bounded LRU pool of open fitsio.FITS handles
+
+    Args:
+        max_open (int): maximum number of open files
+        revalidate (float): seconds between checks for changed files
+    """
+    def __init__(self, max_open=MAX_OPEN_FILES, revalidate=REVALIDATE_INTERVAL):
+        self.max_open = max_open
+        self.revalidate = revalidate
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._pid = os.getpid()
+
+    def _check_fork(self):
+        """Drop handles inherited from a parent process; call with self._lock held"""
+        if os.getpid() != self._pid:
+            for entry in self.entries.values():
+                entry.close()
+            self.entries.clear()
+            self._pid = os.getpid()
+
+    def _evict(self):
+        """Close least recently used files not in use until within max_open; call with self._lock held"""
+        for filename in list(self.entries):
+            if len(self.entries) <= self.max_open:
+                break
+            entry = self.entries[filename]
+            if entry.lock.acquire(blocking=False):
+                del self.entries[filename]
+                entry.close()
+                entry.lock.release()
+
+    def _acquire(self, filename, revalidate=None):
+        """Return entry for filename with its lock held; see open for revalidate"""
+        filename = os.path.abspath(filename)
+        if revalidate is None:
+            revalidate = self.revalidate
+        while True:
+            with self._lock:
+                self._check_fork()
+                entry = self.entries.get(filename)
+                if entry is not None:
+                    self.entries.move_to_end(filename)
+
+            if entry is None:
+                #- open outside the pool lock so other files aren't blocked
+                entry = _Entry(filename)
+                entry.lock.acquire()
+                with self._lock:
+                    if filename in self.entries:
+                        #- another thread opened it first; use theirs
+                        entry.lock.release()
+                        entry.close()
+                        continue
+                    self.entries[filename] = entry
+                    self.misses += 1
+                    self._evict()
+                return entry
+
+            entry.lock.acquire()
+            with self._lock:
+                if self.entries.get(filename) is not entry:
+                    #- evicted or replaced while waiting
+                    entry.lock.release()
+                    continue
+                self.hits += 1
+
+            if time.time() - entry.checked >= revalidate:
+                try:
+                    stamp = _stamp(filename)
+                except OSError:
+                    stamp = None
+                if stamp != entry.stamp:
+                    with self._lock:
+                        if self.entries.get(filename) is entry:
+                            del self.entries[filename]
+                    entry.close()
+                    entry.lock.release()
+                    continue
+                entry.checked = time.time()
+
+            return entry
+
+    @contextmanager
+    def open(self, filename, revalidate=None):
+        """
+        Context manager yielding an open fitsio.FITS for filename, for exclusive use
+
+        revalidate overrides the seconds since the last check after which the
+        file is checked for changes; 0 always checks, e.g. for a file known to
+        have just been rewritten.
+        """
+        entry = self._acquire(filename, revalidate)
+        try:
+            yield entry.fits
+        finally:
+            entry.lock.release()
+
+    def read_header(self, hdu):
+        """
+        Return header of fitsio HDU hdu, cached with its pooled handle
+
+        Call while using the handle from open(filename) that hdu came from;
+        headers of HDUs from other handles are read without caching.  The
+        cached header is shared, so don't modify it.
+        """
+        with self._lock:
+            entry = self.entries.get(os.path.abspath(hdu.get_filename()))
+        ext = hdu.get_extnum()
+        if entry is None or ext >= len(entry.fits) or entry.fits[ext] is not hdu:
+            return hdu.read_header()
+        if ext not in entry.headers:
+            entry.headers[ext] = hdu.read_header()
+        return entry.headers[ext]
+
+    def stamp(self, filename, fits):
+        """
+        Return os.stat stamp of the file that pooled handle fits has open, or
+        None if unknown; call while using fits from open(filename)
+        """
+        with self._lock:
+            entry = self.entries.get(os.path.abspath(filename))
+        if entry is None or entry.fits is not fits:
+            return None
+        return entry.stamp
+
+    def close(self):
+        """Close all files not currently in use"""
+        with self._lock:
+            max_open, self.max_open = self.max_open, 0
+            self._evict()
+            self.max_open = max_open
+
+    def stats(self):
+        """Return dict with number of open files, hits, and misses"""
+        with self._lock:
+            return dict(open=len(self.entries), max_open=self.max_open,
+                        hits=self.hits, misses=self.misses)
+
+_pool = None
+_pool_lock = threading.Lock()
+
+def get_pool():
+    """Return the FITSPool for this process"""
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = FITSPool()
+    return _pool
+
+def open_fits(filename, revalidate=None):
+    """Context manager yielding pooled fitsio.FITS for filename; see FITSPool.open"""
+    return get_pool().open(filename, revalidate)
+
+def read_header(hdu):
+    """Return header of pooled fitsio HDU hdu; see FITSPool.read_header"""
+    return get_pool().read_header(hdu)
+
+def handle_stamp(filename, fits):
+    """Return os.stat stamp of the file open in pooled fits; see FITSPool.stamp"""
+    return get_pool().stamp(filename, fits)
+
+def _hashable(value):
+    """Convert numpy scalars to python so that equal values share a cache entry"""
+    return value.item() if hasattr(value, 'item') else value
+
+@functools.lru_cache(maxsize=FINDFILE_CACHE_SIZE)
+def _findfile(args, kwargs, env):
+    from desispec.io import findfile as desispec_findfile
+    return desispec_findfile(*args, **dict(kwargs))
+
+def findfile(*args, **kwargs):
+    """
+    Memoized desispec.io.findfile
+
+    Only for path resolution: results are cached by arguments and the
+    environment variables findfile resolves paths with, without re-checking
+    whether the file exists.  lru_cache is thread-safe.
+    """
+    env = tuple(os.getenv(name) for name in FINDFILE_ENVIRON)
+    args = tuple(_hashable(a) for a in args)
+    kwargs = tuple(sorted((k, _hashable(v)) for k, v in kwargs.items()))
+    return _findfile(args, kwargs, env)
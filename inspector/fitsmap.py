@@ -0,0 +1,199 @@
+"""
+inspector.fitsmap
+=================
+
+Zero-copy reads of uncompressed FITS image HDUs with numpy.memmap.
+
+The coadd FLUX/IVAR/MASK/RESOLUTION HDUs are plain uncompressed images,
+but reading a few rows through fitsio decodes them into freshly allocated
+native-endian arrays, and each gunicorn worker keeps its own copy.
+image_rows instead maps the file read-only and returns rows straight from
+the page cache, so hot files are shared by every worker:
+
+  * a contiguous range of rows is returned as a view of the mapping,
+    without copying;
+  * other row selections are gathered with a single fancy-indexing copy of
+    just those rows, in the requested order;
+  * data stay big-endian as in the file; numpy handles that transparently,
+    and the byte swap happens only when the caller copies into a native
+    array anyway (e.g. the shared output arrays of inspector.sharedread);
+  * unsigned integer images stored with BZERO=2**(N-1), like MASK, need
+    their sign bit flipped, which is the only case that always copies.
+
+Compressed images, scaled data (BSCALE != 1 or another BZERO), and
+$DESI_INSPECTOR_MEMMAP=0 return None so that callers fall back to fitsio.
+Mappings are cached per process like the open files of inspector.fitscache,
+keyed by the os.stat stamp (inode, size, mtime) of the mapped file.  The
+header offsets and dimensions come from the fitsio handle, so the mapping
+must be of the same file the handle has open: callers with a pooled handle
+pass its stamp from fitscache.handle_stamp, and a file that has since been
+replaced (written elsewhere and renamed) falls back to fitsio instead of
+mixing the old layout with the new contents.  Without a stamp, the file is
+stat'd on each call, which suits handles that were just opened.
+
+Example usage:
+
+    with open_fits(coaddfile) as fx:
+        flux = image_rows(fx['B_FLUX'], rows, stamp=handle_stamp(coaddfile, fx))
+        if flux is None:
+            flux = fx['B_FLUX'].read()[rows]
+"""
+
+import os
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+from inspector.fitscache import MAX_OPEN_FILES, _stamp, read_header
+
+MEMMAP = os.getenv('DESI_INSPECTOR_MEMMAP', '1').lower() not in ('0', 'false', 'no')
+
+#- FITS BITPIX -> big-endian dtype of the stored values
+BITPIX_DTYPES = {8: '>u1', 16: '>i2', 32: '>i4', 64: '>i8', -32: '>f4', -64: '>f8'}
+
+class _MapCache(object):
+    """
+    LRU cache of read-only whole-file numpy.memmap byte arrays, each with
+    the os.stat stamp of the mapped file and a dict of the image layouts
+    parsed from its headers
+    """
+    def __init__(self, max_maps=MAX_OPEN_FILES):
+        self.max_maps = max_maps
+        self.maps = OrderedDict()
+        self._lock = threading.Lock()
+        self._pid = os.getpid()
+
+    def get(self, filename, stamp):
+        """
+        Return (uint8 numpy.memmap of all of filename, dict of layouts) for
+        the version of filename with os.stat stamp, or None if filename has
+        been replaced by another version
+        """
+        with self._lock:
+            if os.getpid() != self._pid:
+                #- inherited mappings are still valid, but start fresh like fitscache
+                self.maps.clear()
+                self._pid = os.getpid()
+
+            cached = self.maps.get(filename)
+            if cached is not None and cached[0] == stamp:
+                self.maps.move_to_end(filename)
+                return cached[1], cached[2]
+
+        #- map outside the lock, checking the stamp of the opened file itself;
+        #- unreferenced mappings are closed when garbage collected
+        with open(filename, 'rb') as fp:
+            if _stamp(fp.fileno()) != stamp:
+                return None
+            data = np.memmap(fp, dtype=np.uint8, mode='r')
+
+        layouts = dict()
+        with self._lock:
+            self.maps[filename] = (stamp, data, layouts)
+            self.maps.move_to_end(filename)
+            while len(self.maps) > self.max_maps:
+                self.maps.popitem(last=False)
+        return data, layouts
+
+_maps = _MapCache()
+
+def _layout(hdu):
+    """Return (dtype, shape, unsigned) of uncompressed image hdu, or None if it can't be mapped"""
+    if hdu.get_exttype() != 'IMAGE_HDU' or hdu.is_compressed():
+        return None
+
+    info = hdu.get_info()
+    dtype = BITPIX_DTYPES.get(info['img_type'])
+    if dtype is None or info['ndims'] == 0:
+        return None
+
+    header = read_header(hdu)
+    bscale = header.get('BSCALE', 1)
+    bzero = header.get('BZERO', 0)
+    if bscale != 1:
+        return None
+
+    dtype = np.dtype(dtype)
+    unsigned = False
+    if bzero != 0:
+        if dtype.kind != 'i' or bzero != 2**(8*dtype.itemsize - 1):
+            return None
+        unsigned = True
+
+    return dtype, tuple(int(n) for n in hdu.get_dims()), unsigned
+
+def image_map(hdu, stamp=None):
+    """
+    Return (array, unsigned) for uncompressed image hdu, or None if it can't be mapped
+
+    hdu is a fitsio ImageHDU from a file on disk, and stamp is the os.stat
+    stamp of the file it has open (e.g. from fitscache.handle_stamp), or
+    None to stat the file now.  array is a read-only view of the stored
+    values with the HDU's numpy shape (slowest axis first) and big-endian
+    dtype; unsigned is True if the values are unsigned integers stored with
+    the standard BZERO offset, i.e. the sign bit of array needs to be flipped.
+    """
+    if not MEMMAP:
+        return None
+
+    filename = hdu.get_filename()
+    try:
+        if stamp is None:
+            stamp = _stamp(filename)
+        mapped = _maps.get(filename, stamp)
+    except (OSError, ValueError):
+        return None
+    if mapped is None:
+        return None
+
+    data, layouts = mapped
+    start = hdu.get_info()['data_start']
+    if start not in layouts:
+        layouts[start] = _layout(hdu)
+    if layouts[start] is None:
+        return None
+
+    dtype, shape, unsigned = layouts[start]
+    nbytes = int(np.prod(shape)) * dtype.itemsize
+    if start + nbytes > len(data):
+        return None
+
+    return np.asarray(data[start:start+nbytes]).view(dtype).reshape(shape), unsigned
+
+def image_rows(hdu, rows, stamp=None):
+    """
+    Return rows of image hdu from its memory map, or None to fall back to fitsio
+
+    Args:
+        hdu: fitsio ImageHDU
+        rows: array of row indices along the first (slowest) axis, in the
+            order wanted; repeats are allowed
+        stamp: os.stat stamp of the file hdu has open; see image_map
+
+    A contiguous increasing range of rows is returned as a view of the file
+    pages; otherwise only the selected rows are copied.  Values keep the
+    file's big-endian byte order; unsigned images are returned as unsigned.
+    """
+    mapped = image_map(hdu, stamp)
+    if mapped is None:
+        return None
+
+    array, unsigned = mapped
+    rows = np.asarray(rows, dtype=np.int64)
+    contiguous = len(rows) > 0 and np.all(np.diff(rows) == 1)
+    if contiguous:
+        data = array[rows[0]:rows[-1]+1]
+    else:
+        data = array[rows]
+
+    if unsigned:
+        #- flipping the sign bit removes the BZERO offset; views of the file need a copy first
+        data = data.view(data.dtype.str.replace('i', 'u'))
+        signbit = data.dtype.type(1 << (8*data.dtype.itemsize - 1))
+        if contiguous:
+            data = data ^ signbit
+        else:
+            data ^= signbit
+
+    return data
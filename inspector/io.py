@@ -3,10 +3,13 @@ inspector.io
 ============
 """
 
+import os
+import itertools
+
 import numpy as np
-from desispec import inventory
-from desispec.io import read_spectra_parallel
-from desispec.io.redrock import read_redrock_targetcat
+
+#- desispec is imported within functions so that importing this module is
+#- cheap; see inspector.startup for preloading
 
 MAX_RADIUS=1800  # 0.5 deg
 MAX_RADIUS_ERROR_MESSAGE = f'Please limit your search to radius < {MAX_RADIUS} arcsec'
@@ -14,6 +17,23 @@ MAX_RADIUS_ERROR_MESSAGE = f'Please limit your search to radius < {MAX_RADIUS} a
 MAX_SPECTRA=1000
 MAX_SPECTRA_ERROR_MESSAGE = '{} spectra is more than we can realistically display; please limit your search to fewer than {} spectra'
 
+#- number of processes reading files for iter_spectra
+PROGRESSIVE_NPROC = int(os.getenv('DESI_INSPECTOR_PROGRESSIVE_NPROC', 4))
+
+class TooManySpectraError(ValueError):
+    """
+    Query matched more than maxspectra spectra
+
+    Subclass of ValueError so that existing error handling still applies, but
+    carries the already-loaded targets so that callers can hand them off to
+    a background job (see inspector.jobs) instead of re-running the query.
+    """
+    def __init__(self, num_spectra, maxspectra, targetcat=None):
+        super().__init__(MAX_SPECTRA_ERROR_MESSAGE.format(num_spectra, maxspectra))
+        self.num_spectra = num_spectra
+        self.maxspectra = maxspectra
+        self.targetcat = targetcat
+
 def standardize_specprod(specprod):
     """
     Return standardized specprod with aliases for dr1 -> iron, etc.
@@ -28,6 +48,16 @@ def standardize_specprod(specprod):
     else:
         return specprod
 
+def production_dir(specprod):
+    """
+    Return top level directory of specprod
+
+    Same as desispec.io.specprod_root: $DESI_SPECTRO_REDUX/specprod, or
+    $DESI_ROOT/spectro/redux/specprod if $DESI_SPECTRO_REDUX isn't set
+    """
+    from desispec.io import specprod_root
+    return specprod_root(specprod)
+
 
 def parse_fibers(fibers_string):
     """
@@ -55,6 +85,7 @@ def parse_fibers(fibers_string):
 
 
 def validate_radec(radec):
+    from desispec import inventory
     ra,dec,radius = inventory.parse_radec(radec)
     if radius > MAX_RADIUS:
         raise ValueError(MAX_RADIUS_ERROR_MESSAGE)
@@ -69,29 +100,71 @@ def add_zcat_columns(targetcat, specprod, xcol=None):
     """
     Return copy of targetcat with zcat columns added
     
-    Adds TARGET_RA, TARGET_DEC, SPECTYPE, Z, ZWARN
+    Adds TARGET_RA, TARGET_DEC, SPECTYPE, Z, ZWARN, plus any xcol, reading
+    only those columns from the redrock files; see inspector.schema
     """
+    from inspector.schema import read_target_columns
+
     t = targetcat.copy(copy_data=False)
     specprod = standardize_specprod(specprod)
 
     if xcol is None:
         xcol = []
 
-    #- Fragile: list of columns that will be in the redrock REDSHIFTS HDU;
-    #- assume others are in the FIBERMAP HDU
-    rrcols = ('TARGETID','Z','ZERR','ZWARN','CHI2','COEFF','NPIXELS','SPECTYPE','SUBTYPE','NCOEFF','DELTACHI2')
-    fmcols = ['TARGET_RA', 'TARGET_DEC']
-    for col in xcol:
-        if (col not in t.colnames) and (col not in rrcols) and (col not in fmcols):
-            fmcols.append(col)
+    columns = list()
+    for col in ['TARGETID', 'TARGET_RA', 'TARGET_DEC', 'SPECTYPE', 'Z', 'ZWARN'] + list(xcol):
+        if (col not in t.colnames) and (col not in columns):
+            columns.append(col)
 
-    zcat = read_redrock_targetcat(t, fmcols=fmcols, specprod=specprod)
-    for col in ['TARGETID', 'TARGET_RA', 'TARGET_DEC', 'SPECTYPE', 'Z', 'ZWARN'] + xcol:
-        if col not in t.colnames:
-            t[col] = zcat[col]
+    zcat = read_target_columns(t, specprod, columns)
+    for col in columns:
+        t[col] = zcat[col]
 
     return t
 
+#- filter_table operators; bitand:MASK keeps rows with any of the bits of MASK set
+FILTER_OPERATORS = ('eq', 'lt', 'le', 'gt', 'ge', 'ne', 'bitand')
+
+def parse_filter(filt):
+    """
+    Parse a single filter string like "gt:2.1" -> ('gt', '2.1'); plain values are 'eq'
+    """
+    if isinstance(filt, str) and ':' in filt:
+        operator, value = filt.split(':', 1)
+    else:
+        operator = 'eq'
+        value = filt
+
+    if operator not in FILTER_OPERATORS:
+        #- TODO: handle error message with error message to user
+        raise ValueError(f'Unrecognized operator {operator}')
+
+    return operator, value
+
+def apply_filter(values, operator, value):
+    """
+    Return boolean array of which values pass operator,value from parse_filter
+    """
+    value = np.array(value, dtype=values.dtype)
+    if operator == 'eq':
+        return values == value
+    elif operator == 'lt':
+        return values < value
+    elif operator == 'le':
+        return values <= value
+    elif operator == 'gt':
+        return values > value
+    elif operator == 'ge':
+        return values >= value
+    elif operator == 'ne':
+        return values != value
+    elif operator == 'bitand':
+        if values.dtype.kind not in 'iu':
+            raise ValueError(f'bitand filter requires an integer column, not {values.dtype}')
+        return (values & value) != 0
+    else:
+        raise ValueError(f'Unrecognized operator {operator}')
+
 def filter_table(table, filters):
     """
     Filter a Table based upon URL args dict
@@ -115,37 +188,73 @@ def filter_table(table, filters):
 
         filter_list = np.atleast_1d(filter_list)
         for filt in filter_list:
-            if isinstance(filt, str) and ':' in filt:
-                operator, value = filt.split(':')
-            else:
-                operator = 'eq'
-                value = filt
-
-            value = np.array(value, dtype=table[column].dtype)
+            operator, value = parse_filter(filt)
             ### print(f'Filter {column} {operator} {value}')
-
-            if operator == 'eq':
-                keep &= (table[column] == value)
-            elif operator == 'lt':
-                keep &= (table[column] < value)
-            elif operator == 'le':
-                keep &= (table[column] <= value)
-            elif operator == 'gt':
-                keep &= (table[column] > value)
-            elif operator == 'ge':
-                keep &= (table[column] >= value)
-            elif operator == 'ne':
-                keep &= (table[column] != value)
-            else:
-                #- TODO: handle error message with error message to user
-                raise ValueError(f'Unrecognized operator {operator}')
+            keep &= apply_filter(table[column], operator, value)
 
     return table[keep]
 
-def load_targets(specprod, specgroup, radec=None, targetids=None, filters=None, xcol=None):
+#- load_targets dedup options -> columns needed to pick the best spectrum of each TARGETID
+DEDUP_COLUMNS = dict(tsnr2=['TSNR2_LRG',], zwarn=['ZWARN', 'DELTACHI2'])
+
+def dedup_targets(targetcat, method):
+    """
+    Return targetcat with one row per TARGETID, keeping the best spectrum
+
+    Args:
+        targetcat: targets table, e.g. from load_targets with specgroup='tiles'
+        method (str): 'tsnr2' for the highest TSNR2_LRG, or 'zwarn' for the
+            lowest ZWARN, breaking ties with the highest DELTACHI2
+
+    Rows keep their original order.  The number of rows removed is
+    recorded in the meta NDEDUP.
+    """
+    if method not in DEDUP_COLUMNS:
+        raise ValueError(f"Unsupported dedup='{method}'; supported options are {list(DEDUP_COLUMNS)}")
+
+    def _values(column, missing):
+        values = targetcat[column]
+        if hasattr(values, 'filled'):
+            values = values.filled(missing)
+        values = np.asarray(values)
+        if values.dtype.kind == 'f':
+            values = np.where(np.isnan(values), missing, values)
+        return values
+
+    #- np.lexsort sorts by the last key first; the best row of each TARGETID sorts first
+    if method == 'tsnr2':
+        keys = (-_values('TSNR2_LRG', -np.inf),)
+    else:
+        keys = (-_values('DELTACHI2', -np.inf), _values('ZWARN', np.iinfo(np.int64).max))
+
+    targetids = np.asarray(targetcat['TARGETID'])
+    order = np.lexsort(keys + (targetids,))
+    first = np.ones(len(order), dtype=bool)
+    first[1:] = targetids[order[1:]] != targetids[order[:-1]]
+    keep = np.sort(order[first])
+
+    t = targetcat[keep]
+    t.meta['NDEDUP'] = len(targetcat) - len(t)
+    return t
+
+def load_targets(specprod, specgroup, radec=None, targetids=None, filters=None, xcol=None, dedup=None):
     """
     required: specprod, specgroup; plus radec OR targetids (but not both)
+
+    dedup: optional 'tsnr2' or 'zwarn' to keep only the best row of each
+    TARGETID, e.g. for tiles targets observed on more than one tile;
+    see dedup_targets
+
+    If $DESI_INSPECTOR_SHARDS is set, the query is instead sent to the shard
+    nodes owning the sky region; see inspector.shards
     """
+    from inspector import shards
+    if shards.SHARD_MAP_FILE is not None:
+        return shards.load_targets(specprod, specgroup, radec=radec, targetids=targetids,
+                                   filters=filters, xcol=xcol, dedup=dedup)
+
+    from desispec import inventory
+    from inspector.schema import validate_columns
     specprod = standardize_specprod(specprod)
 
     if radec is not None:
@@ -156,43 +265,135 @@ def load_targets(specprod, specgroup, radec=None, targetids=None, filters=None,
     else:
         raise ValueError('must specify radec or targetids')
 
+    if dedup is not None and dedup not in DEDUP_COLUMNS:
+        raise ValueError(f"Unsupported dedup='{dedup}'; supported options are {list(DEDUP_COLUMNS)}")
+
+    xcol = list(xcol) if xcol is not None else []
+    if filters is not None:
+        for colname in filters:
+            if colname.isupper() and colname not in xcol:
+                xcol.append(colname)
+    if dedup is not None:
+        for colname in DEDUP_COLUMNS[dedup]:
+            if colname not in xcol:
+                xcol.append(colname)
+
+    #- check column names before reading any files
+    validate_columns(specprod, specgroup, xcol)
+
     if specgroup == 'healpix':
         t = inventory.target_healpix(radec=radec, targetids=targetids, specprod=specprod)
     elif specgroup == 'tiles':
         t = inventory.target_tiles(radec=radec, targetids=targetids, specprod=specprod)
 
-    # TODO: if no targets match, the returned len=0 table will not have xcol,
-    # but this code can't trivially determine the type those should be even if added
-
-    if len(t) > 0:
-        if filters is not None:
-            if xcol is None:
-                xcol = []
-            for colname in filters:
-                if colname not in xcol:
-                    xcol.append(colname)
-
-        t = add_zcat_columns(t, specprod, xcol=xcol)
-        t = filter_table(t, filters)
+    #- if no targets match, this adds empty columns with dtypes from the schema
+    t = add_zcat_columns(t, specprod, xcol=xcol)
+    t = filter_table(t, filters)
+    if dedup is not None:
+        t = dedup_targets(t, dedup)
 
     return t
 
-def load_spectra(specprod, specgroup, radec=None, targetids=None, filters=None, maxspectra=MAX_SPECTRA):
+def load_spectra(specprod, specgroup, radec=None, targetids=None, filters=None, maxspectra=MAX_SPECTRA,
+                 rdspec_kwargs=None, dedup=None):
     """
     Required: specprod, specgroup; and radec OR targetids (but not both)
 
+    Options:
+        rdspec_kwargs (dict): passed to desispec.io.read_spectra;
+            default dict(return_redshifts=True)
+        dedup (str): read only the best spectrum of each TARGETID; see dedup_targets
+
     TODO: separate loading spectra from flask-specific rendering
     """
     specprod = standardize_specprod(specprod)
-    targetcat = load_targets(specprod, specgroup=specgroup, radec=radec, targetids=targetids, filters=filters)
+    targetcat = load_targets(specprod, specgroup=specgroup, radec=radec, targetids=targetids, filters=filters,
+                             dedup=dedup)
 
     num_spectra = len(targetcat)
     if num_spectra == 0:
         return None
     elif num_spectra > maxspectra:
-        raise ValueError(MAX_SPECTRA_ERROR_MESSAGE.format(num_spectra, maxspectra))
+        raise TooManySpectraError(num_spectra, maxspectra, targetcat=targetcat)
 
+    from inspector.sharedread import read_spectra_shared
     print(f'Reading {num_spectra} spectra')
-    spectra = read_spectra_parallel(targetcat, specprod=specprod, rdspec_kwargs=dict(return_redshifts=True))
+    if rdspec_kwargs is None:
+        rdspec_kwargs = dict(return_redshifts=True)
+
+    spectra = read_spectra_shared(targetcat, specprod, rdspec_kwargs=rdspec_kwargs)
     return spectra
 
+
+def iter_spectra(targetcat, specprod, rdspec_kwargs=None, nproc=PROGRESSIVE_NPROC):
+    """
+    Generator yielding Spectra for targetcat one source file at a time
+
+    Args:
+        targetcat: targets table as returned by load_targets
+        specprod (str): production name
+
+    Options:
+        rdspec_kwargs (dict): passed to desispec.io.read_spectra;
+            default dict(return_redshifts=True)
+        nproc (int): number of files to read in parallel
+
+    Files are read by a pool of nproc processes and yielded in the order
+    they finish, so that callers can send the first spectra while the
+    rest are still being read.  The next file is only submitted when the
+    caller is done with the previous one, so at most nproc files are in
+    memory at a time.  Closing the generator cancels reads that haven't
+    started.
+    """
+    from desispec.io import read_spectra_parallel
+    from inspector.sharedread import process_pool
+    from desispec.io.spectra import split_targets_by_file
+
+    if rdspec_kwargs is None:
+        rdspec_kwargs = dict(return_redshifts=True)
+
+    #- splitting into more groups than files gives one group per file, plus empty groups
+    filetargets = [t for t in split_targets_by_file(targetcat, len(targetcat)) if len(t) > 0]
+    print(f'Reading {len(targetcat)} spectra from {len(filetargets)} files')
+
+    nproc = max(1, min(nproc, len(filetargets)))
+    with process_pool(nproc) as pool:
+        yield from _imap_unordered(pool, read_spectra_parallel, filetargets, nproc,
+                                   nproc=1, specprod=specprod, rdspec_kwargs=rdspec_kwargs)
+
+def _imap_unordered(pool, func, args, nsubmit, **kwargs):
+    """
+    Yield func(arg, **kwargs) for each arg in args in the order they finish
+
+    Args:
+        pool: concurrent.futures Executor
+        func: function to call
+        args: iterable of first arguments to func
+        nsubmit (int): maximum number of calls outstanding at a time
+
+    The next call is only submitted once the caller is done with the
+    previous result, and references to yielded results are dropped, so
+    at most nsubmit results are in memory at a time, including the one
+    being processed by the caller.  Closing the generator cancels calls
+    that haven't started.
+    """
+    from concurrent.futures import wait, FIRST_COMPLETED
+
+    args = iter(args)
+    pending = set()
+    try:
+        for arg in itertools.islice(args, nsubmit):
+            pending.add(pool.submit(func, arg, **kwargs))
+
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            while done:
+                result = done.pop().result()
+                yield result
+                del result
+
+                for arg in itertools.islice(args, 1):
+                    pending.add(pool.submit(func, arg, **kwargs))
+    finally:
+        for future in pending:
+            future.cancel()
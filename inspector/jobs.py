@@ -0,0 +1,226 @@
+"""
+inspector.jobs
+==============
+
+Background jobs for spectra requests that are too large to handle
+interactively.
+
+A job is a directory under JOBS_DIR named by its job ID, containing a
+status.json file and, when finished, the results tarball.  State lives on
+disk rather than in memory so that any gunicorn worker can report the status
+of a job submitted through any other worker.
+
+Jobs run in a process pool of the worker that submitted them, so they die
+with it (e.g. when it is restarted); memstats doesn't recycle a worker while
+active_jobs() is non-zero.  status.json records the
+host and pids of the worker and job process, and read_status reports an
+unfinished job as failed once either of them has exited.
+"""
+
+import os
+import json
+import time
+import uuid
+import socket
+import shutil
+import tarfile
+import tempfile
+import threading
+
+from inspector.io import MAX_SPECTRA
+from inspector.admission import _pid_alive
+
+JOBS_DIR = os.getenv('DESI_INSPECTOR_JOBS_DIR', os.path.join(tempfile.gettempdir(), 'desi-inspector-jobs'))
+JOB_EXPIRY = int(os.getenv('DESI_INSPECTOR_JOB_EXPIRY', 3*24*3600))  # seconds
+JOB_NPROC = int(os.getenv('DESI_INSPECTOR_JOB_NPROC', 2))
+MAX_JOB_SPECTRA = int(os.getenv('DESI_INSPECTOR_MAX_JOB_SPECTRA', 50000))
+MAX_JOB_SPECTRA_ERROR_MESSAGE = '{} spectra is more than we can process in a single job; please limit your search to fewer than {} spectra'
+
+#- each batch is read and written separately to bound job memory
+JOB_BATCH_SIZE = MAX_SPECTRA
+
+_pool = None
+_pool_lock = threading.Lock()
+_futures = set()
+
+def _get_pool():
+    """Return the per-process job pool, creating it on first use"""
+    from inspector.sharedread import process_pool
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = process_pool(JOB_NPROC)
+    return _pool
+
+def active_jobs():
+    """Return number of jobs submitted by this process that haven't finished"""
+    with _pool_lock:
+        return len(_futures)
+
+def _job_done(future):
+    with _pool_lock:
+        _futures.discard(future)
+
+def job_dir(jobid):
+    """
+    Return directory for jobid, raising ValueError if jobid is malformed
+
+    jobid must be a uuid hex string; checking this prevents a URL from
+    pointing outside of JOBS_DIR
+    """
+    try:
+        if uuid.UUID(hex=jobid).hex != jobid:
+            raise ValueError
+    except ValueError:
+        raise ValueError(f'Invalid job ID {jobid}')
+
+    return os.path.join(JOBS_DIR, jobid)
+
+def results_filename(jobid):
+    """Return path to the results tarball for jobid"""
+    return os.path.join(job_dir(jobid), f'desi-spectra-{jobid}.tar')
+
+def read_status(jobid):
+    """
+    Return status dict for jobid, or None if that job doesn't exist (or expired)
+    """
+    statusfile = os.path.join(job_dir(jobid), 'status.json')
+    try:
+        with open(statusfile) as fp:
+            status = json.load(fp)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return None
+
+    if status['expires'] < time.time():
+        return None
+
+    if status['status'] in ('queued', 'running') and status.get('host') == socket.gethostname():
+        for key in ('owner', 'pid'):
+            if key in status and not _pid_alive(status[key]):
+                status = _update_status(jobid, status='failed', finished=time.time(),
+                                        message='job was interrupted by a server restart; please resubmit')
+                break
+
+    return status
+
+def _update_status(jobid, **kwargs):
+    """
+    Update status.json for jobid with kwargs, replacing it atomically so that
+    readers in other processes never see a partially written file
+    """
+    dirname = job_dir(jobid)
+    statusfile = os.path.join(dirname, 'status.json')
+    try:
+        with open(statusfile) as fp:
+            status = json.load(fp)
+    except FileNotFoundError:
+        status = dict(jobid=jobid)
+
+    status.update(kwargs)
+    status['updated'] = time.time()
+
+    tmpfile = f'{statusfile}.{os.getpid()}.tmp'
+    with open(tmpfile, 'w') as fp:
+        json.dump(status, fp)
+    os.replace(tmpfile, statusfile)
+
+    return status
+
+def cleanup_expired(now=None):
+    """
+    Remove job directories whose results have expired; returns number removed
+    """
+    if now is None:
+        now = time.time()
+
+    if not os.path.isdir(JOBS_DIR):
+        return 0
+
+    nremoved = 0
+    for jobid in os.listdir(JOBS_DIR):
+        dirname = os.path.join(JOBS_DIR, jobid)
+        try:
+            with open(os.path.join(dirname, 'status.json')) as fp:
+                expires = json.load(fp)['expires']
+        except (OSError, ValueError, KeyError):
+            #- half-created or corrupted job; use directory age instead
+            try:
+                expires = os.path.getmtime(dirname) + JOB_EXPIRY
+            except OSError:
+                continue
+
+        if expires < now:
+            shutil.rmtree(dirname, ignore_errors=True)
+            nremoved += 1
+
+    return nremoved
+
+def submit_spectra_job(targetcat, specprod):
+    """
+    Submit background job to read spectra for targetcat; returns job ID
+
+    Args:
+        targetcat: Table of targets as returned by inspector.io.load_targets
+        specprod (str): production name
+
+    Raises ValueError if targetcat is too large even for a background job
+    """
+    num_spectra = len(targetcat)
+    if num_spectra > MAX_JOB_SPECTRA:
+        raise ValueError(MAX_JOB_SPECTRA_ERROR_MESSAGE.format(num_spectra, MAX_JOB_SPECTRA))
+
+    cleanup_expired()
+
+    jobid = uuid.uuid4().hex
+    os.makedirs(job_dir(jobid))
+    now = time.time()
+    _update_status(jobid, status='queued', specprod=specprod,
+                   num_spectra=num_spectra, num_done=0,
+                   created=now, expires=now+JOB_EXPIRY,
+                   host=socket.gethostname(), owner=os.getpid())
+
+    future = _get_pool().submit(run_spectra_job, jobid, targetcat, specprod)
+    with _pool_lock:
+        _futures.add(future)
+    future.add_done_callback(_job_done)
+    print(f'Submitted job {jobid} for {num_spectra} {specprod} spectra')
+
+    return jobid
+
+def run_spectra_job(jobid, targetcat, specprod):
+    """
+    Read spectra for targetcat in batches and write them into a tarball
+
+    Runs in a job pool process; progress and failures are recorded in the
+    job status rather than raised.
+    """
+    from desispec.io import read_spectra_parallel, write_spectra
+
+    dirname = job_dir(jobid)
+    try:
+        _update_status(jobid, status='running', started=time.time(), pid=os.getpid())
+
+        tmpfile = results_filename(jobid) + '.tmp'
+        num_spectra = len(targetcat)
+        nbatch = (num_spectra + JOB_BATCH_SIZE - 1) // JOB_BATCH_SIZE
+        with tarfile.open(tmpfile, 'w') as tar:
+            for i in range(nbatch):
+                batch = targetcat[i*JOB_BATCH_SIZE:(i+1)*JOB_BATCH_SIZE]
+                spectra = read_spectra_parallel(batch, specprod=specprod,
+                                                rdspec_kwargs=dict(return_redshifts=True))
+
+                batchname = f'desi-spectra-{jobid}-{i:03d}.fits'
+                batchfile = os.path.join(dirname, batchname)
+                write_spectra(batchfile, spectra)
+                tar.add(batchfile, arcname=batchname)
+                os.remove(batchfile)
+                del spectra
+
+                _update_status(jobid, num_done=min(num_spectra, (i+1)*JOB_BATCH_SIZE))
+
+        os.replace(tmpfile, results_filename(jobid))
+        _update_status(jobid, status='done', finished=time.time())
+
+    except Exception as err:
+        print(f'ERROR: job {jobid} failed: {err}')
+        _update_status(jobid, status='failed', message=str(err), finished=time.time())
@@ -0,0 +1,368 @@
+"""
+inspector.loadtest
+==================
+
+Replay a weighted mix of Data Inspector URLs against the Flask app, either
+in-process via app.test_client() or over HTTP against local gunicorn servers,
+and report throughput, per-route latency percentiles, and per-worker RSS.
+
+Examples:
+
+    #- in-process, against a freshly generated synthetic production
+    python -m inspector.loadtest --requests 500 --concurrency 8
+
+    #- compare gunicorn worker counts, with and without preloading
+    python -m inspector.loadtest --desi-root /tmp/synth --gunicorn 1,2,5 \\
+        --env DESI_INSPECTOR_PRELOAD=1 --output loadtest.json
+
+    #- against an already running server
+    python -m inspector.loadtest --url http://localhost:5001 --desi-root /tmp/synth
+
+Target positions, TARGETIDs and tiles for the URLs are read from the
+synthetic inventory tables written by inspector.synthetic.
+"""
+
+import os
+import json
+import time
+import base64
+import signal
+import socket
+import argparse
+import tempfile
+import threading
+import subprocess
+import urllib.request
+import urllib.error
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+#- route -> relative weight; routes are "targets|spectra/radec|targetids|tilefibers/format"
+DEFAULT_MIX = {
+    'targets/radec/html': 25,
+    'targets/radec/csv': 8,
+    'targets/radec/json': 5,
+    'targets/radec/fits': 4,
+    'targets/targetids/html': 10,
+    'targets/targetids/csv': 6,
+    'targets/tilefibers/html': 8,
+    'targets/tilefibers/fits': 4,
+    'spectra/radec/html': 12,
+    'spectra/targetids/html': 6,
+    'spectra/targetids/fits': 4,
+    'spectra/tilefibers/fits': 8,
+}
+
+#- credentials used for the synthetic (non-public) production
+USERNAME = PASSWORD = 'loadtest'
+
+def make_url(route, specprod, targets, obs, rng):
+    """
+    Return URL path for route using random targets/observations
+
+    Args:
+        route (str): e.g. 'targets/radec/html'; see DEFAULT_MIX
+        specprod (str): production name
+        targets: table with TARGETID,TARGET_RA,TARGET_DEC
+        obs: table with TILEID,FIBER
+        rng: numpy random Generator
+    """
+    what, selection, fmt = route.split('/')
+    if selection == 'radec':
+        i = rng.integers(len(targets))
+        ra, dec = targets['TARGET_RA'][i], targets['TARGET_DEC'][i]
+        radius = rng.choice([5, 10, 30, 60])
+        url = f'/{specprod}/{what}/radec/{ra:.5f},{dec:.5f},{radius}'
+    elif selection == 'targetids':
+        n = rng.integers(1, 6)
+        targetids = rng.choice(targets['TARGETID'], n, replace=False)
+        url = f'/{specprod}/{what}/' + ','.join(str(t) for t in targetids)
+    elif selection == 'tilefibers':
+        i = rng.integers(len(obs))
+        tileid, fiber = obs['TILEID'][i], obs['FIBER'][i]
+        first = fiber - fiber % 500
+        url = f'/{specprod}/{what}/tiles/{tileid}/{first}-{first+rng.integers(0, 20)}'
+    else:
+        raise ValueError(f'Unrecognized route selection {selection} in {route}')
+
+    return f'{url}?format={fmt}'
+
+def make_requests(mix, nrequests, specprod, targets, obs, seed=0):
+    """Return list of (route, url) with routes drawn according to mix weights"""
+    rng = np.random.default_rng(seed)
+    routes = list(mix.keys())
+    weights = np.array([mix[r] for r in routes], dtype=float)
+    chosen = rng.choice(len(routes), nrequests, p=weights/weights.sum())
+    return [(routes[i], make_url(routes[i], specprod, targets, obs, rng)) for i in chosen]
+
+def _auth_header():
+    token = base64.b64encode(f'{USERNAME}:{PASSWORD}'.encode()).decode()
+    return {'Authorization': f'Basic {token}'}
+
+def rss_kb(pid):
+    """Return resident set size in kB of process pid, or None if it is gone"""
+    try:
+        with open(f'/proc/{pid}/status') as fp:
+            for line in fp:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1])
+    except OSError:
+        return None
+
+def child_pids(pid):
+    """Return list of pids whose parent is pid"""
+    children = list()
+    for name in os.listdir('/proc'):
+        if not name.isdigit():
+            continue
+        try:
+            with open(f'/proc/{name}/stat') as fp:
+                #- field 4 is ppid; command name in field 2 can contain spaces
+                ppid = int(fp.read().rsplit(')', 1)[1].split()[1])
+        except (OSError, IndexError, ValueError):
+            continue
+        if ppid == pid:
+            children.append(int(name))
+
+    return children
+
+class RSSMonitor(threading.Thread):
+    """Background thread recording the peak RSS of a set of processes"""
+    def __init__(self, get_pids, interval=0.5):
+        super().__init__(daemon=True)
+        self.get_pids = get_pids
+        self.interval = interval
+        self.peak = dict()
+        self._stop_event = threading.Event()
+
+    def run(self):
+        while not self._stop_event.is_set():
+            for pid in self.get_pids():
+                rss = rss_kb(pid)
+                if rss is not None:
+                    self.peak[pid] = max(rss, self.peak.get(pid, 0))
+            self._stop_event.wait(self.interval)
+
+    def stop(self):
+        self._stop_event.set()
+        self.join()
+
+def percentiles(times):
+    """Return dict of count, mean, p50/p95/p99 in seconds for list of times"""
+    times = np.asarray(times)
+    return dict(count=len(times), mean=float(np.mean(times)),
+                p50=float(np.percentile(times, 50)),
+                p95=float(np.percentile(times, 95)),
+                p99=float(np.percentile(times, 99)))
+
+def run_load(requests, fetch, concurrency):
+    """
+    Issue requests with concurrency threads
+
+    Args:
+        requests: list of (route, url)
+        fetch: function(url) -> (status_code, nbytes)
+        concurrency (int): number of simultaneous requests
+
+    Returns dict with throughput and per-route latency stats
+    """
+    def timed_fetch(route_url):
+        route, url = route_url
+        t0 = time.perf_counter()
+        try:
+            status, nbytes = fetch(url)
+        except Exception as err:
+            print(f'ERROR {url}: {err}')
+            status, nbytes = None, 0
+        return route, url, status, nbytes, time.perf_counter() - t0
+
+    t0 = time.perf_counter()
+    with ThreadPoolExecutor(concurrency) as pool:
+        results = list(pool.map(timed_fetch, requests))
+    elapsed = time.perf_counter() - t0
+
+    routes = dict()
+    for route, url, status, nbytes, dt in results:
+        r = routes.setdefault(route, dict(times=list(), status=dict(), nbytes=0))
+        r['times'].append(dt)
+        r['status'][str(status)] = r['status'].get(str(status), 0) + 1
+        r['nbytes'] += nbytes
+
+    report = dict(nrequests=len(results), concurrency=concurrency,
+                  elapsed=elapsed, throughput=len(results)/elapsed, routes=dict())
+    for route, r in sorted(routes.items()):
+        report['routes'][route] = dict(**percentiles(r['times']), status=r['status'], nbytes=r['nbytes'])
+
+    return report
+
+def print_report(label, report):
+    print(f"\n{label}: {report['nrequests']} requests, concurrency {report['concurrency']}, "
+          f"{report['elapsed']:.1f} sec, {report['throughput']:.2f} req/sec")
+    print(f"  {'route':28s} {'count':>6s} {'p50':>8s} {'p95':>8s} {'p99':>8s}  status")
+    for route, r in report['routes'].items():
+        print(f"  {route:28s} {r['count']:6d} {r['p50']:8.3f} {r['p95']:8.3f} {r['p99']:8.3f}  {r['status']}")
+    for pid, rss in sorted(report.get('worker_rss_kb', {}).items()):
+        print(f'  worker {pid} peak RSS {rss/1024:.1f} MB')
+
+def load_test_client(requests, concurrency):
+    """Run requests against app.test_client() in this process"""
+    os.environ['DESI_COLLAB_USERNAME'] = USERNAME
+    os.environ['DESI_COLLAB_PASSWORD'] = PASSWORD
+    from app import app
+    from inspector.auth import reload_credentials
+    reload_credentials()
+
+    headers = _auth_header()
+    local = threading.local()   # one test client per thread
+
+    def fetch(url):
+        if not hasattr(local, 'client'):
+            local.client = app.test_client()
+        response = local.client.get(url, headers=headers)
+        nbytes = len(response.get_data())
+        response.close()   # runs call_on_close handlers, as a real server would
+        return response.status_code, nbytes
+
+    monitor = RSSMonitor(lambda: [os.getpid(),])
+    monitor.start()
+    report = run_load(requests, fetch, concurrency)
+    monitor.stop()
+    report['worker_rss_kb'] = monitor.peak
+    return report
+
+def load_http(requests, concurrency, base_url, server_pid=None):
+    """Run requests over HTTP against base_url; track RSS of server_pid's workers if given"""
+    headers = _auth_header()
+
+    def fetch(url):
+        req = urllib.request.Request(base_url.rstrip('/') + url, headers=headers)
+        try:
+            with urllib.request.urlopen(req, timeout=600) as response:
+                return response.status, len(response.read())
+        except urllib.error.HTTPError as err:
+            return err.code, len(err.read())
+
+    monitor = None
+    if server_pid is not None:
+        monitor = RSSMonitor(lambda: child_pids(server_pid))
+        monitor.start()
+
+    report = run_load(requests, fetch, concurrency)
+
+    if monitor is not None:
+        monitor.stop()
+        report['worker_rss_kb'] = monitor.peak
+
+    return report
+
+def _free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+def start_gunicorn(nworkers, env=None, timeout=120):
+    """
+    Start gunicorn serving app:app with nworkers on a free local port
+
+    Returns (process, base_url) once the server responds
+    """
+    topdir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    port = _free_port()
+    server_env = os.environ.copy()
+    server_env.update(DESI_COLLAB_USERNAME=USERNAME, DESI_COLLAB_PASSWORD=PASSWORD)
+    #- measure cold workers unless warm-up is requested with --env DESI_INSPECTOR_WARMUP=1
+    server_env['DESI_INSPECTOR_WARMUP'] = '0'
+    if env is not None:
+        server_env.update(env)
+
+    cmd = ['gunicorn', '-b', f'127.0.0.1:{port}', '-w', str(nworkers), '--timeout', '600']
+    if server_env.get('DESI_INSPECTOR_PRELOAD', '') in ('1', 'true', 'yes'):
+        cmd.append('--preload')
+    cmd.append('app:app')
+
+    proc = subprocess.Popen(cmd, cwd=topdir, env=server_env)
+    base_url = f'http://127.0.0.1:{port}'
+    t0 = time.time()
+    while time.time() - t0 < timeout:
+        try:
+            with urllib.request.urlopen(base_url + '/about', timeout=5):
+                return proc, base_url
+        except OSError:
+            if proc.poll() is not None:
+                raise RuntimeError(f'gunicorn exited with status {proc.returncode}')
+            time.sleep(0.5)
+
+    proc.send_signal(signal.SIGTERM)
+    raise RuntimeError(f'gunicorn did not start within {timeout} sec')
+
+def read_synthetic_inventory(desi_root, specprod):
+    """Return (targets, obs) inventory tables written by inspector.synthetic"""
+    from astropy.table import Table
+    invdir = os.path.join(desi_root, 'inventory', specprod)
+    targets = Table.read(os.path.join(invdir, f'inventory-{specprod}-healpix.fits'))
+    obs = Table.read(os.path.join(invdir, f'inventory-{specprod}-tiles.fits'))
+    return targets, obs
+
+def main():
+    parser = argparse.ArgumentParser(description='Load test the Data Inspector with a weighted URL mix')
+    parser.add_argument('--desi-root', help='existing synthetic production (default: generate one in a tmpdir)')
+    parser.add_argument('--specprod', default='synth', help='synthetic production name')
+    parser.add_argument('--ntargets', type=int, default=2000, help='targets if generating production')
+    parser.add_argument('-n', '--requests', type=int, default=200, help='number of requests per run')
+    parser.add_argument('-c', '--concurrency', type=int, default=4, help='simultaneous requests')
+    parser.add_argument('--mix', help='json file with {route: weight}; default DEFAULT_MIX')
+    parser.add_argument('--url', help='base URL of an already running server')
+    parser.add_argument('--gunicorn', help='comma separated worker counts; start local gunicorn for each')
+    parser.add_argument('--env', action='append', default=[],
+                        help='KEY=VALUE environment for gunicorn servers, e.g. caching settings; may repeat')
+    parser.add_argument('--seed', type=int, default=0, help='random seed for URL mix')
+    parser.add_argument('-o', '--output', help='write json report to this file')
+    args = parser.parse_args()
+
+    from inspector import synthetic
+
+    if args.mix is not None:
+        with open(args.mix) as fp:
+            mix = json.load(fp)
+    else:
+        mix = DEFAULT_MIX
+
+    env = dict(kv.split('=', 1) for kv in args.env)
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        desi_root = args.desi_root
+        if desi_root is None:
+            desi_root = tmpdir
+            print(f'Generating synthetic production with {args.ntargets} targets')
+            synthetic.make_production(desi_root, args.specprod, ntargets=args.ntargets)
+
+        synthetic.set_environment(desi_root)
+        targets, obs = read_synthetic_inventory(desi_root, args.specprod)
+        requests = make_requests(mix, args.requests, args.specprod, targets, obs, seed=args.seed)
+
+        reports = dict()
+        if args.url is not None:
+            reports[args.url] = load_http(requests, args.concurrency, args.url)
+        elif args.gunicorn is not None:
+            for nworkers in [int(n) for n in args.gunicorn.split(',')]:
+                proc, base_url = start_gunicorn(nworkers, env)
+                try:
+                    label = f'gunicorn -w {nworkers}'
+                    reports[label] = load_http(requests, args.concurrency, base_url, server_pid=proc.pid)
+                finally:
+                    proc.send_signal(signal.SIGTERM)
+                    proc.wait()
+        else:
+            reports['test_client'] = load_test_client(requests, args.concurrency)
+
+    for label, report in reports.items():
+        print_report(label, report)
+
+    if args.output is not None:
+        with open(args.output, 'w') as fp:
+            json.dump(dict(mix=mix, env=env, reports=reports), fp, indent=1)
+        print(f'Wrote {args.output}')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,295 @@
+"""
+inspector.memstats
+==================
+
+Per-request memory instrumentation and worker recycling.
+
+A background thread samples the worker's resident set size (RSS) while
+requests are in progress, recording the peak RSS of each request.  Only
+anonymous memory is counted, not resident pages of memory mapped files or
+shared memory, which would otherwise make workers that touched large
+files look bloated.  With
+$DESI_INSPECTOR_TRACEMALLOC=1, tracemalloc also records the peak python
+allocations and the top allocation sites per request; this has a real CPU
+cost so is off by default.  Requests in other threads of the same worker
+share the process memory, so concurrent requests see each other's peaks.
+
+Stats are aggregated per route and format and written to
+$DESI_INSPECTOR_STATS_DIR/<pid>.json after each request, so that
+collect_stats() can report on every worker.
+
+Once a gunicorn worker's RSS passes $DESI_INSPECTOR_RSS_HIGH_WATER_MB after
+finishing a request, it sends itself SIGTERM, which gunicorn handles as a
+graceful shutdown: the worker finishes any request in progress, exits, and
+the arbiter starts a fresh one.  Recycling is deferred while the worker
+has background jobs running (see inspector.jobs), since they would die with
+it; the next request after they finish recycles the worker instead.
+
+Example usage:
+
+app.before_request(memstats.before_request)
+app.after_request(memstats.after_request)
+"""
+
+import os
+import sys
+import json
+import time
+import signal
+import tempfile
+import threading
+import tracemalloc
+
+from flask import request, g
+
+from inspector.admission import _pid_alive
+
+MEMSTATS = os.getenv('DESI_INSPECTOR_MEMSTATS', '1').lower() not in ('0', 'false', 'no')
+TRACEMALLOC = os.getenv('DESI_INSPECTOR_TRACEMALLOC', '0').lower() in ('1', 'true', 'yes')
+TRACEMALLOC_FRAMES = 10
+TOP_ALLOCATIONS = 10
+
+#- recycle a worker whose RSS exceeds this [MB] after a request; 0 disables
+RSS_HIGH_WATER_MB = int(os.getenv('DESI_INSPECTOR_RSS_HIGH_WATER_MB', 4096))
+
+#- seconds between RSS samples while requests are active
+SAMPLE_INTERVAL = 0.05
+
+STATS_DIR = os.getenv('DESI_INSPECTOR_STATS_DIR', os.path.join(tempfile.gettempdir(), 'desi-inspector-stats'))
+
+_PAGESIZE = os.sysconf('SC_PAGE_SIZE') if hasattr(os, 'sysconf') else 4096
+
+def rss_bytes():
+    """
+    Return current resident anonymous memory of this process in bytes
+
+    Resident pages that are file-backed or shared, e.g. the memory mapped
+    files of inspector.fitsmap and the shared memory of
+    inspector.sharedread, are excluded since the kernel can reclaim them
+    or they belong to other processes too.
+    """
+    try:
+        with open('/proc/self/statm') as fp:
+            fields = fp.read().split()
+        #- resident minus shared (file-backed and shmem) pages
+        return (int(fields[1]) - int(fields[2])) * _PAGESIZE
+    except OSError:
+        #- not Linux; use lifetime max RSS instead
+        import resource
+        maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return maxrss if sys.platform == 'darwin' else maxrss*1024
+
+class _RequestMemory(object):
+    """Memory measurements for a single request"""
+    def __init__(self, route):
+        self.route = route
+        self.t0 = time.time()
+        self.rss_start = self.peak_rss = rss_bytes()
+        self.snapshot = None
+
+class MemoryTracker(object):
+    """
+    Tracks peak RSS of active requests and aggregates stats per route
+    """
+    def __init__(self, sample_interval=SAMPLE_INTERVAL, use_tracemalloc=TRACEMALLOC):
+        self.sample_interval = sample_interval
+        self.use_tracemalloc = use_tracemalloc
+        self.active = set()
+        self.routes = dict()
+        self.nrequests = 0
+        self.recycling = False
+        self.started = time.time()
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._thread = None
+        if use_tracemalloc and not tracemalloc.is_tracing():
+            tracemalloc.start(TRACEMALLOC_FRAMES)
+
+    def _sample(self):
+        """Background thread updating peak_rss of active requests"""
+        while True:
+            self._wakeup.wait()
+            rss = rss_bytes()
+            with self._lock:
+                for r in self.active:
+                    r.peak_rss = max(r.peak_rss, rss)
+                if len(self.active) == 0:
+                    self._wakeup.clear()
+            time.sleep(self.sample_interval)
+
+    def start(self, route):
+        """Start tracking a request to route; returns token for finish()"""
+        r = _RequestMemory(route)
+        if self.use_tracemalloc:
+            r.snapshot = tracemalloc.take_snapshot()
+        with self._lock:
+            #- start sampler here rather than at import, so that it isn't
+            #- lost in the fork of gunicorn --preload
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._sample, daemon=True)
+                self._thread.start()
+            if self.use_tracemalloc and len(self.active) == 0:
+                tracemalloc.reset_peak()
+            self.active.add(r)
+            self._wakeup.set()
+        return r
+
+    def finish(self, r):
+        """Finish tracking request r; returns dict of its measurements"""
+        rss = rss_bytes()
+        with self._lock:
+            self.active.discard(r)
+        r.peak_rss = max(r.peak_rss, rss)
+
+        result = dict(route=r.route, seconds=time.time() - r.t0,
+                      rss_start=r.rss_start, rss_end=rss, peak_rss=r.peak_rss,
+                      peak_increase=r.peak_rss - r.rss_start)
+
+        if self.use_tracemalloc and r.snapshot is not None:
+            result['tracemalloc_peak'] = tracemalloc.get_traced_memory()[1]
+            diff = tracemalloc.take_snapshot().compare_to(r.snapshot, 'lineno')
+            result['top_allocations'] = [
+                dict(location=f'{d.traceback[0].filename}:{d.traceback[0].lineno}',
+                     size_diff=d.size_diff, count_diff=d.count_diff)
+                for d in diff[0:TOP_ALLOCATIONS]]
+
+        self._record(result)
+        return result
+
+    def _record(self, result):
+        with self._lock:
+            self.nrequests += 1
+            stats = self.routes.setdefault(result['route'], dict(
+                count=0, total_seconds=0.0, max_seconds=0.0, max_peak_rss=0,
+                total_peak_increase=0, max_peak_increase=0))
+            stats['count'] += 1
+            stats['total_seconds'] += result['seconds']
+            stats['max_seconds'] = max(stats['max_seconds'], result['seconds'])
+            stats['max_peak_rss'] = max(stats['max_peak_rss'], result['peak_rss'])
+            stats['total_peak_increase'] += result['peak_increase']
+            if result['peak_increase'] >= stats['max_peak_increase']:
+                stats['max_peak_increase'] = result['peak_increase']
+                #- keep the allocation sites of the worst request
+                if 'top_allocations' in result:
+                    stats['top_allocations'] = result['top_allocations']
+                    stats['tracemalloc_peak'] = result['tracemalloc_peak']
+
+    def summary(self):
+        """Return dict of stats for this worker"""
+        with self._lock:
+            routes = dict()
+            for route, stats in self.routes.items():
+                s = dict(stats)
+                s['mean_seconds'] = s['total_seconds'] / s['count']
+                s['mean_peak_increase'] = s['total_peak_increase'] // s['count']
+                routes[route] = s
+
+            return dict(pid=os.getpid(), rss=rss_bytes(), nrequests=self.nrequests,
+                        active=len(self.active), recycling=self.recycling,
+                        uptime=time.time() - self.started, tracemalloc=self.use_tracemalloc,
+                        routes=routes)
+
+    def write_summary(self, stats_dir=STATS_DIR):
+        """Write summary() to stats_dir/<pid>.json"""
+        os.makedirs(stats_dir, exist_ok=True)
+        filename = os.path.join(stats_dir, f'{os.getpid()}.json')
+        tmpfile = f'{filename}.tmp'
+        with open(tmpfile, 'w') as fp:
+            json.dump(self.summary(), fp)
+        os.replace(tmpfile, filename)
+
+_tracker = None
+
+def get_tracker():
+    """Return MemoryTracker for this process"""
+    global _tracker
+    if _tracker is None:
+        _tracker = MemoryTracker()
+    return _tracker
+
+def route_name():
+    """Return name of the current request route for grouping stats, including format"""
+    rule = request.url_rule.rule if request.url_rule is not None else '<unmatched>'
+    fmt = request.args.get('format', 'html').lower()
+    return f'{rule}?format={fmt}'
+
+def before_request():
+    """Start tracking memory for the current request; for use with app.before_request"""
+    if MEMSTATS:
+        g.memstats = get_tracker().start(route_name())
+
+def after_request(response):
+    """
+    Finish tracking when the response has been sent, including streamed
+    responses, then recycle the worker if needed; for use with app.after_request
+    """
+    token = g.pop('memstats', None)
+    if token is None:
+        return response
+
+    under_gunicorn = request.environ.get('SERVER_SOFTWARE', '').startswith('gunicorn')
+
+    def finish():
+        tracker = get_tracker()
+        result = tracker.finish(token)
+        try:
+            tracker.write_summary()
+        except OSError as err:
+            print(f'WARNING: unable to write memory stats: {err}')
+
+        high_water = RSS_HIGH_WATER_MB * 1024**2
+        if high_water > 0 and result['rss_end'] > high_water and not tracker.recycling:
+            njobs = _active_jobs()
+            if njobs > 0:
+                print(f'Worker {os.getpid()} RSS {result["rss_end"]/1024**2:.0f} MB > '
+                      f'{RSS_HIGH_WATER_MB} MB after {result["route"]}; '
+                      f'not recycling while {njobs} jobs are running')
+                return
+
+            print(f'Worker {os.getpid()} RSS {result["rss_end"]/1024**2:.0f} MB > '
+                  f'{RSS_HIGH_WATER_MB} MB after {result["route"]}; recycling')
+            tracker.recycling = True
+            if under_gunicorn:
+                #- graceful shutdown for gunicorn workers: finish current requests, then exit
+                os.kill(os.getpid(), signal.SIGTERM)
+
+    response.call_on_close(finish)
+    return response
+
+def _active_jobs():
+    """Return number of background jobs still running in this worker"""
+    #- no need to import inspector.jobs if this worker never submitted a job
+    jobs = sys.modules.get('inspector.jobs')
+    return jobs.active_jobs() if jobs is not None else 0
+
+def collect_stats(stats_dir=STATS_DIR):
+    """
+    Return stats for all live workers that have written to stats_dir, plus this one
+
+    Returns dict with "workers", a list of per-worker summaries, and
+    settings used for recycling
+    """
+    workers = dict()
+    if os.path.isdir(stats_dir):
+        for name in os.listdir(stats_dir):
+            if not name.endswith('.json'):
+                continue
+            pid = int(name[0:-5]) if name[0:-5].isdigit() else None
+            filename = os.path.join(stats_dir, name)
+            if pid is None or not _pid_alive(pid):
+                try:
+                    os.remove(filename)
+                except OSError:
+                    pass
+                continue
+            try:
+                with open(filename) as fp:
+                    workers[pid] = json.load(fp)
+            except (OSError, ValueError):
+                pass
+
+    #- this worker's stats are always current
+    workers[os.getpid()] = get_tracker().summary()
+
+    return dict(rss_high_water_mb=RSS_HIGH_WATER_MB, tracemalloc=TRACEMALLOC,
+                workers=[workers[pid] for pid in sorted(workers)])
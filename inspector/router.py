@@ -0,0 +1,359 @@
+"""
+inspector.router
+================
+
+Cache-affinity routing front end for several Data Inspector servers.
+
+With N gunicorn workers behind one port, each request goes to whichever
+worker is free, so the per-process caches (open files and findfile lookups
+in inspector.fitscache, zcat schemas, attribute indexes) each see a random
+1/N of the sky and mostly miss.  The router instead forwards each request
+to one of N single-worker servers chosen by consistent hashing of its sky
+region: the HEALPix pixel (nested, nside ROUTE_NSIDE) of radec cone
+searches, or the TILEID of tile/fiber requests; other requests are hashed
+by their path.  Neighboring queries then reuse the caches of the same
+worker, and adding or removing a backend only moves ~1/N of the regions.
+
+If a backend refuses or drops the connection it is marked down for
+DOWN_SECONDS and its requests go to the next backend on the hash ring.
+With --spawn, the router also starts the backends and restarts any that exit.
+
+Example usage:
+
+    #- start 5 single-worker backends on ports 5002-5006 behind port 5001
+    python -m inspector.router --port 5001 --spawn 5
+
+    #- route to already running servers
+    python -m inspector.router --port 5001 --backends http://127.0.0.1:5002,http://127.0.0.1:5003
+"""
+
+import os
+import re
+import sys
+import time
+import bisect
+import signal
+import hashlib
+import argparse
+import threading
+import subprocess
+import http.client
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit
+
+#- HEALPix nside for grouping radec queries; 64 matches the healpix coadd files
+ROUTE_NSIDE = int(os.getenv('DESI_INSPECTOR_ROUTE_NSIDE', 64))
+
+#- points per backend on the hash ring; more points spread keys more evenly
+REPLICAS = 100
+
+#- seconds before retrying a backend that refused a connection
+DOWN_SECONDS = float(os.getenv('DESI_INSPECTOR_ROUTE_DOWN_SECONDS', 10))
+
+#- seconds to wait for a backend response, matching gunicorn --timeout
+BACKEND_TIMEOUT = float(os.getenv('DESI_INSPECTOR_ROUTE_TIMEOUT', 600))
+
+#- bytes per read when relaying responses, so streamed pages are passed on as they arrive
+CHUNK_SIZE = 64*1024
+
+#- longest chunk size or trailer line accepted in chunked request bodies
+CHUNK_LINE_MAX = 8*1024
+
+#- hop-by-hop headers that apply to a single connection and aren't forwarded
+HOP_HEADERS = frozenset(('connection', 'keep-alive', 'proxy-authenticate', 'proxy-authorization',
+                         'te', 'trailer', 'transfer-encoding', 'upgrade'))
+
+_RADEC = re.compile(r'/radec/([^/]+)')
+_TILE_FIBERS = re.compile(r'/(?:targets|spectra|stack)/(?:tiles/)?(\d+)/[^/]+$')
+
+def route_key(path):
+    """
+    Return the string hashed to pick a backend for request path
+
+    "healpix:PIXEL" for radec cone searches, "tile:TILEID" for tile/fiber
+    requests, otherwise "path:PATH" including the query options, so that
+    e.g. production-wide queries with different filters are spread out.
+    """
+    urlpath = urlsplit(path).path
+    match = _RADEC.search(urlpath)
+    if match is not None:
+        import healpy
+        try:
+            ra, dec = [float(x) for x in match.group(1).split(',')[0:2]]
+            pixel = healpy.ang2pix(ROUTE_NSIDE, ra, dec, nest=True, lonlat=True)
+        except ValueError:
+            #- e.g. dec outside [-90,90]; any backend can answer 400
+            pass
+        else:
+            return f'healpix:{pixel}'
+
+    match = _TILE_FIBERS.search(urlpath)
+    if match is not None:
+        return f'tile:{int(match.group(1))}'
+
+    return f'path:{path}'
+
+def _hash(key):
+    return int.from_bytes(hashlib.md5(key.encode()).digest()[0:8], 'big')
+
+class HashRing(object):
+    """
+    Consistent hash ring mapping keys to backends
+
+    Each backend is placed at `replicas` pseudo-random points on the ring,
+    and a key belongs to the first backend point after its own hash.
+    """
+    def __init__(self, backends, replicas=REPLICAS):
+        if len(backends) == 0:
+            raise ValueError('HashRing needs at least one backend')
+
+        self.backends = list(backends)
+        points = sorted((_hash(f'{backend}#{i}'), backend) for backend in self.backends for i in range(replicas))
+        self._hashes = [h for h, backend in points]
+        self._points = [backend for h, backend in points]
+
+    def lookup(self, key):
+        """Return list of all backends in order of preference for key"""
+        start = bisect.bisect(self._hashes, _hash(key))
+        result = list()
+        for i in range(len(self._points)):
+            backend = self._points[(start + i) % len(self._points)]
+            if backend not in result:
+                result.append(backend)
+                if len(result) == len(self.backends):
+                    break
+
+        return result
+
+class Router(object):
+    """
+    Pick backends for requests, tracking which backends are down
+    """
+    def __init__(self, backends, replicas=REPLICAS, down_seconds=DOWN_SECONDS, timeout=BACKEND_TIMEOUT):
+        self.ring = HashRing(backends, replicas=replicas)
+        self.down_seconds = down_seconds
+        self.timeout = timeout
+        self._down_until = dict()
+        self._lock = threading.Lock()
+        self.requests = Counter()
+        self.failures = Counter()
+
+    def candidates(self, path):
+        """
+        Return backends to try for request path in order
+
+        Backends marked down are moved to the end, as a last resort if all are down.
+        """
+        now = time.time()
+        order = self.ring.lookup(route_key(path))
+        with self._lock:
+            up = [b for b in order if self._down_until.get(b, 0) <= now]
+        return up + [b for b in order if b not in up]
+
+    def mark_down(self, backend):
+        with self._lock:
+            self._down_until[backend] = time.time() + self.down_seconds
+            self.failures[backend] += 1
+
+    def mark_up(self, backend):
+        with self._lock:
+            self._down_until.pop(backend, None)
+            self.requests[backend] += 1
+
+    def stats(self):
+        """Return dict of backend -> dict(requests, failures, up)"""
+        now = time.time()
+        with self._lock:
+            return {b: dict(requests=self.requests[b], failures=self.failures[b],
+                            up=self._down_until.get(b, 0) <= now) for b in self.ring.backends}
+
+class _ProxyHandler(BaseHTTPRequestHandler):
+    """Forward each request to the backend picked by self.server.router"""
+
+    protocol_version = 'HTTP/1.1'
+
+    def _read_chunked(self):
+        """Return request body sent with Transfer-Encoding: chunked, or None if malformed"""
+        chunks = list()
+        while True:
+            line = self.rfile.readline(CHUNK_LINE_MAX)
+            try:
+                size = int(line.split(b';', 1)[0].strip(), 16)
+            except ValueError:
+                return None
+            if size == 0:
+                break
+            chunks.append(self.rfile.read(size))
+            if len(chunks[-1]) < size or self.rfile.readline(CHUNK_LINE_MAX).strip():
+                return None
+
+        #- skip trailer headers up to the final blank line
+        while True:
+            line = self.rfile.readline(CHUNK_LINE_MAX)
+            if not line:
+                return None
+            if not line.strip():
+                break
+
+        return b''.join(chunks)
+
+    def _read_body(self):
+        """Return request body, None if there isn't one, or send an error and return False"""
+        encoding = self.headers.get('Transfer-Encoding', '').strip().lower()
+        if encoding == 'chunked':
+            body = self._read_chunked()
+            if body is None:
+                self.close_connection = True
+                self.send_error(400, 'Malformed chunked request body')
+                return False
+            return body
+        elif encoding:
+            #- the body can't be delimited, so the connection can't be reused
+            self.close_connection = True
+            self.send_error(411, 'Content-Length or chunked Transfer-Encoding required')
+            return False
+
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+        except ValueError:
+            self.close_connection = True
+            self.send_error(400, 'Invalid Content-Length')
+            return False
+        return self.rfile.read(length) if length > 0 else None
+
+    def _proxy(self):
+        router = self.server.router
+        body = self._read_body()
+        if body is False:
+            return
+
+        #- keep Host so that the URLs generated by the app point to the router;
+        #- http.client sets Content-Length for the (possibly dechunked) body
+        headers = {k: v for k, v in self.headers.items()
+                   if k.lower() not in HOP_HEADERS and k.lower() != 'content-length'}
+        headers['X-Forwarded-For'] = self.client_address[0]
+
+        for backend in router.candidates(self.path):
+            url = urlsplit(backend)
+            conn = http.client.HTTPConnection(url.hostname, url.port, timeout=router.timeout)
+            try:
+                conn.request(self.command, self.path, body=body, headers=headers)
+                response = conn.getresponse()
+            except TimeoutError:
+                conn.close()
+                self.send_error(504, 'Data Inspector backend timed out')
+                return
+            except ConnectionError as err:
+                #- refused, or the worker died before responding; try the next backend
+                conn.close()
+                print(f'Backend {backend} failed: {err}', file=sys.stderr)
+                router.mark_down(backend)
+                if self.command == 'POST' and not isinstance(err, ConnectionRefusedError):
+                    #- the request may have been acted upon, so don't repeat it elsewhere
+                    self.send_error(502, 'Data Inspector backend failed')
+                    return
+                continue
+
+            router.mark_up(backend)
+            try:
+                self._relay(response)
+            finally:
+                conn.close()
+            return
+
+        self.send_error(503, 'No Data Inspector backends available')
+
+    def _relay(self, response):
+        """Send backend response to the client, streaming the body as it arrives"""
+        self.send_response_only(response.status, response.reason)
+        has_body = self.command != 'HEAD' and response.status not in (204, 304)
+        chunked = has_body and response.getheader('Content-Length') is None
+        for key, value in response.getheaders():
+            if key.lower() not in HOP_HEADERS:
+                self.send_header(key, value)
+        if chunked:
+            self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+
+        while has_body:
+            data = response.read1(CHUNK_SIZE)
+            if not data:
+                break
+            if chunked:
+                self.wfile.write(b'%x\r\n%s\r\n' % (len(data), data))
+            else:
+                self.wfile.write(data)
+
+        if chunked:
+            self.wfile.write(b'0\r\n\r\n')
+
+    do_GET = do_POST = do_HEAD = _proxy
+
+class RouterServer(ThreadingHTTPServer):
+    """HTTP server forwarding requests to the backends of router"""
+    daemon_threads = True
+
+    def __init__(self, address, router):
+        super().__init__(address, _ProxyHandler)
+        self.router = router
+
+def start_backend(port, preload=False):
+    """Start a single-worker gunicorn serving app:app on local port; returns process"""
+    topdir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    cmd = ['gunicorn', '-b', f'127.0.0.1:{port}', '-w', '1', '--timeout', str(int(BACKEND_TIMEOUT))]
+    if preload:
+        cmd.append('--preload')
+    cmd.append('app:app')
+    return subprocess.Popen(cmd, cwd=topdir)
+
+def main():
+    parser = argparse.ArgumentParser(description='Route Data Inspector requests to backends by sky region')
+    parser.add_argument('--host', default='0.0.0.0', help='address to listen on')
+    parser.add_argument('-p', '--port', type=int, default=5001, help='port to listen on')
+    parser.add_argument('--backends', help='comma separated backend URLs')
+    parser.add_argument('--spawn', type=int, help='start this many single-worker gunicorn backends')
+    parser.add_argument('--backend-port', type=int, help='first port for spawned backends (default PORT+1)')
+    args = parser.parse_args()
+
+    if (args.backends is None) == (args.spawn is None):
+        parser.error('Specify either --backends or --spawn')
+
+    processes = dict()
+    if args.spawn is not None:
+        first_port = args.backend_port or args.port + 1
+        preload = os.getenv('DESI_INSPECTOR_PRELOAD', '') in ('1', 'true', 'yes')
+        for port in range(first_port, first_port + args.spawn):
+            processes[port] = start_backend(port, preload=preload)
+        backends = [f'http://127.0.0.1:{port}' for port in processes]
+    else:
+        backends = [b.strip().rstrip('/') for b in args.backends.split(',')]
+
+    router = Router(backends)
+    server = RouterServer((args.host, args.port), router)
+    print(f'Routing http://{args.host}:{args.port} to {", ".join(backends)}')
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        while True:
+            time.sleep(5)
+            for port, proc in processes.items():
+                if proc.poll() is not None:
+                    print(f'Backend on port {port} exited with status {proc.returncode}; restarting',
+                          file=sys.stderr)
+                    processes[port] = start_backend(port, preload=preload)
+    except (KeyboardInterrupt, SystemExit):
+        pass
+    finally:
+        server.shutdown()
+        for proc in processes.values():
+            proc.send_signal(signal.SIGTERM)
+        for proc in processes.values():
+            proc.wait()
+        for backend, stats in router.stats().items():
+            print(f'{backend}: {stats["requests"]} requests, {stats["failures"]} failures')
+
+if __name__ == '__main__':
+    main()
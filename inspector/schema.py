@@ -0,0 +1,446 @@
+"""
+inspector.schema
+================
+
+Catalog of the columns available in each production's redrock files.
+
+add_zcat_columns used to assume that any column not in a fixed list of
+REDSHIFTS columns was in FIBERMAP, so a typo in xcol or a filter only failed
+after the redrock files had been read.  get_schema instead records which
+HDU holds each column, and its dtype, from the headers of a sample of
+redrock files (one per survey/program, plus tiles spread across the
+production), cached in memory and in $DESI_INSPECTOR_SCHEMA_DIR so it is
+built only once per production; update_schema adds the columns of new
+files of productions that are still growing.  validate_columns checks requested columns
+before any spectra or redshift files are read, and read_target_columns
+reads only the requested columns from each HDU.
+
+Example usage:
+
+    validate_columns('iron', 'healpix', ['Z', 'FLUX_R'])
+    columns = read_target_columns(targetcat, 'iron', ['Z', 'FLUX_R'])
+"""
+
+import os
+import json
+import difflib
+import tempfile
+import threading
+
+import numpy as np
+
+SCHEMA_DIR = os.getenv('DESI_INSPECTOR_SCHEMA_DIR', os.path.join(tempfile.gettempdir(), 'desi-inspector-schema'))
+
+#- bump when the cached schema format or file sample changes
+SCHEMA_VERSION = 2
+
+#- maximum number of tiles redrock files to sample for the tiles schema
+SAMPLE_TILES = 16
+
+#- redrock HDUs with one row per target, in order of preference for columns in more than one;
+#- other table HDUs (e.g. EXP_FIBERMAP with a row per exposure) are cataloged but can't be joined
+TARGET_HDUS = ('REDSHIFTS', 'FIBERMAP', 'TSNR2')
+
+#- columns from the target inventory returned by load_targets, not read from redrock files
+INVENTORY_COLUMNS = dict(
+    healpix=dict(TARGETID='>i8', TARGET_RA='>f8', TARGET_DEC='>f8',
+                 SURVEY='<U7', PROGRAM='<U6', HEALPIX='>i4'),
+    tiles=dict(TARGETID='>i8', TARGET_RA='>f8', TARGET_DEC='>f8', SURVEY='<U7', PROGRAM='<U6',
+               TILEID='>i4', LASTNIGHT='>i4', PETAL_LOC='>i2', FIBER='>i4'),
+    )
+
+class UnknownColumnError(ValueError):
+    """Requested columns aren't in the production's redrock files"""
+    def __init__(self, message, columns):
+        super().__init__(message)
+        self.columns = columns
+
+class Schema(object):
+    """
+    Columns of one production and specgroup
+
+    columns[name] = dict(hdu=HDU name, dtype=dtype string, shape=list)
+    """
+    def __init__(self, specprod, specgroup, columns, files=None):
+        self.specprod = specprod
+        self.specgroup = specgroup
+        self.columns = columns
+        self.files = files if files is not None else list()
+
+    def __contains__(self, name):
+        return name in self.columns
+
+    def hdu(self, name):
+        """Return name of HDU holding column name"""
+        return self.columns[name]['hdu']
+
+    def dtype(self, name):
+        """Return numpy dtype of column name as returned by fitsio, i.e. native strings as unicode"""
+        info = self.columns[name]
+        dtype = np.dtype(info['dtype'])
+        if dtype.kind == 'S':
+            dtype = np.dtype(f'U{dtype.itemsize}')
+        elif dtype.kind != 'U':
+            dtype = dtype.newbyteorder('=')
+        return np.dtype((dtype, tuple(info['shape']))) if info['shape'] else dtype
+
+    def validate(self, columns):
+        """Raise UnknownColumnError if any of columns isn't in this schema"""
+        unknown = [c for c in columns if c not in self.columns]
+        if len(unknown) > 0:
+            messages = list()
+            for name in unknown:
+                msg = f'Column "{name}" not found in {self.specprod} {self.specgroup}'
+                close = difflib.get_close_matches(name, self.columns, n=3)
+                if close:
+                    msg += '; did you mean ' + ' or '.join(close) + '?'
+                messages.append(msg)
+            raise UnknownColumnError('; '.join(messages), unknown)
+
+    def projection(self, columns):
+        """
+        Return dict of HDU name -> list of columns to read for columns
+
+        Raises UnknownColumnError for unknown columns, and ValueError for
+        columns that aren't in a per-target HDU
+        """
+        self.validate(columns)
+        projection = dict()
+        for name in columns:
+            hdu = self.hdu(name)
+            if hdu not in TARGET_HDUS:
+                raise ValueError(f'Column "{name}" is in {hdu}, which doesn\'t have '
+                                 'one row per target in the redrock files')
+            projection.setdefault(hdu, list()).append(name)
+
+        return projection
+
+    def to_dict(self):
+        return dict(version=SCHEMA_VERSION, specprod=self.specprod, specgroup=self.specgroup,
+                    files=self.files, columns=self.columns)
+
+    @classmethod
+    def from_dict(cls, d):
+        return cls(d['specprod'], d['specgroup'], d['columns'], d['files'])
+
+def _listdirs(dirname):
+    try:
+        return sorted(e.name for e in os.scandir(dirname) if e.is_dir())
+    except OSError:
+        return list()
+
+def _first_redrock(dirname, depth):
+    """Return first redrock file found depth directory levels below dirname, or None"""
+    if depth == 0:
+        try:
+            names = sorted(os.listdir(dirname))
+        except OSError:
+            return None
+        for name in names:
+            if name.startswith('redrock-') and name.endswith('.fits'):
+                return os.path.join(dirname, name)
+        return None
+
+    for name in _listdirs(dirname):
+        filename = _first_redrock(os.path.join(dirname, name), depth-1)
+        if filename is not None:
+            return filename
+
+    return None
+
+def _survey_tiles(specprod):
+    """
+    Return list of the first TILEID of each SURVEY/PROGRAM in the production
+    tiles file, or an empty list if it can't be read
+    """
+    import fitsio
+    from inspector.io import production_dir
+
+    filename = os.path.join(production_dir(specprod), f'tiles-{specprod}.fits')
+    try:
+        tiles = fitsio.read(filename, 1, columns=['TILEID', 'SURVEY', 'PROGRAM'])
+    except (OSError, ValueError) as err:
+        print(f'WARNING: unable to read {filename} for the tiles schema: {err}')
+        return list()
+
+    first = dict()
+    for tileid, survey, program in sorted(zip(tiles['TILEID'], tiles['SURVEY'], tiles['PROGRAM'])):
+        first.setdefault((survey, program), int(tileid))
+
+    return sorted(first.values())
+
+def sample_files(specprod, specgroup, ntiles=SAMPLE_TILES):
+    """
+    Return list of redrock files whose headers define the schema
+
+    For healpix, one file per survey/program; for tiles, one tile per
+    survey/program from the production tiles file, because each survey
+    has its own fibermap target bit columns (e.g. SV2_DESI_TARGET), plus
+    up to ntiles tiles spread evenly across the production.
+    """
+    from inspector.io import production_dir
+
+    files = list()
+    if specgroup == 'healpix':
+        topdir = os.path.join(production_dir(specprod), 'healpix')
+        for survey in _listdirs(topdir):
+            for program in _listdirs(os.path.join(topdir, survey)):
+                #- healpix/SURVEY/PROGRAM/HPIXGROUP/HEALPIX/redrock-*.fits
+                filename = _first_redrock(os.path.join(topdir, survey, program), 2)
+                if filename is not None:
+                    files.append(filename)
+    else:
+        topdir = os.path.join(production_dir(specprod), 'tiles', 'cumulative')
+        tiles = _listdirs(topdir)
+        tiles.sort(key=lambda t: (not t.isdigit(), int(t) if t.isdigit() else t))
+        sample = set(str(tileid) for tileid in _survey_tiles(specprod)) & set(tiles)
+        if len(tiles) > ntiles:
+            sample.update(tiles[i] for i in np.linspace(0, len(tiles)-1, ntiles).astype(int))
+        else:
+            sample.update(tiles)
+        for tileid in [t for t in tiles if t in sample]:
+            #- tiles/cumulative/TILEID/LASTNIGHT/redrock-*.fits
+            filename = _first_redrock(os.path.join(topdir, tileid), 1)
+            if filename is not None:
+                files.append(filename)
+
+    return files
+
+def _add_file_columns(columns, filename):
+    """Add columns of the table HDUs of redrock filename to columns dict; returns names added"""
+    from inspector.fitscache import open_fits
+
+    #- columns in HDUs earlier in this order take precedence
+    hdu_order = {name: i for i, name in enumerate(TARGET_HDUS)}
+    added = list()
+    with open_fits(filename) as fx:
+        for hdu in fx:
+            if hdu.get_exttype() != 'BINARY_TBL':
+                continue
+            extname = hdu.get_extname()
+            dtype = hdu.get_rec_dtype()[0]
+            rank = hdu_order.get(extname, len(hdu_order))
+            for name in dtype.names:
+                if name in columns and hdu_order.get(columns[name]['hdu'], len(hdu_order)) <= rank:
+                    continue
+                if name not in columns:
+                    added.append(name)
+                base, shape = dtype[name].base, dtype[name].shape
+                columns[name] = dict(hdu=extname, dtype=base.str, shape=list(shape))
+
+    return added
+
+def build_schema(specprod, specgroup):
+    """Return Schema for specprod/specgroup from redrock file headers, or None if there are no files"""
+    files = sample_files(specprod, specgroup)
+    if len(files) == 0:
+        return None
+
+    columns = dict()
+    for filename in files:
+        _add_file_columns(columns, filename)
+
+    for name, dtype in INVENTORY_COLUMNS[specgroup].items():
+        if name not in columns:
+            columns[name] = dict(hdu='INVENTORY', dtype=dtype, shape=[])
+
+    return Schema(specprod, specgroup, columns, files)
+
+_schemas = dict()
+_schemas_lock = threading.Lock()
+
+def _cachefile(specprod, specgroup, schema_dir):
+    return os.path.join(schema_dir, f'schema-{specprod}-{specgroup}.json')
+
+def _write_cachefile(schema, cachefile):
+    try:
+        os.makedirs(os.path.dirname(cachefile), exist_ok=True)
+        tmpfile = f'{cachefile}.{os.getpid()}.tmp'
+        with open(tmpfile, 'w') as fp:
+            json.dump(schema.to_dict(), fp)
+        os.replace(tmpfile, cachefile)
+    except OSError as err:
+        print(f'WARNING: unable to cache column schema: {err}')
+
+def _read_cachefile(cachefile):
+    try:
+        with open(cachefile) as fp:
+            d = json.load(fp)
+        if d.get('version') == SCHEMA_VERSION:
+            return Schema.from_dict(d)
+    except (OSError, ValueError, KeyError):
+        pass
+    return None
+
+def _cache_stamp(cachefile):
+    try:
+        st = os.stat(cachefile)
+        return st.st_mtime_ns, st.st_size
+    except OSError:
+        return None
+
+def get_schema(specprod, specgroup, schema_dir=SCHEMA_DIR):
+    """
+    Return Schema for specprod/specgroup, using the in-memory or on-disk cache if available
+
+    The in-memory copy is reloaded when the on-disk cache changes, e.g.
+    after update_schema in another process.  Returns None if the production
+    has no redrock files for specgroup.
+    """
+    from inspector.io import standardize_specprod
+    specprod = standardize_specprod(specprod)
+    key = (specprod, specgroup)
+    cachefile = _cachefile(specprod, specgroup, schema_dir)
+    stamp = _cache_stamp(cachefile)
+    with _schemas_lock:
+        if key in _schemas and _schemas[key][0] == stamp:
+            return _schemas[key][1]
+
+    schema = _read_cachefile(cachefile)
+    if schema is None:
+        schema = build_schema(specprod, specgroup)
+        if schema is not None:
+            _write_cachefile(schema, cachefile)
+            stamp = _cache_stamp(cachefile)
+
+    if schema is not None:
+        with _schemas_lock:
+            _schemas[key] = (stamp, schema)
+
+    return schema
+
+def update_schema(specprod, specgroup, filenames, schema_dir=SCHEMA_DIR):
+    """
+    Add any new columns of redrock filenames to the cached schema of specprod/specgroup
+
+    Used by inspector.attrindex.update_index for new or changed files of
+    productions that are still growing.  Nothing is rewritten if there is
+    no cached schema yet or no columns are new.  Returns list of new column names.
+    """
+    from inspector.io import standardize_specprod
+    specprod = standardize_specprod(specprod)
+    cachefile = _cachefile(specprod, specgroup, schema_dir)
+    schema = _read_cachefile(cachefile)
+    if schema is None:
+        return list()
+
+    original = {name: dict(info) for name, info in schema.columns.items()}
+    added = list()
+    for filename in filenames:
+        added.extend(_add_file_columns(schema.columns, filename))
+
+    if schema.columns != original:
+        _write_cachefile(schema, cachefile)
+
+    return added
+
+def validate_columns(specprod, specgroup, columns):
+    """
+    Raise UnknownColumnError if any of columns isn't available for specprod/specgroup
+
+    Does nothing if the production has no redrock files, leaving the error
+    to the inventory lookup.
+    """
+    if len(columns) == 0:
+        return
+
+    schema = get_schema(specprod, specgroup)
+    if schema is not None:
+        schema.validate(columns)
+
+def _redrockfile(keys, specprod):
+    """Return redrock filename for file keys from sharedread._file_groups"""
+    from inspector.fitscache import findfile
+    if 'HEALPIX' in keys:
+        return findfile('redrock', healpix=keys['HEALPIX'], survey=keys['SURVEY'],
+                        faprogram=keys['PROGRAM'], readonly=True, specprod=specprod)
+    else:
+        return findfile('redrock', night=keys['LASTNIGHT'], tile=keys['TILEID'],
+                        spectrograph=keys['PETAL_LOC'], readonly=True, specprod=specprod)
+
+def _read_file_columns(filename, keycol, keys, projection):
+    """
+    Read projection columns from filename for rows whose FIBERMAP keycol is in keys
+
+    Returns (found, data) where found[i] is the index into keys of data row i,
+    and data is dict of HDU name -> structured array
+    """
+    from inspector.fitscache import open_fits
+    with open_fits(filename) as fx:
+        filekeys = fx['FIBERMAP'].read(columns=keycol)
+        rows = np.where(np.isin(filekeys, keys))[0]
+        data = dict()
+        for hdu, cols in projection.items():
+            data[hdu] = fx[hdu].read(columns=cols, rows=rows)
+
+    #- each requested key matches one file row, since TARGETID and FIBER are unique within a file
+    key2row = {k: i for i, k in enumerate(filekeys[rows].tolist())}
+    matched = np.array([key2row.get(k, -1) for k in np.asarray(keys).tolist()], dtype=int)
+    found = np.where(matched >= 0)[0]
+    data = {hdu: d[matched[found]] for hdu, d in data.items()}
+    return found, data
+
+def read_target_columns(targetcat, specprod, columns, schema=None, nproc=None):
+    """
+    Read columns from redrock files for the targets in targetcat
+
+    Args:
+        targetcat: table with TARGETID or FIBER, plus HEALPIX,SURVEY,PROGRAM
+            or TILEID,LASTNIGHT(,PETAL_LOC)
+        specprod (str): production name
+        columns (list): column names to read
+
+    Options:
+        schema (Schema): default get_schema(specprod, specgroup of targetcat)
+        nproc (int): read files with the sharedread process pool if at least
+            this many; default sharedread.SHARED_READ_MIN_FILES
+
+    Returns dict of column name -> array in the same order as targetcat;
+    rows missing from the files are masked.
+    """
+    from astropy.table import MaskedColumn
+    from inspector.sharedread import _file_groups, _get_pool, SHARED_READ_MIN_FILES
+
+    specgroup = 'healpix' if 'HEALPIX' in targetcat.colnames else 'tiles'
+    if schema is None:
+        schema = get_schema(specprod, specgroup)
+        if schema is None:
+            raise ValueError(f'No redrock files found for {specprod} {specgroup}')
+
+    projection = schema.projection(columns)
+    result = {name: np.zeros(len(targetcat), dtype=schema.dtype(name)) for name in columns}
+    if len(targetcat) == 0 or len(projection) == 0:
+        return result
+
+    keycol = 'TARGETID' if 'TARGETID' in targetcat.colnames else 'FIBER'
+    keys = np.asarray(targetcat[keycol])
+    groups = _file_groups(targetcat)
+    filenames = [_redrockfile(filekeys, specprod) for filekeys, indices in groups]
+
+    if nproc is None:
+        nproc = SHARED_READ_MIN_FILES
+    if len(groups) >= nproc:
+        pool = _get_pool()
+        futures = [pool.submit(_read_file_columns, filename, keycol, keys[indices], projection)
+                   for filename, (filekeys, indices) in zip(filenames, groups)]
+        results = [f.result() for f in futures]
+    else:
+        results = [_read_file_columns(filename, keycol, keys[indices], projection)
+                   for filename, (filekeys, indices) in zip(filenames, groups)]
+
+    found = np.zeros(len(targetcat), dtype=bool)
+    for (filekeys, indices), (filefound, data) in zip(groups, results):
+        outrows = indices[filefound]
+        found[outrows] = True
+        for hdu, cols in projection.items():
+            for name in cols:
+                values = data[hdu][name]
+                if result[name].dtype.kind == 'U':
+                    #- string widths can differ between files
+                    result[name] = result[name].astype(np.result_type(result[name].dtype, values.dtype))
+                result[name][outrows] = values
+
+    if not np.all(found):
+        result = {name: MaskedColumn(values, mask=~found) for name, values in result.items()}
+
+    return result
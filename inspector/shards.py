@@ -0,0 +1,308 @@
+"""
+inspector.shards
+================
+
+Scatter-gather of target queries across several Data Inspector nodes
+(shards) that each own a disjoint range of HEALPix pixels and/or a subset
+of the productions, so that no single node needs the file caches and
+indexes for every production and the whole sky.
+
+A coordinator is an ordinary inspector app started with
+$DESI_INSPECTOR_SHARDS set to a JSON shard map, e.g.
+
+    {"nside": 8,
+     "shards": [{"url": "http://node1:5001", "specprods": ["iron"], "healpix": [0, 384]},
+                {"url": "http://node2:5001", "specprods": ["iron"], "healpix": [384, 768]},
+                {"url": "http://node3:5001", "specprods": ["loa"]}]}
+
+where "healpix" is a [first, last+1) range of nested pixels at "nside".
+Shards without "healpix" own the whole sky, and shards without "specprods"
+serve every production; the shards of each production must cover the sky
+exactly once.  The shard nodes run the app without $DESI_INSPECTOR_SHARDS.
+
+In the coordinator, inspector.io.load_targets calls load_targets here,
+which sends a radec query to the shards whose pixels overlap the cone, or
+a TARGETID query to every shard of the production, in parallel as
+format=fits /targets/ requests.  Each shard's rows are kept only if their
+TARGET_RA,TARGET_DEC are in that shard's pixels, so that targets in cones
+straddling a boundary aren't duplicated.  The merged rows are ordered by
+HEALPIX (or TILEID, PETAL_LOC) and then as returned by the shards, with
+the meta of the shard responses; dedup is applied after merging.  If any
+shard fails, PartialResultError reports which ones, with the merged
+table from the others.
+
+To try it on one machine, write a shard map splitting the sky across
+local nodes, start a node on each port, and point a coordinator at them:
+
+    python -m inspector.shards --nshards 3 --base-port 5101 > shards.json
+    for port in 5101 5102 5103; do gunicorn -b 127.0.0.1:$port -w 2 app:app & done
+    DESI_INSPECTOR_SHARDS=shards.json gunicorn -b 0.0.0.0:5001 -w 2 app:app
+"""
+
+import io
+import os
+import re
+import html
+import sys
+import json
+import argparse
+import urllib.error
+import urllib.request
+from urllib.parse import urlencode
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from inspector.auth import auth_headers
+
+#- JSON shard map enabling coordinator mode; see module docstring
+SHARD_MAP_FILE = os.getenv('DESI_INSPECTOR_SHARDS')
+
+#- default HEALPix nside of shard map pixel ranges
+SHARD_NSIDE = 8
+
+#- seconds to wait for each shard
+SHARD_TIMEOUT = float(os.getenv('DESI_INSPECTOR_SHARD_TIMEOUT', 300))
+
+#- response header marking partial results, which inspector.caching doesn't cache
+PARTIAL_HEADER = 'X-Inspector-Partial'
+
+#- merged rows are ordered by these columns, like the per-file inventory
+ORDER_COLUMNS = dict(healpix=('HEALPIX',), tiles=('TILEID', 'PETAL_LOC'))
+
+class ShardError(RuntimeError):
+    """A shard could not be reached or failed to answer"""
+    pass
+
+class PartialResultError(RuntimeError):
+    """
+    Some shards failed, so the result is incomplete
+
+    failed is a dict of shard URL -> reason, and table has the merged
+    targets from the shards that answered.
+    """
+    def __init__(self, failed, table, nshards):
+        reasons = '; '.join(f'{url}: {reason}' for url, reason in failed.items())
+        super().__init__(f'Partial result: {len(failed)} of {nshards} shards failed ({reasons}); '
+                         f'{len(table)} targets found by the others')
+        self.failed = failed
+        self.table = table
+        self.nshards = nshards
+
+class ShardMap(object):
+    """
+    Which shard URLs serve each production and HEALPix pixel range
+
+    Args:
+        shards: list of dicts with "url" and optional "specprods", "healpix"
+        nside (int): HEALPix nside of the "healpix" [first, last+1) ranges
+    """
+    def __init__(self, shards, nside=SHARD_NSIDE):
+        from inspector.io import standardize_specprod
+
+        self.nside = nside
+        self.npix = 12 * nside**2
+        self.shards = list()
+        for shard in shards:
+            first, last = shard.get('healpix', (0, self.npix))
+            if not 0 <= first < last <= self.npix:
+                raise ValueError(f'Invalid healpix range {shard["healpix"]} for {shard["url"]} with nside={nside}')
+            specprods = shard.get('specprods')
+            if specprods is not None:
+                specprods = [standardize_specprod(s) for s in specprods]
+            self.shards.append(dict(url=shard['url'].rstrip('/'), specprods=specprods, first=first, last=last))
+
+    @classmethod
+    def read(cls, filename):
+        with open(filename) as fp:
+            config = json.load(fp)
+        return cls(config['shards'], nside=config.get('nside', SHARD_NSIDE))
+
+    def shards_for(self, specprod):
+        """
+        Return list of shard dicts serving specprod, sorted by pixel range
+
+        Raises ValueError unless they cover every pixel exactly once
+        """
+        shards = [s for s in self.shards if s['specprods'] is None or specprod in s['specprods']]
+        shards.sort(key=lambda s: s['first'])
+        if len(shards) == 0:
+            raise ValueError(f'No shards serve {specprod}')
+
+        edges = [(s['first'], s['last']) for s in shards]
+        if edges[0][0] != 0 or edges[-1][1] != self.npix or any(
+                prev[1] != next[0] for prev, next in zip(edges[:-1], edges[1:])):
+            raise ValueError(f'Shards for {specprod} must cover HEALPix pixels 0-{self.npix-1} exactly once, '
+                             f'not {edges}')
+
+        return shards
+
+    def owners(self, shards, pixels):
+        """Return index into shards (from shards_for) of the owner of each pixel"""
+        firsts = np.array([s['first'] for s in shards])
+        return np.searchsorted(firsts, pixels, side='right') - 1
+
+    def pixels(self, ra, dec):
+        """Return nested HEALPix pixels of ra, dec [degrees]"""
+        import healpy
+        return healpy.ang2pix(self.nside, ra, dec, nest=True, lonlat=True)
+
+    def cone_pixels(self, ra, dec, radius):
+        """Return nested HEALPix pixels overlapping cone of radius [arcsec] around ra, dec [degrees]"""
+        import healpy
+        vec = healpy.ang2vec(ra, dec, lonlat=True)
+        return healpy.query_disc(self.nside, vec, np.radians(radius/3600), inclusive=True, nest=True)
+
+_shard_map = None
+
+def get_shard_map():
+    """Return ShardMap read from $DESI_INSPECTOR_SHARDS, cached"""
+    global _shard_map
+    if _shard_map is None:
+        _shard_map = ShardMap.read(SHARD_MAP_FILE)
+    return _shard_map
+
+def _error_message(body):
+    """Return message from an inspector error.html page, or the start of body"""
+    text = body.decode(errors='replace')
+    match = re.search(r'<h2>.*?</h2>\s*<p>\s*(.*?)\s*</p>', text, re.DOTALL)
+    if match is not None:
+        return html.unescape(match.group(1))
+    return text[0:200]
+
+def fetch_table(url, timeout=SHARD_TIMEOUT):
+    """
+    Return astropy Table from a shard format=fits URL
+
+    Raises ValueError for bad requests, e.g. an unknown column, and
+    ShardError if the shard is unreachable or fails.
+    """
+    from astropy.table import Table
+
+    request = urllib.request.Request(url, headers=auth_headers('DESI_INSPECTOR_SHARD'))
+    try:
+        with urllib.request.urlopen(request, timeout=timeout) as response:
+            data = response.read()
+    except urllib.error.HTTPError as err:
+        message = _error_message(err.read())
+        if 400 <= err.code < 500 and err.code not in (401, 403):
+            raise ValueError(message)
+        raise ShardError(f'HTTP {err.code}: {message}')
+    except OSError as err:
+        #- URLError, connection refused/reset, timeout
+        raise ShardError(str(getattr(err, 'reason', err)))
+
+    return Table.read(io.BytesIO(data), format='fits')
+
+def load_targets(specprod, specgroup, radec=None, targetids=None, filters=None, xcol=None, dedup=None,
+                 shard_map=None):
+    """
+    Scatter-gather version of inspector.io.load_targets; see module docstring
+
+    Options are the same as inspector.io.load_targets, plus shard_map
+    (default from $DESI_INSPECTOR_SHARDS).  Raises PartialResultError if
+    any shard fails.
+    """
+    from astropy.table import Table, vstack
+    from inspector.io import standardize_specprod, validate_radec, dedup_targets, DEDUP_COLUMNS
+
+    if shard_map is None:
+        shard_map = get_shard_map()
+
+    specprod = standardize_specprod(specprod)
+    shards = shard_map.shards_for(specprod)
+    if radec is not None:
+        ra, dec, radius = validate_radec(radec)
+        selected = np.unique(shard_map.owners(shards, shard_map.cone_pixels(ra, dec, radius)))
+        path = f'{specprod}/targets/{specgroup}/radec/{ra},{dec},{radius}'
+    elif targetids is not None:
+        if not isinstance(targetids, str):
+            targetids = ','.join(map(str, targetids))
+        selected = np.arange(len(shards))
+        path = f'{specprod}/targets/{specgroup}/{targetids}'
+    else:
+        raise ValueError('must specify radec or targetids')
+
+    if dedup is not None and dedup not in DEDUP_COLUMNS:
+        raise ValueError(f"Unsupported dedup='{dedup}'; supported options are {list(DEDUP_COLUMNS)}")
+
+    #- dedup after merging, so that NDEDUP counts each target once
+    xcol = list(xcol) if xcol is not None else []
+    if dedup is not None:
+        xcol += [c for c in DEDUP_COLUMNS[dedup] if c not in xcol]
+
+    args = [('format', 'fits')]
+    if len(xcol) > 0:
+        args.append(('xcol', ','.join(xcol)))
+    for colname, cuts in (filters or dict()).items():
+        for cut in (cuts if isinstance(cuts, (list, tuple)) else [cuts,]):
+            args.append((colname, str(cut)))
+    query = f'{path}?{urlencode(args)}'
+
+    with ThreadPoolExecutor(max_workers=len(selected)) as pool:
+        futures = [pool.submit(fetch_table, f'{shards[i]["url"]}/{query}') for i in selected]
+
+    tables = list()
+    failed = dict()
+    for i, future in zip(selected, futures):
+        try:
+            t = future.result()
+        except ShardError as err:
+            failed[shards[i]['url']] = str(err)
+            continue
+
+        #- keep only the targets in this shard's pixels
+        if len(t) > 0 and 'TARGET_RA' in t.colnames:
+            owners = shard_map.owners(shards, shard_map.pixels(t['TARGET_RA'], t['TARGET_DEC']))
+            t = t[owners == i]
+        tables.append(t)
+
+    if len(tables) > 0:
+        result = vstack(tables, metadata_conflicts='silent')
+        result.meta = tables[0].meta.copy()
+        result.meta.pop('NDEDUP', None)
+    else:
+        result = Table(meta=dict(SPECPROD=specprod))
+
+    order = [c for c in ORDER_COLUMNS[specgroup] if c in result.colnames]
+    if len(result) > 0 and len(order) > 0:
+        result = result[np.lexsort([np.asarray(result[c]) for c in order[::-1]])]
+
+    if dedup is not None and len(tables) > 0:
+        result = dedup_targets(result, dedup)
+
+    if len(failed) > 0:
+        raise PartialResultError(failed, result, len(selected))
+
+    return result
+
+def main():
+    parser = argparse.ArgumentParser(description='Write a shard map splitting the sky evenly across nodes')
+    parser.add_argument('-n', '--nshards', type=int, help='number of local shards')
+    parser.add_argument('--base-port', type=int, default=5101, help='port of first local shard')
+    parser.add_argument('--urls', help='comma separated shard URLs instead of local ports')
+    parser.add_argument('--nside', type=int, default=SHARD_NSIDE, help='HEALPix nside of pixel ranges')
+    parser.add_argument('--specprods', help='comma separated productions served (default all)')
+    args = parser.parse_args()
+
+    if args.urls is not None:
+        urls = args.urls.split(',')
+    elif args.nshards is None:
+        parser.error('Specify --nshards or --urls')
+    else:
+        urls = [f'http://127.0.0.1:{args.base_port + i}' for i in range(args.nshards)]
+
+    npix = 12 * args.nside**2
+    edges = np.linspace(0, npix, len(urls)+1).astype(int)
+    shards = list()
+    for url, first, last in zip(urls, edges[:-1], edges[1:]):
+        shard = dict(url=url, healpix=[int(first), int(last)])
+        if args.specprods is not None:
+            shard['specprods'] = args.specprods.split(',')
+        shards.append(shard)
+
+    json.dump(dict(nside=args.nside, shards=shards), sys.stdout, indent=1)
+    print()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,448 @@
+"""
+inspector.sharedread
+====================
+
+Read spectra from many files with a process pool, assembling the results in
+shared memory instead of pickling them back to the parent.
+
+desispec.io.read_spectra_parallel returns a Spectra object per file from
+each worker process, which are pickled back to the parent and then
+concatenated by stack_spectra; for hundreds of files these copies cost
+about as much as the reads themselves.  read_spectra_shared instead
+preallocates one multiprocessing.shared_memory block holding the
+flux/ivar/mask/resolution arrays for all requested spectra.  Each worker
+reads only the rows it needs from its file's image HDUs (memory mapped
+with inspector.fitsmap when uncompressed) and writes them directly into
+its rows of the shared arrays, returning just the small fibermap/redshift
+tables.  The parent then returns a SharedSpectra, a Spectra whose arrays
+are views of the shared memory rather than copies, and which only builds
+the per-spectrum Resolution matrices if they are used.
+
+Requests that this reader doesn't support (e.g. Redrock models), or that
+come from only a few files, fall back to read_spectra_parallel.
+
+process_pool creates the process pools used here and by the rest of the
+inspector.  A gunicorn worker can have several threads reading at once
+(the request, cache warm-up, comparison reads), and a process forked while
+another thread holds a lock, e.g. of inspector.fitscache, would inherit it
+held and hang; so by default pool processes are started by a forkserver,
+which preloads FORKSERVER_PRELOAD once so that new processes start quickly.
+"""
+
+import os
+import mmap
+import threading
+import functools
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+
+import numpy as np
+
+#- number of worker processes for reading files
+SHARED_READ_NPROC = int(os.getenv('DESI_INSPECTOR_SHARED_READ_NPROC', max(1, (os.cpu_count() or 2)//2)))
+
+#- use read_spectra_parallel for requests from fewer files than this
+SHARED_READ_MIN_FILES = int(os.getenv('DESI_INSPECTOR_SHARED_READ_MIN_FILES', 8))
+
+#- read_spectra options supported by read_spectra_shared
+SUPPORTED_OPTIONS = ('return_redshifts', 'skip_hdus', 'single')
+
+#- rows closer than this are read with a single contiguous slice
+ROW_GAP = 16
+
+#- multiprocessing start method for pool processes: forkserver, spawn, or fork
+MP_START_METHOD = os.getenv('DESI_INSPECTOR_MP_START_METHOD', 'forkserver')
+
+#- modules imported once by the forkserver rather than by each new process
+FORKSERVER_PRELOAD = ['numpy', 'fitsio', 'astropy.table', 'desispec.io',
+                      'inspector.sharedread', 'inspector.attrindex']
+
+_pool = None
+_pool_lock = threading.Lock()
+
+def process_pool(max_workers):
+    """Return new ProcessPoolExecutor whose processes start with MP_START_METHOD"""
+    context = multiprocessing.get_context(MP_START_METHOD)
+    if MP_START_METHOD == 'forkserver':
+        #- only used when the forkserver starts; missing modules are skipped
+        context.set_forkserver_preload(FORKSERVER_PRELOAD)
+    return ProcessPoolExecutor(max_workers=max_workers, mp_context=context)
+
+def start_forkserver():
+    """
+    Start the forkserver from the calling thread if MP_START_METHOD is forkserver
+
+    Pool processes inherit the CPU and I/O priority of the forkserver, so
+    call this before a thread that may create pools lowers its own, e.g.
+    the inspector.warmup replay thread.
+    """
+    if MP_START_METHOD == 'forkserver':
+        from multiprocessing import forkserver
+        multiprocessing.get_context('forkserver').set_forkserver_preload(FORKSERVER_PRELOAD)
+        forkserver.ensure_running()
+
+def _get_pool():
+    """Return the per-process reader pool, creating it on first use"""
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = process_pool(SHARED_READ_NPROC)
+    return _pool
+
+@functools.lru_cache(maxsize=None)
+def _shared_spectra_class():
+    """Return the SharedSpectra class, importing desispec on first use"""
+    from desispec.spectra import Spectra
+    from desispec.resolution import Resolution
+
+    class SharedSpectra(Spectra):
+        """
+        Spectra using the flux/ivar/mask/resolution_data arrays it is given
+
+        Spectra.__init__ copies every array twice and builds a Resolution
+        for every spectrum; SharedSpectra keeps the arrays as they are, e.g.
+        views of read_spectra_shared's shared memory, and builds R on first use.
+        """
+        def __init__(self, bands, wave, flux, ivar, mask=None, resolution_data=None, **kwargs):
+            #- Spectra sets up the tables, meta, and dtype with no bands to copy
+            super().__init__(**kwargs)
+            self._bands = bands
+            self.wave = wave
+            self.flux = flux
+            self.ivar = ivar
+            self.mask = mask
+            self.resolution_data = resolution_data
+
+        @property
+        def R(self):
+            if self._R is None and self.resolution_data is not None:
+                self._R = {b: np.array([Resolution(r) for r in self.resolution_data[b]])
+                           for b in self.bands}
+            return self._R
+
+        @R.setter
+        def R(self, value):
+            self._R = value
+
+    #- so that SharedSpectra pickles as inspector.sharedread.SharedSpectra
+    SharedSpectra.__module__ = __name__
+    SharedSpectra.__qualname__ = 'SharedSpectra'
+    return SharedSpectra
+
+def __getattr__(name):
+    #- SharedSpectra is created on first use so that importing this module doesn't import desispec
+    if name == 'SharedSpectra':
+        return _shared_spectra_class()
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
+
+def _file_groups(targetcat):
+    """
+    Return list of (keys, indices) for each file needed by targetcat
+
+    keys is a dict of the HEALPIX,SURVEY,PROGRAM or TILEID,LASTNIGHT,PETAL_LOC
+    values identifying the file, and indices are the targetcat rows read
+    from that file
+    """
+    #- tiles files take precedence, as in desispec.io.spectra.determine_specgroup
+    colnames = targetcat.colnames
+    if 'HEALPIX' in colnames and not ('TILEID' in colnames and 'LASTNIGHT' in colnames):
+        keycols = ('HEALPIX', 'SURVEY', 'PROGRAM')
+    else:
+        keycols = ('TILEID', 'LASTNIGHT', 'PETAL_LOC')
+
+    columns = list()
+    for col in keycols:
+        if col == 'PETAL_LOC' and col not in targetcat.colnames:
+            #- tiles/fibers requests only have FIBER
+            columns.append((np.asarray(targetcat['FIBER']) // 500).tolist())
+        else:
+            columns.append(targetcat[col].tolist())
+
+    index = dict()
+    for i, row in enumerate(zip(*columns)):
+        index.setdefault(row, list()).append(i)
+
+    return [(dict(zip(keycols, row)), np.array(indices)) for row, indices in index.items()]
+
+def _specfile(keys, specprod):
+    """Return coadd filename for file keys from _file_groups"""
+    from inspector.fitscache import findfile
+    if 'HEALPIX' in keys:
+        return findfile('coadd', healpix=keys['HEALPIX'], survey=keys['SURVEY'],
+                        faprogram=keys['PROGRAM'], readonly=True, specprod=specprod)
+    else:
+        return findfile('coadd', night=keys['LASTNIGHT'], tile=keys['TILEID'],
+                        spectrograph=keys['PETAL_LOC'], readonly=True, specprod=specprod)
+
+def _layout(specfile, nspec, skip_hdus, ftype):
+    """
+    Return (bands, wave, layout, nbytes) for nspec spectra shaped like specfile
+
+    layout[(band, name)] = (offset, shape, dtype) within the shared block
+    """
+    from inspector.fitscache import open_fits
+    bands = list()
+    wave = dict()
+    layout = dict()
+    offset = 0
+    with open_fits(specfile) as fx:
+        extnames = [hdu.get_extname() for hdu in fx]
+        for extname in extnames:
+            if not extname.endswith('_WAVELENGTH'):
+                continue
+            band = extname.split('_')[0]
+            bands.append(band.lower())
+            wave[band.lower()] = fx[extname].read().astype(np.float64)
+
+        for band in bands:
+            nwave = len(wave[band])
+            arrays = [('FLUX', (nspec, nwave), ftype), ('IVAR', (nspec, nwave), ftype)]
+            if 'MASK' not in skip_hdus:
+                arrays.append(('MASK', (nspec, nwave), np.uint32))
+            if 'RESOLUTION' not in skip_hdus:
+                ndiag = fx[f'{band.upper()}_RESOLUTION'].get_dims()[1]
+                arrays.append(('RESOLUTION', (nspec, ndiag, nwave), ftype))
+
+            for name, shape, dtype in arrays:
+                layout[(band, name)] = (offset, shape, np.dtype(dtype).str)
+                offset += int(np.prod(shape)) * np.dtype(dtype).itemsize
+                offset += -offset % 64   # keep arrays cache-line aligned
+
+    return bands, wave, layout, offset
+
+def _runs(rows, gap=ROW_GAP):
+    """Split sorted rows into (start, stop) slices with gaps of at most gap rows"""
+    runs = list()
+    start = prev = rows[0]
+    for r in rows[1:]:
+        if r - prev > gap:
+            runs.append((start, prev+1))
+            start = r
+        prev = r
+    runs.append((start, prev+1))
+    return runs
+
+def _read_image_rows(hdu, rows):
+    """Read rows (sorted) of image hdu, reading contiguous runs rather than the full image"""
+    parts = list()
+    ndim = len(hdu.get_dims())
+    for start, stop in _runs(rows):
+        data = hdu[(slice(start, stop),) + (slice(None),)*(ndim-1)]
+        parts.append(data[rows[(rows >= start) & (rows < stop)] - start])
+    return np.concatenate(parts)
+
+def _read_table(fx, extname, rows):
+    """Read rows of table extname as read_spectra does"""
+    from astropy.table import Table
+    from desiutil.io import encode_table
+    from desispec.io.util import addkeys
+    from inspector.fitscache import read_header
+    table = encode_table(Table(fx[extname].read(rows=rows), copy=True).as_array())
+    addkeys(table.meta, read_header(fx[extname]))
+    return table
+
+def _attach(name):
+    """Attach to existing shared memory block name, which the parent will unlink"""
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)   # python >= 3.13
+    except TypeError:
+        #- pool processes share the parent's resource tracker, which ignores
+        #- the duplicate registration, so don't unregister here
+        return shared_memory.SharedMemory(name=name)
+
+def _read_file_shared(specfile, keys, targetids, outrows, shm_name, layout, wave, rdspec_kwargs):
+    """
+    Read targetids from specfile into outrows of the shared arrays
+
+    Returns dict with the output rows filled and the table HDUs for them,
+    in the same order
+    """
+    from astropy.table import Table
+    from inspector.fitscache import open_fits, handle_stamp, read_header
+    from inspector.fitsmap import image_rows
+
+    skip_hdus = set(rdspec_kwargs.get('skip_hdus', ()))
+    return_redshifts = rdspec_kwargs.get('return_redshifts', False)
+
+    #- TARGETID -> output rows; a target can be requested more than once
+    target_outrows = dict()
+    for tid, outrow in zip(targetids, outrows):
+        target_outrows.setdefault(int(tid), list()).append(int(outrow))
+
+    result = dict(outrows=list())
+    with open_fits(specfile) as fx:
+        file_targetids = fx['FIBERMAP'].read(columns='TARGETID')
+        rows = np.where(np.isin(file_targetids, targetids))[0]
+        if len(rows) == 0:
+            return result
+
+        #- each file row fills one or more output rows
+        filerows = list()
+        fileouts = list()
+        for i, tid in enumerate(file_targetids[rows]):
+            for outrow in target_outrows[int(tid)]:
+                filerows.append(i)
+                fileouts.append(outrow)
+
+        #- only map the version of the file that fx has open, which FIBERMAP rows came from
+        stamp = handle_stamp(specfile, fx)
+        shm = _attach(shm_name)
+        try:
+            for (band, name), (offset, shape, dtype) in layout.items():
+                if name == 'FLUX':
+                    file_wave = fx[f'{band.upper()}_WAVELENGTH'].read()
+                    if len(file_wave) != len(wave[band]) or not np.allclose(file_wave, wave[band]):
+                        raise ValueError(f'{specfile} {band} wavelength grid differs from other files')
+
+                hdu = fx[f'{band.upper()}_{name}']
+                #- gather straight from the page cache in output order if the HDU can be mapped
+                data = None if stamp is None else image_rows(hdu, rows[filerows], stamp)
+                if data is None:
+                    data = _read_image_rows(hdu, rows)[filerows]
+                out = np.ndarray(shape, dtype=dtype, buffer=shm.buf, offset=offset)
+                out[fileouts] = data
+                del out, data
+        finally:
+            shm.close()
+
+        fibermap = _read_table(fx, 'FIBERMAP', rows)[filerows]
+        #- match read_spectra_parallel, which adds the file keys if needed
+        for col, value in keys.items():
+            if col not in fibermap.colnames:
+                fibermap[col] = value
+        result['fibermap'] = fibermap
+
+        if 'SCORES' in fx and 'SCORES' not in skip_hdus:
+            result['scores'] = _read_table(fx, 'SCORES', rows)[filerows]
+        if 'EXTRA_CATALOG' in fx and 'EXTRA_CATALOG' not in skip_hdus:
+            result['extra_catalog'] = _read_table(fx, 'EXTRA_CATALOG', rows)[filerows]
+        if 'EXP_FIBERMAP' in fx and 'EXP_FIBERMAP' not in skip_hdus:
+            exp_targetids = fx['EXP_FIBERMAP'].read(columns='TARGETID')
+            exp_rows = np.where(np.isin(exp_targetids, targetids))[0]
+            result['exp_fibermap'] = _read_table(fx, 'EXP_FIBERMAP', exp_rows)
+
+        if return_redshifts:
+            if 'REDSHIFTS' in fx:
+                redshifts = _read_table(fx, 'REDSHIFTS', rows)
+            else:
+                from desispec.io.util import replace_prefix
+                redrock_file = replace_prefix(specfile, 'coadd', 'redrock')
+                if not os.path.isfile(redrock_file):
+                    raise IOError(f'{redrock_file} does not exist')
+                redshifts = Table.read(redrock_file, hdu='REDSHIFTS')[rows]
+            result['redshifts'] = redshifts[filerows]
+
+        result['meta'] = dict(read_header(fx[0]))
+
+    result['outrows'] = fileouts
+    return result
+
+def _map_shared(shm, nbytes):
+    """
+    Return a buffer for shared memory block shm whose lifetime is tied to
+    the arrays using it, so that shm itself can be closed and unlinked
+    """
+    path = f'/dev/shm/{shm.name.lstrip("/")}'
+    if os.path.exists(path):
+        with open(path, 'r+b') as fp:
+            return mmap.mmap(fp.fileno(), nbytes)
+    else:
+        #- no /dev/shm (not Linux): fall back to a single copy
+        return bytearray(shm.buf[0:nbytes])
+
+def read_spectra_shared(targetcat, specprod, rdspec_kwargs=None, nproc=None, min_files=SHARED_READ_MIN_FILES):
+    """
+    Read spectra for targetcat using a process pool and shared memory
+
+    Args:
+        targetcat: targets table as returned by load_targets
+        specprod (str): production name
+
+    Options:
+        rdspec_kwargs (dict): read_spectra options; default dict(return_redshifts=True)
+        nproc (int): number of worker processes; default SHARED_READ_NPROC
+        min_files (int): use read_spectra_parallel for fewer files than this
+
+    Returns Spectra in the same order as targetcat, like read_spectra_parallel;
+    when reading from shared memory this is a SharedSpectra whose arrays are
+    views of it (copies if targets were missing from their files)
+    """
+    from desispec.io import read_spectra_parallel
+
+    if rdspec_kwargs is None:
+        rdspec_kwargs = dict(return_redshifts=True)
+
+    groups = _file_groups(targetcat)
+    unsupported = set(rdspec_kwargs) - set(SUPPORTED_OPTIONS)
+    if len(unsupported) > 0 or len(groups) < min_files:
+        return read_spectra_parallel(targetcat, specprod=specprod, rdspec_kwargs=rdspec_kwargs)
+
+    from astropy.table import vstack
+
+    nspec = len(targetcat)
+    skip_hdus = set(rdspec_kwargs.get('skip_hdus', ()))
+    ftype = np.float32 if rdspec_kwargs.get('single', False) else np.float64
+
+    specfiles = [_specfile(keys, specprod) for keys, indices in groups]
+    bands, wave, layout, nbytes = _layout(specfiles[0], nspec, skip_hdus, ftype)
+    targetids = np.asarray(targetcat['TARGETID'])
+
+    shm = shared_memory.SharedMemory(create=True, size=max(nbytes, 1))
+    try:
+        pool = _get_pool() if nproc is None else process_pool(nproc)
+        try:
+            #- spectra are written to the same rows as their targets in targetcat
+            futures = [pool.submit(_read_file_shared, specfile, keys, targetids[indices],
+                                   indices, shm.name, layout, wave, rdspec_kwargs)
+                       for specfile, (keys, indices) in zip(specfiles, groups)]
+            results = [f.result() for f in futures]
+        finally:
+            if nproc is not None:
+                pool.shutdown()
+
+        buffer = _map_shared(shm, nbytes)
+    finally:
+        shm.close()
+        shm.unlink()
+
+    results = [r for r in results if len(r['outrows']) > 0]
+    if len(results) == 0:
+        return None
+
+    filled = np.concatenate([r['outrows'] for r in results])
+    order = np.argsort(filled)
+
+    #- targets missing from their files are dropped, as by read_spectra_parallel
+    keep = None if len(filled) == nspec else filled[order]
+
+    arrays = dict()
+    for (band, name), (offset, shape, dtype) in layout.items():
+        data = np.ndarray(shape, dtype=dtype, buffer=buffer, offset=offset)
+        arrays[(band, name)] = data if keep is None else data[keep]
+
+    def _stack(key, reorder=True):
+        tables = [r[key] for r in results if key in r]
+        if len(tables) == 0:
+            return None
+        table = vstack(tables)
+        return table[order] if reorder else table
+
+    mask = {b: arrays[(b, 'MASK')] for b in bands} if 'MASK' not in skip_hdus else None
+    if 'RESOLUTION' not in skip_hdus:
+        resolution_data = {b: arrays[(b, 'RESOLUTION')] for b in bands}
+    else:
+        resolution_data = None
+
+    #- the arrays stay views of the shared memory, which is freed with the last of them
+    SharedSpectra = _shared_spectra_class()
+    spectra = SharedSpectra(bands, wave,
+                            flux={b: arrays[(b, 'FLUX')] for b in bands},
+                            ivar={b: arrays[(b, 'IVAR')] for b in bands},
+                            mask=mask, resolution_data=resolution_data,
+                            fibermap=_stack('fibermap'), exp_fibermap=_stack('exp_fibermap', reorder=False),
+                            meta=results[0]['meta'], extra_catalog=_stack('extra_catalog'),
+                            single=(ftype == np.float32), scores=_stack('scores'),
+                            redshifts=_stack('redshifts'))
+
+    return spectra
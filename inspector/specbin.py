@@ -0,0 +1,123 @@
+"""
+inspector.specbin
+=================
+
+Compact binary encoding of spectra for client-side rendering.
+
+Layout of the encoded bytes:
+
+    uint32 little-endian N = length of the JSON index
+    N bytes UTF-8 JSON index, space-padded so the arrays start 4-byte aligned
+    little-endian float32 arrays, concatenated
+
+The JSON index has "nspec"; "title"; optionally "label" (e.g. the
+production, when overlaying spectra from several productions); "targets", a
+list with one dict of metadata (TARGETID, Z, SPECTYPE, ...) per spectrum,
+with 64-bit integers such as TARGETID as decimal strings because javascript
+numbers are only exact up to 2**53; and "cameras", a dict of
+camera -> {"nwave": nwave, "arrays": {name: {"offset": bytes, "shape": [...]}}}
+with offsets relative to the start of the arrays.  Each camera has arrays
+"wave" [nwave] and "flux", "ivar" [nspec, nwave], plus "model" [nspec, nwave]
+if models were loaded.  Masked pixels have ivar=0.
+
+In javascript, new Float32Array(buffer, 4+N+offset, length) gives a
+zero-copy view of each array.
+"""
+
+import json
+import struct
+import numpy as np
+
+#- metadata columns to include from fibermap and redshifts, if present
+METADATA_COLUMNS = ('TARGETID', 'TARGET_RA', 'TARGET_DEC', 'TILEID', 'FIBER',
+                    'HEALPIX', 'SURVEY', 'PROGRAM', 'Z', 'ZERR', 'ZWARN',
+                    'SPECTYPE', 'SUBTYPE', 'DELTACHI2')
+
+#- HDUs not needed for the binary format, passed to read_spectra skip_hdus
+SKIP_HDUS = ('RESOLUTION', 'EXP_FIBERMAP', 'SCORES', 'EXTRA_CATALOG')
+
+def _json_value(value):
+    """Return value as a JSON-compatible python value; NaN is not valid JSON"""
+    if isinstance(value, bytes):
+        return value.decode()
+    if isinstance(value, float) and not np.isfinite(value):
+        return None
+    return value
+
+def _metadata(spectra):
+    """Return list of per-spectrum metadata dicts from spectra fibermap and redshifts"""
+    tables = [spectra.fibermap]
+    if spectra.redshifts is not None:
+        tables.append(spectra.redshifts)
+
+    columns = dict()
+    for col in METADATA_COLUMNS:
+        for t in tables:
+            if col in t.colnames:
+                data = np.asarray(t[col])
+                if data.dtype.kind in 'iu' and data.dtype.itemsize == 8:
+                    columns[col] = [str(v) for v in data.tolist()]
+                else:
+                    columns[col] = [_json_value(v) for v in data.tolist()]
+                break
+
+    nspec = len(spectra.fibermap)
+    return [{col: values[i] for col, values in columns.items()} for i in range(nspec)]
+
+def encode_spectra(spectra, title=None, label=None):
+    """
+    Encode desispec Spectra object as bytes; see module docstring for format
+    """
+    nspec = len(spectra.fibermap)
+    index = dict(nspec=nspec, title=title, targets=_metadata(spectra), cameras=dict())
+    if label is not None:
+        index['label'] = label
+
+    chunks = list()
+    offset = 0
+    def add_array(arrays, name, data):
+        nonlocal offset
+        data = np.ascontiguousarray(data, dtype='<f4')
+        arrays[name] = dict(offset=offset, shape=list(data.shape))
+        chunks.append(data.tobytes())
+        offset += data.nbytes
+
+    for camera in spectra.bands:
+        arrays = dict()
+        ivar = spectra.ivar[camera]
+        if spectra.mask is not None:
+            ivar = ivar * (spectra.mask[camera] == 0)
+
+        add_array(arrays, 'wave', spectra.wave[camera])
+        add_array(arrays, 'flux', spectra.flux[camera])
+        add_array(arrays, 'ivar', ivar)
+        if spectra.model is not None and camera in spectra.model:
+            add_array(arrays, 'model', spectra.model[camera])
+
+        index['cameras'][camera] = dict(nwave=len(spectra.wave[camera]), arrays=arrays)
+
+    header = json.dumps(index).encode()
+    header += b' ' * (-(4 + len(header)) % 4)   # align arrays to 4 bytes
+
+    return struct.pack('<I', len(header)) + header + b''.join(chunks)
+
+def decode_spectra(data):
+    """
+    Decode bytes from encode_spectra
+
+    Returns (index, arrays) where index is the JSON index dict and
+    arrays[camera][name] are numpy float32 arrays viewing data
+    """
+    n = struct.unpack('<I', data[0:4])[0]
+    index = json.loads(data[4:4+n].decode())
+    start = 4 + n
+
+    arrays = dict()
+    for camera, info in index['cameras'].items():
+        arrays[camera] = dict()
+        for name, a in info['arrays'].items():
+            count = int(np.prod(a['shape']))
+            arrays[camera][name] = np.frombuffer(data, dtype='<f4', count=count,
+                                                 offset=start+a['offset']).reshape(a['shape'])
+
+    return index, arrays
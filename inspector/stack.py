@@ -0,0 +1,294 @@
+"""
+inspector.stack
+===============
+
+Rest-frame stacks of many spectra, computed on the server so that users
+get just the stacked spectrum rather than downloading every input.
+
+Each spectrum is shifted to the rest frame with its Redrock Z and
+resampled onto a common linear wavelength grid by vectorized linear
+interpolation, combining overlapping cameras weighted by ivar.  Spectra are
+read one file at a time with inspector.io.iter_spectra and processed in
+chunks of at most CHUNK_SIZE rows, so memory doesn't grow with the number
+of inputs: the mean stack only keeps running sums, and the median stack
+keeps the resampled fluxes in a temporary memory-mapped file and takes the
+median over blocks of wavelength bins.
+
+Example usage:
+
+    grid = rest_grid(targetcat['Z'])
+    result = stack_spectra(targetcat, 'iron', grid, method='median')
+"""
+
+import os
+import tempfile
+
+import numpy as np
+
+#- maximum number of spectra in a stack
+MAX_STACK_SPECTRA = int(os.getenv('DESI_INSPECTOR_MAX_STACK_SPECTRA', 10000))
+
+#- maximum number of wavelength bins in the rest-frame grid
+MAX_GRID_SIZE = 20000
+
+#- observed wavelength range of DESI spectra [Angstrom]
+DESI_WMIN = 3600.0
+DESI_WMAX = 9824.0
+
+#- default rest-frame bin size [Angstrom]
+DEFAULT_DW = 1.0
+
+#- spectra resampled at a time
+CHUNK_SIZE = 64
+
+#- wavelength bins per block when taking the median
+MEDIAN_BLOCK = 512
+
+METHODS = ('mean', 'median')
+
+def rest_grid(z, wmin=None, wmax=None, dw=DEFAULT_DW):
+    """
+    Return rest-frame wavelength grid covering spectra at redshifts z
+
+    Args:
+        z: array of redshifts
+
+    Options:
+        wmin, wmax (float): rest-frame range [Angstrom]; default covers all z
+        dw (float): bin size [Angstrom]
+
+    Raises ValueError if the grid would have more than MAX_GRID_SIZE bins
+    """
+    z = np.asarray(z, dtype=float)
+    if wmin is None:
+        wmin = DESI_WMIN / (1 + np.max(z)) if len(z) > 0 else DESI_WMIN
+    if wmax is None:
+        wmax = DESI_WMAX / (1 + np.min(z)) if len(z) > 0 else DESI_WMAX
+
+    if not (dw > 0 and 0 < wmin < wmax):
+        raise ValueError(f'Invalid rest-frame grid wmin={wmin}, wmax={wmax}, dw={dw}')
+
+    nbins = int(np.floor((wmax - wmin) / dw)) + 1
+    if nbins > MAX_GRID_SIZE:
+        raise ValueError(f'Rest-frame grid {wmin:.1f}-{wmax:.1f} with dw={dw} has {nbins} bins; '
+                         f'please use a larger dw or smaller wavelength range for at most {MAX_GRID_SIZE} bins')
+
+    return wmin + dw*np.arange(nbins)
+
+def resample(wave, flux, ivar, z, grid):
+    """
+    Resample spectra at redshifts z onto rest-frame grid
+
+    Args:
+        wave: 1D observed wavelengths shared by all spectra
+        flux, ivar: 2D [nspec, nwave]
+        z: 1D redshifts [nspec]
+        grid: 1D rest-frame wavelengths
+
+    Returns (flux, ivar) arrays [nspec, len(grid)]; ivar is 0 outside of
+    each spectrum's wavelength range or next to masked pixels
+    """
+    nspec, nwave = flux.shape
+    obs = grid[None, :] * (1 + np.asarray(z, dtype=float))[:, None]
+
+    #- left neighbor of every output bin, for all spectra at once
+    i = np.clip(np.searchsorted(wave, obs) - 1, 0, nwave - 2)
+    t = (obs - wave[i]) / (wave[i+1] - wave[i])
+    inside = (t >= 0) & (t <= 1)
+
+    f0 = np.take_along_axis(flux, i, axis=1)
+    f1 = np.take_along_axis(flux, i+1, axis=1)
+    w0 = np.take_along_axis(ivar, i, axis=1)
+    w1 = np.take_along_axis(ivar, i+1, axis=1)
+
+    good = inside & (w0 > 0) & (w1 > 0)
+    out_flux = np.where(good, (1-t)*f0 + t*f1, 0.0)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        var = (1-t)**2 / w0 + t**2 / w1
+        out_ivar = np.where(good, 1/var, 0.0)
+
+    return out_flux, out_ivar
+
+def resample_spectra(spectra, z, grid, rows=None):
+    """
+    Resample rows of a desispec Spectra onto grid, combining cameras weighted by ivar
+
+    Returns (flux, ivar) arrays [nrows, len(grid)]
+    """
+    if rows is None:
+        rows = slice(None)
+
+    sum_wf = None
+    sum_w = None
+    for band in spectra.bands:
+        ivar = spectra.ivar[band][rows]
+        if spectra.mask is not None and spectra.mask.get(band) is not None:
+            ivar = ivar * (spectra.mask[band][rows] == 0)
+        flux, ivar = resample(spectra.wave[band], spectra.flux[band][rows], ivar, z, grid)
+        if sum_w is None:
+            sum_wf, sum_w = ivar*flux, ivar
+        else:
+            sum_wf += ivar*flux
+            sum_w += ivar
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        flux = np.where(sum_w > 0, sum_wf / sum_w, 0.0)
+
+    return flux, sum_w
+
+class Stacker(object):
+    """
+    Accumulates resampled spectra for a mean or median stack
+
+    Args:
+        grid: rest-frame wavelength grid
+        method (str): mean (ivar-weighted) or median
+        maxspec (int): maximum number of spectra, for sizing the median buffer
+        norm (tuple): optional (wmin, wmax) rest-frame window; each spectrum is
+            divided by its ivar-weighted mean flux in the window, and spectra
+            without coverage there are skipped
+    """
+    def __init__(self, grid, method='mean', maxspec=MAX_STACK_SPECTRA, norm=None):
+        if method not in METHODS:
+            raise ValueError(f"Unsupported stack method='{method}'; supported methods are {METHODS}")
+
+        self.grid = np.asarray(grid)
+        self.method = method
+        self.norm = norm
+        self.nspec = 0
+        self.nskipped = 0
+        self.sum_wf = np.zeros(len(grid))
+        self.sum_w = np.zeros(len(grid))
+        self.count = np.zeros(len(grid), dtype=np.int32)
+        self._tmpfile = None
+        self._fluxes = None
+        if method == 'median':
+            #- resampled fluxes with NaN for no data, on disk rather than in memory
+            self._tmpfile = tempfile.TemporaryFile()
+            self._fluxes = np.memmap(self._tmpfile, dtype=np.float32, mode='w+',
+                                     shape=(max(maxspec, 1), len(grid)))
+
+    def close(self):
+        if self._tmpfile is not None:
+            del self._fluxes
+            self._fluxes = None
+            self._tmpfile.close()
+            self._tmpfile = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def add(self, flux, ivar):
+        """Add resampled flux, ivar arrays [nspec, len(grid)]"""
+        if self.norm is not None:
+            window = (self.grid >= self.norm[0]) & (self.grid <= self.norm[1])
+            w = ivar[:, window]
+            wsum = w.sum(axis=1)
+            with np.errstate(divide='ignore', invalid='ignore'):
+                scale = (flux[:, window]*w).sum(axis=1) / wsum
+            ok = (wsum > 0) & (scale > 0)
+            self.nskipped += int(np.sum(~ok))
+            flux = flux[ok] / scale[ok, None]
+            ivar = ivar[ok] * scale[ok, None]**2
+
+        n = flux.shape[0]
+        if self._fluxes is not None and self.nspec + n > self._fluxes.shape[0]:
+            raise ValueError(f'More than {self._fluxes.shape[0]} spectra in stack')
+
+        good = ivar > 0
+        self.sum_wf += (ivar*flux).sum(axis=0)
+        self.sum_w += ivar.sum(axis=0)
+        self.count += good.sum(axis=0).astype(np.int32)
+        if self._fluxes is not None:
+            self._fluxes[self.nspec:self.nspec+n] = np.where(good, flux, np.nan)
+
+        self.nspec += n
+
+    def add_spectra(self, spectra, z):
+        """Resample and add all spectra in a desispec Spectra with redshifts z, CHUNK_SIZE at a time"""
+        z = np.asarray(z, dtype=float)
+        for start in range(0, len(z), CHUNK_SIZE):
+            rows = slice(start, start + CHUNK_SIZE)
+            flux, ivar = resample_spectra(spectra, z[rows], self.grid, rows)
+            self.add(flux, ivar)
+
+    def result(self):
+        """Return Table with WAVE, FLUX, IVAR, NSPEC for the stack"""
+        from astropy.table import Table
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            if self.method == 'mean':
+                flux = np.where(self.sum_w > 0, self.sum_wf / self.sum_w, 0.0)
+                ivar = self.sum_w
+            else:
+                flux = np.zeros(len(self.grid))
+                for start in range(0, len(self.grid), MEDIAN_BLOCK):
+                    block = self._fluxes[0:self.nspec, start:start+MEDIAN_BLOCK]
+                    covered = self.count[start:start+MEDIAN_BLOCK] > 0
+                    if np.any(covered):
+                        flux[start:start+MEDIAN_BLOCK][covered] = np.nanmedian(block[:, covered], axis=0)
+                #- variance of the median of normal data is pi/2 times that of the mean
+                ivar = self.sum_w * 2/np.pi
+
+        t = Table()
+        t['WAVE'] = self.grid.astype(np.float32)
+        t['FLUX'] = flux.astype(np.float32)
+        t['IVAR'] = ivar.astype(np.float32)
+        t['NSPEC'] = self.count
+        t['WAVE'].unit = 'Angstrom'
+        t.meta['METHOD'] = self.method
+        t.meta['NSTACK'] = self.nspec
+        t.meta['NSKIPPED'] = self.nskipped
+        if self.norm is not None:
+            t.meta['NORMWMIN'], t.meta['NORMWMAX'] = self.norm
+
+        return t
+
+def stack_spectra(targetcat, specprod, grid, method='mean', norm=None, spectra_iter=None):
+    """
+    Return rest-frame stack of the spectra of targetcat
+
+    Args:
+        targetcat: targets table from load_targets, with Z
+        specprod (str): production name
+        grid: rest-frame wavelength grid, e.g. from rest_grid
+
+    Options:
+        method (str): mean or median
+        norm (tuple): (wmin, wmax) rest-frame normalization window; see Stacker
+        spectra_iter: iterable of Spectra with redshifts; default
+            inspector.io.iter_spectra(targetcat, specprod, ...)
+
+    Returns Table with WAVE, FLUX, IVAR, NSPEC columns and stack metadata
+    """
+    from inspector.io import iter_spectra
+    from inspector.specbin import SKIP_HDUS
+
+    if spectra_iter is None:
+        rdspec_kwargs = dict(return_redshifts=True, skip_hdus=SKIP_HDUS)
+        spectra_iter = iter_spectra(targetcat, specprod, rdspec_kwargs=rdspec_kwargs)
+
+    z = np.asarray(targetcat['Z'], dtype=float)
+    with Stacker(grid, method, maxspec=len(targetcat), norm=norm) as stacker:
+        try:
+            for spectra in spectra_iter:
+                #- same Redrock Z as add_zcat_columns put in targetcat
+                stacker.add_spectra(spectra, spectra.redshifts['Z'])
+                #- don't hold on to this file while the next one is read
+                del spectra
+        finally:
+            if hasattr(spectra_iter, 'close'):
+                spectra_iter.close()
+
+        t = stacker.result()
+
+    t.meta['SPECPROD'] = specprod
+    t.meta['ZMIN'] = float(np.min(z)) if len(z) > 0 else 0.0
+    t.meta['ZMAX'] = float(np.max(z)) if len(z) > 0 else 0.0
+    t.meta['ZMEDIAN'] = float(np.median(z)) if len(z) > 0 else 0.0
+    if 'NDEDUP' in targetcat.meta:
+        t.meta['NDEDUP'] = targetcat.meta['NDEDUP']
+    return t
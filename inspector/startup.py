@@ -0,0 +1,118 @@
+"""
+inspector.startup
+=================
+
+Control when the heavy data-access modules are imported.
+
+By default the app imports desispec, prospect, fitsio, and astropy only when
+the first data request needs them, so that workers start quickly and info
+pages like /about never pay that cost.  With $DESI_INSPECTOR_PRELOAD set,
+app.py calls preload() at import instead; combined with `gunicorn --preload`
+the modules are then imported once in the master process and shared
+copy-on-write by the forked workers.
+
+Report where import time goes with
+
+    python -m inspector.startup [--top N]
+"""
+
+import os
+import sys
+import gc
+import time
+import argparse
+import importlib
+import subprocess
+
+PRELOAD = os.getenv('DESI_INSPECTOR_PRELOAD', '').lower() in ('1', 'true', 'yes')
+
+#- modules that app.py and inspector.io import lazily
+HEAVY_MODULES = (
+    'numpy',
+    'astropy.table',
+    'fitsio',
+    'desispec.inventory',
+    'desispec.io',
+    'desispec.io.meta',
+    'desispec.io.redrock',
+    'prospect.viewer',
+    )
+
+def preload(modules=HEAVY_MODULES):
+    """
+    Import modules now, then freeze the garbage collector so that objects
+    created so far are never touched by collection in forked workers (which
+    would otherwise copy the shared pages).
+
+    Returns dict of module name -> import time in seconds
+    """
+    times = dict()
+    for name in modules:
+        t0 = time.perf_counter()
+        importlib.import_module(name)
+        times[name] = time.perf_counter() - t0
+
+    gc.freeze()
+    print(f'Preloaded {len(times)} modules in {sum(times.values()):.2f} sec')
+    return times
+
+def parse_importtime(stderr):
+    """
+    Parse `python -X importtime` output into list of (module, self_usec, cumulative_usec)
+    """
+    results = list()
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+
+        selftime, cumulative, module = line[len('import time:'):].split('|')
+        results.append((module.strip(), int(selftime), int(cumulative)))
+
+    return results
+
+def importtime_report(statement, top=20):
+    """
+    Run statement in a fresh interpreter with -X importtime
+
+    Returns (wallclock_seconds, list of (module, self_usec, cumulative_usec)
+    for the top slowest imports sorted by cumulative time)
+    """
+    cmd = [sys.executable, '-X', 'importtime', '-c', statement]
+    t0 = time.perf_counter()
+    proc = subprocess.run(cmd, capture_output=True, text=True)
+    wallclock = time.perf_counter() - t0
+    if proc.returncode != 0:
+        raise RuntimeError(f'{statement!r} failed:\n{proc.stderr[-2000:]}')
+
+    results = parse_importtime(proc.stderr)
+    results.sort(key=lambda r: r[2], reverse=True)
+    return wallclock, results[0:top]
+
+def main():
+    parser = argparse.ArgumentParser(description='Report Data Inspector import times')
+    parser.add_argument('--top', type=int, default=15, help='number of modules to list')
+    args = parser.parse_args()
+
+    #- run from the repo top level so that "import app" works
+    topdir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    os.chdir(topdir)
+
+    env = os.environ.copy()
+    for mode, preload_value in (('lazy', '0'), ('preload', '1')):
+        os.environ['DESI_INSPECTOR_PRELOAD'] = preload_value
+        try:
+            wallclock, results = importtime_report('import app', top=args.top)
+        except RuntimeError as err:
+            print(f'\n{mode}: ERROR {err}')
+            continue
+
+        print(f'\n{mode}: "import app" took {wallclock:.2f} sec including interpreter startup')
+        print(f'  {"cumulative [ms]":>15s} {"self [ms]":>10s}  module')
+        for module, selftime, cumulative in results:
+            print(f'  {cumulative/1000:15.1f} {selftime/1000:10.1f}  {module}')
+
+    os.environ.clear()
+    os.environ.update(env)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,282 @@
+"""
+inspector.synthetic
+===================
+
+Generate a miniature synthetic DESI spectroscopic production for offline
+benchmarks and tests.
+
+The files follow the production directory layout and HDU structure of real
+productions so that desispec.io.findfile, read_spectra_parallel, and
+read_redrock_targetcat work on them unmodified:
+
+    $DESI_ROOT/spectro/redux/SPECPROD/
+        tiles-SPECPROD.fits, tiles-SPECPROD.csv
+        tiles/cumulative/TILEID/LASTNIGHT/{coadd,redrock}-PETAL-TILEID-thruLASTNIGHT.fits
+        healpix/SURVEY/PROGRAM/HPIXGROUP/HPIX/{coadd,redrock}-SURVEY-PROGRAM-HPIX.fits
+
+plus target inventory tables under $DESI_TARGET_INVENTORY_DIR/SPECPROD/.
+All targets lie within MAX_RADIUS of (ra0,dec0) so that a single cone
+search can return any number of them.
+"""
+
+import os
+import numpy as np
+
+#- DESI camera wavelength coverage [Angstrom]
+CAMERA_WAVE_RANGE = dict(b=(3600.0, 5800.0), r=(5760.0, 7620.0), z=(7520.0, 9824.0))
+RESOLUTION_NDIAG = 11
+NSIDE = 64
+FIBERS_PER_PETAL = 500
+TSNR2_COLUMNS = ('TSNR2_LRG', 'TSNR2_ELG', 'TSNR2_QSO', 'TSNR2_BGS', 'TSNR2_LYA')
+
+def set_environment(desi_root):
+    """Set $DESI_ROOT and related environment variables to use the synthetic production at desi_root"""
+    os.environ['DESI_ROOT'] = desi_root
+    os.environ['DESI_SPECTRO_REDUX'] = os.path.join(desi_root, 'spectro', 'redux')
+    os.environ['DESI_TARGET_INVENTORY_DIR'] = os.path.join(desi_root, 'inventory')
+
+def _radec2healpix(ra, dec):
+    import healpy
+    return healpy.ang2pix(NSIDE, ra, dec, nest=True, lonlat=True)
+
+def make_targets(ntargets, ra0=210.0, dec0=5.0, radius=0.45, ntiles=None, frac_repeat=0.1, seed=0):
+    """
+    Generate table of synthetic targets and their observations
+
+    Args:
+        ntargets (int): number of unique targets
+        ra0, dec0 (float): field center [degrees]
+        radius (float): targets are uniformly distributed within this radius [degrees]
+        ntiles (int): number of tiles; default enough for all targets to get a fiber
+        frac_repeat (float): fraction of targets observed on a second tile
+        seed (int): random seed
+
+    Returns (targets, observations) tables; targets has one row per TARGETID
+    with redshifts and healpix; observations has one row per TARGETID per tile
+    """
+    from astropy.table import Table
+
+    rng = np.random.default_rng(seed)
+
+    #- uniform on the sky within radius of (ra0,dec0)
+    r = radius * np.sqrt(rng.uniform(0, 1, ntargets))
+    theta = rng.uniform(0, 2*np.pi, ntargets)
+    dec = dec0 + r*np.sin(theta)
+    ra = ra0 + r*np.cos(theta)/np.cos(np.radians(dec))
+
+    targets = Table()
+    targets['TARGETID'] = 39627908959960000 + np.arange(ntargets, dtype=np.int64)
+    targets['TARGET_RA'] = ra
+    targets['TARGET_DEC'] = dec
+    targets['HEALPIX'] = _radec2healpix(ra, dec).astype(np.int32)
+    targets['SURVEY'] = np.where(rng.uniform(0, 1, ntargets) < 0.2, 'sv3', 'main').astype('U7')
+    targets['PROGRAM'] = 'dark'
+    targets['DESI_TARGET'] = rng.choice(np.array([1, 2, 4, 2**60], dtype=np.int64), ntargets)
+    targets['BGS_TARGET'] = np.zeros(ntargets, dtype=np.int64)
+    targets['MWS_TARGET'] = np.zeros(ntargets, dtype=np.int64)
+    for band in ('G', 'R', 'Z'):
+        targets[f'FLUX_{band}'] = rng.lognormal(0.5, 1.0, ntargets).astype(np.float32)
+
+    spectype = rng.choice(np.array(['GALAXY', 'QSO', 'STAR']), ntargets, p=[0.7, 0.2, 0.1])
+    z = np.where(spectype == 'GALAXY', rng.uniform(0.05, 1.6, ntargets),
+                 np.where(spectype == 'QSO', rng.uniform(0.5, 3.8, ntargets),
+                          rng.normal(0, 1e-4, ntargets)))
+    targets['Z'] = z
+    targets['ZERR'] = rng.uniform(1e-5, 1e-3, ntargets)
+    targets['ZWARN'] = np.where(rng.uniform(0, 1, ntargets) < 0.05, 4, 0).astype(np.int64)
+    targets['SPECTYPE'] = spectype.astype('U6')
+    targets['SUBTYPE'] = np.where(spectype == 'STAR', 'K', '').astype('U20')
+    targets['DELTACHI2'] = rng.lognormal(4, 2, ntargets)
+    targets['CHI2'] = rng.normal(8000, 100, ntargets)
+    targets['NPIXELS'] = np.full(ntargets, 7900, dtype=np.int64)
+    targets['NCOEFF'] = np.full(ntargets, 10, dtype=np.int64)
+    targets['COEFF'] = rng.normal(0, 1, (ntargets, 10))
+    targets['TSNR2_LRG'] = rng.lognormal(4, 0.5, ntargets).astype(np.float32)
+    for col in TSNR2_COLUMNS[1:]:
+        targets[col] = (targets['TSNR2_LRG'] * rng.uniform(0.5, 2, ntargets)).astype(np.float32)
+
+    #- tiles, each with 10 petals of FIBERS_PER_PETAL fibers
+    ntargets_observed = int(ntargets*(1+frac_repeat))
+    if ntiles is None:
+        ntiles = max(2, int(np.ceil(ntargets_observed / (0.8*10*FIBERS_PER_PETAL))))
+
+    tileids = 1000 + np.arange(ntiles)
+    lastnights = 20210418 + np.arange(ntiles)
+    tile_of_target = rng.integers(0, ntiles, ntargets)
+    irepeat = rng.choice(ntargets, int(frac_repeat*ntargets), replace=False)
+    repeat_tile = (tile_of_target[irepeat] + rng.integers(1, ntiles, len(irepeat))) % ntiles
+
+    obs_index = np.concatenate([np.arange(ntargets), irepeat])
+    obs_tile = np.concatenate([tile_of_target, repeat_tile])
+
+    #- assign fibers sequentially within each tile, spreading across petals
+    fiber = np.zeros(len(obs_index), dtype=np.int32)
+    for i in range(ntiles):
+        ii = np.where(obs_tile == i)[0]
+        if len(ii) > 10*FIBERS_PER_PETAL:
+            raise ValueError(f'{len(ii)} targets on tile {tileids[i]}; use more tiles')
+        k = np.arange(len(ii))
+        fiber[ii] = (k % 10)*FIBERS_PER_PETAL + k//10
+
+    obs = targets[obs_index]
+    obs['TILEID'] = tileids[obs_tile].astype(np.int32)
+    obs['LASTNIGHT'] = lastnights[obs_tile].astype(np.int32)
+    obs['FIBER'] = fiber
+    obs['PETAL_LOC'] = (fiber // FIBERS_PER_PETAL).astype(np.int16)
+
+    #- each tile contributes part of the per-target healpix coadd depth
+    depth = rng.uniform(0.3, 1.0, len(obs)).astype(np.float32)
+    for col in TSNR2_COLUMNS:
+        obs[col] *= depth
+
+    obs.sort(['TILEID', 'FIBER'])
+    return targets, obs
+
+def _camera_wave(camera, wavestep):
+    wmin, wmax = CAMERA_WAVE_RANGE[camera]
+    return np.arange(wmin, wmax+wavestep/2, wavestep)
+
+def _fibermap(rows, tile=True):
+    """Return FIBERMAP structured array for rows of the observations table"""
+    from astropy.table import Table
+    cols = ['TARGETID', 'TARGET_RA', 'TARGET_DEC', 'DESI_TARGET', 'BGS_TARGET',
+            'MWS_TARGET', 'FLUX_G', 'FLUX_R', 'FLUX_Z']
+    if tile:
+        cols = ['TARGETID', 'PETAL_LOC', 'FIBER', 'TILEID'] + cols[1:]
+    fm = Table(rows[cols], copy=True)
+    fm['COADD_FIBERSTATUS'] = np.zeros(len(fm), dtype=np.int32)
+    fm['COADD_NUMEXP'] = np.ones(len(fm), dtype=np.int16)
+    return fm.as_array()
+
+def _exp_fibermap(rows):
+    from astropy.table import Table
+    efm = Table()
+    efm['TARGETID'] = np.asarray(rows['TARGETID'])
+    efm['NIGHT'] = np.asarray(rows['LASTNIGHT']) if 'LASTNIGHT' in rows.colnames else 20210418
+    efm['EXPID'] = np.arange(len(rows), dtype=np.int32) + 100000
+    efm['TILEID'] = np.asarray(rows['TILEID']) if 'TILEID' in rows.colnames else 1000
+    efm['FIBER'] = np.asarray(rows['FIBER']) if 'FIBER' in rows.colnames else 0
+    return efm.as_array()
+
+def _redshifts(rows):
+    from astropy.table import Table
+    cols = ['TARGETID', 'CHI2', 'COEFF', 'Z', 'ZERR', 'ZWARN', 'NPIXELS',
+            'SPECTYPE', 'SUBTYPE', 'NCOEFF', 'DELTACHI2']
+    return Table(rows[cols], copy=True).as_array()
+
+def _tsnr2(rows):
+    from astropy.table import Table
+    return Table(rows[['TARGETID',] + list(TSNR2_COLUMNS)], copy=True).as_array()
+
+def write_files(coaddfile, redrockfile, rows, header, wavestep, rng, tile=True):
+    """
+    Write synthetic coadd and redrock files for rows of observations table
+    """
+    import fitsio
+
+    os.makedirs(os.path.dirname(coaddfile), exist_ok=True)
+    n = len(rows)
+    fibermap = _fibermap(rows, tile=tile)
+    exp_fibermap = _exp_fibermap(rows)
+
+    with fitsio.FITS(coaddfile, 'rw', clobber=True) as fx:
+        fx.write(None, header=header)
+        fx.write(fibermap, extname='FIBERMAP')
+        fx.write(exp_fibermap, extname='EXP_FIBERMAP')
+        for camera in ('b', 'r', 'z'):
+            wave = _camera_wave(camera, wavestep)
+            nwave = len(wave)
+            flux = (1 + rng.normal(0, 0.5, (n, nwave))).astype(np.float32)
+            ivar = rng.uniform(1, 4, (n, nwave)).astype(np.float32)
+            mask = np.zeros((n, nwave), dtype=np.int32)
+            res = np.zeros((n, RESOLUTION_NDIAG, nwave), dtype=np.float32)
+            res[:, RESOLUTION_NDIAG//2-1:RESOLUTION_NDIAG//2+2, :] = np.array([0.25, 0.5, 0.25])[None, :, None]
+            C = camera.upper()
+            fx.write(wave, extname=f'{C}_WAVELENGTH', header=dict(BUNIT='Angstrom'))
+            fx.write(flux, extname=f'{C}_FLUX', header=dict(BUNIT='10**-17 erg/(s cm2 Angstrom)'))
+            fx.write(ivar, extname=f'{C}_IVAR', header=dict(BUNIT='10**+34 (s2 cm4 Angstrom2) / erg2'))
+            fx.write(mask, extname=f'{C}_MASK')
+            fx.write(res, extname=f'{C}_RESOLUTION')
+
+        fx.write(_tsnr2(rows), extname='SCORES')
+
+    with fitsio.FITS(redrockfile, 'rw', clobber=True) as fx:
+        fx.write(None, header=header)
+        fx.write(_redshifts(rows), extname='REDSHIFTS')
+        fx.write(fibermap, extname='FIBERMAP')
+        fx.write(exp_fibermap, extname='EXP_FIBERMAP')
+        fx.write(_tsnr2(rows), extname='TSNR2')
+
+def make_production(desi_root, specprod='synth', ntargets=12000, wavestep=8.0, seed=0, **kwargs):
+    """
+    Write a synthetic production under desi_root
+
+    Args:
+        desi_root (str): output directory, used as $DESI_ROOT
+        specprod (str): production name
+        ntargets (int): number of unique targets
+        wavestep (float): wavelength step [Angstrom]; real productions use 0.8
+        seed (int): random seed
+        kwargs: passed to make_targets
+
+    Returns (targets, observations) tables as returned by make_targets
+    """
+    from astropy.table import Table
+
+    rng = np.random.default_rng(seed)
+    targets, obs = make_targets(ntargets, seed=seed, **kwargs)
+
+    proddir = os.path.join(desi_root, 'spectro', 'redux', specprod)
+    os.makedirs(proddir, exist_ok=True)
+
+    #- tiles, grouped into per-petal cumulative coadd/redrock files
+    tiles = Table()
+    tiles['TILEID'], ii = np.unique(obs['TILEID'], return_index=True)
+    tiles['SURVEY'] = 'main'
+    tiles['PROGRAM'] = 'dark'
+    tiles['LASTNIGHT'] = obs['LASTNIGHT'][ii]
+    tiles['TILERA'] = np.mean(obs['TARGET_RA'])
+    tiles['TILEDEC'] = np.mean(obs['TARGET_DEC'])
+    tiles.write(os.path.join(proddir, f'tiles-{specprod}.fits'), overwrite=True)
+    tiles.write(os.path.join(proddir, f'tiles-{specprod}.csv'), overwrite=True)
+
+    for rows in obs.group_by(['TILEID', 'PETAL_LOC']).groups:
+        tileid, night, petal = rows['TILEID'][0], rows['LASTNIGHT'][0], rows['PETAL_LOC'][0]
+        tiledir = os.path.join(proddir, 'tiles', 'cumulative', str(tileid), str(night))
+        header = dict(SPECPROD=specprod, TILEID=tileid, NIGHT=night, PETAL=petal,
+                      SPGRP='cumulative', SURVEY='main', PROGRAM='dark')
+        write_files(os.path.join(tiledir, f'coadd-{petal}-{tileid}-thru{night}.fits'),
+                    os.path.join(tiledir, f'redrock-{petal}-{tileid}-thru{night}.fits'),
+                    rows, header, wavestep, rng, tile=True)
+
+    #- healpix coadd/redrock files per survey/program/healpix
+    for rows in targets.group_by(['SURVEY', 'PROGRAM', 'HEALPIX']).groups:
+        survey, program, hpix = rows['SURVEY'][0], rows['PROGRAM'][0], rows['HEALPIX'][0]
+        hpixdir = os.path.join(proddir, 'healpix', survey, program, str(hpix//100), str(hpix))
+        header = dict(SPECPROD=specprod, HPXPIXEL=hpix, HPXNSIDE=NSIDE, HPXNEST=True,
+                      SPGRP='healpix', SURVEY=survey, PROGRAM=program)
+        write_files(os.path.join(hpixdir, f'coadd-{survey}-{program}-{hpix}.fits'),
+                    os.path.join(hpixdir, f'redrock-{survey}-{program}-{hpix}.fits'),
+                    rows, header, wavestep, rng, tile=False)
+
+    write_inventory(os.path.join(desi_root, 'inventory'), specprod, targets, obs)
+
+    return targets, obs
+
+def write_inventory(inventory_dir, specprod, targets, obs):
+    """
+    Write target inventory tables for the healpix and tiles spectra groupings
+
+    These contain the key columns needed to locate each target's spectra:
+    TARGETID,TARGET_RA,TARGET_DEC plus SURVEY,PROGRAM,HEALPIX for healpix
+    or TILEID,LASTNIGHT,PETAL_LOC for tiles.
+    """
+    outdir = os.path.join(inventory_dir, specprod)
+    os.makedirs(outdir, exist_ok=True)
+
+    healpix_cols = ['TARGETID', 'TARGET_RA', 'TARGET_DEC', 'SURVEY', 'PROGRAM', 'HEALPIX']
+    tiles_cols = ['TARGETID', 'TARGET_RA', 'TARGET_DEC', 'SURVEY', 'PROGRAM',
+                  'TILEID', 'LASTNIGHT', 'PETAL_LOC', 'FIBER']
+
+    targets[healpix_cols].write(os.path.join(outdir, f'inventory-{specprod}-healpix.fits'), overwrite=True)
+    obs[tiles_cols].write(os.path.join(outdir, f'inventory-{specprod}-tiles.fits'), overwrite=True)
@@ -0,0 +1,375 @@
+"""
+inspector.warmup
+================
+
+Warm the per-worker caches by replaying popular queries at startup.
+
+A freshly started worker has empty caches (open files and findfile
+lookups in inspector.fitscache, zcat schemas, attribute indexes), so the
+first users of popular queries pay the full cold-cache latency.  When
+$DESI_INSPECTOR_WARMUP is set, the gunicorn post_worker_init hook in
+gunicorn.conf.py calls start(), which parses the access logs named by
+$DESI_INSPECTOR_WARMUP_LOG (comma separated glob patterns, optionally
+gzipped), ranks the data queries by frequency, and replays the top
+WARMUP_TOP of them through the app in a background thread.  The queries
+linked from examples.html follow the logged ones, so a new deployment
+without logs still warms those.
+
+Queries are normalized so that requests for the same data share a key:
+the production name is standardized, query options are sorted, and the
+format option is dropped because no cache depends on it.  Each key is
+replayed once in the cheapest format that reads the same files (json for
+tables, bin for spectra).
+
+Replay is limited to WARMUP_SECONDS in total, and sleeps between queries
+so that it only uses a WARMUP_DUTY fraction of that time; the thread also
+runs at lower CPU and I/O priority (nice WARMUP_NICE), after start() has
+started the pool processes at normal priority.  Requests that would have
+been rejected by admission control or auth simply fail and are reported
+as such.  The report, including the fraction of logged traffic
+covered by the warmed queries, is printed and written to
+$DESI_INSPECTOR_STATS_DIR/warmup/<pid>.json for /internal/stats.
+
+Report the top queries of a log, or warm a running server over HTTP
+(e.g. through inspector.router so that each backend warms its own regions):
+
+    python -m inspector.warmup access.log [--top N] [--url http://127.0.0.1:5001]
+"""
+
+import os
+import re
+import sys
+import glob
+import gzip
+import json
+import time
+import argparse
+import threading
+import urllib.error
+import urllib.request
+from collections import Counter
+from urllib.parse import urlsplit, parse_qsl, urlencode
+
+from inspector import memstats
+from inspector.admission import _pid_alive
+from inspector.auth import auth_headers
+
+WARMUP = os.getenv('DESI_INSPECTOR_WARMUP', '0').lower() in ('1', 'true', 'yes')
+
+#- comma separated glob patterns of access logs in nginx/gunicorn combined format
+WARMUP_LOG = os.getenv('DESI_INSPECTOR_WARMUP_LOG', '')
+
+#- number of distinct queries to replay
+WARMUP_TOP = int(os.getenv('DESI_INSPECTOR_WARMUP_TOP', 50))
+
+#- total seconds allowed for replaying, including the sleeps between queries
+WARMUP_SECONDS = float(os.getenv('DESI_INSPECTOR_WARMUP_SECONDS', 300))
+
+#- fraction of the time spent replaying rather than sleeping
+WARMUP_DUTY = float(os.getenv('DESI_INSPECTOR_WARMUP_DUTY', 0.5))
+
+#- niceness of the replay thread, which also lowers its default I/O priority on Linux
+WARMUP_NICE = int(os.getenv('DESI_INSPECTOR_WARMUP_NICE', 10))
+
+EXAMPLES_TEMPLATE = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                                 'templates', 'examples.html')
+
+REPORT_DIR = os.path.join(memstats.STATS_DIR, 'warmup')
+
+#- request line and status of a combined format access log entry
+_LOG_ENTRY = re.compile(r'"GET (\S+) HTTP/[\d.]+" (\d{3}) ')
+
+#- routes that read data; excludes info pages, assets, jobs, and POST-only routes
+_DATA_ROUTE = re.compile(r'^/(compare/[^/]+|[^/]+)/(targets|spectra|stack|query)(/|$)')
+
+_EXAMPLE_HREF = re.compile(r'href="(?:\{\{\s*root_url\s*\}\})?(/[^"]*)"')
+
+def normalize_query(path):
+    """
+    Return cache key for request path, or None if it doesn't read data
+
+    The key is the path with a standardized production name and sorted
+    query options, without the format option.
+    """
+    from inspector.io import standardize_specprod
+    from inspector.compare import parse_specprods
+
+    url = urlsplit(path)
+    match = _DATA_ROUTE.match(url.path)
+    if match is None:
+        return None
+
+    prefix = match.group(1)
+    try:
+        if prefix.startswith('compare/'):
+            specprods = ','.join(parse_specprods(prefix[len('compare/'):]))
+            prefix = f'compare/{specprods}'
+        else:
+            prefix = standardize_specprod(prefix)
+    except ValueError:
+        return None
+
+    urlpath = f'/{prefix}' + url.path[match.end(1):].rstrip('/')
+    args = sorted((k, v) for k, v in parse_qsl(url.query, keep_blank_values=True) if k != 'format')
+    if args:
+        return f'{urlpath}?{urlencode(args)}'
+    else:
+        return urlpath
+
+def replay_path(key):
+    """Return path for replaying key in the cheapest format that reads the same data"""
+    urlpath = urlsplit(key).path
+    if urlpath.startswith('/compare/') and '/spectra/' in urlpath:
+        #- comparisons only have html spectra, streamed as the files are read
+        return key
+    elif '/spectra/' in urlpath:
+        format_type = 'bin'
+    else:
+        format_type = 'json'
+
+    return key + ('&' if '?' in key else '?') + f'format={format_type}'
+
+def _open_log(filename):
+    if filename.endswith('.gz'):
+        return gzip.open(filename, 'rt', errors='replace')
+    else:
+        return open(filename, errors='replace')
+
+def parse_logs(patterns):
+    """
+    Return Counter of normalized query key -> number of successful GET requests
+
+    patterns is a list of glob patterns (or comma separated str) of access
+    logs in nginx/gunicorn combined format; unreadable files are skipped.
+    """
+    if isinstance(patterns, str):
+        patterns = [p.strip() for p in patterns.split(',') if p.strip()]
+
+    counts = Counter()
+    for pattern in patterns:
+        for filename in sorted(glob.glob(pattern)):
+            try:
+                with _open_log(filename) as fp:
+                    for line in fp:
+                        match = _LOG_ENTRY.search(line)
+                        if match is None or match.group(2) not in ('200', '304'):
+                            continue
+                        key = normalize_query(match.group(1))
+                        if key is not None:
+                            counts[key] += 1
+            except OSError as err:
+                print(f'WARNING: unable to read access log {filename}: {err}', file=sys.stderr)
+
+    return counts
+
+def example_queries(filename=EXAMPLES_TEMPLATE):
+    """Return list of normalized query keys linked from examples.html, in page order"""
+    with open(filename) as fp:
+        html = fp.read()
+
+    keys = list()
+    for path in _EXAMPLE_HREF.findall(html):
+        key = normalize_query(path.replace('&amp;', '&'))
+        if key is not None and key not in keys:
+            keys.append(key)
+
+    return keys
+
+def rank_queries(counts, examples=(), top=WARMUP_TOP):
+    """
+    Return list of up to top keys: most frequent first, then unlogged examples
+    """
+    keys = [key for key, n in counts.most_common()]
+    keys.extend(key for key in examples if key not in counts)
+    return keys[0:top]
+
+def wsgi_fetcher(wsgi_app):
+    """Return function path -> HTTP status that requests path from wsgi_app in this process"""
+    from werkzeug.test import Client
+
+    client = Client(wsgi_app)
+    headers = auth_headers('DESI_INSPECTOR_WARMUP')
+
+    def fetch(path):
+        response = client.get(path, headers=headers)
+        try:
+            #- consume streamed pages so that all of their data are read
+            for chunk in response.iter_encoded():
+                pass
+        finally:
+            response.close()
+        return response.status_code
+
+    return fetch
+
+def url_fetcher(base_url, timeout=600):
+    """Return function path -> HTTP status that requests path from the server at base_url"""
+    base_url = base_url.rstrip('/')
+    headers = auth_headers('DESI_INSPECTOR_WARMUP')
+
+    def fetch(path):
+        request = urllib.request.Request(base_url + path, headers=headers)
+        try:
+            with urllib.request.urlopen(request, timeout=timeout) as response:
+                while response.read(1024*1024):
+                    pass
+                return response.status
+        except urllib.error.HTTPError as err:
+            return err.code
+
+    return fetch
+
+def _lower_priority(niceness):
+    """Lower the CPU and default I/O priority of the calling thread; Linux only"""
+    try:
+        os.setpriority(os.PRIO_PROCESS, threading.get_native_id(), niceness)
+    except (AttributeError, OSError):
+        pass
+
+def warm(fetch, keys, counts=None, seconds=WARMUP_SECONDS, duty=WARMUP_DUTY):
+    """
+    Replay keys in order with fetch(path) -> status within the time budget
+
+    Args:
+        fetch: function returning the HTTP status of requesting a path
+        keys: list of normalized query keys from rank_queries
+        counts: Counter of logged requests per key, for the coverage report
+        seconds: stop starting new queries after this many seconds
+        duty: fraction of time spent replaying; sleeps the rest
+
+    Returns report dict with the number of logged requests, the keys that
+    were warmed, failed, or skipped for lack of time, and the fraction of
+    logged requests whose key was warmed.
+    """
+    if counts is None:
+        counts = Counter()
+
+    t0 = time.time()
+    queries = list()
+    for key in keys:
+        if time.time() - t0 > seconds:
+            queries.append(dict(key=key, count=counts[key], status=None, seconds=0.0))
+            continue
+
+        t1 = time.time()
+        try:
+            status = fetch(replay_path(key))
+        except Exception as err:
+            print(f'WARNING: warm-up of {key} failed: {err}', file=sys.stderr)
+            status = 500
+        dt = time.time() - t1
+        queries.append(dict(key=key, count=counts[key], status=status, seconds=round(dt, 3)))
+
+        if 0 < duty < 1:
+            time.sleep(min(dt * (1 - duty) / duty, max(0, seconds - (time.time() - t0))))
+
+    nlogged = sum(counts.values())
+    warmed = [q for q in queries if q['status'] in (200, 304)]
+    nwarmed_requests = sum(q['count'] for q in warmed)
+    return dict(nlogged=nlogged, nunique=len(counts), nqueries=len(queries),
+                nwarmed=len(warmed),
+                nfailed=sum(q['status'] is not None and q['status'] not in (200, 304) for q in queries),
+                nskipped=sum(q['status'] is None for q in queries),
+                coverage=round(nwarmed_requests / nlogged, 4) if nlogged > 0 else None,
+                elapsed=round(time.time() - t0, 3), queries=queries)
+
+def _write_report(report, report_dir=REPORT_DIR):
+    try:
+        os.makedirs(report_dir, exist_ok=True)
+        filename = os.path.join(report_dir, f'{os.getpid()}.json')
+        with open(filename + '.tmp', 'w') as fp:
+            json.dump(report, fp)
+        os.replace(filename + '.tmp', filename)
+    except OSError as err:
+        print(f'WARNING: unable to write warm-up report: {err}', file=sys.stderr)
+
+def collect_reports(report_dir=REPORT_DIR):
+    """Return list of warm-up reports of live workers, removing those of workers that exited"""
+    reports = list()
+    if not os.path.isdir(report_dir):
+        return reports
+
+    for name in sorted(os.listdir(report_dir)):
+        stem = name[0:-5]
+        if not (name.endswith('.json') and stem.isdigit()):
+            continue
+        filename = os.path.join(report_dir, name)
+        if not _pid_alive(int(stem)):
+            try:
+                os.remove(filename)
+            except OSError:
+                pass
+            continue
+        try:
+            with open(filename) as fp:
+                reports.append(json.load(fp))
+        except (OSError, ValueError):
+            pass
+
+    return reports
+
+def run(wsgi_app, log_patterns=WARMUP_LOG, top=WARMUP_TOP, seconds=WARMUP_SECONDS, duty=WARMUP_DUTY):
+    """Rank logged and example queries, replay them through wsgi_app, and report; returns report dict"""
+    from inspector import fitscache, sharedread
+
+    #- processes started with fork or spawn inherit the priority of the thread
+    #- that starts them, and could be started here for the life of the worker
+    if sharedread.MP_START_METHOD == 'forkserver':
+        _lower_priority(WARMUP_NICE)
+    counts = parse_logs(log_patterns)
+    keys = rank_queries(counts, example_queries(), top=top)
+    report = warm(wsgi_fetcher(wsgi_app), keys, counts=counts, seconds=seconds, duty=duty)
+    report['pid'] = os.getpid()
+    report['fitscache'] = fitscache.get_pool().stats()
+
+    coverage = 'n/a' if report['coverage'] is None else f'{100*report["coverage"]:.1f}%'
+    print(f'Warm-up of worker {os.getpid()}: {report["nwarmed"]}/{report["nqueries"]} queries in '
+          f'{report["elapsed"]:.1f} sec ({report["nfailed"]} failed, {report["nskipped"]} skipped); '
+          f'coverage of {report["nlogged"]} logged requests {coverage}')
+    _write_report(report)
+    return report
+
+def start(wsgi_app, **kwargs):
+    """Run warm-up of wsgi_app in a background thread; kwargs are passed to run(); returns thread"""
+    from inspector import jobs, sharedread
+
+    #- start the forkserver and the long-lived pools, including their executor
+    #- threads, from this thread rather than the lower priority replay thread
+    sharedread.start_forkserver()
+    for pool in (sharedread._get_pool(), jobs._get_pool()):
+        pool.submit(os.getpid).result()
+
+    thread = threading.Thread(target=run, args=(wsgi_app,), kwargs=kwargs,
+                              name='inspector-warmup', daemon=True)
+    thread.start()
+    return thread
+
+def main():
+    parser = argparse.ArgumentParser(description='Rank popular Data Inspector queries from access logs')
+    parser.add_argument('logs', nargs='*', help='access log files or glob patterns')
+    parser.add_argument('--top', type=int, default=WARMUP_TOP, help='number of queries')
+    parser.add_argument('--no-examples', action='store_true', help="don't add the examples.html queries")
+    parser.add_argument('--url', help='replay the queries against the server at this URL')
+    parser.add_argument('--seconds', type=float, default=WARMUP_SECONDS, help='time budget for --url')
+    parser.add_argument('--duty', type=float, default=1.0, help='fraction of time spent replaying for --url')
+    args = parser.parse_args()
+
+    counts = parse_logs(args.logs)
+    examples = () if args.no_examples else example_queries()
+    keys = rank_queries(counts, examples, top=args.top)
+    if args.url is None:
+        for key in keys:
+            print(f'{counts[key]:8d}  {key}')
+        return
+
+    report = warm(url_fetcher(args.url), keys, counts=counts, seconds=args.seconds, duty=args.duty)
+    for q in report['queries']:
+        status = 'skipped' if q['status'] is None else q['status']
+        print(f'{q["count"]:8d}  {status!s:>7}  {q["seconds"]:7.2f}s  {q["key"]}')
+
+    coverage = 'n/a' if report['coverage'] is None else f'{100*report["coverage"]:.1f}%'
+    print(f'Warmed {report["nwarmed"]}/{report["nqueries"]} queries in {report["elapsed"]:.1f} sec; '
+          f'coverage of {report["nlogged"]} logged requests {coverage}')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,116 @@
+"""
+Test inspector.admission memory cost estimates and budgets
+"""
+
+import os
+import tempfile
+import threading
+import unittest
+
+import numpy as np
+from astropy.table import Table
+
+from inspector import admission
+from inspector.admission import estimate_cost, preview_size, MemoryBudget, AdmissionError, SpectraCost
+
+def _targets(nspec, nfiles):
+    t = Table()
+    t['TARGETID'] = np.arange(nspec)
+    t['HEALPIX'] = np.arange(nspec) % nfiles
+    t['SURVEY'] = 'main'
+    t['PROGRAM'] = 'dark'
+    return t
+
+class TestAdmission(unittest.TestCase):
+
+    def test_estimate_cost(self):
+        t = _targets(100, 10)
+        cost = estimate_cost(t, dict(return_redshifts=True), 'html')
+        self.assertEqual(cost.nspec, 100)
+        self.assertEqual(cost.nfiles, 10)
+        self.assertGreater(cost.peak_bytes, cost.bytes_read)
+        self.assertIn('100 spectra from 10 files', str(cost))
+
+        #- skipping RESOLUTION reads much less; models add a little
+        t = _targets(1000, 10)
+        cost = estimate_cost(t, dict(return_redshifts=True), 'html')
+        cost_bin = estimate_cost(t, dict(skip_hdus=('RESOLUTION',)), 'bin')
+        self.assertLess(cost_bin.bytes_read, cost.bytes_read/2)
+        cost_model = estimate_cost(t, dict(skip_hdus=('RESOLUTION',), return_models=True), 'bin')
+        self.assertGreater(cost_model.bytes_read, cost_bin.bytes_read)
+
+        #- more files cost more for the same number of spectra
+        self.assertGreater(estimate_cost(_targets(1000, 50)).bytes_read, cost.bytes_read)
+
+        #- progressive only holds a few files at a time
+        cost_prog = estimate_cost(t, dict(), 'progressive', nproc=2)
+        self.assertLess(cost_prog.peak_bytes, estimate_cost(t, dict(), 'bin').peak_bytes)
+
+        #- ... but is charged for the largest files, not the average
+        t = _targets(1000, 10)
+        t['HEALPIX'][0:900] = 0
+        cost_uneven = estimate_cost(t, dict(), 'progressive', nproc=2)
+        self.assertEqual(cost_uneven.nfiles, 10)
+        self.assertGreater(cost_uneven.peak_bytes, 4*cost_prog.peak_bytes)
+        self.assertEqual(estimate_cost(t, dict(), 'progressive', nproc=10).peak_bytes,
+                         estimate_cost(t, dict(), 'progressive', nproc=100).peak_bytes)
+
+    def test_tiles_files(self):
+        t = Table()
+        t['FIBER'] = [0, 1, 499, 500, 4999]
+        t['TILEID'] = 1000
+        t['LASTNIGHT'] = 20210101
+        self.assertEqual(admission.count_files(t), 3)
+        self.assertEqual(admission.count_files(t[0:0]), 0)
+
+    def test_preview_size(self):
+        t = _targets(200, 20)
+        one_mb = 1024**2
+        budget_mb = estimate_cost(t[0:50], format_type='html').peak_bytes // one_mb + 1
+        n = preview_size(t, format_type='html', budget_mb=budget_mb)
+        self.assertGreaterEqual(n, 50)
+        self.assertLess(n, 200)
+        self.assertLessEqual(estimate_cost(t[0:n], format_type='html').peak_bytes, budget_mb*one_mb)
+        self.assertEqual(preview_size(t, budget_mb=100000), 200)
+        self.assertEqual(preview_size(t, budget_mb=1), 0)
+
+    def test_worker_budget(self):
+        budget = MemoryBudget(worker_mb=100, global_mb=0)
+        cost = SpectraCost(10, 1, 10, 60*1024**2)
+        r1 = budget.try_reserve(cost)
+        self.assertIsNotNone(r1)
+        self.assertIsNone(budget.try_reserve(cost))
+        with self.assertRaises(AdmissionError) as cm:
+            budget.reserve(cost, timeout=0.2)
+        self.assertIsNotNone(cm.exception.retry_after)
+        self.assertIn('60 MB peak memory', str(cm.exception))
+
+        #- released memory is available to a waiting request
+        threading.Timer(0.2, r1.release).start()
+        with budget.reserve(cost, timeout=5):
+            self.assertEqual(budget.reserved, cost.peak_bytes)
+        self.assertEqual(budget.reserved, 0)
+
+        #- never fits
+        with self.assertRaises(AdmissionError) as cm:
+            budget.reserve(SpectraCost(10, 1, 10, 200*1024**2))
+        self.assertIsNone(cm.exception.retry_after)
+
+    def test_global_budget(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            ledger = os.path.join(tmpdir, 'ledger.json')
+            worker1 = MemoryBudget(worker_mb=0, global_mb=100, ledger_file=ledger)
+            worker2 = MemoryBudget(worker_mb=0, global_mb=100, ledger_file=ledger)
+            cost = SpectraCost(10, 1, 10, 60*1024**2)
+            r1 = worker1.try_reserve(cost)
+            self.assertIsNotNone(r1)
+            self.assertIsNone(worker2.try_reserve(cost))
+            r1.release()
+            r2 = worker2.try_reserve(cost)
+            self.assertIsNotNone(r2)
+            self.assertEqual(worker1.ledger.total(), cost.peak_bytes)
+            r2.release()
+            self.assertEqual(worker1.ledger.total(), 0)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,99 @@
+"""
+Test inspector.assets extraction of inline javascript/css
+"""
+
+import os
+import time
+import tempfile
+import unittest
+
+import inspector.assets as assets
+
+class TestAssets(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.orig_assets_dir = assets.ASSETS_DIR
+        assets.ASSETS_DIR = self.tmpdir.name
+        assets._stored.clear()
+
+    def tearDown(self):
+        assets.ASSETS_DIR = self.orig_assets_dir
+        assets._stored.clear()
+        self.tmpdir.cleanup()
+
+    def test_externalize(self):
+        library = 'var Bokeh = {};' + ' '*assets.ASSET_MIN_SIZE
+        css = '.bk {}' + ' '*assets.ASSET_MIN_SIZE
+        docs = '{"docs_json": 1}' + ' '*assets.ASSET_MIN_SIZE
+        html = (f'<html><head><script type="text/javascript">{library}</script>'
+                f'<style>{css}</style></head><body>'
+                f'<script type="application/json" id="1">{docs}</script>'
+                f'<script type="text/javascript">embed_items();</script></body></html>')
+
+        result = assets.externalize_assets(html, '/assets')
+        self.assertLess(len(result), len(html))
+        self.assertNotIn('var Bokeh', result)
+        self.assertNotIn('.bk {}', result)
+
+        #- per-page document and small scripts stay inline
+        self.assertIn(docs, result)
+        self.assertIn('embed_items();', result)
+
+        #- stored assets have the original content
+        names = sorted(os.listdir(self.tmpdir.name))
+        self.assertEqual(len(names), 2)
+        for name in names:
+            self.assertTrue(assets.valid_asset_name(name))
+            self.assertIn(f'/assets/{name}', result)
+            with open(os.path.join(self.tmpdir.name, name)) as fp:
+                self.assertIn(fp.read(), (library, css))
+
+        #- same libraries on another page map to the same assets
+        result2 = assets.externalize_assets(html.replace('embed_items', 'embed_other'), '/assets')
+        self.assertEqual(result2.replace('embed_other', 'embed_items'), result)
+        self.assertEqual(len(os.listdir(self.tmpdir.name)), 2)
+
+    def test_remove_stale(self):
+        old_time = time.time() - 2*assets.ASSET_KEEP_DAYS*24*3600
+        stale = assets.store_asset('var old = 1;', 'js')
+        used = assets.store_asset('var used = 1;', 'js')
+        for name in (stale, used):
+            os.utime(os.path.join(self.tmpdir.name, name), (old_time, old_time))
+
+        #- a new worker uses one of the old assets, then a new version is stored
+        assets._stored.clear()
+        assets.store_asset('var used = 1;', 'js')
+        new = assets.store_asset('var new = 1;', 'js')
+
+        self.assertEqual(sorted(os.listdir(self.tmpdir.name)), sorted([used, new]))
+        self.assertEqual(assets.remove_stale_assets(), [])
+
+    def test_touch_in_use(self):
+        #- a long-running worker keeps touching the assets it still uses
+        old_time = time.time() - 2*assets.ASSET_KEEP_DAYS*24*3600
+        used = assets.store_asset('var used = 1;', 'js')
+        filename = os.path.join(self.tmpdir.name, used)
+        os.utime(filename, (old_time, old_time))
+
+        assets.store_asset('var used = 1;', 'js')
+        self.assertEqual(os.stat(filename).st_mtime, old_time)
+
+        assets._stored[used] -= assets.ASSET_TOUCH_INTERVAL + 1
+        assets.store_asset('var used = 1;', 'js')
+        new = assets.store_asset('var new = 1;', 'js')
+        self.assertEqual(sorted(os.listdir(self.tmpdir.name)), sorted([used, new]))
+
+        #- an asset removed by another worker is stored again
+        os.remove(filename)
+        assets._stored[used] -= assets.ASSET_TOUCH_INTERVAL + 1
+        assets.store_asset('var used = 1;', 'js')
+        self.assertTrue(os.path.exists(filename))
+
+    def test_valid_asset_name(self):
+        self.assertTrue(assets.valid_asset_name('0123456789abcdef0123456789abcdef.js'))
+        self.assertFalse(assets.valid_asset_name('../../etc/passwd'))
+        self.assertFalse(assets.valid_asset_name('0123456789abcdef0123456789abcdef.py'))
+
+if __name__ == '__main__':
+    unittest.main()
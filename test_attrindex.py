@@ -0,0 +1,318 @@
+"""
+Test inspector.attrindex secondary indexes, using small fake redrock files
+"""
+
+import os
+import time
+import tempfile
+import unittest
+import threading
+
+import numpy as np
+import fitsio
+from astropy.table import Table, vstack
+
+from inspector import attrindex
+from inspector.io import filter_table
+
+SPECTYPES = ('GALAXY', 'QSO', 'STAR')
+
+def _write_redrock(filename, n, rng, bitcol='DESI_TARGET', header=None):
+    os.makedirs(os.path.dirname(filename), exist_ok=True)
+    targetid = rng.choice(10**6, n, replace=False)
+    zz = np.zeros(n, dtype=[('TARGETID', 'i8'), ('Z', 'f8'), ('ZWARN', 'i8'), ('SPECTYPE', 'S6')])
+    zz['TARGETID'] = targetid
+    zz['Z'] = rng.uniform(0, 4, n)
+    zz['Z'][0] = np.nan
+    zz['ZWARN'] = rng.choice([0, 0, 0, 4, 1024], n)
+    zz['SPECTYPE'] = rng.choice(SPECTYPES, n)
+    fm = np.zeros(n, dtype=[('TARGETID', 'i8'), ('TARGET_RA', 'f8'), ('TARGET_DEC', 'f8'),
+                            ('FIBER', 'i4'), (bitcol, 'i8')])
+    #- FIBERMAP in a different order than REDSHIFTS
+    fm['TARGETID'] = targetid[::-1]
+    fm['TARGET_RA'] = rng.uniform(0, 360, n)
+    fm['TARGET_DEC'] = rng.uniform(-10, 10, n)
+    fm['FIBER'] = np.arange(n)
+    fm[bitcol] = rng.integers(0, 2**10, n)
+    with fitsio.FITS(filename, 'rw', clobber=True) as fx:
+        fx.write(None, header=header)
+        fx.write(zz, extname='REDSHIFTS')
+        fx.write(fm, extname='FIBERMAP')
+
+def _read_redrock(filename):
+    zz = Table(fitsio.read(filename, 'REDSHIFTS'))
+    fm = Table(fitsio.read(filename, 'FIBERMAP'))
+    fm = fm[np.argsort(fm['TARGETID'])][np.argsort(np.argsort(zz['TARGETID']))]
+    for col in fm.colnames[1:]:
+        zz[col] = fm[col]
+    return zz
+
+class TestAttributeIndex(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.redux = os.path.join(self.tmpdir.name, 'redux')
+        self.index_dir = os.path.join(self.tmpdir.name, 'index')
+        self.orig_redux = os.getenv('DESI_SPECTRO_REDUX')
+        os.environ['DESI_SPECTRO_REDUX'] = self.redux
+        attrindex._indexes.clear()
+
+        rng = np.random.default_rng(0)
+        hpixdir = os.path.join(self.redux, 'test', 'healpix')
+        _write_redrock(os.path.join(hpixdir, 'main', 'dark', '100', '10000', 'redrock-main-dark-10000.fits'), 500, rng)
+        _write_redrock(os.path.join(hpixdir, 'main', 'bright', '100', '10001', 'redrock-main-bright-10001.fits'), 300, rng)
+        _write_redrock(os.path.join(hpixdir, 'sv1', 'dark', '100', '10000', 'redrock-sv1-dark-10000.fits'), 200, rng,
+                       bitcol='SV1_DESI_TARGET')
+        tiledir = os.path.join(self.redux, 'test', 'tiles', 'cumulative')
+        for petal in range(3):
+            #- older cumulative night is ignored
+            for night in (20210417, 20210418):
+                _write_redrock(os.path.join(tiledir, '1000', str(night), f'redrock-{petal}-1000-thru{night}.fits'),
+                               100, rng, header=dict(SURVEY='main', PROGRAM='dark'))
+
+    def tearDown(self):
+        if self.orig_redux is None:
+            del os.environ['DESI_SPECTRO_REDUX']
+        else:
+            os.environ['DESI_SPECTRO_REDUX'] = self.orig_redux
+        attrindex._indexes.clear()
+        self.tmpdir.cleanup()
+
+    def test_list_files(self):
+        files = attrindex.list_redrock_files('test', 'healpix')
+        self.assertEqual(len(files), 3)
+        self.assertEqual(files[0][1], dict(SURVEY='main', PROGRAM='bright', HEALPIX=10001))
+
+        files = attrindex.list_redrock_files('test', 'tiles')
+        self.assertEqual(len(files), 3)
+        self.assertEqual(files[2][1], dict(TILEID=1000, LASTNIGHT=20210418, PETAL_LOC=2))
+
+    def test_select(self):
+        """Index selections match filter_table on all rows"""
+        attrindex.build_index('test', 'healpix', index_dir=self.index_dir, nproc=1)
+        index = attrindex.get_index('test', 'healpix', index_dir=self.index_dir)
+        self.assertEqual(index.nrows, 1000)
+        self.assertEqual(index.columns['Z']['index'], 'sorted')
+        self.assertEqual(index.columns['SPECTYPE']['index'], 'bitmap')
+        self.assertEqual(index.columns['DESI_TARGET']['index'], 'bits')
+
+        files = attrindex.list_redrock_files('test', 'healpix')
+        tables = list()
+        for filename, keys in files:
+            tables.append(_read_redrock(filename))
+            tables[-1]['SURVEY'] = keys['SURVEY']
+        full = vstack(tables)
+        full['DESI_TARGET'] = full['DESI_TARGET'].filled(0)
+        full['SV1_DESI_TARGET'] = full['SV1_DESI_TARGET'].filled(0)
+
+        for filters in [
+                dict(SPECTYPE='QSO', Z=['gt:2.1', 'lt:2.2'], ZWARN='0'),
+                dict(Z='ge:3.5'), dict(Z='le:0.5', TARGET_RA='gt:100', TARGET_DEC='lt:0'),
+                dict(DESI_TARGET='bitand:5'), dict(SV1_DESI_TARGET='bitand:8', SPECTYPE='ne:GALAXY'),
+                dict(ZWARN='bitand:4'), dict(SURVEY='sv1', Z='lt:1'), dict(DESI_TARGET='gt:512'),
+                dict(TARGETID=str(full['TARGETID'][10])), dict(SPECTYPE='BLAT'), dict()]:
+            rows = index.select(filters)
+            expected = filter_table(full, filters)
+            self.assertEqual(list(index._array('TARGETID')[rows]), list(expected['TARGETID']), str(filters))
+
+        with self.assertRaises(ValueError):
+            index.select(dict(FLUX_R='gt:1'))    #- not indexed
+        with self.assertRaises(ValueError):
+            index.select(dict(Z='xx:1'))         #- bad operator
+        with self.assertRaises(ValueError):
+            index.select(dict(ZWARN='blat'))     #- bad value
+
+    def test_query(self):
+        attrindex.build_index('test', 'tiles', index_dir=self.index_dir, nproc=2)
+        filters = dict(SPECTYPE='QSO', DESI_TARGET='bitand:1')
+        t = attrindex.query('test', 'tiles', filters=filters, offset=0, limit=10, index_dir=self.index_dir)
+        self.assertEqual(len(t), 10)
+        self.assertEqual(t.meta['NEXT_OFFSET'], 10)
+        for col in attrindex.OUTPUT_COLUMNS['tiles'] + ('DESI_TARGET',):
+            self.assertIn(col, t.colnames)
+        self.assertTrue(np.all(t['SPECTYPE'] == 'QSO'))
+        self.assertTrue(np.all(t['SURVEY'] == 'main'))
+        self.assertTrue(np.all(t['LASTNIGHT'] == 20210418))
+
+        #- pages cover all matches without repeats
+        nmatch = t.meta['NMATCH']
+        targetids = list()
+        offset = 0
+        while offset < nmatch:
+            t = attrindex.query('test', 'tiles', filters=filters, offset=offset, limit=7, index_dir=self.index_dir)
+            targetids.extend(t['TARGETID'])
+            offset = t.meta.get('NEXT_OFFSET', nmatch)
+        self.assertEqual(len(targetids), nmatch)
+        self.assertEqual(len(set(targetids)), nmatch)
+
+        with self.assertRaises(ValueError):
+            attrindex.query('test', 'tiles', limit=attrindex.MAX_QUERY_LIMIT+1, index_dir=self.index_dir)
+        with self.assertRaises(ValueError):
+            attrindex.query('test', 'tiles', offset=-1, index_dir=self.index_dir)
+
+    def test_autobuild(self):
+        #- built on first use for small productions
+        index = attrindex.get_index('test', 'healpix', index_dir=self.index_dir)
+        self.assertEqual(index.nrows, 1000)
+
+        orig = attrindex.AUTOBUILD_MAX_FILES
+        try:
+            attrindex.AUTOBUILD_MAX_FILES = 2
+            with self.assertRaises(attrindex.IndexNotBuiltError):
+                attrindex.get_index('test', 'tiles', index_dir=self.index_dir)
+        finally:
+            attrindex.AUTOBUILD_MAX_FILES = orig
+
+        with self.assertRaises(ValueError):
+            attrindex.get_index('nosuchprod', 'tiles', index_dir=self.index_dir)
+
+    def test_autobuild_once(self):
+        #- concurrent first queries wait for a single build, without blocking queries of other indexes
+        attrindex.build_index('test', 'tiles', index_dir=self.index_dir, nproc=1)
+        orig_build_index = attrindex.build_index
+        builds = list()
+        building, other_query = threading.Event(), threading.Event()
+        def build_index(*args, **kwargs):
+            building.set()
+            builds.append(other_query.wait(timeout=5))
+            time.sleep(0.2)
+            return orig_build_index(*args, **kwargs)
+
+        results, errors = list(), list()
+        def worker():
+            try:
+                results.append(attrindex.get_index('test', 'healpix', index_dir=self.index_dir).nrows)
+            except Exception as err:
+                errors.append(err)
+
+        try:
+            attrindex.build_index = build_index
+            threads = [threading.Thread(target=worker) for i in range(4)]
+            for t in threads:
+                t.start()
+            self.assertTrue(building.wait(timeout=5))
+            self.assertEqual(attrindex.get_index('test', 'tiles', index_dir=self.index_dir).nrows, 300)
+            other_query.set()
+            for t in threads:
+                t.join()
+        finally:
+            attrindex.build_index = orig_build_index
+
+        self.assertEqual(errors, [])
+        self.assertEqual(results, [1000]*4)
+        self.assertEqual(builds, [True])
+
+    def _assert_same_index(self, path1, path2):
+        index1, index2 = attrindex.AttributeIndex(path1), attrindex.AttributeIndex(path2)
+        self.assertEqual(index1.nrows, index2.nrows)
+        self.assertEqual(index1.columns, index2.columns)
+        self.assertEqual([(e['filename'], e['offset'], e['nrows']) for e in index1.meta['files']],
+                         [(e['filename'], e['offset'], e['nrows']) for e in index2.meta['files']])
+        for name in index1.columns:
+            values1, values2 = index1._array(name), index2._array(name)
+            equal_nan = values1.dtype.kind == 'f'
+            self.assertTrue(np.array_equal(values1, values2, equal_nan=equal_nan), name)
+
+    def test_update(self):
+        for specgroup in ('healpix', 'tiles'):
+            attrindex.build_index('test', specgroup, index_dir=self.index_dir, nproc=1)
+            changes = attrindex.update_index('test', specgroup, index_dir=self.index_dir, nproc=1)
+            self.assertEqual(changes, dict(added=[], changed=[], removed=[]))
+
+        #- rewrite one healpix file, add another, and remove a third
+        rng = np.random.default_rng(1)
+        hpixdir = os.path.join(self.redux, 'test', 'healpix')
+        _write_redrock(os.path.join(hpixdir, 'main', 'dark', '100', '10000', 'redrock-main-dark-10000.fits'), 50, rng)
+        _write_redrock(os.path.join(hpixdir, 'main', 'dark', '100', '10002', 'redrock-main-dark-10002.fits'), 70, rng,
+                       bitcol='SV3_DESI_TARGET')
+        os.remove(os.path.join(hpixdir, 'sv1', 'dark', '100', '10000', 'redrock-sv1-dark-10000.fits'))
+
+        #- a new night for the existing tile, and a new tile
+        tiledir = os.path.join(self.redux, 'test', 'tiles', 'cumulative')
+        for petal in range(3):
+            _write_redrock(os.path.join(tiledir, '1000', '20210420', f'redrock-{petal}-1000-thru20210420.fits'),
+                           80, rng, header=dict(SURVEY='main', PROGRAM='dark'))
+        _write_redrock(os.path.join(tiledir, '1001', '20210420', 'redrock-5-1001-thru20210420.fits'),
+                       60, rng, header=dict(SURVEY='special', PROGRAM='backup'))
+
+        orig_read_file = attrindex._read_file
+        read = list()
+        def read_file(filename):
+            read.append(os.path.basename(filename))
+            return orig_read_file(filename)
+
+        try:
+            attrindex._read_file = read_file
+            index = attrindex.get_index('test', 'healpix', index_dir=self.index_dir)
+            changes = attrindex.update_index('test', 'healpix', index_dir=self.index_dir, nproc=1)
+            self.assertEqual(changes, dict(added=['healpix/main/dark/100/10002/redrock-main-dark-10002.fits'],
+                                           changed=['healpix/main/dark/100/10000/redrock-main-dark-10000.fits'],
+                                           removed=['healpix/sv1/dark/100/10000/redrock-sv1-dark-10000.fits']))
+            self.assertEqual(sorted(read), ['redrock-main-dark-10000.fits', 'redrock-main-dark-10002.fits'])
+
+            del read[:]
+            changes = attrindex.update_index('test', 'tiles', index_dir=self.index_dir, nproc=1)
+            self.assertEqual(len(changes['added']), 4)
+            self.assertEqual(len(changes['removed']), 3)
+            self.assertEqual(len(read), 4)
+        finally:
+            attrindex._read_file = orig_read_file
+
+        #- workers reload the updated index, which matches a full rebuild
+        self.assertIsNot(attrindex.get_index('test', 'healpix', index_dir=self.index_dir), index)
+        full_dir = os.path.join(self.tmpdir.name, 'full')
+        for specgroup in ('healpix', 'tiles'):
+            attrindex.build_index('test', specgroup, index_dir=full_dir, nproc=1)
+            self._assert_same_index(os.path.join(self.index_dir, f'test-{specgroup}'),
+                                    os.path.join(full_dir, f'test-{specgroup}'))
+
+        t = attrindex.query('test', 'tiles', filters=dict(SURVEY='special'), index_dir=self.index_dir)
+        self.assertEqual(len(t), 60)
+        self.assertTrue(np.all(t['LASTNIGHT'] == 20210420))
+
+    def test_update_while_open(self):
+        attrindex.build_index('test', 'healpix', index_dir=self.index_dir, nproc=1)
+        path = os.path.join(self.index_dir, 'test-healpix')
+        index = attrindex.AttributeIndex(path)
+        self.assertEqual(len(index._array('TARGETID')), 1000)
+
+        rng = np.random.default_rng(1)
+        hpixdir = os.path.join(self.redux, 'test', 'healpix')
+        _write_redrock(os.path.join(hpixdir, 'main', 'dark', '100', '10000', 'redrock-main-dark-10000.fits'), 800, rng)
+        attrindex.update_index('test', 'healpix', index_dir=self.index_dir, nproc=1)
+
+        #- the open index keeps reading its own version, including columns not yet loaded
+        self.assertTrue(os.path.islink(path))
+        self.assertNotEqual(os.path.realpath(path), index.path)
+        self.assertEqual(index.nrows, 1000)
+        for name in ('Z', 'SPECTYPE'):
+            self.assertEqual(len(index._array(name)), 1000)
+        self.assertEqual(len(index._array('Z', 'order')), 1000)
+        rows = index.select(dict(ZWARN='0', Z='gt:1'))
+        self.assertTrue(np.all(index._array('Z')[rows] > 1))
+        self.assertTrue(np.all(index._array('ZWARN')[rows] == 0))
+        self.assertEqual(attrindex.AttributeIndex(path).nrows, 1300)
+
+        #- the old version is removed once unused for INDEX_KEEP_OLD
+        attrindex._remove_old_versions('test', 'healpix', self.index_dir)
+        self.assertTrue(os.path.exists(index.path))
+        attrindex._remove_old_versions('test', 'healpix', self.index_dir, keep=-1)
+        self.assertFalse(os.path.exists(index.path))
+        self.assertEqual(attrindex.AttributeIndex(path).nrows, 1300)
+
+    def test_unversioned_index(self):
+        #- an index directory from before version directories is replaced by a symlink
+        attrindex.build_index('test', 'healpix', index_dir=self.index_dir, nproc=1)
+        path = os.path.join(self.index_dir, 'test-healpix')
+        version = os.path.realpath(path)
+        os.remove(path)
+        os.rename(version, path)
+
+        attrindex.build_index('test', 'healpix', index_dir=self.index_dir, nproc=1)
+        self.assertTrue(os.path.islink(path))
+        self.assertEqual(attrindex.AttributeIndex(path).nrows, 1000)
+        attrindex._remove_old_versions('test', 'healpix', self.index_dir, keep=-1)
+        self.assertEqual(len(os.listdir(self.index_dir)), 2)
+
+if __name__ == '__main__':
+    unittest.main()
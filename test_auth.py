@@ -0,0 +1,102 @@
+"""
+Test inspector.auth credential handling that doesn't need the webapp
+"""
+
+import os
+import time
+import tempfile
+import hashlib
+import unittest
+from unittest import mock
+
+class TestAuth(unittest.TestCase):
+
+    def test_hash_password(self):
+        from inspector.auth import hash_password, verify_password
+        hashed = hash_password('foo', iterations=1000)
+        self.assertTrue(hashed.startswith('pbkdf2_sha256$1000$'))
+        self.assertTrue(verify_password('foo', hashed))
+        self.assertFalse(verify_password('bar', hashed))
+
+        #- salted, so the same password gives different hashes
+        self.assertNotEqual(hashed, hash_password('foo', iterations=1000))
+
+        #- malformed hashes never verify
+        self.assertFalse(verify_password('foo', 'blat'))
+        self.assertFalse(verify_password('foo', hashed.replace('pbkdf2_sha256', 'md5')))
+
+    def test_credentials_file(self):
+        from inspector.auth import CredentialStore, hash_password
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            filename = os.path.join(tmpdir, 'credentials')
+            with open(filename, 'w') as fp:
+                fp.write('# comment line\n')
+                fp.write(f"blat:{hash_password('foo', iterations=1000)}\n")
+
+            store = CredentialStore(filename)
+            self.assertTrue(store.check('blat', 'foo'))
+            self.assertTrue(store.check('blat', 'foo'))   # cached
+            self.assertFalse(store.check('blat', 'bar'))
+            self.assertFalse(store.check('biz', 'foo'))
+            self.assertFalse(store.check(None, None))
+
+            #- rotate password; picked up without explicit reload
+            with open(filename, 'w') as fp:
+                fp.write(f"blat:{hash_password('bar', iterations=1000)}\n")
+            os.utime(filename, (time.time()+10, time.time()+10))
+            store._last_check = 0
+            self.assertFalse(store.check('blat', 'foo'))
+            self.assertTrue(store.check('blat', 'bar'))
+
+    def test_malformed_lines(self):
+        from inspector.auth import CredentialStore, hash_password
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            filename = os.path.join(tmpdir, 'credentials')
+            with open(filename, 'w') as fp:
+                fp.write('no colon on this line\n')
+                fp.write(':nousername\n')
+                fp.write(f"blat:{hash_password('foo', iterations=1000)}\n")
+
+            store = CredentialStore(filename)
+            self.assertTrue(store.check('blat', 'foo'))
+
+            #- an unreadable file on reload keeps the previous credentials
+            with open(filename, 'wb') as fp:
+                fp.write(b'\xff\xfe bad bytes\n')
+            os.utime(filename, (time.time()+10, time.time()+10))
+            store._last_check = 0
+            self.assertTrue(store.check('blat', 'foo'))
+            self.assertFalse(store.check('blat', 'bar'))
+
+    def test_unknown_user_cost(self):
+        from inspector import auth
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            filename = os.path.join(tmpdir, 'credentials')
+            with open(filename, 'w') as fp:
+                fp.write(f"blat:{auth.hash_password('foo')}\n")
+
+            store = auth.CredentialStore(filename)
+            iterations = list()
+            orig = hashlib.pbkdf2_hmac
+            def pbkdf2_hmac(name, password, salt, n):
+                iterations.append(n)
+                return orig(name, password, salt, n)
+
+            with mock.patch.object(auth.hashlib, 'pbkdf2_hmac', pbkdf2_hmac):
+                self.assertFalse(store.check('blat', 'bar'))
+                self.assertFalse(store.check('biz', 'bar'))
+
+            self.assertEqual(iterations, [auth.PBKDF2_ITERATIONS, auth.PBKDF2_ITERATIONS])
+
+        #- without hashed credentials there is nothing to hide, so no hashing at all
+        store = auth.CredentialStore(None)
+        iterations.clear()
+        with mock.patch.object(auth.hashlib, 'pbkdf2_hmac', pbkdf2_hmac):
+            self.assertFalse(store.check('biz', 'bar'))
+        self.assertEqual(iterations, [])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,49 @@
+"""
+Test the synthetic production and benchmark helpers, which don't need $DESI_ROOT
+"""
+
+import unittest
+import numpy as np
+
+class TestBenchmark(unittest.TestCase):
+
+    def test_make_targets(self):
+        from inspector.synthetic import make_targets, FIBERS_PER_PETAL
+        targets, obs = make_targets(1000, frac_repeat=0.1)
+        self.assertEqual(len(targets), 1000)
+        self.assertEqual(len(np.unique(targets['TARGETID'])), 1000)
+        self.assertEqual(len(obs), 1100)
+
+        #- every observation has a unique fiber on its tile, consistent with PETAL_LOC
+        tilefiber = obs['TILEID'].astype(np.int64)*10000 + obs['FIBER']
+        self.assertEqual(len(np.unique(tilefiber)), len(obs))
+        self.assertTrue(np.all(obs['PETAL_LOC'] == obs['FIBER']//FIBERS_PER_PETAL))
+
+        #- repeat observations are on a different tile
+        tids, counts = np.unique(obs['TARGETID'], return_counts=True)
+        self.assertEqual(np.sum(counts == 2), 100)
+        for tid in tids[counts == 2]:
+            self.assertEqual(len(np.unique(obs['TILEID'][obs['TARGETID'] == tid])), 2)
+
+    def test_radius_for_size(self):
+        from inspector.synthetic import make_targets
+        from inspector.benchmark import radius_for_size
+        targets, obs = make_targets(500)
+        for n in (1, 10, 100):
+            radius = radius_for_size(targets, n)
+            self.assertLess(radius, 1800)
+            self.assertLess(radius_for_size(targets, n), radius_for_size(targets, n+1))
+
+    def test_compare(self):
+        from inspector.benchmark import compare
+        baseline = [dict(name='a', specgroup='healpix', size=1, median=1.0),
+                    dict(name='b', specgroup='healpix', size=1, median=1.0)]
+        results = [dict(name='a', specgroup='healpix', size=1, median=1.1),
+                   dict(name='b', specgroup='healpix', size=1, median=2.0),
+                   dict(name='c', specgroup='healpix', size=1, median=9.0)]
+        regressions = compare(results, baseline, tolerance=1.25)
+        self.assertEqual(len(regressions), 1)
+        self.assertEqual(regressions[0][0]['name'], 'b')
+
+if __name__ == '__main__':
+    unittest.main()
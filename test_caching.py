@@ -0,0 +1,91 @@
+"""
+Test inspector.caching Cache-Control headers, which don't need $DESI_ROOT
+"""
+
+import unittest
+
+from flask import Flask, Response
+
+from inspector import caching
+from inspector.caching import http_cache
+
+class TestCaching(unittest.TestCase):
+
+    def setUp(self):
+        self.immutable = caching.IMMUTABLE_SPECPRODS
+        caching.IMMUTABLE_SPECPRODS = frozenset(('fuji', 'iron', 'loa'))
+        #- production directories aren't needed for these headers
+        caching._production_mtimes.update(fuji=None, iron=None, loa=None)
+
+        app = Flask(__name__)
+
+        @app.route('/<string:specprod>/targets/<string:targetids>')
+        @http_cache
+        def targets(specprod, targetids):
+            return targetids
+
+        @app.route('/compare/<string:specprods>/targets/<string:targetids>')
+        @http_cache
+        def compare_targets(specprods, targetids):
+            return targetids
+
+        @app.route('/<string:specprod>/spectra/<string:targetids>')
+        @http_cache
+        def spectra(specprod, targetids):
+            response = Response(iter(['<html>', 'loadError()', '</html>']))
+            response.cache_control.no_store = True
+            return response
+
+        self.app = app.test_client()
+
+    def tearDown(self):
+        caching.IMMUTABLE_SPECPRODS = self.immutable
+        caching._production_mtimes.clear()
+
+    def test_public(self):
+        response = self.app.get('/dr1/targets/1,2')
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('public', response.headers['Cache-Control'])
+        self.assertIn('max-age', response.headers['Cache-Control'])
+
+    def test_protected(self):
+        #- immutable but not public: revalidated with ETags, never stored by shared caches
+        for url in ('/loa/targets/1,2', '/dr2/targets/1,2', '/compare/iron,loa/targets/1,2'):
+            response = self.app.get(url)
+            self.assertIn('private', response.headers['Cache-Control'], url)
+            self.assertNotIn('public', response.headers['Cache-Control'], url)
+
+            etag = response.headers['ETag']
+            response = self.app.get(url, headers={'If-None-Match': etag})
+            self.assertEqual(response.status_code, 304)
+            self.assertIn('private', response.headers['Cache-Control'], url)
+
+    def test_vary(self):
+        #- only csv/ascii depend on the User-Agent; 304s vary like the 200s they validate
+        from inspector.compression import compress_response
+        self.app.application.after_request(compress_response)
+        for fmt, vary_agent in (('html', False), ('json', False), ('csv', True), ('ascii', True)):
+            url = f'/dr1/targets/1,2?format={fmt}'
+            response = self.app.get(url)
+            self.assertEqual('User-Agent' in response.vary, vary_agent, fmt)
+
+            response304 = self.app.get(url, headers={'If-None-Match': response.headers['ETag']})
+            self.assertEqual(response304.status_code, 304)
+            self.assertEqual(set(response304.vary), set(response.vary), fmt)
+            self.assertIn('Accept-Encoding', response304.vary)
+
+    def test_no_store(self):
+        #- streamed pages marked no-store keep it even for public immutable productions
+        response = self.app.get('/dr1/spectra/1,2')
+        self.assertEqual(response.status_code, 200)
+        self.assertNotIn('ETag', response.headers)
+        self.assertIn('no-store', response.headers['Cache-Control'])
+        self.assertNotIn('public', response.headers['Cache-Control'])
+
+    def test_mutable(self):
+        response = self.app.get('/daily/targets/1,2')
+        self.assertNotIn('ETag', response.headers)
+        self.assertIn('no-cache', response.headers['Cache-Control'])
+
+if __name__ == '__main__':
+    unittest.main()
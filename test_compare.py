@@ -0,0 +1,104 @@
+"""
+Test inspector.compare joins of targets across productions
+"""
+
+import time
+import unittest
+
+import numpy as np
+from astropy.table import Table
+
+from inspector import compare
+
+def _targets(targetids, z, survey='main'):
+    t = Table()
+    t['TARGETID'] = np.asarray(targetids, dtype=np.int64)
+    t['SURVEY'] = survey
+    t['PROGRAM'] = 'dark'
+    t['HEALPIX'] = 100
+    t['TARGET_RA'] = 210.0 + t['TARGETID'] / 1000
+    t['TARGET_DEC'] = 5.0
+    t['Z'] = np.asarray(z, dtype=np.float64)
+    t['ZWARN'] = 0
+    t['SPECTYPE'] = 'GALAXY'
+    t.meta['SPECPROD'] = 'blat'
+    return t
+
+class TestCompare(unittest.TestCase):
+
+    def test_parse_specprods(self):
+        self.assertEqual(compare.parse_specprods('dr1,loa'), ['iron', 'loa'])
+        self.assertEqual(compare.parse_specprods(['iron', 'dr1', ' loa']), ['iron', 'loa'])
+
+        for specprods in ('iron', 'iron,dr1', 'a,b,c,d,e'):
+            with self.assertRaises(ValueError):
+                compare.parse_specprods(specprods)
+
+    def test_join_targets(self):
+        tables = dict(iron=_targets([1, 2, 3], [0.1, 0.2, 0.3]),
+                      loa=_targets([2, 3, 4], [0.25, 0.3, 0.4]))
+        t = compare.join_targets(tables, 'healpix')
+
+        self.assertEqual(list(t['TARGETID']), [1, 2, 3, 4])
+        for col in ('Z', 'ZWARN', 'SPECTYPE'):
+            self.assertNotIn(col, t.colnames)
+            self.assertIn(col + '_IRON', t.colnames)
+            self.assertIn(col + '_LOA', t.colnames)
+
+        #- positions are shared, so they are known even for targets missing from a production
+        self.assertNotIn('TARGET_RA_IRON', t.colnames)
+        self.assertTrue(np.allclose(t['TARGET_RA'], 210.0 + np.arange(1, 5) / 1000))
+
+        #- targets missing from a production are masked
+        self.assertEqual(list(np.ma.getmaskarray(t['Z_IRON'])), [False, False, False, True])
+        self.assertEqual(list(np.ma.getmaskarray(t['Z_LOA'])), [True, False, False, False])
+        self.assertAlmostEqual(t['Z_LOA'][1], 0.25)
+
+        #- the same TARGETID in a different survey is a different spectrum
+        tables['loa'] = _targets([1, 2], [0.1, 0.2], survey='sv3')
+        t = compare.join_targets(tables, 'healpix')
+        self.assertEqual(len(t), 5)
+        t = compare.join_targets(tables, 'healpix', keys=['TARGETID',])
+        self.assertEqual(len(t), 3)
+        self.assertIn('SURVEY_LOA', t.colnames)
+
+    def test_split_targets(self):
+        tables = dict(iron=_targets([1, 2, 3], [0.1, 0.2, 0.3]),
+                      loa=_targets([2, 3, 4], [0.25, 0.3, 0.4]))
+        t = compare.join_targets(tables, 'healpix')
+        targetcats = compare.split_targets(t, 'healpix', ['iron', 'loa'])
+
+        for specprod, original in tables.items():
+            targets = targetcats[specprod]
+            self.assertEqual(list(targets['TARGETID']), list(original['TARGETID']))
+            self.assertTrue(np.allclose(targets['Z'], original['Z']))
+            self.assertIn('HEALPIX', targets.colnames)
+            self.assertNotIn('Z_IRON', targets.colnames)
+
+    def test_iter_compare_spectra(self):
+        import inspector.io
+
+        produced = dict(iron=0, loa=0)
+        def iter_spectra(targetcat, specprod, rdspec_kwargs=None):
+            for i in range(10):
+                produced[specprod] += 1
+                yield i
+
+        tables = dict(iron=_targets([1, 2], [0.1, 0.2]), loa=_targets([3, 4], [0.3, 0.4]))
+        original = inspector.io.iter_spectra
+        inspector.io.iter_spectra = iter_spectra
+        try:
+            results = compare.iter_compare_spectra(tables)
+            first = [next(results) for i in range(3)]
+            time.sleep(0.3)
+            #- readers wait for the caller instead of queueing every file
+            self.assertLessEqual(sum(produced.values()), len(first) + 2*len(tables))
+            rest = list(results)
+        finally:
+            inspector.io.iter_spectra = original
+
+        self.assertEqual(len(first) + len(rest), 20)
+        self.assertEqual(produced, dict(iron=10, loa=10))
+
+if __name__ == '__main__':
+    unittest.main()
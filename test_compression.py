@@ -0,0 +1,84 @@
+"""
+Test inspector.compression with a minimal Flask app
+"""
+
+import gzip
+import unittest
+from flask import Flask, Response
+
+from inspector.compression import compress_response, compress_chunks, zstandard
+
+def make_app():
+    app = Flask(__name__)
+    app.after_request(compress_response)
+    text = 'DESI '*1000
+
+    @app.route('/text')
+    def text_page():
+        return text
+
+    @app.route('/small')
+    def small_page():
+        return 'tiny'
+
+    @app.route('/fits')
+    def fits_page():
+        return Response(text.encode(), mimetype='application/fits')
+
+    @app.route('/stream')
+    def stream_page():
+        return Response((f'chunk {i}\n'*100 for i in range(10)), mimetype='text/html')
+
+    return app, text
+
+class TestCompression(unittest.TestCase):
+
+    def setUp(self):
+        self.app, self.text = make_app()
+        self.client = self.app.test_client()
+
+    def test_gzip(self):
+        response = self.client.get('/text', headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual(response.headers['Content-Encoding'], 'gzip')
+        self.assertIn('Accept-Encoding', response.headers['Vary'])
+        self.assertLess(len(response.data), len(self.text))
+        self.assertEqual(gzip.decompress(response.data).decode(), self.text)
+
+    @unittest.skipIf(zstandard is None, 'zstandard not installed')
+    def test_zstd(self):
+        response = self.client.get('/text', headers={'Accept-Encoding': 'gzip, zstd'})
+        self.assertEqual(response.headers['Content-Encoding'], 'zstd')
+        data = zstandard.ZstdDecompressor().decompressobj().decompress(response.data)
+        self.assertEqual(data.decode(), self.text)
+
+    def test_not_accepted(self):
+        for headers in ({}, {'Accept-Encoding': 'identity'}, {'Accept-Encoding': 'gzip;q=0'}):
+            response = self.client.get('/text', headers=headers)
+            self.assertNotIn('Content-Encoding', response.headers)
+            self.assertEqual(response.get_data(as_text=True), self.text)
+
+    def test_threshold(self):
+        response = self.client.get('/small', headers={'Accept-Encoding': 'gzip'})
+        self.assertNotIn('Content-Encoding', response.headers)
+
+    def test_fits_only_if_asked(self):
+        response = self.client.get('/fits', headers={'Accept-Encoding': 'gzip'})
+        self.assertNotIn('Content-Encoding', response.headers)
+
+        response = self.client.get('/fits?compress=1', headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual(response.headers['Content-Encoding'], 'gzip')
+        self.assertEqual(gzip.decompress(response.data).decode(), self.text)
+
+    def test_streamed(self):
+        response = self.client.get('/stream', headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual(response.headers['Content-Encoding'], 'gzip')
+        expected = ''.join(f'chunk {i}\n'*100 for i in range(10))
+        self.assertEqual(gzip.decompress(response.data).decode(), expected)
+
+    def test_compress_chunks(self):
+        chunks = [b'abc'*100, 'def'*100]
+        data = b''.join(compress_chunks(chunks, 'gzip', flush_each=True))
+        self.assertEqual(gzip.decompress(data), b'abc'*100 + b'def'*100)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,165 @@
+"""
+Test inspector.crossmatch position parsing, grouping, and matching
+"""
+
+import io
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+import numpy as np
+import fitsio
+from astropy.table import Table
+
+from inspector import crossmatch, schema
+from inspector.crossmatch import read_positions, group_positions, match_positions
+
+def _separation(ra1, dec1, ra2, dec2):
+    """Angular separation in arcsec, brute force"""
+    ra1, dec1, ra2, dec2 = map(np.radians, (ra1, dec1, ra2, dec2))
+    #- haversine, accurate for small separations
+    h = np.sin((dec2-dec1)/2)**2 + np.cos(dec1)*np.cos(dec2)*np.sin((ra2-ra1)/2)**2
+    return np.degrees(2*np.arcsin(np.sqrt(np.clip(h, 0, 1))))*3600
+
+class TestCrossmatch(unittest.TestCase):
+
+    def test_read_positions(self):
+        csv = b'ra,dec,radius\n10.0,20.0,2.0\n359.9,-5.0,1.5\n'
+        t = read_positions(csv)
+        self.assertEqual(t.colnames, ['RA', 'DEC', 'RADIUS'])
+        self.assertEqual(list(t['RADIUS']), [2.0, 1.5])
+
+        t = read_positions(b'TARGET_RA,TARGET_DEC\n10,20\n', default_radius=3)
+        self.assertEqual(list(t['RADIUS']), [3.0])
+
+        buffer = io.BytesIO()
+        Table(dict(RA=[1.0, 2.0], DEC=[3.0, 4.0])).write(buffer, format='fits')
+        t = read_positions(buffer.getvalue())
+        self.assertEqual(list(t['DEC']), [3.0, 4.0])
+
+        with self.assertRaises(ValueError):
+            read_positions(b'')
+        with self.assertRaises(ValueError):
+            read_positions(b'x,y\n1,2\n')                 #- no RA,DEC columns
+        with self.assertRaises(ValueError):
+            read_positions(b'ra,dec\n10,100\n')           #- dec>90
+        with self.assertRaises(ValueError):
+            read_positions(b'ra,dec,radius\n10,10,600\n') #- radius too big
+
+        header = b'ra,dec\n'
+        rows = b'1,2\n' * (crossmatch.MAX_POSITIONS + 1)
+        with self.assertRaises(ValueError):
+            read_positions(header + rows)
+
+    def test_group_positions(self):
+        rng = np.random.default_rng(0)
+        n = 2000
+        ra = rng.uniform(0, 360, n)
+        dec = np.degrees(np.arcsin(rng.uniform(-1, 1, n)))
+        ra[0:100] = rng.uniform(359.99, 360, 100) % 360   #- wrap around RA=0
+        radius = rng.uniform(1, 10, n)
+
+        groups = group_positions(ra, dec, radius)
+        indices = np.concatenate([g[0] for g in groups])
+        self.assertEqual(sorted(indices.tolist()), list(range(n)))
+        for indices, ra_center, dec_center, cone_radius in groups:
+            sep = _separation(ra[indices], dec[indices], ra_center, dec_center)
+            self.assertTrue(np.all(sep + radius[indices] <= cone_radius + 1e-6))
+
+    def test_match_positions(self):
+        rng = np.random.default_rng(1)
+        ra2 = rng.uniform(10, 10.1, 3000)
+        dec2 = rng.uniform(-0.05, 0.05, 3000)
+        ra1 = np.concatenate([ra2[0:500] + 1/3600, rng.uniform(10, 10.1, 100)])
+        dec1 = np.concatenate([dec2[0:500], rng.uniform(-0.05, 0.05, 100)])
+        radius1 = rng.uniform(0.5, 10, len(ra1))
+
+        idx1, idx2, sep = match_positions(ra1, dec1, radius1, ra2, dec2)
+
+        expected = set()
+        for i in range(len(ra1)):
+            s = _separation(ra1[i], dec1[i], ra2, dec2)
+            expected.update((i, j) for j in np.where(s <= radius1[i])[0])
+        self.assertEqual(set(zip(idx1.tolist(), idx2.tolist())), expected)
+        self.assertTrue(np.allclose(sep, _separation(ra1[idx1], dec1[idx1], ra2[idx2], dec2[idx2]), atol=1e-6))
+
+        #- sorted by input row, then separation
+        order = np.lexsort((sep, idx1))
+        self.assertTrue(np.all(order == np.arange(len(idx1))))
+
+        idx1, idx2, sep = match_positions(ra1, dec1, radius1, [], [])
+        self.assertEqual(len(idx1), 0)
+
+    def test_crossmatch_no_matches(self):
+        positions = read_positions(b'ra,dec\n10,20\n30,40\n')
+        def cone_search(specprod, specgroup, ra, dec, radius):
+            return Table(dict(TARGETID=[1], TARGET_RA=[50.0], TARGET_DEC=[50.0]))
+
+        #- a production without redrock files has no schema; don't look for one under $DESI_ROOT
+        with mock.patch.object(schema, 'get_schema', return_value=None):
+            t = crossmatch.crossmatch(positions, 'nosuchprod', 'healpix', cone_search=cone_search)
+        self.assertEqual(len(t), 0)
+        for col in ('INPUT_ROW', 'INPUT_RA', 'INPUT_DEC', 'SEPARATION', 'TARGETID'):
+            self.assertIn(col, t.colnames)
+        self.assertEqual(t.meta['SPECPROD'], 'nosuchprod')
+
+    def test_crossmatch_lookups(self):
+        #- an all-sky catalog needs at most one inventory search per inventory pixel
+        rng = np.random.default_rng(2)
+        n = crossmatch.MAX_POSITIONS
+        ra = rng.uniform(0, 360, n)
+        dec = np.degrees(np.arcsin(rng.uniform(-1, 1, n)))
+        positions = Table(dict(RA=ra, DEC=dec, RADIUS=np.ones(n)))
+
+        searches = list()
+        def cone_search(specprod, specgroup, ra_center, dec_center, radius):
+            searches.append(radius)
+            return Table(dict(TARGETID=[1], TARGET_RA=[ra_center], TARGET_DEC=[np.clip(dec_center+0.5, -90, 90)]))
+
+        with mock.patch.object(schema, 'get_schema', return_value=None):
+            t = crossmatch.crossmatch(positions, 'nosuchprod', 'healpix', cone_search=cone_search)
+        self.assertEqual(len(t), 0)
+        self.assertLessEqual(len(searches), 12*crossmatch.INVENTORY_NSIDE**2)
+        self.assertLess(len(searches), n // 3)
+
+    def test_crossmatch_empty_columns(self):
+        #- requested columns are present, with their dtypes, even without matches
+        with tempfile.TemporaryDirectory() as tmpdir:
+            orig_redux = os.getenv('DESI_SPECTRO_REDUX')
+            os.environ['DESI_SPECTRO_REDUX'] = tmpdir
+            try:
+                filename = os.path.join(tmpdir, 'xmatchtest', 'healpix', 'main', 'dark', '100', '10000',
+                                        'redrock-main-dark-10000.fits')
+                os.makedirs(os.path.dirname(filename))
+                zz = np.zeros(2, dtype=[('TARGETID', 'i8'), ('Z', 'f8'), ('ZWARN', 'i8'), ('SPECTYPE', 'S6')])
+                fm = np.zeros(2, dtype=[('TARGETID', 'i8'), ('TARGET_RA', 'f8'), ('TARGET_DEC', 'f8'),
+                                        ('FLUX_R', 'f4')])
+                with fitsio.FITS(filename, 'rw', clobber=True) as fx:
+                    fx.write(None)
+                    fx.write(zz, extname='REDSHIFTS')
+                    fx.write(fm, extname='FIBERMAP')
+
+                positions = read_positions(b'ra,dec\n10,20\n')
+                cone_search = lambda *args: Table(dict(TARGETID=[1], TARGET_RA=[50.0], TARGET_DEC=[50.0]))
+                t = crossmatch.crossmatch(positions, 'xmatchtest', 'healpix', xcol=['FLUX_R'],
+                                          cone_search=cone_search)
+            finally:
+                schema._schemas.clear()
+                try:
+                    os.remove(schema._cachefile('xmatchtest', 'healpix', schema.SCHEMA_DIR))
+                except OSError:
+                    pass
+                if orig_redux is None:
+                    del os.environ['DESI_SPECTRO_REDUX']
+                else:
+                    os.environ['DESI_SPECTRO_REDUX'] = orig_redux
+
+        self.assertEqual(len(t), 0)
+        self.assertEqual(t['FLUX_R'].dtype, np.dtype('f4'))
+        self.assertEqual(t['HEALPIX'].dtype.kind, 'i')
+        for col in ('Z', 'SPECTYPE', 'SURVEY', 'SEPARATION'):
+            self.assertIn(col, t.colnames)
+
+if __name__ == '__main__':
+    unittest.main()
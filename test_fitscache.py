@@ -0,0 +1,130 @@
+"""
+Test inspector.fitscache pool of open FITS files
+"""
+
+import os
+import time
+import tempfile
+import unittest
+import threading
+from unittest import mock
+
+import numpy as np
+import fitsio
+
+from inspector import fitscache
+from inspector.fitscache import FITSPool
+
+def _nrows(filename):
+    with fitscache.open_fits(filename) as fx:
+        return fx['FIBERMAP'].get_nrows()
+
+def _write(filename, n):
+    fm = np.zeros(n, dtype=[('TARGETID', 'i8'), ('FIBER', 'i4')])
+    fm['TARGETID'] = np.arange(n) + 1000
+    fm['FIBER'] = np.arange(n)
+    fitsio.write(filename, fm, extname='FIBERMAP', header=dict(NROWS=n), clobber=True)
+
+class TestFITSPool(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.files = list()
+        for i in range(4):
+            filename = os.path.join(self.tmpdir.name, f'test-{i}.fits')
+            _write(filename, 10+i)
+            self.files.append(filename)
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_reuse(self):
+        pool = FITSPool(max_open=2)
+        with pool.open(self.files[0]) as fx:
+            first = fx
+            fm = fx['FIBERMAP'].read(columns=('TARGETID', 'FIBER'))
+        self.assertEqual(len(fm), 10)
+        with pool.open(self.files[0]) as fx:
+            self.assertIs(fx, first)
+
+        with pool.open(self.files[0]) as fx:
+            hdr = pool.read_header(fx['FIBERMAP'])
+            self.assertEqual(hdr['NROWS'], 10)
+        with pool.open(self.files[0]) as fx:
+            self.assertIs(pool.read_header(fx['FIBERMAP']), hdr)
+
+        #- HDUs of handles outside the pool are read without caching
+        with fitsio.FITS(self.files[0]) as fx:
+            self.assertIsNot(pool.read_header(fx['FIBERMAP']), hdr)
+            self.assertEqual(pool.read_header(fx['FIBERMAP'])['NROWS'], 10)
+
+        stats = pool.stats()
+        self.assertEqual(stats['misses'], 1)
+        self.assertEqual(stats['hits'], 3)
+
+    def test_bounded(self):
+        pool = FITSPool(max_open=2)
+        for filename in self.files:
+            with pool.open(filename) as fx:
+                self.assertEqual(fx['FIBERMAP'].get_nrows(), 10 + self.files.index(filename))
+            self.assertLessEqual(pool.stats()['open'], 2)
+
+        #- least recently used files were closed
+        self.assertEqual(list(pool.entries), [os.path.abspath(f) for f in self.files[2:]])
+        pool.close()
+        self.assertEqual(pool.stats()['open'], 0)
+
+    def test_changed_file(self):
+        pool = FITSPool(revalidate=0)
+        with pool.open(self.files[0]) as fx:
+            self.assertEqual(pool.read_header(fx['FIBERMAP'])['NROWS'], 10)
+        time.sleep(0.01)
+        _write(self.files[0], 20)
+        with pool.open(self.files[0]) as fx:
+            self.assertEqual(pool.read_header(fx['FIBERMAP'])['NROWS'], 20)
+            self.assertEqual(fx['FIBERMAP'].get_nrows(), 20)
+
+    def test_threads(self):
+        pool = FITSPool(max_open=2)
+        errors = list()
+
+        def worker(i):
+            try:
+                for j in range(20):
+                    filename = self.files[(i+j) % len(self.files)]
+                    with pool.open(filename) as fx:
+                        fm = fx['FIBERMAP'].read()
+                    n = 10 + self.files.index(filename)
+                    assert len(fm) == n and fm['TARGETID'][-1] == 1000 + n - 1
+            except Exception as err:
+                errors.append(err)
+
+        threads = [threading.Thread(target=worker, args=(i,)) for i in range(8)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        self.assertEqual(errors, [])
+        self.assertLessEqual(pool.stats()['open'], 2)
+
+    def test_process_pool(self):
+        #- pool processes don't inherit locks held by other threads of this process
+        from inspector.sharedread import process_pool
+        pool = fitscache.get_pool()
+        with pool._lock, process_pool(2) as executor:
+            futures = [executor.submit(_nrows, f) for f in self.files]
+            nrows = [f.result(timeout=60) for f in futures]
+        self.assertEqual(nrows, [10, 11, 12, 13])
+
+    def test_findfile_environ(self):
+        #- memoized paths follow changes to $DESI_ROOT when $DESI_SPECTRO_REDUX isn't set
+        kwargs = dict(healpix=10000, survey='main', faprogram='dark', specprod='test')
+        with mock.patch.dict(os.environ):
+            os.environ.pop('DESI_SPECTRO_REDUX', None)
+            for name in ('root1', 'root2'):
+                os.environ['DESI_ROOT'] = os.path.join(self.tmpdir.name, name)
+                self.assertTrue(fitscache.findfile('coadd', **kwargs).startswith(os.environ['DESI_ROOT']))
+
+if __name__ == '__main__':
+    unittest.main()
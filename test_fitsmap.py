@@ -0,0 +1,129 @@
+"""
+Test inspector.fitsmap memory mapped image reads against fitsio
+"""
+
+import os
+import tempfile
+import unittest
+
+import numpy as np
+import fitsio
+
+from inspector import fitsmap, fitscache
+from inspector.fitscache import open_fits, handle_stamp
+
+def _write(filename, nspec=50, nwave=30, rng=None):
+    rng = np.random.default_rng(0) if rng is None else rng
+    with fitsio.FITS(filename, 'rw', clobber=True) as fx:
+        fx.write(None)
+        fx.write(np.zeros(5, dtype=[('TARGETID', 'i8')]), extname='FIBERMAP')
+        fx.write(rng.normal(size=(nspec, nwave)).astype('f4'), extname='B_FLUX')
+        fx.write(rng.uniform(size=(nspec, nwave)), extname='B_IVAR')
+        fx.write(rng.integers(0, 2**32, size=(nspec, nwave), dtype='u4'), extname='B_MASK')
+        fx.write(rng.normal(size=(nspec, 11, nwave)).astype('f4'), extname='B_RESOLUTION')
+        fx.write(rng.integers(-100, 100, size=(nspec, nwave), dtype='i2'), extname='COUNTS')
+        fx.write(rng.normal(size=(nspec, nwave)).astype('f4'), extname='COMPRESSED', compress='rice')
+
+class TestFitsMap(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.filename = os.path.join(self.tmpdir.name, 'coadd-test.fits')
+        _write(self.filename)
+        fitsmap._maps.maps.clear()
+
+    def tearDown(self):
+        fitsmap._maps.maps.clear()
+        fitscache.get_pool().close()
+        self.tmpdir.cleanup()
+
+    def test_image_rows(self):
+        rows = np.array([3, 1, 1, 40, 41, 49])
+        with fitsio.FITS(self.filename) as fx:
+            for extname in ('B_FLUX', 'B_IVAR', 'B_MASK', 'B_RESOLUTION', 'COUNTS'):
+                expected = fx[extname].read()
+                data = fitsmap.image_rows(fx[extname], rows)
+                self.assertEqual(data.dtype.newbyteorder('='), expected.dtype.newbyteorder('='), extname)
+                self.assertTrue(np.array_equal(data, expected[rows]), extname)
+
+                contiguous = fitsmap.image_rows(fx[extname], np.arange(10, 20))
+                self.assertTrue(np.array_equal(contiguous, expected[10:20]), extname)
+
+            #- contiguous rows are views of the file pages, without byte swapping
+            flux = fitsmap.image_rows(fx['B_FLUX'], np.arange(10, 20))
+            self.assertEqual(flux.dtype.str, '>f4')
+            self.assertFalse(flux.flags.owndata)
+            self.assertFalse(flux.flags.writeable)
+
+            #- the BZERO offset of unsigned masks is removed
+            self.assertTrue(fitsmap.image_map(fx['B_MASK'])[1])
+            self.assertEqual(fitsmap.image_rows(fx['B_MASK'], rows).dtype.kind, 'u')
+
+            #- compressed images fall back to fitsio
+            self.assertIsNone(fitsmap.image_map(fx['COMPRESSED']))
+            self.assertIsNone(fitsmap.image_rows(fx['COMPRESSED'], rows))
+
+    def test_replaced_file(self):
+        with fitsio.FITS(self.filename) as fx:
+            before = np.array(fitsmap.image_rows(fx['B_FLUX'], [0, 1]))
+
+        #- write a new file and rename it into place, as the pipeline does
+        tmpfile = self.filename + '.tmp'
+        _write(tmpfile, rng=np.random.default_rng(1))
+        os.rename(tmpfile, self.filename)
+        with fitsio.FITS(self.filename) as fx:
+            after = fitsmap.image_rows(fx['B_FLUX'], [0, 1])
+            self.assertTrue(np.array_equal(after, fx['B_FLUX'].read()[0:2]))
+        self.assertFalse(np.array_equal(before, after))
+
+    def test_pooled_handle(self):
+        pool = fitscache.get_pool()
+        orig = pool.revalidate
+        try:
+            pool.revalidate = 1e6
+            with open_fits(self.filename) as fx:
+                stamp = handle_stamp(self.filename, fx)
+                self.assertIsNotNone(stamp)
+                before = np.array(fitsmap.image_rows(fx['B_FLUX'], [0, 1], stamp))
+                self.assertTrue(np.array_equal(before, fx['B_FLUX'].read()[0:2]))
+
+            #- replace the file before the pooled handle is revalidated
+            tmpfile = self.filename + '.tmp'
+            _write(tmpfile, nspec=60, rng=np.random.default_rng(1))
+            os.rename(tmpfile, self.filename)
+
+            with open_fits(self.filename) as fx:
+                #- the old handle only ever gets rows of the file it has open
+                stamp = handle_stamp(self.filename, fx)
+                data = fitsmap.image_rows(fx['B_FLUX'], [0, 1], stamp)
+                self.assertTrue(np.array_equal(data, before))
+
+                #- and can't be mapped once that mapping is gone
+                fitsmap._maps.maps.clear()
+                self.assertIsNone(fitsmap.image_rows(fx['B_FLUX'], [0, 1], stamp))
+
+            #- a revalidated handle maps the new file
+            pool.revalidate = 0
+            with open_fits(self.filename) as fx:
+                stamp = handle_stamp(self.filename, fx)
+                data = fitsmap.image_rows(fx['B_FLUX'], [0, 1], stamp)
+                self.assertTrue(np.array_equal(data, fx['B_FLUX'].read()[0:2]))
+                self.assertFalse(np.array_equal(data, before))
+
+            #- handles that aren't pooled have no stamp
+            with fitsio.FITS(self.filename) as fx:
+                self.assertIsNone(handle_stamp(self.filename, fx))
+        finally:
+            pool.revalidate = orig
+
+    def test_disabled(self):
+        orig = fitsmap.MEMMAP
+        try:
+            fitsmap.MEMMAP = False
+            with fitsio.FITS(self.filename) as fx:
+                self.assertIsNone(fitsmap.image_rows(fx['B_FLUX'], [0, 1]))
+        finally:
+            fitsmap.MEMMAP = orig
+
+if __name__ == '__main__':
+    unittest.main()
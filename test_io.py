@@ -86,12 +86,37 @@ class TestIO(unittest.TestCase):
         t = filter_table(table, dict(A=['ge:3', 'le:7']))
         self.assertEqual(list(t['A']), [3,4,5,6,7])
 
+        t = filter_table(table, dict(A='bitand:6'))
+        self.assertEqual(list(t['A']), [2,3,4,5,6,7])
+
         with self.assertRaises(ValueError):
             t = filter_table(table, dict(A='xx:25'))
 
         with self.assertRaises(ValueError):
             t = filter_table(table, dict(A='eq:blat'))
 
+    def test_dedup_targets(self):
+        from astropy.table import Table
+        from inspector.io import dedup_targets
+        t = Table()
+        t['TARGETID'] = [1, 2, 1, 3, 1, 2]
+        t['TILEID'] = [10, 11, 12, 13, 14, 15]
+        t['TSNR2_LRG'] = np.array([5.0, np.nan, 7.0, 1.0, 6.0, 2.0], dtype=np.float32)
+        t['ZWARN'] = [4, 0, 0, 0, 0, 0]
+        t['DELTACHI2'] = [100.0, 10.0, 20.0, 5.0, 30.0, 10.0]
+
+        d = dedup_targets(t, 'tsnr2')
+        self.assertEqual(list(d['TILEID']), [12, 13, 15])
+        self.assertEqual(d.meta['NDEDUP'], 3)
+
+        #- ZWARN first, then DELTACHI2; ties keep the first row
+        d = dedup_targets(t, 'zwarn')
+        self.assertEqual(list(d['TILEID']), [11, 13, 14])
+
+        self.assertEqual(len(dedup_targets(t[0:0], 'zwarn')), 0)
+        with self.assertRaises(ValueError):
+            dedup_targets(t, 'blat')
+
     def test_load_targets(self):
         """Test load_targets, including failure modes"""
         from inspector.io import load_targets
@@ -119,8 +144,17 @@ class TestIO(unittest.TestCase):
         self.assertIn('ZERR', targets.colnames)
         self.assertTrue(np.all(targets['ZERR']>zerr_cut))
 
+        #- best spectrum per TARGETID for targets on more than one tile
+        targets = load_targets('dr1', 'tiles', radec=(210,5,300))
+        for dedup in ('tsnr2', 'zwarn'):
+            best = load_targets('dr1', 'tiles', radec=(210,5,300), dedup=dedup)
+            self.assertEqual(len(best), len(np.unique(targets['TARGETID'])))
+            self.assertEqual(best.meta['NDEDUP'], len(targets) - len(best))
+
         with self.assertRaises(ValueError):
             targets = load_targets('dr1', 'healpix')  # needs radec or targetids
+        with self.assertRaises(ValueError):
+            targets = load_targets('dr1', 'tiles', radec=(210,5,30), dedup='blat')
 
     def test_load_spectra(self):
         """Test load_spectra (basic), including failure modes"""
@@ -139,6 +173,27 @@ class TestIO(unittest.TestCase):
         with self.assertRaises(ValueError):
             sp = load_spectra('dr1', 'healpix', targetids=targetids, maxspectra=1)
 
+    def test_read_spectra_shared(self):
+        """Test shared memory reader matches read_spectra_parallel"""
+        from desispec.io import read_spectra_parallel
+        from inspector.io import load_targets
+        from inspector.sharedread import read_spectra_shared
+        targetids = [39627908959964170, 39627908959964322]
+        targets = load_targets('dr1', 'healpix', targetids=targetids)
+        rdspec_kwargs = dict(return_redshifts=True)
+        sp1 = read_spectra_parallel(targets, specprod='iron', rdspec_kwargs=rdspec_kwargs)
+        sp2 = read_spectra_shared(targets, 'iron', rdspec_kwargs=rdspec_kwargs, nproc=2, min_files=1)
+
+        self.assertEqual(list(sp1.bands), list(sp2.bands))
+        self.assertTrue(np.all(sp1.fibermap['TARGETID'] == sp2.fibermap['TARGETID']))
+        self.assertTrue(np.all(sp1.redshifts['Z'] == sp2.redshifts['Z']))
+        for band in sp1.bands:
+            self.assertTrue(np.all(sp1.wave[band] == sp2.wave[band]))
+            self.assertTrue(np.all(sp1.flux[band] == sp2.flux[band]))
+            self.assertTrue(np.all(sp1.ivar[band] == sp2.ivar[band]))
+            self.assertTrue(np.all(sp1.mask[band] == sp2.mask[band]))
+            self.assertTrue(np.all(sp1.resolution_data[band] == sp2.resolution_data[band]))
+
     def test_add_zcat_columns(self):
         from inspector.io import add_zcat_columns
         t1 = Table()
@@ -165,6 +220,71 @@ class TestIO(unittest.TestCase):
         t5 = add_zcat_columns(t1, 'iron', xcol=['Z', 'SPECTYPE'])
         self.assertEqual(t2.colnames, t5.colnames)
 
+        #- New column in TSNR2 HDU
+        t6 = add_zcat_columns(t1, 'iron', xcol=['TSNR2_LRG'])
+        self.assertIn('TSNR2_LRG', t6.colnames)
+
+        #- Unknown column
+        with self.assertRaises(ValueError):
+            add_zcat_columns(t1, 'iron', xcol=['BLAT'])
+
+    def test_imap_unordered(self):
+        import time
+        import threading
+        from concurrent.futures import ThreadPoolExecutor
+        from inspector.io import _imap_unordered
+
+        lock = threading.Lock()
+        counts = dict(outstanding=0, max_outstanding=0)
+
+        def read(i, delay=0.0):
+            with lock:
+                counts['outstanding'] += 1
+                counts['max_outstanding'] = max(counts['max_outstanding'], counts['outstanding'])
+            time.sleep(delay)
+            return i
+
+        nproc = 3
+        results = list()
+        with ThreadPoolExecutor(8) as pool:
+            for i in _imap_unordered(pool, read, range(20), nproc, delay=0.01):
+                #- slow consumer: reads must not pile up while it works
+                time.sleep(0.02)
+                with lock:
+                    counts['outstanding'] -= 1
+                results.append(i)
+
+        self.assertEqual(sorted(results), list(range(20)))
+        self.assertLessEqual(counts['max_outstanding'], nproc)
+
+        #- closing the generator early cancels reads that haven't started
+        counts['outstanding'] = 0
+        with ThreadPoolExecutor(1) as pool:
+            gen = _imap_unordered(pool, read, range(20), 2, delay=0.01)
+            next(gen)
+            gen.close()
+        self.assertLessEqual(counts['outstanding'], 2)
+
+    def test_production_dir(self):
+        import os
+        from inspector.io import production_dir
+
+        orig = {key: os.environ.get(key) for key in ('DESI_ROOT', 'DESI_SPECTRO_REDUX')}
+        try:
+            #- deployments may only set $DESI_ROOT
+            os.environ['DESI_ROOT'] = '/blat/desi'
+            os.environ.pop('DESI_SPECTRO_REDUX', None)
+            self.assertEqual(production_dir('iron'), '/blat/desi/spectro/redux/iron')
+
+            os.environ['DESI_SPECTRO_REDUX'] = '/foo/redux'
+            self.assertEqual(production_dir('iron'), '/foo/redux/iron')
+        finally:
+            for key, value in orig.items():
+                if value is None:
+                    os.environ.pop(key, None)
+                else:
+                    os.environ[key] = value
+
     def test_standardize_specprod(self):
         from inspector.io import standardize_specprod
         self.assertEqual(standardize_specprod('edr'), 'fuji')
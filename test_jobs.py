@@ -0,0 +1,57 @@
+"""
+Test inspector.jobs status handling, which doesn't need $DESI_ROOT
+"""
+
+import os
+import time
+import socket
+import tempfile
+import unittest
+import subprocess
+
+from inspector import jobs
+
+class TestJobs(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.jobs_dir = jobs.JOBS_DIR
+        jobs.JOBS_DIR = self.tmpdir.name
+
+    def tearDown(self):
+        jobs.JOBS_DIR = self.jobs_dir
+        self.tmpdir.cleanup()
+
+    def _create(self, **kwargs):
+        jobid = '0123456789abcdef0123456789abcdef'
+        os.makedirs(jobs.job_dir(jobid), exist_ok=True)
+        now = time.time()
+        jobs._update_status(jobid, status='running', created=now, expires=now+60,
+                            host=socket.gethostname(), **kwargs)
+        return jobid
+
+    def test_live_owner(self):
+        jobid = self._create(owner=os.getpid(), pid=os.getpid())
+        self.assertEqual(jobs.read_status(jobid)['status'], 'running')
+
+    def test_dead_owner(self):
+        #- pid of a process that has exited
+        proc = subprocess.Popen(['true'])
+        proc.wait()
+
+        jobid = self._create(owner=proc.pid)
+        status = jobs.read_status(jobid)
+        self.assertEqual(status['status'], 'failed')
+        self.assertIn('resubmit', status['message'])
+
+        #- and stays failed
+        self.assertEqual(jobs.read_status(jobid)['status'], 'failed')
+
+    def test_other_host(self):
+        #- pids from another host can't be checked here
+        jobid = self._create(owner=2**22+1)
+        jobs._update_status(jobid, host='some-other-host')
+        self.assertEqual(jobs.read_status(jobid)['status'], 'running')
+
+if __name__ == '__main__':
+    unittest.main()
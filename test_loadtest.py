@@ -0,0 +1,51 @@
+"""
+Test inspector.loadtest helpers, which don't need $DESI_ROOT
+"""
+
+import os
+import unittest
+
+class TestLoadTest(unittest.TestCase):
+
+    def test_make_requests(self):
+        from inspector.synthetic import make_targets
+        from inspector.loadtest import make_requests, DEFAULT_MIX
+        targets, obs = make_targets(200)
+        requests = make_requests(DEFAULT_MIX, 500, 'synth', targets, obs)
+        self.assertEqual(len(requests), 500)
+        for route, url in requests:
+            what, selection, fmt = route.split('/')
+            self.assertTrue(url.startswith(f'/synth/{what}/'))
+            self.assertTrue(url.endswith(f'?format={fmt}'))
+            if selection == 'radec':
+                self.assertIn('/radec/', url)
+            elif selection == 'tilefibers':
+                self.assertIn('/tiles/', url)
+
+        #- only routes in the mix are used
+        requests = make_requests({'targets/radec/csv': 1}, 10, 'synth', targets, obs)
+        self.assertEqual(set(r[0] for r in requests), {'targets/radec/csv',})
+
+        with self.assertRaises(ValueError):
+            make_requests({'targets/blat/csv': 1}, 1, 'synth', targets, obs)
+
+    def test_run_load(self):
+        from inspector.loadtest import run_load
+        requests = [('a', '/a'),]*20 + [('b', '/b'),]*10
+        fetch = lambda url: (200 if url == '/a' else 404, 10)
+        report = run_load(requests, fetch, concurrency=4)
+        self.assertEqual(report['nrequests'], 30)
+        self.assertEqual(report['routes']['a']['count'], 20)
+        self.assertEqual(report['routes']['a']['status'], {'200': 20})
+        self.assertEqual(report['routes']['b']['status'], {'404': 10})
+        self.assertEqual(report['routes']['b']['nbytes'], 100)
+        for key in ('p50', 'p95', 'p99'):
+            self.assertIn(key, report['routes']['a'])
+
+    def test_rss(self):
+        from inspector.loadtest import rss_kb, child_pids
+        self.assertGreater(rss_kb(os.getpid()), 0)
+        self.assertIn(os.getpid(), child_pids(os.getppid()))
+
+if __name__ == '__main__':
+    unittest.main()
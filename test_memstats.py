@@ -0,0 +1,119 @@
+"""
+Test inspector.memstats per-request memory tracking
+"""
+
+import os
+import base64
+import tempfile
+import unittest
+from unittest import mock
+from concurrent.futures import Future
+
+import numpy as np
+from flask import Flask, Response
+
+from inspector import memstats
+from inspector.memstats import MemoryTracker
+
+class TestMemStats(unittest.TestCase):
+
+    def test_tracker(self):
+        tracker = MemoryTracker(sample_interval=0.01, use_tracemalloc=True)
+        token = tracker.start('/test?format=html')
+        data = np.ones(20*1024**2 // 8)   # 20 MB
+        result = tracker.finish(token)
+        del data
+
+        self.assertGreater(result['peak_increase'], 10*1024**2)
+        self.assertGreaterEqual(result['peak_rss'], result['rss_start'])
+        self.assertGreater(result['tracemalloc_peak'], 10*1024**2)
+        self.assertLessEqual(len(result['top_allocations']), memstats.TOP_ALLOCATIONS)
+
+        token = tracker.start('/test?format=html')
+        tracker.finish(token)
+        summary = tracker.summary()
+        self.assertEqual(summary['nrequests'], 2)
+        self.assertEqual(summary['active'], 0)
+        stats = summary['routes']['/test?format=html']
+        self.assertEqual(stats['count'], 2)
+        self.assertEqual(stats['max_peak_increase'], result['peak_increase'])
+        self.assertIn('top_allocations', stats)
+
+    def test_file_mappings(self):
+        #- resident pages of memory mapped files don't count towards RSS
+        with tempfile.TemporaryFile() as fp:
+            nbytes = 64*1024**2
+            fp.truncate(nbytes)
+            rss_start = memstats.rss_bytes()
+            data = np.memmap(fp, dtype=np.uint8, mode='r', shape=(nbytes,))
+            self.assertEqual(int(data[::4096].sum()), 0)
+            self.assertLess(memstats.rss_bytes() - rss_start, nbytes // 4)
+            del data
+
+        #- but anonymous memory does
+        rss_start = memstats.rss_bytes()
+        data = np.ones(nbytes // 8)
+        self.assertGreater(memstats.rss_bytes() - rss_start, nbytes // 2)
+        del data
+
+    def test_collect_stats(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            tracker = memstats.get_tracker()
+            tracker.write_summary(tmpdir)
+            #- stale stats from a worker that no longer exists are removed
+            stale = os.path.join(tmpdir, '999999999.json')
+            with open(stale, 'w') as fp:
+                fp.write('{}')
+
+            stats = memstats.collect_stats(tmpdir)
+            self.assertEqual([w['pid'] for w in stats['workers']], [os.getpid(),])
+            self.assertFalse(os.path.exists(stale))
+
+    def test_recycle_deferred(self):
+        from inspector import jobs
+        tracker = memstats.get_tracker()
+        app = Flask(__name__)
+
+        def request_finished():
+            with app.test_request_context('/test'):
+                from flask import g
+                g.memstats = tracker.start('/test?format=html')
+                memstats.after_request(Response('ok')).close()
+
+        #- every worker is over a 1 MB high water mark, but not recycled while a job runs
+        future = Future()
+        with mock.patch.object(memstats, 'RSS_HIGH_WATER_MB', 1), \
+             mock.patch.object(tracker, 'recycling', False), \
+             mock.patch.object(jobs, '_futures', set()):
+            jobs._futures.add(future)
+            future.add_done_callback(jobs._job_done)
+            self.assertEqual(jobs.active_jobs(), 1)
+            request_finished()
+            self.assertFalse(tracker.recycling)
+
+            #- once the job finishes the next request recycles it
+            future.set_result(None)
+            self.assertEqual(jobs.active_jobs(), 0)
+            request_finished()
+            self.assertTrue(tracker.recycling)
+
+    def test_endpoint(self):
+        os.environ['DESI_COLLAB_USERNAME'] = 'memstats'
+        os.environ['DESI_COLLAB_PASSWORD'] = 'memstats'
+        from app import app
+        from inspector.auth import reload_credentials
+        reload_credentials()
+        client = app.test_client()
+
+        client.get('/about').close()
+        self.assertEqual(client.get('/internal/stats').status_code, 401)
+
+        auth = base64.b64encode(b'memstats:memstats').decode()
+        response = client.get('/internal/stats', headers={'Authorization': f'Basic {auth}'})
+        self.assertEqual(response.status_code, 200)
+        workers = response.get_json()['workers']
+        this_worker = [w for w in workers if w['pid'] == os.getpid()][0]
+        self.assertIn('/about?format=html', this_worker['routes'])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,183 @@
+"""
+Test inspector.router cache-affinity routing
+"""
+
+import threading
+import unittest
+import http.client
+import urllib.error
+import urllib.request
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from inspector import router
+
+class _Backend(BaseHTTPRequestHandler):
+    """Respond with the backend name, streaming the body without Content-Length for /stream"""
+
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        name = self.server.name.encode()
+        self.send_response(200)
+        if self.path.startswith('/stream'):
+            self.send_header('Connection', 'close')
+            self.end_headers()
+            for i in range(3):
+                self.wfile.write(name + b'%d' % i)
+        else:
+            self.send_header('Content-Length', str(len(name)))
+            self.end_headers()
+            self.wfile.write(name)
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        if self.path.startswith('/echo'):
+            self.send_response(200)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+            return
+
+        #- drop the connection as if the worker died
+        self.server.posts += 1
+        self.close_connection = True
+
+    def log_message(self, *args):
+        pass
+
+def _start(server):
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+class TestRouter(unittest.TestCase):
+
+    def test_route_key(self):
+        k1 = router.route_key('/dr1/targets/radec/210,5,30?format=csv')
+        k2 = router.route_key('/dr1/spectra/tiles/radec/210.001,5.001,10')
+        k3 = router.route_key('/compare/iron,loa/targets/radec/210,5,30')
+        self.assertTrue(k1.startswith('healpix:'))
+        self.assertEqual(k1, k2)
+        self.assertEqual(k1, k3)
+        self.assertNotEqual(k1, router.route_key('/dr1/targets/radec/10,-5,30'))
+
+        self.assertEqual(router.route_key('/dr1/spectra/80605/0-10'), 'tile:80605')
+        self.assertEqual(router.route_key('/dr1/targets/tiles/80605/10,11'), 'tile:80605')
+        self.assertEqual(router.route_key('/dr1/targets/tiles/39627908959964170'),
+                         'path:/dr1/targets/tiles/39627908959964170')
+        self.assertEqual(router.route_key('/dr1/targets/radec/blat?x=1'), 'path:/dr1/targets/radec/blat?x=1')
+        #- invalid coordinates are left for a backend to reject
+        self.assertEqual(router.route_key('/iron/targets/radec/10,100,30'), 'path:/iron/targets/radec/10,100,30')
+
+    def test_hash_ring(self):
+        backends = [f'http://127.0.0.1:{5002+i}' for i in range(5)]
+        ring = router.HashRing(backends)
+        keys = [f'healpix:{i}' for i in range(5000)]
+        first = {key: ring.lookup(key)[0] for key in keys}
+
+        #- every backend gets a share of the keys, and every key has all backends as fallbacks
+        counts = [list(first.values()).count(b) for b in backends]
+        self.assertGreater(min(counts), 500)
+        self.assertEqual(sorted(ring.lookup(keys[0])), sorted(backends))
+
+        #- removing a backend only moves its own keys
+        smaller = router.HashRing(backends[:-1])
+        for key in keys:
+            if first[key] != backends[-1]:
+                self.assertEqual(smaller.lookup(key)[0], first[key])
+
+        with self.assertRaises(ValueError):
+            router.HashRing([])
+
+    def test_proxy_failover(self):
+        backends = dict()
+        for name in ('a', 'b'):
+            server = _start(ThreadingHTTPServer(('127.0.0.1', 0), _Backend))
+            server.name = name
+            backends[f'http://127.0.0.1:{server.server_address[1]}'] = server
+
+        r = router.Router(list(backends), down_seconds=60)
+        proxy = _start(router.RouterServer(('127.0.0.1', 0), r))
+        base_url = f'http://127.0.0.1:{proxy.server_address[1]}'
+        try:
+            path = '/dr1/targets/radec/210,5,30'
+            expected = backends[r.candidates(path)[0]].name
+            for i in range(3):
+                with urllib.request.urlopen(base_url + path) as response:
+                    self.assertEqual(response.read().decode(), expected)
+
+            #- responses without Content-Length are relayed chunked
+            with urllib.request.urlopen(base_url + '/stream') as response:
+                name = backends[r.candidates('/stream')[0]].name
+                self.assertEqual(response.read().decode(), f'{name}0{name}1{name}2')
+
+            #- requests for a dead backend go to the next one on the ring
+            dead = r.candidates(path)[0]
+            backends[dead].shutdown()
+            backends[dead].server_close()
+            with urllib.request.urlopen(base_url + path) as response:
+                self.assertNotEqual(response.read().decode(), expected)
+            self.assertFalse(r.stats()[dead]['up'])
+            self.assertEqual(r.stats()[dead]['failures'], 1)
+            self.assertEqual(r.candidates(path)[-1], dead)
+        finally:
+            proxy.shutdown()
+            proxy.server_close()
+            for server in backends.values():
+                server.shutdown()
+                server.server_close()
+
+    def test_proxy_post(self):
+        backends = list()
+        for name in ('a', 'b'):
+            server = _start(ThreadingHTTPServer(('127.0.0.1', 0), _Backend))
+            server.name = name
+            server.posts = 0
+            backends.append(server)
+
+        r = router.Router([f'http://127.0.0.1:{b.server_address[1]}' for b in backends])
+        proxy = _start(router.RouterServer(('127.0.0.1', 0), r))
+        try:
+            #- a POST that reached a backend isn't repeated on another one
+            request = urllib.request.Request(f'http://127.0.0.1:{proxy.server_address[1]}/dr1/crossmatch',
+                                             data=b'x')
+            with self.assertRaises(urllib.error.HTTPError) as cm:
+                urllib.request.urlopen(request)
+            self.assertEqual(cm.exception.code, 502)
+            self.assertEqual(sum(b.posts for b in backends), 1)
+        finally:
+            proxy.shutdown()
+            proxy.server_close()
+            for server in backends:
+                server.shutdown()
+                server.server_close()
+
+    def test_proxy_chunked(self):
+        server = _start(ThreadingHTTPServer(('127.0.0.1', 0), _Backend))
+        server.name = 'a'
+        r = router.Router([f'http://127.0.0.1:{server.server_address[1]}'])
+        proxy = _start(router.RouterServer(('127.0.0.1', 0), r))
+        conn = http.client.HTTPConnection('127.0.0.1', proxy.server_address[1])
+        try:
+            #- chunked uploads are forwarded whole, and the connection stays usable
+            conn.request('POST', '/echo', body=iter([b'210,5\n', b'211,6\n']), encode_chunked=True,
+                         headers={'Transfer-Encoding': 'chunked'})
+            response = conn.getresponse()
+            self.assertEqual(response.status, 200)
+            self.assertEqual(response.read(), b'210,5\n211,6\n')
+
+            conn.request('GET', '/dr1/targets/1,2')
+            response = conn.getresponse()
+            self.assertEqual(response.read(), b'a')
+
+            #- bodies that can't be delimited are refused
+            conn.request('POST', '/echo', body=b'x', headers={'Transfer-Encoding': 'gzip'})
+            self.assertEqual(conn.getresponse().status, 411)
+        finally:
+            conn.close()
+            proxy.shutdown()
+            proxy.server_close()
+            server.shutdown()
+            server.server_close()
+
+if __name__ == '__main__':
+    unittest.main()
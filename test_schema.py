@@ -0,0 +1,141 @@
+"""
+Test inspector.schema column catalog, using small fake redrock files
+"""
+
+import os
+import json
+import tempfile
+import unittest
+
+import numpy as np
+import fitsio
+
+from inspector import schema
+
+def _write_redrock(filename, fibermap_cols):
+    os.makedirs(os.path.dirname(filename), exist_ok=True)
+    n = 5
+    zz = np.zeros(n, dtype=[('TARGETID', 'i8'), ('Z', 'f8'), ('SPECTYPE', 'S6'), ('COEFF', 'f8', (10,))])
+    fm = np.zeros(n, dtype=[('TARGETID', 'i8'), ('FIBER', 'i4')] + [(c, 'f4') for c in fibermap_cols])
+    efm = np.zeros(2*n, dtype=[('TARGETID', 'i8'), ('EXPID', 'i4')])
+    with fitsio.FITS(filename, 'rw', clobber=True) as fx:
+        fx.write(None)
+        fx.write(zz, extname='REDSHIFTS')
+        fx.write(fm, extname='FIBERMAP')
+        fx.write(efm, extname='EXP_FIBERMAP')
+
+class TestSchema(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.redux = os.path.join(self.tmpdir.name, 'redux')
+        self.schema_dir = os.path.join(self.tmpdir.name, 'schema')
+        self.orig_redux = os.getenv('DESI_SPECTRO_REDUX')
+        os.environ['DESI_SPECTRO_REDUX'] = self.redux
+        schema._schemas.clear()
+
+        hpixdir = os.path.join(self.redux, 'test', 'healpix')
+        _write_redrock(os.path.join(hpixdir, 'main', 'dark', '100', '10000', 'redrock-main-dark-10000.fits'), ['FLUX_R'])
+        _write_redrock(os.path.join(hpixdir, 'sv1', 'dark', '100', '10001', 'redrock-sv1-dark-10001.fits'), ['SV1_DESI_TARGET'])
+        tiledir = os.path.join(self.redux, 'test', 'tiles', 'cumulative')
+        for tileid in range(1000, 1040):
+            _write_redrock(os.path.join(tiledir, str(tileid), '20210418', f'redrock-0-{tileid}-thru20210418.fits'), ['FLUX_G'])
+
+    def tearDown(self):
+        if self.orig_redux is None:
+            del os.environ['DESI_SPECTRO_REDUX']
+        else:
+            os.environ['DESI_SPECTRO_REDUX'] = self.orig_redux
+        schema._schemas.clear()
+        self.tmpdir.cleanup()
+
+    def test_build(self):
+        s = schema.build_schema('test', 'healpix')
+        self.assertEqual(len(s.files), 2)
+        self.assertEqual(s.hdu('Z'), 'REDSHIFTS')
+        self.assertEqual(s.hdu('TARGETID'), 'REDSHIFTS')
+        self.assertEqual(s.hdu('FLUX_R'), 'FIBERMAP')
+        self.assertEqual(s.hdu('SV1_DESI_TARGET'), 'FIBERMAP')   #- union over surveys
+        self.assertEqual(s.hdu('EXPID'), 'EXP_FIBERMAP')
+        self.assertEqual(s.hdu('HEALPIX'), 'INVENTORY')
+        self.assertEqual(s.dtype('SPECTYPE'), np.dtype('U6'))
+        self.assertEqual(s.dtype('COEFF').shape, (10,))
+
+        self.assertEqual(s.projection(['Z', 'FLUX_R', 'SPECTYPE']),
+                         dict(REDSHIFTS=['Z', 'SPECTYPE'], FIBERMAP=['FLUX_R']))
+        with self.assertRaises(ValueError):
+            s.projection(['EXPID'])
+
+        #- tiles samples are limited and spread across the production
+        s = schema.build_schema('test', 'tiles')
+        self.assertEqual(len(s.files), schema.SAMPLE_TILES)
+        self.assertIn('/1000/', s.files[0])
+        self.assertIn('/1039/', s.files[-1])
+
+        self.assertIsNone(schema.build_schema('nosuchprod', 'healpix'))
+
+    def test_survey_tiles(self):
+        #- a survey with a single tile between the evenly spaced samples
+        tiledir = os.path.join(self.redux, 'test', 'tiles', 'cumulative')
+        _write_redrock(os.path.join(tiledir, '1001', '20210418', 'redrock-0-1001-thru20210418.fits'),
+                       ['SV2_DESI_TARGET'])
+        tiles = np.zeros(40, dtype=[('TILEID', 'i4'), ('SURVEY', 'S7'), ('PROGRAM', 'S6')])
+        tiles['TILEID'] = np.arange(1000, 1040)
+        tiles['SURVEY'] = 'main'
+        tiles['PROGRAM'] = 'dark'
+        tiles['SURVEY'][1] = 'sv2'
+        fitsio.write(os.path.join(self.redux, 'test', 'tiles-test.fits'), tiles, extname='TILES', clobber=True)
+
+        s = schema.build_schema('test', 'tiles')
+        self.assertEqual(len(s.files), schema.SAMPLE_TILES + 1)
+        self.assertIn('/1001/', s.files[1])
+        self.assertEqual(s.hdu('SV2_DESI_TARGET'), 'FIBERMAP')
+
+    def test_validate(self):
+        schema.validate_columns('test', 'healpix', ['Z', 'FLUX_R', 'SURVEY'])
+        with self.assertRaises(schema.UnknownColumnError) as cm:
+            schema.validate_columns('test', 'healpix', ['Z', 'FLUXR'])
+        self.assertEqual(cm.exception.columns, ['FLUXR'])
+        self.assertIn('FLUX_R', str(cm.exception))
+
+        #- unknown productions are left to the inventory to report
+        schema.validate_columns('nosuchprod', 'healpix', ['BLAT'])
+
+    def test_cache(self):
+        s1 = schema.get_schema('test', 'healpix', schema_dir=self.schema_dir)
+        cachefile = os.path.join(self.schema_dir, 'schema-test-healpix.json')
+        self.assertTrue(os.path.exists(cachefile))
+        self.assertIs(schema.get_schema('test', 'healpix', schema_dir=self.schema_dir), s1)
+
+        #- a new process uses the cached file rather than reading headers
+        schema._schemas.clear()
+        with open(cachefile) as fp:
+            d = json.load(fp)
+        d['columns']['CACHED'] = dict(hdu='FIBERMAP', dtype='>f4', shape=[])
+        with open(cachefile, 'w') as fp:
+            json.dump(d, fp)
+        s2 = schema.get_schema('test', 'healpix', schema_dir=self.schema_dir)
+        self.assertIn('CACHED', s2)
+        self.assertEqual(s2.columns['Z'], s1.columns['Z'])
+
+    def test_update(self):
+        s1 = schema.get_schema('test', 'healpix', schema_dir=self.schema_dir)
+        self.assertNotIn('FLUX_Z', s1)
+
+        filename = os.path.join(self.redux, 'test', 'healpix', 'main', 'dark', '100', '10002',
+                                'redrock-main-dark-10002.fits')
+        _write_redrock(filename, ['FLUX_R', 'FLUX_Z'])
+        added = schema.update_schema('test', 'healpix', [filename], schema_dir=self.schema_dir)
+        self.assertEqual(added, ['FLUX_Z'])
+
+        #- other processes see the cached file change
+        s2 = schema.get_schema('test', 'healpix', schema_dir=self.schema_dir)
+        self.assertIsNot(s2, s1)
+        self.assertEqual(s2.hdu('FLUX_Z'), 'FIBERMAP')
+        self.assertIs(schema.get_schema('test', 'healpix', schema_dir=self.schema_dir), s2)
+
+        self.assertEqual(schema.update_schema('test', 'healpix', [filename], schema_dir=self.schema_dir), [])
+        self.assertEqual(schema.update_schema('test', 'tiles', [filename], schema_dir=self.schema_dir), [])
+
+if __name__ == '__main__':
+    unittest.main()
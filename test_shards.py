@@ -0,0 +1,147 @@
+"""
+Test inspector.shards scatter-gather across local fake shard servers
+"""
+
+import io
+import threading
+import unittest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, parse_qs
+
+import numpy as np
+from astropy.table import Table
+
+from inspector import shards
+from inspector.io import filter_table
+
+def _catalog(n=2000, seed=0):
+    import healpy
+    rng = np.random.default_rng(seed)
+    t = Table()
+    t['TARGETID'] = np.arange(n, dtype=np.int64) + 1000
+    t['TARGET_RA'] = rng.uniform(0, 360, n)
+    t['TARGET_DEC'] = np.degrees(np.arcsin(rng.uniform(-1, 1, n)))
+    t['HEALPIX'] = healpy.ang2pix(64, t['TARGET_RA'], t['TARGET_DEC'], nest=True, lonlat=True)
+    t['Z'] = rng.uniform(0, 3, n)
+    return t
+
+class _Shard(BaseHTTPRequestHandler):
+    """
+    Minimal /<specprod>/targets/healpix/<targetids> endpoint returning all
+    matching targets of server.catalog as FITS, like a node that can read
+    every file but is only asked about its own region
+    """
+    def do_GET(self):
+        url = urlsplit(self.path)
+        specprod, route, specgroup, targetids = url.path.strip('/').split('/')
+        args = parse_qs(url.query)
+        t = self.server.catalog
+        t = t[np.isin(t['TARGETID'], [int(x) for x in targetids.split(',')])]
+        try:
+            t = filter_table(t, {k: v for k, v in args.items() if k.isupper()})
+        except ValueError as err:
+            body = f'<h2>Error 400 - Bad Request</h2>\n\n<p>\n{err}\n</p>'.encode()
+            self.send_response(400)
+        else:
+            t.meta['SPECPROD'] = specprod
+            with io.BytesIO() as buffer:
+                t.write(buffer, format='fits')
+                body = buffer.getvalue()
+            self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+class TestShards(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.catalog = _catalog()
+        cls.servers = list()
+        for i in range(3):
+            server = ThreadingHTTPServer(('127.0.0.1', 0), _Shard)
+            server.catalog = cls.catalog
+            threading.Thread(target=server.serve_forever, daemon=True).start()
+            cls.servers.append(server)
+        cls.urls = [f'http://127.0.0.1:{s.server_address[1]}' for s in cls.servers]
+
+    @classmethod
+    def tearDownClass(cls):
+        for server in cls.servers:
+            server.shutdown()
+            server.server_close()
+
+    def _shard_map(self, urls):
+        nside = 2
+        edges = np.linspace(0, 12*nside**2, len(urls)+1).astype(int)
+        return shards.ShardMap([dict(url=url, healpix=[int(a), int(b)])
+                                for url, a, b in zip(urls, edges[:-1], edges[1:])], nside=nside)
+
+    def test_shard_map(self):
+        shard_map = self._shard_map(['http://a', 'http://b'])
+        shard_list = shard_map.shards_for('iron')
+        self.assertEqual([s['url'] for s in shard_list], ['http://a', 'http://b'])
+        self.assertEqual(list(shard_map.owners(shard_list, [0, 23, 24, 47])), [0, 0, 1, 1])
+
+        #- a small cone only touches one shard, a large one several
+        self.assertEqual(len(np.unique(shard_map.owners(shard_list, shard_map.cone_pixels(10, 10, 10)))), 1)
+        pixels = shard_map.cone_pixels(0, 0, 90*3600)
+        self.assertEqual(len(np.unique(shard_map.owners(shard_list, pixels))), 2)
+
+        #- productions must be covered exactly once
+        shard_map = shards.ShardMap([dict(url='http://a', healpix=[0, 24], specprods=['dr1']),
+                                     dict(url='http://b', healpix=[20, 48], specprods=['iron']),
+                                     dict(url='http://c', specprods=['loa'])], nside=2)
+        self.assertEqual(len(shard_map.shards_for('loa')), 1)
+        with self.assertRaises(ValueError):
+            shard_map.shards_for('iron')
+        with self.assertRaises(ValueError):
+            shard_map.shards_for('fuji')
+        with self.assertRaises(ValueError):
+            shards.ShardMap([dict(url='http://a', healpix=[0, 100])], nside=2)
+
+    def test_load_targets(self):
+        shard_map = self._shard_map(self.urls)
+        targetids = list(self.catalog['TARGETID'][::7])
+        t = shards.load_targets('iron', 'healpix', targetids=targetids, shard_map=shard_map)
+
+        #- every target exactly once, ordered by HEALPIX, with the shard meta
+        self.assertEqual(sorted(t['TARGETID']), targetids)
+        self.assertTrue(np.all(np.diff(t['HEALPIX']) >= 0))
+        self.assertEqual(t.meta['SPECPROD'], 'iron')
+
+        t = shards.load_targets('iron', 'healpix', targetids=targetids, filters=dict(Z='gt:2'),
+                                shard_map=shard_map)
+        expected = self.catalog[np.isin(self.catalog['TARGETID'], targetids) & (self.catalog['Z'] > 2)]
+        self.assertEqual(sorted(t['TARGETID']), sorted(expected['TARGETID']))
+
+        with self.assertRaises(ValueError):
+            shards.load_targets('iron', 'healpix', targetids=targetids, filters=dict(Z='xx:2'),
+                                shard_map=shard_map)
+
+    def test_partial_result(self):
+        #- nothing is listening on the last URL
+        server = ThreadingHTTPServer(('127.0.0.1', 0), _Shard)
+        dead_url = f'http://127.0.0.1:{server.server_address[1]}'
+        server.server_close()
+
+        shard_map = self._shard_map(self.urls[0:2] + [dead_url,])
+        targetids = list(self.catalog['TARGETID'])
+        with self.assertRaises(shards.PartialResultError) as cm:
+            shards.load_targets('iron', 'healpix', targetids=targetids, shard_map=shard_map)
+
+        err = cm.exception
+        self.assertEqual(list(err.failed), [dead_url,])
+        self.assertIn(dead_url, str(err))
+        self.assertEqual(err.nshards, 3)
+
+        #- the partial table has the targets of the shards that answered
+        shard_list = shard_map.shards_for('iron')
+        owners = shard_map.owners(shard_list, shard_map.pixels(self.catalog['TARGET_RA'], self.catalog['TARGET_DEC']))
+        self.assertEqual(sorted(err.table['TARGETID']), sorted(self.catalog['TARGETID'][owners < 2]))
+
+if __name__ == '__main__':
+    unittest.main()
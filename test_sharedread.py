@@ -0,0 +1,64 @@
+"""
+Test inspector.sharedread on a synthetic production, which doesn't need $DESI_ROOT
+"""
+
+import os
+import pickle
+import tempfile
+import unittest
+from unittest import mock
+
+import numpy as np
+
+class TestSharedRead(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        from inspector.synthetic import make_production, set_environment
+        cls.tmpdir = tempfile.TemporaryDirectory()
+        cls.environ = mock.patch.dict(os.environ)
+        cls.environ.start()
+        set_environment(cls.tmpdir.name)
+        targets, obs = make_production(cls.tmpdir.name, ntargets=200, wavestep=40.0)
+        cls.obs = obs[np.argsort(obs['TARGETID'])][0:60]
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.environ.stop()
+        cls.tmpdir.cleanup()
+
+    def test_shared_arrays(self):
+        """read_spectra_shared matches read_spectra_parallel without copying the shared arrays"""
+        from desispec.io import read_spectra_parallel
+        from inspector.sharedread import read_spectra_shared, SharedSpectra
+
+        rdspec_kwargs = dict(return_redshifts=True)
+        sp1 = read_spectra_parallel(self.obs, specprod='synth', rdspec_kwargs=rdspec_kwargs)
+        sp2 = read_spectra_shared(self.obs, 'synth', rdspec_kwargs=rdspec_kwargs, nproc=2, min_files=1)
+
+        self.assertIsInstance(sp2, SharedSpectra)
+        self.assertEqual(list(sp1.bands), list(sp2.bands))
+        self.assertTrue(np.all(sp1.fibermap['TARGETID'] == sp2.fibermap['TARGETID']))
+        self.assertTrue(np.all(sp1.redshifts['Z'] == sp2.redshifts['Z']))
+
+        base = sp2.flux[sp2.bands[0]].base
+        for band in sp1.bands:
+            self.assertTrue(np.all(sp1.wave[band] == sp2.wave[band]))
+            for name in ('flux', 'ivar', 'mask', 'resolution_data'):
+                data = getattr(sp2, name)[band]
+                self.assertTrue(np.all(getattr(sp1, name)[band] == data), f'{band} {name}')
+                self.assertIs(data.base, base, f'{band} {name}')
+
+        #- Resolution matrices are built on first use
+        self.assertIsNone(sp2._R)
+        band = sp2.bands[0]
+        self.assertEqual(len(sp2.R[band]), len(sp2.fibermap))
+        self.assertTrue(np.allclose(sp1.R[band][0].toarray(), sp2.R[band][0].toarray()))
+
+        #- pickling copies the arrays out of shared memory
+        sp3 = pickle.loads(pickle.dumps(sp2))
+        self.assertIsInstance(sp3, SharedSpectra)
+        self.assertTrue(np.all(sp3.flux[band] == sp2.flux[band]))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,101 @@
+"""
+Test inspector.specbin binary encoding of spectra
+"""
+
+import unittest
+from types import SimpleNamespace
+
+import numpy as np
+from astropy.table import Table
+
+from inspector.specbin import encode_spectra, decode_spectra
+
+def _fake_spectra(nspec=3, model=False):
+    """Return object with the Spectra attributes used by encode_spectra"""
+    rng = np.random.default_rng(0)
+    bands = ['b', 'r']
+    wave = dict(b=np.linspace(3600, 5800, 11), r=np.linspace(5760, 7620, 7))
+    flux = {b: rng.normal(size=(nspec, len(wave[b]))) for b in bands}
+    ivar = {b: np.ones((nspec, len(wave[b]))) for b in bands}
+    mask = {b: np.zeros((nspec, len(wave[b])), dtype=np.int32) for b in bands}
+    mask['b'][1, 2] = 1
+    fibermap = Table(dict(TARGETID=np.arange(nspec)+10, TARGET_RA=np.ones(nspec)))
+    redshifts = Table(dict(TARGETID=np.arange(nspec)+10, Z=np.arange(nspec)/10,
+                           SPECTYPE=np.array([b'GALAXY',]*nspec)))
+    redshifts['Z'][0] = np.nan
+    if model:
+        model = {b: flux[b] * 2 for b in bands}
+    else:
+        model = None
+
+    return SimpleNamespace(bands=bands, wave=wave, flux=flux, ivar=ivar, mask=mask,
+                           model=model, fibermap=fibermap, redshifts=redshifts)
+
+class TestSpecBin(unittest.TestCase):
+
+    def test_roundtrip(self):
+        spectra = _fake_spectra()
+        data = encode_spectra(spectra, title='test')
+        index, arrays = decode_spectra(data)
+
+        self.assertEqual(index['nspec'], 3)
+        self.assertEqual(index['title'], 'test')
+        self.assertEqual(index['targets'][1]['TARGETID'], '11')
+        self.assertEqual(index['targets'][2]['SPECTYPE'], 'GALAXY')
+        self.assertAlmostEqual(index['targets'][1]['Z'], 0.1)
+        self.assertIsNone(index['targets'][0]['Z'])
+
+        #- arrays start 4-byte aligned for javascript Float32Array views
+        n = int.from_bytes(data[0:4], 'little')
+        self.assertEqual((4 + n) % 4, 0)
+
+        for b in spectra.bands:
+            self.assertEqual(index['cameras'][b]['nwave'], len(spectra.wave[b]))
+            self.assertEqual(arrays[b]['flux'].dtype, np.float32)
+            self.assertTrue(np.allclose(arrays[b]['wave'], spectra.wave[b]))
+            self.assertTrue(np.allclose(arrays[b]['flux'], spectra.flux[b]))
+            self.assertNotIn('model', arrays[b])
+
+        #- masked pixels have ivar=0
+        self.assertEqual(arrays['b']['ivar'][1, 2], 0.0)
+        self.assertEqual(arrays['b']['ivar'].sum(), spectra.ivar['b'].sum() - 1)
+
+        #- optional label, e.g. the production when overlaying productions
+        index, arrays = decode_spectra(encode_spectra(spectra, label='iron'))
+        self.assertEqual(index['label'], 'iron')
+
+    def test_large_targetid(self):
+        #- TARGETIDs above 2**53 aren't exact as javascript numbers, so they are strings
+        spectra = _fake_spectra()
+        targetid = 39627908959964170
+        self.assertGreater(targetid, 2**53)
+        spectra.fibermap['TARGETID'][1] = targetid
+        index, arrays = decode_spectra(encode_spectra(spectra))
+        self.assertEqual(index['targets'][1]['TARGETID'], str(targetid))
+        self.assertEqual(int(index['targets'][1]['TARGETID']), targetid)
+        self.assertEqual(float(index['targets'][1]['TARGET_RA']), 1.0)
+
+    def test_model(self):
+        spectra = _fake_spectra(model=True)
+        index, arrays = decode_spectra(encode_spectra(spectra))
+        self.assertIsNone(index['title'])
+        self.assertNotIn('label', index)
+        for b in spectra.bands:
+            self.assertTrue(np.allclose(arrays[b]['model'], spectra.model[b]))
+
+    def test_progressive_template(self):
+        from flask import render_template
+        from app import app, PROGRESSIVE_MARKER
+        with app.test_request_context('/iron/spectra/radec/210,5,10?format=progressive'):
+            page = render_template('specviewer.html', progressive=True, title='test',
+                                   table_html='<table></table>', data_url='x', fits_url='y', table_url='z')
+
+        #- batches are streamed between the viewer javascript and the end of the page
+        head, tail = page.split(PROGRESSIVE_MARKER)
+        self.assertIn('function addBatchBase64', head)
+        self.assertIn('<table></table>', head)
+        self.assertNotIn('fetch(dataURL)', head)
+        self.assertIn('</html>', tail)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,122 @@
+"""
+Test inspector.stack rest-frame resampling and stacking
+"""
+
+import unittest
+
+import numpy as np
+
+from inspector import stack
+from inspector.stack import rest_grid, resample, Stacker
+
+class FakeSpectra(object):
+    """Minimal stand-in for desispec.spectra.Spectra with wave/flux/ivar/mask dicts"""
+    def __init__(self, wave, flux, ivar, mask=None):
+        self.bands = list(wave.keys())
+        self.wave = wave
+        self.flux = flux
+        self.ivar = ivar
+        self.mask = mask
+
+class TestStack(unittest.TestCase):
+
+    def test_rest_grid(self):
+        grid = rest_grid([0.0, 1.0], dw=2.0)
+        self.assertAlmostEqual(grid[0], stack.DESI_WMIN/2)
+        self.assertLessEqual(grid[-1], stack.DESI_WMAX)
+        self.assertTrue(np.allclose(np.diff(grid), 2.0))
+
+        grid = rest_grid([0.5], wmin=1000, wmax=2000, dw=10)
+        self.assertEqual(len(grid), 101)
+
+        with self.assertRaises(ValueError):
+            rest_grid([0.5], wmin=2000, wmax=1000)
+        with self.assertRaises(ValueError):
+            rest_grid([0.0, 5.0], dw=0.01)   #- too many bins
+
+    def test_resample(self):
+        wave = np.linspace(3600, 5800, 2201)
+        z = np.array([0.0, 0.5, 1.0])
+        flux = np.vstack([np.sin(wave/100 + i) for i in range(3)])
+        ivar = np.ones_like(flux)
+        ivar[1, 1000] = 0
+        grid = np.linspace(1800, 5800, 4001)
+
+        rflux, rivar = resample(wave, flux, ivar, z, grid)
+        for i in range(3):
+            obs = grid*(1+z[i])
+            inside = (obs >= wave[0]) & (obs <= wave[-1])
+            expected = np.interp(obs, wave, flux[i])
+            self.assertTrue(np.all(rivar[i][~inside] == 0))
+            good = rivar[i] > 0
+            self.assertTrue(np.allclose(rflux[i][good], expected[good]))
+            if i != 1:
+                self.assertTrue(np.all(good == inside))
+
+        #- bins next to the masked pixel have no data
+        obs = grid*1.5
+        near = np.abs(obs - wave[1000]) < 1
+        self.assertTrue(np.any(near))
+        self.assertTrue(np.all(rivar[1][near] == 0))
+
+    def test_mean_median(self):
+        grid = np.arange(100.0)
+        flux = np.array([np.full(100, 1.0), np.full(100, 2.0), np.full(100, 6.0)])
+        ivar = np.array([np.full(100, 1.0), np.full(100, 1.0), np.full(100, 2.0)])
+        ivar[2, 50:] = 0
+
+        with Stacker(grid, 'mean') as s:
+            s.add(flux[0:2], ivar[0:2])
+            s.add(flux[2:], ivar[2:])
+            t = s.result()
+        self.assertTrue(np.allclose(t['FLUX'][0:50], (1+2+12)/4))
+        self.assertTrue(np.allclose(t['FLUX'][50:], 1.5))
+        self.assertTrue(np.allclose(t['IVAR'][0:50], 4))
+        self.assertEqual(list(t['NSPEC'][[0, 99]]), [3, 2])
+        self.assertEqual(t.meta['NSTACK'], 3)
+
+        with Stacker(grid, 'median', maxspec=3) as s:
+            s.add(flux[0:1], ivar[0:1])
+            s.add(flux[1:], ivar[1:])
+            t = s.result()
+        self.assertTrue(np.allclose(t['FLUX'][0:50], 2.0))
+        self.assertTrue(np.allclose(t['FLUX'][50:], 1.5))
+
+        with self.assertRaises(ValueError):
+            Stacker(grid, 'mode')
+
+    def test_norm(self):
+        grid = np.arange(100.0)
+        flux = np.array([np.full(100, 2.0), np.full(100, 8.0), np.full(100, 1.0)])
+        ivar = np.ones_like(flux)
+        ivar[2, 0:20] = 0   #- no coverage in normalization window
+
+        with Stacker(grid, 'mean', norm=(0, 10)) as s:
+            s.add(flux, ivar)
+            t = s.result()
+        self.assertTrue(np.allclose(t['FLUX'], 1.0))
+        self.assertEqual(t.meta['NSTACK'], 2)
+        self.assertEqual(t.meta['NSKIPPED'], 1)
+
+    def test_add_spectra(self):
+        #- two cameras overlapping in 5000-5100 are combined weighted by ivar
+        wave = dict(b=np.linspace(4000, 5100, 1101), r=np.linspace(5000, 6000, 1001))
+        nspec = stack.CHUNK_SIZE + 10
+        flux = dict(b=np.full((nspec, 1101), 1.0), r=np.full((nspec, 1001), 3.0))
+        ivar = dict(b=np.full((nspec, 1101), 1.0), r=np.full((nspec, 1001), 1.0))
+        mask = dict(b=np.zeros((nspec, 1101), dtype=int), r=np.zeros((nspec, 1001), dtype=int))
+        spectra = FakeSpectra(wave, flux, ivar, mask)
+
+        grid = np.arange(2000.0, 3000.0, 5)
+        with Stacker(grid, 'mean') as s:
+            s.add_spectra(spectra, np.ones(nspec))
+            t = s.result()
+
+        self.assertEqual(t.meta['NSTACK'], nspec)
+        rest = t['WAVE']
+        self.assertTrue(np.allclose(t['FLUX'][(rest > 2010) & (rest < 2490)], 1.0))
+        self.assertTrue(np.allclose(t['FLUX'][(rest > 2510) & (rest < 2540)], 2.0))
+        self.assertTrue(np.allclose(t['FLUX'][(rest > 2560) & (rest < 2990)], 3.0))
+
+if __name__ == '__main__':
+    unittest.main()
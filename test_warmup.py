@@ -0,0 +1,138 @@
+"""
+Test inspector.warmup ranking and replay of logged queries
+"""
+
+import os
+import gzip
+import json
+import tempfile
+import unittest
+from collections import Counter
+
+from flask import Flask, Response
+
+from inspector import warmup
+
+LOG_LINES = [
+    '1.2.3.4 - - [19/Oct/2026:10:00:00 +0000] "GET /dr1/targets/radec/210,5,30?format=csv HTTP/1.1" 200 123 "-" "curl"',
+    '1.2.3.4 - - [19/Oct/2026:10:00:01 +0000] "GET /iron/targets/radec/210,5,30 HTTP/1.1" 200 456 "-" "firefox"',
+    '1.2.3.4 - - [19/Oct/2026:10:00:02 +0000] "GET /iron/targets/radec/210,5,30/ HTTP/1.1" 304 0 "-" "firefox"',
+    '1.2.3.4 - - [19/Oct/2026:10:00:03 +0000] "GET /dr1/spectra/39627908959964170?model=1&format=bin HTTP/1.1" 200 9 "-" "x"',
+    '1.2.3.4 - - [19/Oct/2026:10:00:04 +0000] "GET /dr1/spectra/39627908959964170?format=html&model=1 HTTP/1.1" 200 9 "-" "x"',
+    '1.2.3.4 - - [19/Oct/2026:10:00:05 +0000] "GET /dr1/spectra/39627908959964170?model=1 HTTP/1.1" 200 9 "-" "x"',
+    '1.2.3.4 - - [19/Oct/2026:10:00:06 +0000] "GET /loa/targets/1,2 HTTP/1.1" 401 9 "-" "x"',
+    '1.2.3.4 - - [19/Oct/2026:10:00:07 +0000] "GET /about HTTP/1.1" 200 9 "-" "x"',
+    '1.2.3.4 - - [19/Oct/2026:10:00:08 +0000] "POST /dr1/crossmatch HTTP/1.1" 200 9 "-" "x"',
+    'garbage',
+]
+
+class TestWarmup(unittest.TestCase):
+
+    def test_normalize_query(self):
+        key = '/iron/targets/radec/210,5,30?SPECTYPE=QSO&Z=gt%3A2'
+        self.assertEqual(warmup.normalize_query('/dr1/targets/radec/210,5,30?Z=gt:2&format=json&SPECTYPE=QSO'), key)
+        self.assertEqual(warmup.normalize_query('/iron/targets/radec/210,5,30/?SPECTYPE=QSO&Z=gt:2'), key)
+        self.assertEqual(warmup.normalize_query('/compare/loa,dr1/spectra/1,2?format=progressive'),
+                         '/compare/loa,iron/spectra/1,2')
+        self.assertEqual(warmup.normalize_query('/loa/query?ZWARN=0'), '/loa/query?ZWARN=0')
+        for path in ('/', '/about', '/assets/bokeh.js', '/internal/stats', '/iron/jobs/abc', '/compare/iron/targets/1'):
+            self.assertIsNone(warmup.normalize_query(path), path)
+
+        self.assertEqual(warmup.replay_path('/iron/spectra/1,2?model=1'), '/iron/spectra/1,2?model=1&format=bin')
+        self.assertEqual(warmup.replay_path('/iron/targets/1,2'), '/iron/targets/1,2?format=json')
+        self.assertEqual(warmup.replay_path('/compare/iron,loa/spectra/1,2'), '/compare/iron,loa/spectra/1,2')
+
+    def test_parse_logs(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            with open(f'{tmpdir}/access.log', 'w') as fp:
+                fp.write('\n'.join(LOG_LINES[0:5]) + '\n')
+            with gzip.open(f'{tmpdir}/access.log.1.gz', 'wt') as fp:
+                fp.write('\n'.join(LOG_LINES[5:]) + '\n')
+
+            counts = warmup.parse_logs(f'{tmpdir}/access.log*, {tmpdir}/missing.log')
+
+        self.assertEqual(counts, Counter({'/iron/spectra/39627908959964170?model=1': 3,
+                                          '/iron/targets/radec/210,5,30': 3}))
+
+        examples = warmup.example_queries()
+        self.assertIn('/iron/targets/radec/210,5,30', examples)
+        self.assertIn('/iron/targets/tiles/150/0:1000?SPECTYPE=QSO&Z=gt%3A2.1', examples)
+        self.assertEqual(len(examples), len(set(examples)))
+
+        keys = warmup.rank_queries(counts, ['/fuji/targets/radec/210,5,30', '/iron/targets/radec/210,5,30'], top=5)
+        self.assertEqual(len(keys), 3)
+        self.assertEqual(keys[-1], '/fuji/targets/radec/210,5,30')
+        self.assertEqual(len(warmup.rank_queries(counts, examples, top=4)), 4)
+
+    def test_warm(self):
+        counts = Counter({'/iron/targets/1': 6, '/iron/targets/2': 3, '/loa/targets/3': 1})
+        fetched = list()
+        def fetch(path):
+            fetched.append(path)
+            return 401 if path.startswith('/loa') else 200
+
+        report = warmup.warm(fetch, list(counts) + ['/fuji/targets/4'], counts=counts, duty=1.0)
+        self.assertEqual(fetched[0], '/iron/targets/1?format=json')
+        self.assertEqual(report['nlogged'], 10)
+        self.assertEqual(report['nwarmed'], 3)
+        self.assertEqual(report['nfailed'], 1)
+        self.assertEqual(report['nskipped'], 0)
+        self.assertAlmostEqual(report['coverage'], 0.9)
+
+        #- nothing new is started once the time budget is used
+        report = warmup.warm(fetch, list(counts), counts=counts, seconds=-1)
+        self.assertEqual(report['nskipped'], 3)
+        self.assertEqual(report['coverage'], 0.0)
+
+    def test_wsgi_fetcher(self):
+        app = Flask(__name__)
+        read = list()
+
+        @app.route('/iron/spectra/<targetids>')
+        def spectra(targetids):
+            def generate():
+                for i in range(3):
+                    read.append(i)
+                    yield str(i)
+            return Response(generate())
+
+        fetch = warmup.wsgi_fetcher(app)
+        self.assertEqual(fetch('/iron/spectra/1?format=bin'), 200)
+        self.assertEqual(read, [0, 1, 2])
+        self.assertEqual(fetch('/blat'), 404)
+
+    def test_collect_reports(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            warmup._write_report(dict(pid=os.getpid(), nwarmed=1), report_dir=tmpdir)
+            stale = os.path.join(tmpdir, '999999999.json')
+            with open(stale, 'w') as fp:
+                json.dump(dict(pid=999999999), fp)
+
+            reports = warmup.collect_reports(tmpdir)
+            self.assertEqual(reports, [dict(pid=os.getpid(), nwarmed=1)])
+            self.assertFalse(os.path.exists(stale))
+
+    @unittest.skipUnless(hasattr(os, 'setpriority'), 'needs per-thread priorities')
+    def test_pool_priority(self):
+        import threading
+        from inspector import sharedread
+
+        if sharedread.MP_START_METHOD != 'forkserver':
+            self.skipTest('pool processes are not started by a forkserver')
+
+        sharedread.start_forkserver()
+
+        #- a pool created by the lower priority replay thread still gets processes at normal priority
+        niceness = list()
+        def replay():
+            warmup._lower_priority(os.nice(0) + 5)
+            with sharedread.process_pool(1) as pool:
+                niceness.append(pool.submit(os.nice, 0).result())
+
+        thread = threading.Thread(target=replay)
+        thread.start()
+        thread.join()
+        self.assertEqual(niceness, [os.nice(0)])
+
+if __name__ == '__main__':
+    unittest.main()
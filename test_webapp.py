@@ -7,6 +7,7 @@ from astropy.table import Table
 import numpy as np
 
 from app import app
+from inspector.auth import reload_credentials
 
 #- Utility to temporarily override environment variables while safely cleaning up
 #- Written by LBL CBorg Coder AI
@@ -81,8 +82,10 @@ class FlaskAppTestCase(unittest.TestCase):
                         self.assertEqual(response.status_code, 401, errmsg)
 
         #- successful authorization with fake credentials
+        #- (credentials are loaded once, so reload after changing them)
         with TempEnvironmentVariable('DESI_COLLAB_USERNAME', 'blat'):
             with TempEnvironmentVariable('DESI_COLLAB_PASSWORD', 'foo'):
+                reload_credentials()
                 #- success
                 auth_bytes = "blat:foo".encode('utf-8')
                 base64_bytes = base64.b64encode(auth_bytes)
@@ -99,6 +102,8 @@ class FlaskAppTestCase(unittest.TestCase):
                 response = self.app.get('/dr2/targets/tiles/7614/1500-1503', headers=headers)
                 self.assertEqual(response.status_code, 401)
 
+        reload_credentials()
+
 
 
     #---------------------------------------------------------------------
@@ -273,6 +278,57 @@ class FlaskAppTestCase(unittest.TestCase):
         self.assertIn('SUBTYPE', colnames)
         self.assertIn('FLUX_R', colnames)
 
+    def test_crossmatch(self):
+        #- crossmatch two positions against the targets of a cone search
+        t1 = self.get_table('/dr1/targets/radec/210,5,30?format=csv')
+        csv = f'ra,dec,radius\n{t1["TARGET_RA"][0]},{t1["TARGET_DEC"][0]},1\n0,0,1\n'
+        response = self.app.post('/dr1/crossmatch?format=csv&xcol=FLUX_R',
+                                 data=dict(positions=(BytesIO(csv.encode()), 'positions.csv')))
+        self.assertEqual(response.status_code, 200)
+        t2 = Table.read(BytesIO(response.get_data()), format='csv')
+        self.assertIn(t1['TARGETID'][0], t2['TARGETID'])
+        self.assertTrue(np.all(t2['INPUT_ROW'] == 0))
+        self.assertTrue(np.all(t2['SEPARATION'] <= 1))
+        self.assertIn('FLUX_R', t2.colnames)
+
+        #- bad upload and bad column
+        response = self.app.post('/dr1/crossmatch', data=b'x,y\n1,2\n')
+        self.assertEqual(response.status_code, 400)
+        response = self.app.post('/dr1/crossmatch?xcol=BLAT', data=csv.encode())
+        self.assertEqual(response.status_code, 400)
+
+    def test_stack(self):
+        t = self.get_table('/dr1/stack/radec/210,5,30?format=csv&dw=5')
+        self.assertEqual(t.colnames, ['WAVE', 'FLUX', 'IVAR', 'NSPEC'])
+        self.assertTrue(np.allclose(np.diff(t['WAVE']), 5, atol=1e-3))
+        self.assertGreater(np.max(t['NSPEC']), 0)
+
+        t = self.get_table('/dr1/stack/radec/210,5,30?format=csv&method=median&wmin=2000&wmax=4000&norm=3000,3500')
+        self.assertEqual(t['WAVE'][0], 2000)
+
+        response = self.app.get('/dr1/stack/radec/210,5,30?method=mode')
+        self.assertEqual(response.status_code, 400)
+        response = self.app.get('/dr1/stack/radec/210,5,30?dw=0.0001')
+        self.assertEqual(response.status_code, 400)
+
+    def test_compare(self):
+        t = self.get_table('/compare/edr,dr1/targets/radec/210,5,30?format=csv')
+        for col in ('TARGETID', 'TARGET_RA', 'Z_FUJI', 'Z_IRON', 'ZWARN_FUJI', 'SPECTYPE_IRON'):
+            self.assertIn(col, t.colnames)
+
+        t = self.get_table('/compare/dr1,edr/targets/tiles/radec/210,5,30?format=csv&dedup=zwarn')
+        self.assertEqual(len(t), len(np.unique(t['TARGETID'])))
+
+        response = self.app.get('/compare/dr1,edr/spectra/radec/210,5,30')
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(b'addBatchBase64', response.data)
+        self.assertIn('no-store', response.headers['Cache-Control'])
+
+        for url in ('/compare/dr1/targets/radec/210,5,30', '/compare/dr1,dr1/targets/radec/210,5,30',
+                    '/compare/dr1,edr/spectra/radec/210,5,30?format=fits'):
+            response = self.app.get(url)
+            self.assertEqual(response.status_code, 400, url)
+
     def test_targets_extra_column_filters(self):
         #- confirm that filtering on a column adds it to the list of columns
         baseurl = '/dr1/targets/tiles/150/0-500?format=csv'
@@ -285,6 +341,42 @@ class FlaskAppTestCase(unittest.TestCase):
         self.assertTrue(np.all(t2['DELTACHI2']>25))
 
 
+    def test_targets_dedup(self):
+        t1 = self.get_table('/dr1/targets/tiles/radec/210,5,300?format=csv')
+        t2 = self.get_table('/dr1/targets/tiles/radec/210,5,300?format=csv&dedup=tsnr2')
+        self.assertEqual(len(t2), len(np.unique(t1['TARGETID'])))
+        self.assertIn('TSNR2_LRG', t2.colnames)
+
+        response = self.app.get('/dr1/targets/tiles/radec/210,5,300?dedup=zwarn')
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(b'duplicate rows', response.data)
+
+        response = self.app.get('/dr1/targets/tiles/radec/210,5,300?dedup=blat')
+        self.assertEqual(response.status_code, 400)
+
+    def test_http_cache(self):
+        #- released productions get an ETag and can be revalidated with 304
+        url = '/dr1/targets/radec/210,5,30?format=csv'
+        response = self.app.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('public', response.headers['Cache-Control'])
+        etag = response.headers['ETag']
+
+        response = self.app.get(url, headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.headers['ETag'], etag)
+
+        #- ETag doesn't depend upon order of options, but does on their values
+        response = self.app.get('/dr1/targets/radec/210,5,30?format=csv&Z=gt:0.5&ZWARN=0')
+        response2 = self.app.get('/dr1/targets/radec/210,5,30?ZWARN=0&Z=gt:0.5&format=csv')
+        self.assertEqual(response.headers['ETag'], response2.headers['ETag'])
+        self.assertNotEqual(response.headers['ETag'], etag)
+
+        #- errors aren't cached
+        response = self.app.get('/dr1/targets/radec/210,100,10', headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 400)
+        self.assertNotIn('ETag', response.headers)
+
     #---------------------------------------------------------------------
     #- Spectra
     #- slower, so less complete coverage of all matrix options
@@ -304,6 +396,12 @@ class FlaskAppTestCase(unittest.TestCase):
         response = self.app.get('/dr1/spectra/radec/210,5,30?format=fits')
         self.assertEqual(response.status_code, 200)
 
+        #- progressive pages are streamed, so read errors can't change the status and aren't cached
+        response = self.app.get('/dr1/spectra/radec/210,5,30?format=progressive')
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('no-store', response.headers['Cache-Control'])
+        self.assertNotIn('ETag', response.headers)
+
         #- plotting with noise model
         response = self.app.get('/dr1/spectra/radec/210,5,30?plotnoise=1')
         self.assertEqual(response.status_code, 200)
@@ -378,5 +476,27 @@ class FlaskAppTestCase(unittest.TestCase):
         response = self.app.get('/dr1/spectra/99999/0,2,3?format=fits')
         self.assertEqual(response.status_code, 404)
 
+    def test_spectra_jobs(self):
+        #- too many spectra to view, but fits download becomes a background job
+        response = self.app.get('/dr1/spectra/tiles/1000/0:2000?format=fits')
+        self.assertEqual(response.status_code, 202)
+        job = response.get_json()
+        self.assertIn('jobid', job)
+
+        response = self.app.get(f"/dr1/jobs/{job['jobid']}")
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(response.get_json()['status'], ('queued', 'running', 'done'))
+
+        #- job IDs are per-production
+        response = self.app.get(f"/edr/jobs/{job['jobid']}")
+        self.assertEqual(response.status_code, 404)
+
+        #- malformed and unknown job IDs
+        response = self.app.get('/dr1/jobs/blatfoo')
+        self.assertEqual(response.status_code, 400)
+
+        response = self.app.get('/dr1/jobs/00000000000000000000000000000000/download')
+        self.assertEqual(response.status_code, 404)
+
 if __name__ == '__main__':
     unittest.main()